@@ -0,0 +1,48 @@
+"""
+Management command to recompute AttendanceSummary rows from Attendance.
+Use it to backfill summaries for historical attendance; day-to-day marking
+keeps summaries current on its own.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School, Term
+from attendance.services import AttendanceSummaryEngine
+
+
+class Command(BaseCommand):
+    help = 'Recompute attendance summaries per term with set-based aggregation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only refresh summaries for this school',
+        )
+        parser.add_argument(
+            '--term-id',
+            type=int,
+            help='Only refresh summaries for this term',
+        )
+
+    def handle(self, *args, **options):
+        schools = School.objects.all()
+        if options.get('school_id'):
+            schools = schools.filter(id=options['school_id'])
+            if not schools.exists():
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        total = 0
+        for school in schools:
+            terms = Term.objects.filter(school=school)
+            if options.get('term_id'):
+                terms = terms.filter(id=options['term_id'])
+            written = AttendanceSummaryEngine.refresh_school(school, terms=terms)
+            unmatched = AttendanceSummaryEngine.unmatched_dates(school)
+            self.stdout.write(f'{school.name}: {written} summary row(s) written')
+            if unmatched:
+                self.stdout.write(self.style.WARNING(
+                    f'  {len(unmatched)} attendance date(s) fall outside every term and were not summarised'
+                ))
+            total += written
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} attendance summary row(s).'))
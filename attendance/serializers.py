@@ -45,6 +45,19 @@ class AttendanceSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
+class AttendanceRegisterEntrySerializer(serializers.Serializer):
+    student_id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=Attendance.ATTENDANCE_STATUS_CHOICES, default='present')
+    remarks = serializers.CharField(required=False, allow_blank=True, default='')
+
+
+class AttendanceRegisterSerializer(serializers.Serializer):
+    """Payload of the bulk_mark action: one date and class, many students"""
+    date = serializers.DateField(required=False)
+    class_id = serializers.IntegerField(required=False, allow_null=True)
+    students = AttendanceRegisterEntrySerializer(many=True, allow_empty=False)
+
+
 class AttendanceSummarySerializer(serializers.ModelSerializer):
     student = StudentSerializer(read_only=True)
     student_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
@@ -1,10 +1,300 @@
 """
 Service classes for attendance module business logic
 """
-from django.db.models import Count, Q
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q
 from django.utils import timezone
+from decimal import Decimal, ROUND_HALF_UP
 from .models import Attendance, AttendanceSummary
 from core.models import Student, Term
+from core.term_calendar import TermCalendar
+
+
+def _percentage(days_present, total_days):
+    if not total_days:
+        return Decimal('0')
+    return (Decimal(days_present) / Decimal(total_days) * 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+class AttendanceSummaryEngine:
+    """
+    Set-based AttendanceSummary maintenance.
+
+    Status counts for a term come from one conditional-aggregate GROUP BY over
+    the term's date range, and summaries are written with a single upsert.
+    ``refresh`` can be limited to the students whose attendance changed.
+    """
+
+    BATCH_SIZE = 1000
+
+    @staticmethod
+    def refresh(school, term, student_ids=None):
+        """
+        Recompute attendance summaries for a term
+
+        Args:
+            school: School instance
+            term: Term instance
+            student_ids: Optional iterable of student ids to refresh; when None,
+                every active student gets a summary (zero counts if no attendance)
+
+        Returns:
+            Dict with created and updated counts
+        """
+        if student_ids is not None:
+            target_ids = {int(student_id) for student_id in student_ids}
+        else:
+            target_ids = set(
+                Student.objects.filter(school=school, is_active=True).values_list('id', flat=True)
+            )
+        if not target_ids:
+            return {'created': 0, 'updated': 0}
+
+        attendances = Attendance.objects.filter(
+            school=school,
+            date__gte=term.start_date,
+            date__lte=term.end_date,
+        )
+        if student_ids is not None:
+            attendances = attendances.filter(student_id__in=target_ids)
+        else:
+            attendances = attendances.filter(student__is_active=True)
+
+        counts = {
+            row['student_id']: row
+            for row in attendances.values('student_id').annotate(
+                total_days=Count('id'),
+                days_present=Count('id', filter=Q(status='present')),
+                days_absent=Count('id', filter=Q(status='absent')),
+                days_late=Count('id', filter=Q(status='late')),
+                days_excused=Count('id', filter=Q(status='excused')),
+            ).order_by()
+        }
+
+        summaries = []
+        for student_id in target_ids:
+            row = counts.get(student_id, {})
+            total_days = row.get('total_days', 0)
+            days_present = row.get('days_present', 0)
+            summaries.append(AttendanceSummary(
+                school=school,
+                student_id=student_id,
+                term=term,
+                total_days=total_days,
+                days_present=days_present,
+                days_absent=row.get('days_absent', 0),
+                days_late=row.get('days_late', 0),
+                days_excused=row.get('days_excused', 0),
+                attendance_percentage=_percentage(days_present, total_days),
+            ))
+
+        existing = AttendanceSummary.objects.filter(school=school, term=term)
+        if student_ids is not None:
+            existing = existing.filter(student_id__in=target_ids)
+        existing_ids = set(existing.values_list('student_id', flat=True))
+
+        AttendanceSummary.objects.bulk_create(
+            summaries,
+            batch_size=AttendanceSummaryEngine.BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['school', 'student', 'term'],
+            update_fields=[
+                'total_days', 'days_present', 'days_absent', 'days_late',
+                'days_excused', 'attendance_percentage', 'updated_at',
+            ],
+        )
+        created = len(target_ids - existing_ids)
+        return {'created': created, 'updated': len(summaries) - created}
+
+    @staticmethod
+    def refresh_for_dates(school, student_ids, dates):
+        """
+        Refresh the summaries of the given students for every term covering any of the dates
+
+        Returns:
+            Number of summaries written
+        """
+        dates = set(dates)
+        student_ids = {int(student_id) for student_id in student_ids}
+        if not dates or not student_ids:
+            return 0
+        written = 0
+        for term in TermCalendar.for_school(school).terms:
+            if any(term.start_date <= d <= term.end_date for d in dates):
+                result = AttendanceSummaryEngine.refresh(school, term, student_ids=student_ids)
+                written += result['created'] + result['updated']
+        return written
+
+    @staticmethod
+    def refresh_school(school, terms=None):
+        """
+        Refresh summaries of all active students for each of the school's
+        terms (all terms when None)
+
+        Returns:
+            Number of summaries written
+        """
+        if terms is None:
+            terms = Term.objects.filter(school=school)
+        written = 0
+        for term in terms:
+            with transaction.atomic():
+                result = AttendanceSummaryEngine.refresh(school, term)
+            written += result['created'] + result['updated']
+        return written
+
+    @staticmethod
+    def unmatched_dates(school):
+        """Distinct attendance dates that don't fall within any of the school's terms"""
+        covering_terms = Term.objects.filter(
+            school=school,
+            start_date__lte=OuterRef('date'),
+            end_date__gte=OuterRef('date'),
+        )
+        return list(
+            Attendance.objects.filter(school=school).exclude(
+                Exists(covering_terms)
+            ).values_list('date', flat=True).distinct().order_by('date')
+        )
+
+
+class AttendanceRegisterError(ValueError):
+    """A register failed validation; ``errors`` lists every problem found"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__('; '.join(self.errors))
+
+
+class AttendanceRegisterService:
+    """
+    Bulk attendance marking for a class register.
+
+    The whole register is validated up front (one query for the term, one for
+    the students), then written with a single INSERT ... ON CONFLICT upsert on
+    (school, student, date). The touched students' summaries are refreshed in
+    the same transaction, so a register is saved with a fixed number of
+    queries however many learners it has.
+    """
+
+    BATCH_SIZE = 1000
+    STATUSES = {choice for choice, _ in Attendance.ATTENDANCE_STATUS_CHOICES}
+
+    @staticmethod
+    def validate(school, attendance_date, entries, class_id=None):
+        """
+        Check a register and normalise its entries
+
+        Args:
+            school: School instance
+            attendance_date: date being marked
+            entries: Iterable of dicts with student_id, and optionally status
+                (default 'present') and remarks
+            class_id: Optional SchoolClass id recorded on every row
+
+        Returns:
+            List of dicts with int student_id, status and remarks
+
+        Raises:
+            AttendanceRegisterError listing every invalid entry
+        """
+        from core.models import SchoolClass
+
+        errors = []
+        rows = []
+        seen = set()
+        for index, entry in enumerate(entries, start=1):
+            try:
+                student_id = int(entry.get('student_id'))
+            except (TypeError, ValueError):
+                errors.append(f'Entry {index}: invalid student id {entry.get("student_id")!r}')
+                continue
+            status = entry.get('status') or 'present'
+            if status not in AttendanceRegisterService.STATUSES:
+                errors.append(f'Entry {index}: invalid status {status!r}')
+            if student_id in seen:
+                errors.append(f'Entry {index}: student {student_id} appears more than once')
+            seen.add(student_id)
+            rows.append({
+                'student_id': student_id,
+                'status': status,
+                'remarks': (entry.get('remarks') or '').strip(),
+            })
+
+        if not rows and not errors:
+            errors.append('No students selected.')
+
+        if TermCalendar.for_school(school).term_for(attendance_date) is None:
+            errors.append(
+                f'{attendance_date.strftime("%B %d, %Y")} does not fall within any term\'s date range.'
+            )
+
+        if class_id:
+            if not str(class_id).isdigit() or not SchoolClass.objects.filter(school=school, id=class_id).exists():
+                errors.append(f'Class {class_id} not found.')
+
+        if seen:
+            known = set(Student.objects.filter(school=school, id__in=seen).values_list('id', flat=True))
+            unknown = sorted(seen - known)
+            if unknown:
+                errors.append(f'Students not found: {", ".join(str(student_id) for student_id in unknown)}')
+
+        if errors:
+            raise AttendanceRegisterError(errors)
+        return rows
+
+    @staticmethod
+    def save(school, attendance_date, entries, user=None, class_id=None):
+        """
+        Validate and upsert a register, refreshing the affected summaries
+
+        Args:
+            school: School instance
+            attendance_date: date being marked
+            entries: Iterable of dicts with student_id, status and remarks
+            user: User recorded as marked_by
+            class_id: Optional SchoolClass id
+
+        Returns:
+            Dict with created, updated and summaries (number of summaries written)
+
+        Raises:
+            AttendanceRegisterError when the register is invalid; nothing is written
+        """
+        rows = AttendanceRegisterService.validate(school, attendance_date, entries, class_id=class_id)
+        student_ids = [row['student_id'] for row in rows]
+        now = timezone.now()
+
+        with transaction.atomic():
+            # Only used for the created/updated counts; the upsert itself is race-free
+            existing = set(Attendance.objects.filter(
+                school=school, date=attendance_date, student_id__in=student_ids
+            ).values_list('student_id', flat=True))
+
+            Attendance.objects.bulk_create(
+                [
+                    Attendance(
+                        school=school,
+                        student_id=row['student_id'],
+                        school_class_id=class_id or None,
+                        date=attendance_date,
+                        status=row['status'],
+                        remarks=row['remarks'],
+                        marked_by=user,
+                        created_at=now,
+                        updated_at=now,
+                    )
+                    for row in rows
+                ],
+                batch_size=AttendanceRegisterService.BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['school', 'student', 'date'],
+                update_fields=['school_class', 'status', 'remarks', 'marked_by', 'updated_at'],
+            )
+            summaries = AttendanceSummaryEngine.refresh_for_dates(school, student_ids, [attendance_date])
+
+        created = len(set(student_ids) - existing)
+        return {'created': created, 'updated': len(rows) - created, 'summaries': summaries}
 
 
 class AttendanceService:
@@ -16,57 +306,17 @@ class AttendanceService:
         Update or create attendance summary for a student in a term.
         This should be called whenever attendance is marked or updated.
         """
-        attendances = Attendance.objects.filter(
-            school=student.school,
-            student=student,
-            date__gte=term.start_date,
-            date__lte=term.end_date
-        )
-        
-        total_days = attendances.count()
-        days_present = attendances.filter(status='present').count()
-        days_absent = attendances.filter(status='absent').count()
-        days_late = attendances.filter(status='late').count()
-        days_excused = attendances.filter(status='excused').count()
-        
-        attendance_percentage = (days_present / total_days * 100) if total_days > 0 else 0
-        
-        summary, created = AttendanceSummary.objects.update_or_create(
-            school=student.school,
-            student=student,
-            term=term,
-            defaults={
-                'total_days': total_days,
-                'days_present': days_present,
-                'days_absent': days_absent,
-                'days_late': days_late,
-                'days_excused': days_excused,
-                'attendance_percentage': attendance_percentage,
-            }
-        )
-        
-        return summary
+        AttendanceSummaryEngine.refresh(student.school, term, student_ids=[student.id])
+        return AttendanceSummary.objects.filter(
+            school=student.school, student=student, term=term
+        ).first()
     
     @staticmethod
     def generate_summaries_for_term(school, term):
         """
         Generate attendance summaries for all active students in a term.
         """
-        students = Student.objects.filter(school=school, is_active=True)
-        created_count = 0
-        
-        for student in students:
-            # Check if summary exists before updating
-            existing = AttendanceSummary.objects.filter(
-                school=school,
-                student=student,
-                term=term
-            ).exists()
-            summary = AttendanceService.update_attendance_summary(student, term)
-            if not existing:
-                created_count += 1
-        
-        return created_count
+        return AttendanceSummaryEngine.refresh(school, term)['created']
     
     @staticmethod
     def get_student_attendance_stats(student, term=None):
@@ -85,11 +335,18 @@ class AttendanceService:
                 date__lte=term.end_date
             )
         
-        total_days = attendances.count()
-        days_present = attendances.filter(status='present').count()
-        days_absent = attendances.filter(status='absent').count()
-        days_late = attendances.filter(status='late').count()
-        days_excused = attendances.filter(status='excused').count()
+        counts = attendances.aggregate(
+            total_days=Count('id'),
+            days_present=Count('id', filter=Q(status='present')),
+            days_absent=Count('id', filter=Q(status='absent')),
+            days_late=Count('id', filter=Q(status='late')),
+            days_excused=Count('id', filter=Q(status='excused')),
+        )
+        total_days = counts['total_days']
+        days_present = counts['days_present']
+        days_absent = counts['days_absent']
+        days_late = counts['days_late']
+        days_excused = counts['days_excused']
         
         attendance_percentage = (days_present / total_days * 100) if total_days > 0 else 0
         
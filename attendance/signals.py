@@ -4,8 +4,7 @@ Signals for attendance module
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from .models import Attendance
-from .services import AttendanceService
-from core.models import Term
+from .services import AttendanceSummaryEngine
 
 
 @receiver(post_save, sender=Attendance)
@@ -13,16 +12,9 @@ def update_attendance_summary_on_save(sender, instance, created, **kwargs):
     """
     Automatically update attendance summary when attendance is saved.
     """
-    # Find the term that this attendance date falls within
-    # Don't filter by is_active - we want to update summaries for all terms
-    term = Term.objects.filter(
-        school=instance.school,
-        start_date__lte=instance.date,
-        end_date__gte=instance.date
-    ).first()
-    
-    if term:
-        AttendanceService.update_attendance_summary(instance.student, term)
+    # Refresh the summary of every term this date falls within
+    # (not only active terms)
+    AttendanceSummaryEngine.refresh_for_dates(instance.school, [instance.student_id], [instance.date])
 
 
 @receiver(post_delete, sender=Attendance)
@@ -30,14 +22,4 @@ def update_attendance_summary_on_delete(sender, instance, **kwargs):
     """
     Automatically update attendance summary when attendance is deleted.
     """
-    # Find the term that this attendance date falls within
-    # Don't filter by is_active - we want to update summaries for all terms
-    term = Term.objects.filter(
-        school=instance.school,
-        start_date__lte=instance.date,
-        end_date__gte=instance.date
-    ).first()
-    
-    if term:
-        AttendanceService.update_attendance_summary(instance.student, term)
-
+    AttendanceSummaryEngine.refresh_for_dates(instance.school, [instance.student_id], [instance.date])
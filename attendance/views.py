@@ -10,8 +10,10 @@ from django.contrib import messages
 from django.core.paginator import Paginator
 from datetime import date, timedelta, datetime
 from .models import Attendance, AttendanceSummary
-from .serializers import AttendanceSerializer, AttendanceSummarySerializer
+from .services import AttendanceRegisterError, AttendanceRegisterService, AttendanceSummaryEngine
+from .serializers import AttendanceRegisterSerializer, AttendanceSerializer, AttendanceSummarySerializer
 from core.models import Student, Term, SchoolClass
+from core.term_calendar import TermCalendar
 
 
 class AttendanceViewSet(viewsets.ModelViewSet):
@@ -56,41 +58,27 @@ class AttendanceViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'])
     def bulk_mark(self, request):
-        """Bulk mark attendance for multiple students"""
+        """Bulk mark attendance for a register of students with a single upsert"""
         school = request.user.profile.school
-        date_str = request.data.get('date', str(timezone.now().date()))
-        class_id = request.data.get('class_id')
-        students_data = request.data.get('students', [])
+        serializer = AttendanceRegisterSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
         
-        created_count = 0
-        updated_count = 0
-        
-        for student_data in students_data:
-            student_id = student_data.get('student_id')
-            status_val = student_data.get('status', 'present')
-            remarks = student_data.get('remarks', '')
-            
-            attendance, created = Attendance.objects.update_or_create(
-                school=school,
-                student_id=student_id,
-                date=date_str,
-                defaults={
-                    'status': status_val,
-                    'remarks': remarks,
-                    'marked_by': request.user,
-                    'school_class_id': class_id,
-                }
+        try:
+            result = AttendanceRegisterService.save(
+                school,
+                data.get('date') or timezone.now().date(),
+                data['students'],
+                user=request.user,
+                class_id=data.get('class_id'),
             )
-            
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+        except AttendanceRegisterError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response({
-            'message': f'Attendance marked for {len(students_data)} students',
-            'created': created_count,
-            'updated': updated_count
+            'message': f'Attendance marked for {len(data["students"])} students',
+            'created': result['created'],
+            'updated': result['updated']
         })
 
     @action(detail=False, methods=['get'])
@@ -168,46 +156,14 @@ class AttendanceSummaryViewSet(viewsets.ModelViewSet):
             return Response({'error': 'term_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         
         term = Term.objects.get(id=term_id, school=school)
-        students = Student.objects.filter(school=school, is_active=True)
-        
-        created_count = 0
-        
-        for student in students:
-            attendances = Attendance.objects.filter(
-                school=school,
-                student=student,
-                date__gte=term.start_date,
-                date__lte=term.end_date
-            )
-            
-            total_days = attendances.count()
-            days_present = attendances.filter(status='present').count()
-            days_absent = attendances.filter(status='absent').count()
-            days_late = attendances.filter(status='late').count()
-            days_excused = attendances.filter(status='excused').count()
-            
-            attendance_percentage = (days_present / total_days * 100) if total_days > 0 else 0
-            
-            summary, created = AttendanceSummary.objects.update_or_create(
-                school=school,
-                student=student,
-                term=term,
-                defaults={
-                    'total_days': total_days,
-                    'days_present': days_present,
-                    'days_absent': days_absent,
-                    'days_late': days_late,
-                    'days_excused': days_excused,
-                    'attendance_percentage': attendance_percentage,
-                }
-            )
-            
-            if created:
-                created_count += 1
+        result = AttendanceSummaryEngine.refresh(school, term)
+        created_count = result['created']
         
         return Response({
             'message': f'Generated attendance summaries for {created_count} students',
-            'term': term.name
+            'term': term.name,
+            'created': created_count,
+            'updated': result['updated'],
         })
 
 
@@ -284,11 +240,7 @@ def attendance_edit(request, attendance_id):
             messages.warning(request, 'Invalid date format. Using original date.')
         
         # Validate that the attendance date falls within a term's date range
-        matching_term = Term.objects.filter(
-            school=school,
-            start_date__lte=attendance_date,
-            end_date__gte=attendance_date
-        ).first()
+        matching_term = TermCalendar.for_school(school).term_for(attendance_date)
         
         if not matching_term:
             messages.error(
@@ -345,11 +297,7 @@ def attendance_edit(request, attendance_id):
             pass
     
     # Check if date is valid
-    matching_term = Term.objects.filter(
-        school=school,
-        start_date__lte=date_to_check,
-        end_date__gte=date_to_check
-    ).first()
+    matching_term = TermCalendar.for_school(school).term_for(date_to_check)
     
     date_valid = matching_term is not None
     
@@ -415,11 +363,7 @@ def mark_attendance(request):
             messages.warning(request, f'Invalid date format. Using today\'s date: {attendance_date}')
         
         # Validate that the attendance date falls within a term's date range
-        matching_term = Term.objects.filter(
-            school=school,
-            start_date__lte=attendance_date,
-            end_date__gte=attendance_date
-        ).first()
+        matching_term = TermCalendar.for_school(school).term_for(attendance_date)
         
         if not matching_term:
             messages.error(
@@ -434,29 +378,29 @@ def mark_attendance(request):
                 redirect_url += f"&class_id={class_id}"
             return redirect(redirect_url)
         
-        created_count = 0
-        updated_count = 0
+        entries = [
+            {
+                'student_id': student_id,
+                'status': statuses[i] if i < len(statuses) else 'present',
+                'remarks': remarks_list[i] if i < len(remarks_list) else '',
+            }
+            for i, student_id in enumerate(students_data)
+        ]
         
-        for i, student_id in enumerate(students_data):
-            status_val = statuses[i] if i < len(statuses) else 'present'
-            remarks = remarks_list[i] if i < len(remarks_list) else ''
-            
-            attendance, created = Attendance.objects.update_or_create(
-                school=school,
-                student_id=student_id,
-                date=attendance_date,
-                defaults={
-                    'status': status_val,
-                    'remarks': remarks,
-                    'marked_by': request.user,
-                    'school_class_id': class_id if class_id else None,
-                }
+        # One upsert for the whole register; summaries are refreshed in the same transaction
+        try:
+            result = AttendanceRegisterService.save(
+                school, attendance_date, entries, user=request.user, class_id=class_id or None
             )
-            
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+        except AttendanceRegisterError as e:
+            for error in e.errors:
+                messages.error(request, error)
+            redirect_url = f"{reverse('attendance:mark_attendance')}?date={date_str}"
+            if class_id:
+                redirect_url += f"&class_id={class_id}"
+            return redirect(redirect_url)
+        created_count = result['created']
+        updated_count = result['updated']
         
         messages.success(request, f'Attendance marked for {len(students_data)} students ({created_count} new, {updated_count} updated)')
         # Redirect to attendance list page
@@ -493,11 +437,7 @@ def mark_attendance(request):
     
     # Check if the selected date falls within any term's date range
     # Note: We check all terms, not just active ones, to allow attendance for any term period
-    matching_term = Term.objects.filter(
-        school=school,
-        start_date__lte=attendance_date,
-        end_date__gte=attendance_date
-    ).first()
+    matching_term = TermCalendar.for_school(school).term_for(attendance_date)
     
     date_valid = matching_term is not None
     
@@ -548,40 +488,14 @@ def mark_attendance(request):
 
 @login_required
 def attendance_summary(request):
-    """View attendance summaries - auto-generates summaries if missing"""
+    """View attendance summaries"""
     school = request.user.profile.school
-    from .services import AttendanceService
     from .models import Attendance
     
-    # Auto-generate summaries for student-term combinations that have attendance
-    # Get all attendance records and find their corresponding terms
-    attendance_records = Attendance.objects.filter(school=school).select_related('student')
-    
-    # Track attendance records that don't match any term
-    unmatched_attendance = []
-    
-    # Process each attendance record to ensure summaries are created/updated
-    processed_combinations = set()
-    for attendance in attendance_records:
-        # Find which term this attendance belongs to
-        term = Term.objects.filter(
-            school=school,
-            start_date__lte=attendance.date,
-            end_date__gte=attendance.date
-        ).first()
-        
-        if term:
-            key = (attendance.student_id, term.id)
-            if key not in processed_combinations:
-                try:
-                    student = Student.objects.get(id=attendance.student_id, school=school, is_active=True)
-                    AttendanceService.update_attendance_summary(student, term)
-                    processed_combinations.add(key)
-                except Student.DoesNotExist:
-                    continue
-        else:
-            # Track attendance that doesn't match any term
-            unmatched_attendance.append(attendance.date)
+    # Summaries are kept current when attendance is marked, edited or deleted
+    # (see attendance.signals and AttendanceSummaryEngine), so this page only
+    # reads them. Attendance outside every term can't be summarised; list those dates.
+    unmatched_attendance = AttendanceSummaryEngine.unmatched_dates(school)
     
     summaries = AttendanceSummary.objects.filter(school=school).select_related(
         'student', 'term'
@@ -606,7 +520,7 @@ def attendance_summary(request):
     students_list = Student.objects.filter(school=school, is_active=True).order_by('first_name')
     
     # Get unique unmatched dates for display
-    unmatched_dates = sorted(set(unmatched_attendance)) if unmatched_attendance else []
+    unmatched_dates = unmatched_attendance
     
     # Check if all summaries have 0 days (meaning no attendance matches term dates)
     all_zero = all(summary.total_days == 0 for summary in page_obj) if page_obj else False
@@ -618,7 +532,7 @@ def attendance_summary(request):
         'term_id': term_id,
         'student_id': student_id,
         'unmatched_dates': unmatched_dates,
-        'has_attendance': attendance_records.exists(),
+        'has_attendance': Attendance.objects.filter(school=school).exists(),
         'all_zero': all_zero,
     }
     return render(request, 'attendance/attendance_summary.html', context)
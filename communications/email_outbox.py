@@ -0,0 +1,330 @@
+"""
+Email outbox
+
+Bulk emails are written as EmailMessage rows with status ``queued`` and
+sent by a background drain instead of inside the request:
+
+- ``queue_emails`` bulk-creates the rows and schedules a drain job.
+- ``drain`` claims queued rows in batches (SELECT ... FOR UPDATE SKIP LOCKED,
+  so concurrent drains never pick the same row), sends each batch over one
+  reused backend connection, throttled to EMAIL_OUTBOX_RATE_PER_SECOND, and
+  records the outcome with bulk updates.
+- Failed sends are retried with exponential backoff up to
+  EMAIL_OUTBOX_MAX_ATTEMPTS before the row is marked failed.
+
+A claimed row is leased until ``next_attempt_at`` and claiming counts as an
+attempt; if a worker dies mid-batch the lease expires and the row is picked
+up again, or marked failed if that was its last attempt.
+"""
+
+from dataclasses import dataclass
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage as DjangoEmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+import logging
+import time
+
+from core import job_queue
+from .models import EmailMessage, CommunicationLog
+
+logger = logging.getLogger(__name__)
+
+# Seconds a claimed batch may stay in 'sending' before another drain may retry it
+SENDING_LEASE_SECONDS = 15 * 60
+
+# Attachments stored under this prefix belong to the outbox and are deleted once
+# sent; anything else (e.g. cached statement PDFs) is left alone
+TEMPORARY_ATTACHMENT_PREFIX = 'outbox/'
+
+
+@dataclass
+class OutgoingEmail:
+    """An email to queue for one recipient"""
+    student: object
+    recipient_email: str
+    subject: str
+    content: str
+    template: object = None
+    attachment_path: str = ''
+    attachment_name: str = ''
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def queue_emails(school, emails, sent_by=None, schedule_drain=True):
+    """
+    Write emails to the outbox and schedule a drain job
+
+    Args:
+        school: School the emails belong to
+        emails: Iterable of OutgoingEmail
+        sent_by: User who requested the emails
+        schedule_drain: Enqueue a drain_email_outbox job for the school
+
+    Returns:
+        Tuple of (queued_count, drain_job or None)
+    """
+    now = timezone.now()
+    rows = [
+        EmailMessage(
+            school=school,
+            template=email.template,
+            student=email.student,
+            recipient_email=email.recipient_email,
+            subject=email.subject[:200],
+            content=email.content,
+            status='queued',
+            next_attempt_at=now,
+            attachment_path=email.attachment_path,
+            attachment_name=email.attachment_name,
+            sent_by=sent_by,
+        )
+        for email in emails
+    ]
+    EmailMessage.objects.bulk_create(rows, batch_size=500)
+
+    job = None
+    if rows and schedule_drain:
+        job = schedule_outbox_drain(school, user=sent_by)
+    return len(rows), job
+
+
+def schedule_outbox_drain(school, user=None, run_after=None):
+    """Enqueue a background job that drains the school's outbox"""
+    return job_queue.enqueue(
+        'drain_email_outbox', {}, school=school, user=user, max_attempts=1, run_after=run_after
+    )
+
+
+def ensure_outbox_drain(school):
+    """Schedule a drain for the school's next due email, unless a drain is already queued"""
+    from core.models import Job
+
+    run_after = next_due_at(school)
+    if run_after is None or Job.objects.filter(
+        job_type='drain_email_outbox', school=school, status='queued'
+    ).exists():
+        return None
+    return schedule_outbox_drain(school, run_after=run_after)
+
+
+def _claim_batch(school, batch_size, max_attempts):
+    """
+    Lease up to batch_size due rows for this drain
+
+    Claiming counts as an attempt, so a message whose send crashes or hangs
+    the worker is retried only until its lease has expired max_attempts
+    times.
+
+    Returns:
+        Tuple of (claimed rows, rows failed because their lease expired on
+        the last attempt)
+    """
+    now = timezone.now()
+    due = EmailMessage.objects.filter(
+        Q(status='queued') | Q(status='sending'),
+        next_attempt_at__lte=now,
+    )
+    if school is not None:
+        due = due.filter(school=school)
+    with transaction.atomic():
+        due_rows = list(
+            due.order_by('next_attempt_at', 'id').select_for_update(skip_locked=True).values_list(
+                'id', 'status', 'attempts'
+            )[:batch_size]
+        )
+        ids = [pk for pk, status, attempts in due_rows if status == 'queued' or attempts < max_attempts]
+        expired_ids = [pk for pk, status, attempts in due_rows if status == 'sending' and attempts >= max_attempts]
+        if expired_ids:
+            EmailMessage.objects.filter(id__in=expired_ids).update(
+                status='failed', next_attempt_at=None, error_message='Sending did not finish before the lease expired'
+            )
+        if ids:
+            EmailMessage.objects.filter(id__in=ids).update(
+                status='sending',
+                attempts=F('attempts') + 1,
+                next_attempt_at=now + timedelta(seconds=SENDING_LEASE_SECONDS),
+            )
+    claimed = list(EmailMessage.objects.filter(id__in=ids).select_related('student').order_by('id'))
+    expired = list(EmailMessage.objects.filter(id__in=expired_ids)) if expired_ids else []
+    return claimed, expired
+
+
+def _build_message(row, connection, attachments):
+    message = DjangoEmailMessage(
+        subject=row.subject,
+        body=row.content,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[row.recipient_email],
+        connection=connection,
+    )
+    if row.attachment_path:
+        content = attachments.get(row.attachment_path)
+        if content is None:
+            with default_storage.open(row.attachment_path, 'rb') as f:
+                content = f.read()
+            attachments[row.attachment_path] = content
+        message.attach(row.attachment_name or row.attachment_path.rsplit('/', 1)[-1], content, 'application/pdf')
+    return message
+
+
+def _send_batch(rows, throttle):
+    """
+    Send a batch over one connection
+
+    Returns:
+        Tuple of (sent_rows, [(row, error_message), ...])
+    """
+    sent = []
+    failed = []
+    attachments = {}
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        return sent, [(row, f'Connection error: {str(e)}') for row in rows]
+    try:
+        for row in rows:
+            throttle()
+            try:
+                # One message per call so each failure is attributed to its row;
+                # the connection stays open for the whole batch
+                if connection.send_messages([_build_message(row, connection, attachments)]):
+                    sent.append(row)
+                else:
+                    failed.append((row, 'Email backend reported no messages sent'))
+            except Exception as e:
+                logger.error(f'Error sending queued email {row.id} to {row.recipient_email}: {str(e)}')
+                failed.append((row, str(e)))
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return sent, failed
+
+
+def _record_results(sent, failed, max_attempts):
+    now = timezone.now()
+    with transaction.atomic():
+        if sent:
+            EmailMessage.objects.filter(id__in=[row.id for row in sent]).update(
+                status='sent', sent_at=now, error_message='', next_attempt_at=None
+            )
+            CommunicationLog.objects.bulk_create([
+                CommunicationLog(
+                    school_id=row.school_id,
+                    student_id=row.student_id,
+                    communication_type='email',
+                    template_id=row.template_id,
+                    email_message=row,
+                    sent_by_id=row.sent_by_id,
+                )
+                for row in sent
+            ], batch_size=500)
+
+        for row, error in failed:
+            # attempts was counted when the row was claimed
+            row.error_message = error
+            if row.attempts >= max_attempts:
+                row.status = 'failed'
+                row.next_attempt_at = None
+            else:
+                row.status = 'queued'
+                row.next_attempt_at = now + timedelta(seconds=job_queue.retry_delay(row.attempts))
+        if failed:
+            EmailMessage.objects.bulk_update(
+                [row for row, _ in failed], ['error_message', 'status', 'next_attempt_at']
+            )
+
+
+def _cleanup_attachments(rows):
+    """Delete temporary attachment files no longer needed by any unsent email"""
+    paths = {
+        row.attachment_path for row in rows
+        if row.attachment_path and row.attachment_path.startswith(TEMPORARY_ATTACHMENT_PREFIX)
+    }
+    if not paths:
+        return
+    pending = set(
+        EmailMessage.objects.filter(
+            attachment_path__in=paths, status__in=['queued', 'sending']
+        ).values_list('attachment_path', flat=True)
+    )
+    for path in paths - pending:
+        try:
+            default_storage.delete(path)
+        except Exception as e:
+            logger.warning(f'Could not delete email attachment {path}: {str(e)}')
+
+
+def drain(school=None, max_batches=None, progress=None):
+    """
+    Send due queued emails
+
+    Args:
+        school: Only drain this school's outbox (all schools when None)
+        max_batches: Stop after this many batches (drain until empty when None)
+        progress: Optional callable(sent, failed) called after each batch
+
+    Returns:
+        Dict with sent, failed (permanently), retrying counts and the
+        earliest next_attempt_at of unsent rows (``next_due_at``)
+    """
+    batch_size = max(1, _setting('EMAIL_OUTBOX_BATCH_SIZE', 50))
+    max_attempts = max(1, _setting('EMAIL_OUTBOX_MAX_ATTEMPTS', 3))
+    rate = _setting('EMAIL_OUTBOX_RATE_PER_SECOND', 5)
+    interval = 1.0 / rate if rate and rate > 0 else 0
+    last_send = [0.0]
+
+    def throttle():
+        if interval:
+            wait = last_send[0] + interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            last_send[0] = time.monotonic()
+
+    totals = {'sent': 0, 'failed': 0, 'retrying': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        rows, expired = _claim_batch(school, batch_size, max_attempts)
+        if expired:
+            totals['failed'] += len(expired)
+            _cleanup_attachments(expired)
+        if not rows:
+            if expired:
+                continue
+            break
+        batches += 1
+        sent, failed = _send_batch(rows, throttle)
+        _record_results(sent, failed, max_attempts)
+        _cleanup_attachments(rows)
+
+        totals['sent'] += len(sent)
+        for row, _ in failed:
+            if row.status == 'failed':
+                totals['failed'] += 1
+            else:
+                totals['retrying'] += 1
+        if progress is not None:
+            progress(totals['sent'], totals['failed'])
+
+    totals['next_retry_at'] = next_due_at(school)
+    return totals
+
+
+def next_due_at(school=None):
+    """
+    When the next unsent email becomes due: a queued row's retry time or a
+    sending row's lease expiry (its drain may have died)
+    """
+    rows = EmailMessage.objects.filter(status__in=['queued', 'sending'], next_attempt_at__isnull=False)
+    if school is not None:
+        rows = rows.filter(school=school)
+    return rows.order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first()
@@ -0,0 +1,112 @@
+"""
+Background job handlers for the communications app
+"""
+from core.job_queue import register_job, register_stale_handler
+
+
+@register_job('bulk_estatement_email')
+def bulk_estatement_email_job(ctx):
+    """Email PDF statements to the parents of the selected students"""
+    from datetime import date
+    from django.contrib.auth.models import User
+    from core.models import School
+    from .views import send_bulk_estatements
+
+    payload = ctx.payload
+    school = School.objects.get(pk=ctx.school_id)
+    sent_by = User.objects.filter(jobs__pk=ctx.job_id).first()
+    start_date = date.fromisoformat(payload['start_date']) if payload.get('start_date') else None
+    end_date = date.fromisoformat(payload['end_date']) if payload.get('end_date') else None
+
+    try:
+        result = send_bulk_estatements(
+            school=school,
+            student_ids=payload.get('student_ids', []),
+            start_date=start_date,
+            end_date=end_date,
+            encrypt=payload.get('encrypt_pdf', False),
+            password=payload.get('pdf_password', ''),
+            email_subject=payload.get('subject', 'Fee Statement'),
+            email_content=payload.get('content', 'Please find attached your fee statement.'),
+            sent_by=sent_by,
+            ctx=ctx,
+        )
+    finally:
+        # Never leave the PDF password sitting in the jobs table
+        ctx.redact('pdf_password')
+
+    ctx.progress(len(payload.get('student_ids', [])), len(payload.get('student_ids', [])), 'Done')
+    return result
+
+
+@register_job('bulk_sms')
+def bulk_sms_job(ctx):
+    """Send a personalised SMS to the parents of the selected students"""
+    from django.contrib.auth.models import User
+    from core.models import School
+    from .models import CommunicationTemplate
+    from .sms_dispatcher import BulkSMSDispatcher
+
+    payload = ctx.payload
+    school = School.objects.get(pk=ctx.school_id)
+    sent_by = User.objects.filter(jobs__pk=ctx.job_id).first()
+    template = None
+    if payload.get('template_id'):
+        template = CommunicationTemplate.objects.filter(school=school, id=payload['template_id']).first()
+
+    dispatcher = BulkSMSDispatcher(school, template=template, sent_by=sent_by)
+    ctx.progress(0, None, 'Preparing messages', force=True)
+    result = dispatcher.dispatch(
+        payload.get('student_ids', []),
+        payload.get('content', ''),
+        progress=lambda done, total: ctx.progress(done, total, f'Sent {done} of {total} SMS'),
+    )
+    ctx.progress(1, 1, 'Done')
+    return result
+
+
+@register_job('drain_email_outbox')
+def drain_email_outbox_job(ctx):
+    """Send the school's queued emails over reused connections (see communications.email_outbox)"""
+    from core.models import School
+    from .email_outbox import drain, ensure_outbox_drain
+
+    school = School.objects.get(pk=ctx.school_id)
+    ctx.progress(0, None, 'Sending queued emails', force=True)
+    try:
+        result = drain(
+            school,
+            progress=lambda sent, failed: ctx.progress(sent, None, f'Sent {sent} email(s), {failed} failed'),
+        )
+    finally:
+        # Come back for emails waiting on a retry or a lease expiry, even if this drain failed
+        ensure_outbox_drain(school)
+    result.pop('next_retry_at')
+
+    ctx.progress(1, 1, 'Done')
+    return result
+
+
+@register_stale_handler('drain_email_outbox')
+@register_stale_handler('bulk_estatement_email')
+def drain_email_outbox_abandoned(school_id):
+    """A drain whose worker died leaves its batch leased; drain again when the lease expires"""
+    from core.models import School
+    from .email_outbox import ensure_outbox_drain
+
+    school = School.objects.filter(pk=school_id).first()
+    if school is not None:
+        ensure_outbox_drain(school)
+
+
+@register_job('send_payment_receipt')
+def send_payment_receipt_job(ctx):
+    """Email/SMS the receipt for a payment posted outside a request (e.g. an M-Pesa callback)"""
+    from receivables.models import Payment
+    from .services import CommunicationService
+
+    payment = Payment.objects.select_related(
+        'student', 'student_fee__fee_category', 'student_fee__term'
+    ).get(pk=ctx.payload['payment_id'], school_id=ctx.school_id)
+    results = CommunicationService().send_payment_receipt(payment)
+    return {channel: bool(sent) for channel, sent in results.items()}
@@ -0,0 +1,40 @@
+"""
+Management command to send queued outbox emails.
+The drain_email_outbox background job normally does this; the command is
+useful from cron or to flush the outbox by hand.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School
+from communications.email_outbox import drain
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails from the outbox over reused connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only send queued emails for this school',
+        )
+        parser.add_argument(
+            '--max-batches',
+            type=int,
+            help='Stop after this many batches',
+        )
+
+    def handle(self, *args, **options):
+        school = None
+        if options.get('school_id'):
+            try:
+                school = School.objects.get(id=options['school_id'])
+            except School.DoesNotExist:
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        result = drain(school, max_batches=options.get('max_batches'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Sent {result["sent"]} email(s); {result["failed"]} failed, {result["retrying"]} waiting for retry.'
+        ))
+        if result['next_retry_at']:
+            self.stdout.write(f'Next retry due at {result["next_retry_at"]:%Y-%m-%d %H:%M:%S}.')
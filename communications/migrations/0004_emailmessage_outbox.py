@@ -0,0 +1,42 @@
+# Generated by Django 5.2.3 on 2026-10-16 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communications', '0003_add_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailmessage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('bounced', 'Bounced')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When a queued email may next be sent (lease expiry while sending)', null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='attachment_path',
+            field=models.CharField(blank=True, help_text='Storage path of a file to attach when sending', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='attachment_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='email_msg_st_next_idx'),
+        ),
+    ]
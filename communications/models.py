@@ -66,6 +66,8 @@ class EmailMessage(models.Model):
     """Model for email message logs"""
     STATUS_CHOICES = [
         ('pending', 'Pending'),
+        ('queued', 'Queued'),
+        ('sending', 'Sending'),
         ('sent', 'Sent'),
         ('failed', 'Failed'),
         ('bounced', 'Bounced'),
@@ -83,6 +85,11 @@ class EmailMessage(models.Model):
     payment_reminder = models.ForeignKey(PaymentReminder, on_delete=models.SET_NULL, null=True, blank=True)
     payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True)
     sent_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    # Outbox delivery (see communications.email_outbox)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True, help_text='When a queued email may next be sent (lease expiry while sending)')
+    attachment_path = models.CharField(max_length=500, blank=True, help_text='Storage path of a file to attach when sending')
+    attachment_name = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -117,6 +124,7 @@ class EmailMessage(models.Model):
             models.Index(fields=['school', 'status', 'created_at'], name='email_msg_sch_st_crt_idx'),
             models.Index(fields=['student', 'status'], name='email_msg_stu_st_idx'),
             models.Index(fields=['status', 'created_at'], name='email_msg_st_crt_idx'),
+            models.Index(fields=['status', 'next_attempt_at'], name='email_msg_st_next_idx'),
         ]
 
 
@@ -3,7 +3,9 @@ from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
 import re
+import threading
 from .models import EmailMessage, SMSMessage, CommunicationTemplate, CommunicationLog
 from core.models import Student
 from receivables.models import Payment, PaymentReminder
@@ -11,6 +13,28 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+_sms_session = None
+_sms_session_lock = threading.Lock()
+
+
+def get_sms_session():
+    """
+    Shared requests.Session for SMS gateway calls, so connections (and TLS
+    handshakes) are reused across messages instead of opened per request
+    """
+    global _sms_session
+    if _sms_session is None:
+        with _sms_session_lock:
+            if _sms_session is None:
+                pool_size = max(1, getattr(settings, 'SMS_DISPATCH_CONCURRENCY', 4))
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                _sms_session = session
+    return _sms_session
+
 
 class EmailService:
     """Service class for email communications"""
@@ -240,6 +264,7 @@ class SMSService:
         self.api_key = settings.CELCOM_API_KEY
         self.partner_id = settings.CELCOM_PARTNER_ID
         self.shortcode = settings.CELCOM_SHORTCODE
+        self.timeout = getattr(settings, 'SMS_HTTP_TIMEOUT', 15)
         
         # Celcom Africa API return codes and descriptions
         self.api_codes = {
@@ -260,6 +285,35 @@ class SMSService:
             4093: "Details Not Found"
         }
     
+    def build_payload(self, formatted_phone, content, client_sms_id=None):
+        """Celcom Africa JSON payload for a single message"""
+        payload = {
+            "partnerID": str(self.partner_id),
+            "apikey": self.api_key,
+            "mobile": formatted_phone,
+            "message": content,
+            "shortcode": self.shortcode,
+            "pass_type": "plain"
+        }
+        if client_sms_id is not None:
+            payload["clientsmsid"] = client_sms_id
+        return payload
+    
+    def parse_recipient_response(self, recipient):
+        """
+        Interpret one entry of a Celcom Africa "responses" list
+        
+        Returns:
+            Tuple of (succeeded, message_id, error_message)
+        """
+        # Celcom spells the key "respose-code" in some responses
+        response_code = recipient.get("respose-code") or recipient.get("response-code")
+        response_description = recipient.get("response-description", "Unknown")
+        message_id = recipient.get("messageid") or ''
+        if response_code == 200 or (response_code is None and str(response_description).lower() == "success"):
+            return True, str(message_id), ''
+        return False, str(message_id), self.api_codes.get(response_code, response_description)
+    
     def validate_phone_number(self, phone_number):
         """
         Validate and format phone number for Celcom Africa (expected: 254xxxxxxxxxx)
@@ -316,21 +370,10 @@ class SMSService:
                 return False
             
             # Construct the JSON payload for Celcom Africa
-            payload = {
-                "partnerID": str(self.partner_id),
-                "apikey": self.api_key,
-                "mobile": formatted_phone,
-                "message": content,
-                "shortcode": self.shortcode,
-                "pass_type": "plain"
-            }
-
-            headers = {
-                "Content-Type": "application/json"
-            }
+            payload = self.build_payload(formatted_phone, content)
 
-            # Send the POST request to Celcom Africa
-            response = requests.post(self.api_url, json=payload, headers=headers)
+            # Send the POST request to Celcom Africa over the shared session
+            response = get_sms_session().post(self.api_url, json=payload, timeout=self.timeout)
             response.raise_for_status()
 
             # Parse the JSON response
@@ -340,12 +383,10 @@ class SMSService:
             # Check if the SMS was sent successfully
             if result.get("responses"):
                 recipient = result["responses"][0]
-                response_code = recipient.get("respose-code") or recipient.get("response-code")
-                response_description = recipient.get("response-description", "Unknown")
-                message_id = recipient.get("messageid")
+                succeeded, message_id, error_message = self.parse_recipient_response(recipient)
 
                 # Update SMS tracker
-                if response_code == 200 or (response_code is None and response_description.lower() == "success"):
+                if succeeded:
                     # Get school from student if available, otherwise from template
                     school = student.school if student else (template.school if template else None)
                     if not school and student:
@@ -382,8 +423,7 @@ class SMSService:
                     logger.info(f"SMS sent successfully to {formatted_phone}, Message ID: {message_id}")
                     return True
                 else:
-                    error_message = self.api_codes.get(response_code, response_description)
-                    logger.error(f"SMS failed with response code {response_code}: {error_message}")
+                    logger.error(f"SMS to {formatted_phone} failed: {error_message}")
                     
                     # Log failed SMS
                     if student:
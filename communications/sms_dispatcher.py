@@ -0,0 +1,304 @@
+"""
+Bulk SMS dispatch
+
+Sends one personalised message to the parents of many students:
+
+1. Messages are rendered up front (two queries for all students and parents)
+   and phone numbers are normalised and de-duplicated.
+2. Messages go to Celcom Africa in multi-message batches (``sendbulk``) over
+   the shared connection-pooled session, with bounded concurrency and a
+   request rate limit. When CELCOM_URL_SENDBULK is not configured each
+   message is posted to ``sendsms`` instead, still over the pooled session.
+3. SMSMessage and CommunicationLog rows are written with bulk_create.
+
+HTTP calls never touch the database, so they run on worker threads while
+all writes happen on the calling thread. URLs and limits can be passed to
+the constructor, e.g. to point the dispatcher at a local stub server.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+import logging
+import threading
+import time
+import requests
+
+from .models import SMSMessage, CommunicationLog
+from .services import SMSService, get_sms_session
+
+logger = logging.getLogger(__name__)
+
+
+class _SafeDict(dict):
+    """Leave unknown {placeholders} in the message as-is"""
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+@dataclass
+class OutgoingSMS:
+    """One message to one phone number"""
+    student: object
+    recipient_phone: str
+    formatted_phone: str
+    content: str
+    client_sms_id: str
+    status: str = 'pending'
+    error_message: str = ''
+    message_id: str = ''
+    sent_at: object = None
+
+
+class RateLimiter:
+    """Spaces out calls so no more than ``rate`` start per second (thread-safe)"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class BulkSMSDispatcher:
+    """Render, batch, send and record a bulk SMS blast"""
+
+    def __init__(self, school, template=None, sent_by=None, send_url=None, bulk_url=None,
+                 batch_size=None, concurrency=None, rate_per_second=None, session=None):
+        self.school = school
+        self.template = template
+        self.sent_by = sent_by
+        self.sms_service = SMSService()
+        if send_url is not None:
+            self.sms_service.api_url = send_url
+        self.bulk_url = bulk_url if bulk_url is not None else getattr(settings, 'CELCOM_URL_SENDBULK', '')
+        self.batch_size = max(1, batch_size or getattr(settings, 'SMS_BULK_BATCH_SIZE', 20))
+        self.concurrency = max(1, concurrency or getattr(settings, 'SMS_DISPATCH_CONCURRENCY', 4))
+        self.rate_limiter = RateLimiter(
+            rate_per_second if rate_per_second is not None
+            else getattr(settings, 'SMS_DISPATCH_RATE_PER_SECOND', 10)
+        )
+        self.session = session or get_sms_session()
+
+    def render(self, student_ids, content):
+        """
+        Build the outgoing messages for the selected students
+
+        Returns:
+            Tuple of (messages, invalid, students_without_phone) where invalid
+            are messages whose phone number could not be normalised
+        """
+        from core.models import Student
+
+        students = Student.objects.filter(
+            school=self.school, id__in=[int(sid) for sid in student_ids]
+        ).select_related('school').prefetch_related('parents')
+
+        outgoing = []
+        invalid = []
+        without_phone = 0
+        seen = set()
+        for student in students:
+            parents = list(student.parents.all())
+            phones = []
+            if student.parent_phone:
+                phones.append(student.parent_phone)
+            phones.extend(parent.phone for parent in parents if parent.phone)
+            if not phones:
+                without_phone += 1
+                continue
+
+            parent_name = parents[0].full_name if parents else student.parent_name
+            personalized_content = self._personalize(content, student, parent_name)
+
+            for phone in phones:
+                formatted_phone = self.sms_service.validate_phone_number(phone)
+                key = (formatted_phone or phone, personalized_content)
+                if key in seen:
+                    # Same number listed twice (e.g. 07... and 2547...), or a
+                    # parent of several students receiving identical text
+                    continue
+                seen.add(key)
+                message = OutgoingSMS(
+                    student=student,
+                    recipient_phone=phone,
+                    formatted_phone=formatted_phone,
+                    content=personalized_content,
+                    client_sms_id=str(len(outgoing) + len(invalid) + 1),
+                )
+                if formatted_phone:
+                    outgoing.append(message)
+                else:
+                    message.status = 'failed'
+                    message.error_message = f"Invalid phone number format: {phone}"
+                    invalid.append(message)
+        return outgoing, invalid, without_phone
+
+    def _personalize(self, content, student, parent_name):
+        context = {
+            'student_name': student.full_name,
+            'parent_name': parent_name,
+            'school_name': self.school.name,
+        }
+        defaults = {'amount': '', 'due_date': '', 'due_name': ''}
+        try:
+            return content.format_map(_SafeDict({**context, **defaults}))
+        except (KeyError, ValueError, IndexError) as e:
+            logger.warning(f'Error replacing placeholders in bulk SMS for student {student.id}: {str(e)}')
+            return content
+
+    def dispatch(self, student_ids, content, progress=None):
+        """
+        Render, send and record a bulk SMS
+
+        Args:
+            student_ids: Ids of the students whose parents receive the message
+            content: Message text with optional {student_name}, {parent_name}, {school_name}
+            progress: Optional callable(sent_so_far, total) for progress reporting
+
+        Returns:
+            Dict with sent, failed and no_phone counts
+        """
+        outgoing, invalid, without_phone = self.render(student_ids, content)
+        self.send(outgoing, progress=progress)
+        self.save(outgoing + invalid)
+
+        sent = sum(1 for message in outgoing if message.status == 'sent')
+        return {
+            'sent': sent,
+            'failed': len(outgoing) - sent + len(invalid),
+            'no_phone': without_phone,
+        }
+
+    def send(self, outgoing, progress=None):
+        """Send messages in batches on a bounded thread pool; updates each message's status"""
+        if not outgoing:
+            return
+        if self.bulk_url:
+            batches = [outgoing[i:i + self.batch_size] for i in range(0, len(outgoing), self.batch_size)]
+            send_batch = self._send_bulk_batch
+        else:
+            batches = [[message] for message in outgoing]
+            send_batch = self._send_single
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(send_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f'Bulk SMS batch failed: {str(e)}')
+                    self._fail(batch, f'Error: {str(e)}')
+                done += len(batch)
+                if progress is not None:
+                    progress(done, len(outgoing))
+
+    def _post(self, url, payload):
+        self.rate_limiter.wait()
+        response = self.session.post(url, json=payload, timeout=self.sms_service.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _send_single(self, batch):
+        message = batch[0]
+        try:
+            result = self._post(
+                self.sms_service.api_url,
+                self.sms_service.build_payload(message.formatted_phone, message.content),
+            )
+        except requests.exceptions.RequestException as e:
+            self._fail(batch, f"Network error: {str(e)}")
+            return
+        responses = result.get("responses") or []
+        if not responses:
+            self._fail(batch, "No recipient data in response")
+            return
+        self._apply_response(message, responses[0])
+
+    def _send_bulk_batch(self, batch):
+        payload = {
+            "count": len(batch),
+            "smslist": [
+                self.sms_service.build_payload(message.formatted_phone, message.content, message.client_sms_id)
+                for message in batch
+            ],
+        }
+        try:
+            result = self._post(self.bulk_url, payload)
+        except requests.exceptions.RequestException as e:
+            self._fail(batch, f"Network error: {str(e)}")
+            return
+
+        responses = result.get("responses") or []
+        by_client_id = {str(r.get("clientsmsid")): r for r in responses if r.get("clientsmsid") is not None}
+        for index, message in enumerate(batch):
+            recipient = by_client_id.get(message.client_sms_id)
+            if recipient is None and not by_client_id and index < len(responses):
+                # Responses without client ids come back in request order
+                recipient = responses[index]
+            if recipient is None:
+                self._fail([message], "No recipient data in response")
+            else:
+                self._apply_response(message, recipient)
+
+    def _apply_response(self, message, recipient):
+        succeeded, message_id, error_message = self.sms_service.parse_recipient_response(recipient)
+        message.message_id = message_id
+        if succeeded:
+            message.status = 'sent'
+            message.sent_at = timezone.now()
+        else:
+            message.status = 'failed'
+            message.error_message = error_message
+
+    @staticmethod
+    def _fail(messages, error_message):
+        for message in messages:
+            if message.status == 'pending':
+                message.status = 'failed'
+                message.error_message = error_message
+
+    def save(self, messages):
+        """Write SMSMessage rows for every message and CommunicationLog rows for sent ones"""
+        if not messages:
+            return
+        with transaction.atomic():
+            rows = SMSMessage.objects.bulk_create([
+                SMSMessage(
+                    school=self.school,
+                    template=self.template,
+                    student=message.student,
+                    recipient_phone=message.formatted_phone or message.recipient_phone[:15],
+                    content=message.content,
+                    status='failed' if message.status == 'pending' else message.status,
+                    sent_at=message.sent_at,
+                    error_message=message.error_message,
+                    twilio_sid=message.message_id,  # Using twilio_sid field to store Celcom message ID
+                    sent_by=self.sent_by,
+                )
+                for message in messages
+            ], batch_size=500)
+            CommunicationLog.objects.bulk_create([
+                CommunicationLog(
+                    school=self.school,
+                    student=row.student,
+                    communication_type='sms',
+                    template=self.template,
+                    sms_message=row,
+                    sent_by=self.sent_by,
+                )
+                for row in rows if row.status == 'sent'
+            ], batch_size=500)
@@ -0,0 +1,222 @@
+"""
+E-statement rendering pipeline
+
+WeasyPrint takes seconds of CPU per statement, so bulk statement runs:
+
+- fingerprint every student's statement inputs (the student row with its
+  grade and class, school, date range, statement date, and the count and
+  latest ``updated_at`` of their fees and payments) with one student query
+  and two grouped queries;
+- reuse a cached PDF from default storage when the fingerprint is unchanged,
+  so reruns and re-sends skip unchanged statements;
+- render the remaining statements in parallel in a ProcessPoolExecutor of
+  STATEMENT_RENDER_WORKERS processes and store them in the cache.
+
+Cached PDFs are unencrypted; password protection is applied to the cached
+bytes afterwards (see ``StatementRenderer.pdf_bytes``).
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+from django.utils import timezone
+import hashlib
+import logging
+import multiprocessing
+
+from core import job_queue
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_CACHE_DIR = 'statement_cache'
+
+
+def _cache_path(school_id, student_id, digest):
+    return f'{STATEMENT_CACHE_DIR}/{school_id}/{student_id}/{digest}.pdf'
+
+
+def _store(path, pdf_bytes):
+    """
+    Save a rendered PDF at its cache path and drop older versions for the student
+
+    Unencrypted outbox emails attach the cached PDF directly, so versions
+    still attached to a queued or sending email are kept; they are pruned by
+    a later render once the email has gone.
+    """
+    from .models import EmailMessage
+
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(pdf_bytes))
+    directory, name = path.rsplit('/', 1)
+    try:
+        _, files = default_storage.listdir(directory)
+    except (NotImplementedError, OSError):
+        return
+    stale_paths = {f'{directory}/{stale}' for stale in files if stale != name}
+    if not stale_paths:
+        return
+    stale_paths -= set(
+        EmailMessage.objects.filter(
+            attachment_path__in=stale_paths, status__in=['queued', 'sending']
+        ).values_list('attachment_path', flat=True)
+    )
+    for stale_path in stale_paths:
+        try:
+            default_storage.delete(stale_path)
+        except Exception:
+            pass
+
+
+def render_to_cache(school_id, student_id, start_date, end_date, path):
+    """
+    Render one statement and store it at ``path``
+
+    Module-level so it can be submitted to a process pool.
+
+    Returns:
+        The cache path
+    """
+    from core.models import School, Student
+    from .views import generate_student_statement_pdf
+
+    school = School.objects.get(pk=school_id)
+    student = Student.objects.get(pk=student_id, school=school)
+    pdf_bytes = generate_student_statement_pdf(
+        student=student, school=school, start_date=start_date, end_date=end_date
+    )
+    _store(path, pdf_bytes)
+    return path
+
+
+class StatementRenderer:
+    """Render (or reuse cached) statement PDFs for many students of a school"""
+
+    def __init__(self, school, start_date=None, end_date=None, workers=None):
+        self.school = school
+        self.start_date = start_date
+        self.end_date = end_date
+        self.workers = max(1, workers or getattr(settings, 'STATEMENT_RENDER_WORKERS', 2))
+
+    def fingerprints(self, student_ids):
+        """
+        Content hash of each student's statement inputs
+
+        Returns:
+            Dict of student_id -> hex digest
+        """
+        from core.models import Student, StudentFee
+        from receivables.models import Payment
+
+        student_ids = [int(sid) for sid in student_ids]
+        # The statement header prints the student's details and grade and class names
+        students = {
+            row['id']: row
+            for row in Student.objects.filter(school=self.school, id__in=student_ids).values(
+                'id', 'updated_at', 'grade__name', 'grade__updated_at', 'school_class__name', 'school_class__updated_at'
+            )
+        }
+        fees = {
+            row['student_id']: row
+            for row in StudentFee.objects.filter(
+                school=self.school, student_id__in=student_ids
+            ).values('student_id').annotate(count=Count('id'), latest=Max('updated_at')).order_by()
+        }
+        payments = {
+            row['student_id']: row
+            for row in Payment.objects.filter(
+                school=self.school, student_id__in=student_ids, status='completed'
+            ).values('student_id').annotate(count=Count('id'), latest=Max('updated_at')).order_by()
+        }
+
+        today = timezone.now().date()
+        digests = {}
+        for student_id in student_ids:
+            fee = fees.get(student_id, {})
+            payment = payments.get(student_id, {})
+            student = students.get(student_id, {})
+            parts = [
+                self.school.id, self.school.updated_at, student_id,
+                student.get('updated_at'), student.get('grade__name'), student.get('grade__updated_at'),
+                student.get('school_class__name'), student.get('school_class__updated_at'),
+                self.start_date, self.end_date, today,
+                fee.get('count', 0), fee.get('latest'),
+                payment.get('count', 0), payment.get('latest'),
+            ]
+            digests[student_id] = hashlib.sha256('|'.join(str(p) for p in parts).encode()).hexdigest()[:32]
+        return digests
+
+    def render_many(self, student_ids, progress=None):
+        """
+        Ensure a cached PDF exists for each student
+
+        Args:
+            student_ids: Students to render
+            progress: Optional callable(done, total)
+
+        Returns:
+            Tuple of (dict student_id -> cache path, dict student_id -> error message)
+        """
+        digests = self.fingerprints(student_ids)
+        paths = {}
+        missing = {}
+        for student_id, digest in digests.items():
+            path = _cache_path(self.school.id, student_id, digest)
+            if default_storage.exists(path):
+                paths[student_id] = path
+            else:
+                missing[student_id] = path
+
+        total = len(digests)
+        done = len(paths)
+        if progress is not None:
+            progress(done, total)
+        logger.info(f'Statement run for {self.school}: {len(paths)} cached, {len(missing)} to render')
+
+        errors = {}
+        if len(missing) > 1 and self.workers > 1:
+            # Spawn (not fork) so render processes never share this process's database connection
+            with ProcessPoolExecutor(
+                max_workers=min(self.workers, len(missing)),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=job_queue.init_worker_process,
+            ) as pool:
+                futures = {
+                    pool.submit(render_to_cache, self.school.id, student_id, self.start_date, self.end_date, path): student_id
+                    for student_id, path in missing.items()
+                }
+                for future in as_completed(futures):
+                    student_id = futures[future]
+                    try:
+                        paths[student_id] = future.result()
+                    except Exception as e:
+                        logger.error(f'Error rendering statement for student {student_id}: {str(e)}')
+                        errors[student_id] = str(e)
+                    done += 1
+                    if progress is not None:
+                        progress(done, total)
+        else:
+            for student_id, path in missing.items():
+                try:
+                    paths[student_id] = render_to_cache(
+                        self.school.id, student_id, self.start_date, self.end_date, path
+                    )
+                except Exception as e:
+                    logger.error(f'Error rendering statement for student {student_id}: {str(e)}')
+                    errors[student_id] = str(e)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+        return paths, errors
+
+    @staticmethod
+    def pdf_bytes(path, encrypt=False, password=None):
+        """Read a cached statement, password-protecting it if requested"""
+        from .views import encrypt_pdf
+
+        with default_storage.open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        if encrypt and password:
+            pdf_bytes = encrypt_pdf(pdf_bytes, password)
+        return pdf_bytes
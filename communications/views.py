@@ -2,21 +2,30 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.paginator import Paginator
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.db.models import Q, Sum
 from django.http import JsonResponse, HttpResponse
 from django.template.loader import render_to_string
+from django.urls import reverse
 from django.utils import timezone
 from .models import CommunicationTemplate, EmailMessage, SMSMessage, CommunicationLog
 from .services import CommunicationService
 from core.models import Student, StudentFee, Grade, SchoolClass, TransportRoute
 from core.decorators import permission_required
+from core.services.statement_ledger import StatementLedger
+from core import job_queue
+from .email_outbox import (
+    OutgoingEmail, TEMPORARY_ATTACHMENT_PREFIX, queue_emails, schedule_outbox_drain, drain as drain_outbox
+)
+from .statement_renderer import StatementRenderer
 from receivables.models import Payment
-from decimal import Decimal
 from datetime import datetime
 import json
 import logging
 import io
 import os
+import uuid
 try:
     from weasyprint import HTML, CSS
     WEASYPRINT_AVAILABLE = True
@@ -586,6 +595,90 @@ def get_template_content(request, template_id):
         }, status=404)
 
 
+def render_bulk_emails(school, student_ids, subject, content, template=None):
+    """
+    Personalise a bulk email for the parents of each student
+
+    Students, parents and fee balances are loaded with three queries for the
+    whole selection. Supported placeholders: {student_name}, {parent_name},
+    {school_name}, {amount}, {due_date} (alias {due_name}).
+
+    Returns:
+        Tuple of (list of email_outbox.OutgoingEmail, number of students without a parent email)
+    """
+    from django.db.models import Min
+    from decimal import Decimal
+    from core.models import StudentFee
+
+    class SafeDict(dict):
+        def __missing__(self, key):
+            # Return the original placeholder if not found
+            return '{' + key + '}'
+
+    students = Student.objects.filter(school=school, id__in=student_ids).prefetch_related('parents', 'parents__user')
+    balances = {
+        row['student_id']: row
+        for row in StudentFee.objects.filter(school=school, student_id__in=student_ids).values('student_id').annotate(
+            charged=Sum('amount_charged'),
+            paid=Sum('amount_paid'),
+            next_due=Min('due_date', filter=Q(is_paid=False)),
+        ).order_by()
+    }
+
+    emails = []
+    without_email = 0
+    for student in students:
+        parents = list(student.parents.all())
+        # Maps email -> Parent object (or None for student.parent_email)
+        email_to_parent = {}
+        if student.parent_email:
+            email_to_parent[student.parent_email] = None
+        for parent in parents:
+            if parent.email:
+                email_to_parent[parent.email] = parent
+            elif parent.user and parent.user.email:
+                email_to_parent[parent.user.email] = parent
+        if not email_to_parent:
+            without_email += 1
+            continue
+
+        balance = balances.get(student.id, {})
+        total_balance = (balance.get('charged') or Decimal('0.00')) - (balance.get('paid') or Decimal('0.00'))
+        amount_str = f"KES {total_balance:,.2f}" if total_balance > 0 else ''
+        due_date_str = balance['next_due'].strftime('%Y-%m-%d') if balance.get('next_due') else ''
+
+        for recipient_email, parent_obj in email_to_parent.items():
+            if parent_obj:
+                parent_name = parent_obj.full_name
+            else:
+                parent_name = parents[0].full_name if parents else student.parent_name
+            student_context = {
+                'student_name': student.full_name,
+                'parent_name': parent_name,
+                'school_name': school.name,
+                'amount': amount_str,
+                'due_date': due_date_str,
+                'due_name': due_date_str,  # Alias for due_date
+            }
+            try:
+                safe_context = SafeDict(student_context)
+                personalized_subject = subject.format_map(safe_context)
+                personalized_content = content.format_map(safe_context)
+            except (KeyError, ValueError, IndexError) as e:
+                # Keep the original text if placeholder replacement fails
+                logger.warning(f'Error replacing placeholders in bulk email to {recipient_email} for student {student.id}: {str(e)}')
+                personalized_subject = subject
+                personalized_content = content
+            emails.append(OutgoingEmail(
+                student=student,
+                recipient_email=recipient_email,
+                subject=personalized_subject,
+                content=personalized_content,
+                template=template,
+            ))
+    return emails, without_email
+
+
 @login_required
 @permission_required('view', 'bulk_email')
 def bulk_email(request):
@@ -673,126 +766,19 @@ def bulk_email(request):
                         # Invalid template_id - ignore it and continue without template
                         pass
                 
-                communication_service = CommunicationService()
-                success_count = 0
-                error_count = 0
-                
-                # Send email to each selected student
-                for student_id in selected_students:
-                    try:
-                        student = Student.objects.prefetch_related('parents', 'parents__user').get(school=school, id=student_id)
-                        
-                        # Collect all recipient emails with their corresponding parent objects
-                        # Use dict to map email to parent for personalization
-                        email_to_parent = {}  # Maps email -> Parent object (or None for student.parent_email)
-                        
-                        # Add student.parent_email if present (no specific parent object)
-                        if student.parent_email:
-                            email_to_parent[student.parent_email] = None
-                        
-                        # Add emails from all linked Parent objects
-                        if student.parents.exists():
-                            for parent in student.parents.all():
-                                if parent.email:
-                                    email_to_parent[parent.email] = parent
-                                elif parent.user.email:
-                                    email_to_parent[parent.user.email] = parent
-                        
-                        # Get student's total balance for {amount} placeholder
-                        from django.db.models import Sum
-                        from decimal import Decimal
-                        from core.models import StudentFee
-                        student_fees = StudentFee.objects.filter(student=student)
-                        total_charged = student_fees.aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-                        total_paid = student_fees.aggregate(total=Sum('amount_paid'))['total'] or Decimal('0.00')
-                        total_balance = total_charged - total_paid
-                        amount_str = f"KES {total_balance:,.2f}" if total_balance > 0 else ''
-                        
-                        # Get earliest due date for {due_date} placeholder
-                        earliest_due_date = student_fees.filter(is_paid=False).order_by('due_date').first()
-                        due_date_str = earliest_due_date.due_date.strftime('%Y-%m-%d') if earliest_due_date else ''
-                        
-                        # Send email to all recipients for this student with personalized content
-                        if email_to_parent:
-                            for recipient_email, parent_obj in email_to_parent.items():
-                                try:
-                                    # Get parent name for this specific recipient
-                                    if parent_obj:
-                                        # Use the specific parent's full name
-                                        parent_name = parent_obj.full_name
-                                    else:
-                                        # Fall back to student.parent_name for student.parent_email
-                                        parent_name = student.parent_name
-                                        # Try to get from first linked parent if available
-                                        if student.parents.exists():
-                                            first_parent = student.parents.first()
-                                            if first_parent:
-                                                parent_name = first_parent.full_name
-                                    
-                                    # Build context for placeholder replacement per recipient
-                                    student_context = {
-                                        'student_name': student.full_name,
-                                        'parent_name': parent_name,
-                                        'school_name': school.name,
-                                        'amount': amount_str,
-                                        'due_date': due_date_str,
-                                        'due_name': due_date_str,  # Alias for due_date
-                                    }
-                                    
-                                    # Replace placeholders in subject and content for this recipient
-                                    try:
-                                        # Use format with SafeDict to handle missing placeholders gracefully
-                                        class SafeDict(dict):
-                                            def __missing__(self, key):
-                                                # Return the original placeholder if not found
-                                                return '{' + key + '}'
-                                        
-                                        safe_context = SafeDict(student_context)
-                                        personalized_subject = subject.format(**safe_context)
-                                        personalized_content = content.format(**safe_context)
-                                    except (KeyError, ValueError) as e:
-                                        # If format fails, log but continue with original content
-                                        logger.warning(f'Error replacing placeholders in bulk email to {recipient_email} for student {student_id}: {str(e)}')
-                                        # Try with basic replacements only
-                                        try:
-                                            personalized_subject = subject.format(**student_context)
-                                            personalized_content = content.format(**student_context)
-                                        except Exception:
-                                            # Keep original if replacement fails
-                                            personalized_subject = subject
-                                            personalized_content = content
-                                    
-                                    success = communication_service.email_service.send_email(
-                                        recipient_email=recipient_email,
-                                        subject=personalized_subject,
-                                        content=personalized_content,
-                                        student=student,
-                                        template=template,
-                                        sent_by=request.user
-                                    )
-                                    if success:
-                                        success_count += 1  # Count each successful email send
-                                    else:
-                                        error_count += 1  # Count each failed email send
-                                except Exception as e:
-                                    logger.error(f'Error sending bulk email to {recipient_email} for student {student_id}: {str(e)}')
-                                    error_count += 1  # Count each failed email send
-                        else:
-                            error_count += 1
-                    except Exception as e:
-                        logger.error(f'Error sending bulk email to student {student_id}: {str(e)}')
-                        error_count += 1
+                student_ids = [int(sid) for sid in selected_students if str(sid).isdigit()]
+                emails, without_email = render_bulk_emails(school, student_ids, subject, content, template)
                 
-                if success_count > 0:
-                    if success_count == 1:
-                        messages.success(request, 'Successfully sent 1 email.')
-                    else:
-                        messages.success(request, f'Successfully sent {success_count} emails.')
-                if error_count > 0:
-                    if error_count == 1:
-                        messages.warning(request, 'Failed to send 1 email.')
-                    else:
-                        messages.warning(request, f'Failed to send {error_count} emails.')
+                # Emails are written to the outbox and sent in the background over
+                # a reused connection (see communications.email_outbox)
+                queued_count, job = queue_emails(school, emails, sent_by=request.user)
+                if without_email:
+                    messages.warning(request, f'{without_email} selected student(s) have no parent email address.')
+                if job is None:
+                    messages.error(request, 'No emails were queued.')
+                    return redirect('communications:bulk_email')
+                messages.info(request, f'Queued {queued_count} email(s) for sending.')
+                return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('communications:bulk_email')}")
                     
             except Exception as e:
                 messages.error(request, f'Error sending bulk emails: {str(e)}')
@@ -917,106 +903,23 @@ def bulk_sms(request):
                         # Invalid template_id - ignore it and continue without template
                         pass
                 
-                communication_service = CommunicationService()
-                success_count = 0
-                error_count = 0
-                
-                # Send SMS to each selected student
-                for student_id in selected_students:
-                    try:
-                        student = Student.objects.prefetch_related('parents', 'parents__user').get(school=school, id=student_id)
-                        
-                        # Collect all recipient phone numbers with their corresponding parent objects
-                        # Use dict to map phone to parent for personalization
-                        phone_to_parent = {}  # Maps phone -> Parent object (or None for student.parent_phone)
-                        
-                        # Add student.parent_phone if present (no specific parent object)
-                        if student.parent_phone:
-                            phone_to_parent[student.parent_phone] = None
-                        
-                        # Add phones from all linked Parent objects
-                        if student.parents.exists():
-                            for parent in student.parents.all():
-                                if parent.phone:
-                                    phone_to_parent[parent.phone] = parent
-                        
-                        # Replace placeholders per student
-                        # Get parent name - try from linked parents first, then fall back to student.parent_name
-                        parent_name = student.parent_name
-                        if student.parents.exists():
-                            # Use first parent's full name if available
-                            first_parent = student.parents.first()
-                            if first_parent:
-                                parent_name = first_parent.full_name
-                        
-                        # Build context for placeholder replacement per student
-                        student_context = {
-                            'student_name': student.full_name,
-                            'parent_name': parent_name,
-                            'school_name': school.name,
-                        }
-                        
-                        # Optional placeholders (will be left as-is if not provided)
-                        placeholder_defaults = {
-                            'amount': '',
-                            'due_date': '',
-                            'due_name': '',  # Alias for due_date if needed
-                        }
-                        
-                        # Replace placeholders in content for this student
-                        try:
-                            # Use format with SafeDict to handle missing placeholders gracefully
-                            class SafeDict(dict):
-                                def __missing__(self, key):
-                                    # Return the original placeholder if not found
-                                    return '{' + key + '}'
-                            
-                            safe_context = SafeDict({**student_context, **placeholder_defaults})
-                            personalized_content = content.format(**safe_context)
-                        except (KeyError, ValueError) as e:
-                            # If format fails, log but continue with original content
-                            logger.warning(f'Error replacing placeholders in bulk SMS for student {student_id}: {str(e)}')
-                            # Try with basic replacements only
-                            try:
-                                personalized_content = content.format(**student_context)
-                            except Exception:
-                                # Keep original if replacement fails
-                                personalized_content = content
-                        
-                        # Send SMS to all recipients for this student
-                        if phone_to_parent:
-                            for recipient_phone, parent_obj in phone_to_parent.items():
-                                try:
-                                    success = communication_service.sms_service.send_sms(
-                                        recipient_phone=recipient_phone,
-                                        content=personalized_content,
-                                        student=student,
-                                        template=template,
-                                        sent_by=request.user
-                                    )
-                                    if success:
-                                        success_count += 1  # Count each successful SMS send
-                                    else:
-                                        error_count += 1  # Count each failed SMS send
-                                except Exception as e:
-                                    logger.error(f'Error sending bulk SMS to {recipient_phone} for student {student_id}: {str(e)}')
-                                    error_count += 1  # Count each failed SMS send
-                        else:
-                            error_count += 1
-                    except Exception as e:
-                        logger.error(f'Error sending bulk SMS to student {student_id}: {str(e)}')
-                        error_count += 1
-                
-                if success_count > 0:
-                    if success_count == 1:
-                        messages.success(request, 'Successfully sent 1 SMS.')
-                    else:
-                        messages.success(request, f'Successfully sent {success_count} SMS.')
-                if error_count > 0:
-                    if error_count == 1:
-                        messages.warning(request, 'Failed to send 1 SMS.')
-                    else:
-                        messages.warning(request, f'Failed to send {error_count} SMS.')
+                # Rendering, batching and sending happen in the background
+                # (see communications.sms_dispatcher) so large blasts don't
+                # run into the request timeout
+                student_ids = [int(sid) for sid in selected_students if str(sid).isdigit()]
+                job = job_queue.enqueue(
+                    'bulk_sms',
+                    {
+                        'student_ids': student_ids,
+                        'content': content,
+                        'template_id': template.id if template else None,
+                    },
+                    school=school,
+                    user=request.user,
+                    max_attempts=1,
+                )
+                messages.info(request, f'Queued SMS to the parents of {len(student_ids)} student(s).')
+                return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('communications:bulk_sms')}")
                     
             except Exception as e:
                 messages.error(request, f'Error sending bulk SMS: {str(e)}')
@@ -1060,106 +963,7 @@ def generate_student_statement_pdf(student, school, start_date=None, end_date=No
     if not WEASYPRINT_AVAILABLE:
         raise ImportError("WeasyPrint is not installed. Please install it using: pip install weasyprint. You may also need to install system dependencies. See: https://weasyprint.org/install/")
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    # Use due_date for fees to match the transaction date filtering
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            due_date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    # Use created_at as transaction date (when fee was charged), due_date goes in description
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee'
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': f"Payment - {payment.student_fee.fee_category.name}",
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display()
-        })
-    
-    # Sort transactions by date
-    transactions.sort(key=lambda x: x['date'])
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
+    ledger = StatementLedger(student, school=school, start_date=start_date, end_date=end_date)
     
     # Get logo path for WeasyPrint (needs absolute file path)
     logo_path = None
@@ -1185,22 +989,7 @@ def generate_student_statement_pdf(student, school, start_date=None, end_date=No
             logo_path = None
             logger.debug('MEDIA_ROOT is None, skipping logo (likely using S3 storage)')
     
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
+    context = ledger.context(logo_path=logo_path)
     
     # Render HTML template
     html_string = render_to_string('core/student_statement_pdf.html', context)
@@ -1220,26 +1009,150 @@ def generate_student_statement_pdf(student, school, start_date=None, end_date=No
     
     # Apply encryption if requested
     if encrypt and password:
+        pdf_bytes = encrypt_pdf(pdf_bytes, password)
+    
+    return pdf_bytes
+
+
+def encrypt_pdf(pdf_bytes, password):
+    """Password-protect an already rendered PDF (cheap compared to rendering)"""
+    try:
+        from pypdf import PdfWriter, PdfReader
+    except ImportError:
         try:
-            from pypdf import PdfWriter, PdfReader
+            from PyPDF2 import PdfWriter, PdfReader
         except ImportError:
-            try:
-                from PyPDF2 import PdfWriter, PdfReader
-            except ImportError:
-                raise ImportError("pypdf or PyPDF2 is required for PDF encryption. Install with: pip install pypdf")
-        
-        pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
-        pdf_writer = PdfWriter()
-        
-        for page in pdf_reader.pages:
-            pdf_writer.add_page(page)
-        
-        pdf_writer.encrypt(password)
-        output_buffer = io.BytesIO()
-        pdf_writer.write(output_buffer)
-        pdf_bytes = output_buffer.getvalue()
+            raise ImportError("pypdf or PyPDF2 is required for PDF encryption. Install with: pip install pypdf")
     
-    return pdf_bytes
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    pdf_writer = PdfWriter()
+    
+    for page in pdf_reader.pages:
+        pdf_writer.add_page(page)
+    
+    pdf_writer.encrypt(password)
+    output_buffer = io.BytesIO()
+    pdf_writer.write(output_buffer)
+    return output_buffer.getvalue()
+
+
+def send_bulk_estatements(school, student_ids, start_date, end_date, encrypt, password,
+                          email_subject, email_content, sent_by=None, ctx=None):
+    """
+    Generate PDF statements for a list of students and email them through the outbox
+
+    Called by the ``bulk_estatement_email`` background job; ``ctx`` (a
+    core.job_queue.JobContext) receives per-student progress.
+
+    Returns:
+        Dict with success_count, error_count, skipped_count and skipped_students
+    """
+    success_count = 0
+    error_count = 0
+    skipped_count = 0
+    skipped_students = []
+    outgoing = []
+    
+    requested_ids = []
+    for student_id in student_ids:
+        try:
+            requested_ids.append(int(student_id))
+        except (TypeError, ValueError):
+            logger.error(f'Error processing student {student_id}: invalid id')
+            error_count += 1
+    students = {
+        student.id: student
+        for student in Student.objects.filter(school=school, id__in=requested_ids).prefetch_related('parents__user')
+    }
+    error_count += len(set(requested_ids) - set(students))
+    
+    # Only students with transactions in the date range get a statement. Filter by
+    # transaction date (created_at / payment_date) to match PDF generation.
+    fee_query = StudentFee.objects.filter(school=school, student_id__in=students)
+    if start_date:
+        fee_query = fee_query.filter(created_at__date__gte=start_date)
+    if end_date:
+        fee_query = fee_query.filter(created_at__date__lte=end_date)
+    payment_query = Payment.objects.filter(school=school, student_id__in=students, status='completed')
+    if start_date:
+        payment_query = payment_query.filter(payment_date__date__gte=start_date)
+    if end_date:
+        payment_query = payment_query.filter(payment_date__date__lte=end_date)
+    with_transactions = set(fee_query.values_list('student_id', flat=True).distinct()) | set(
+        payment_query.values_list('student_id', flat=True).distinct()
+    )
+    
+    recipients = {}
+    for student_id, student in students.items():
+        if student_id not in with_transactions:
+            skipped_count += 1
+            skipped_students.append(student.full_name)
+            continue
+        email_to_parent = {}
+        if student.parent_email:
+            email_to_parent[student.parent_email] = student.parent_email
+        for parent in student.parents.all():
+            parent_email = parent.email or (parent.user.email if parent.user else None)
+            if parent_email:
+                email_to_parent[parent_email] = parent_email
+        if not email_to_parent:
+            error_count += 1
+            continue
+        recipients[student_id] = list(email_to_parent.values())
+    
+    # Render in parallel, reusing cached PDFs for unchanged statements
+    def render_progress(done, total):
+        if ctx is not None:
+            ctx.progress(done, total, f'Rendered {done} of {total} e-statement(s)')
+    
+    renderer = StatementRenderer(school, start_date=start_date, end_date=end_date)
+    paths, render_errors = renderer.render_many(list(recipients), progress=render_progress)
+    error_count += len(render_errors)
+    
+    filename_date = timezone.now().strftime('%Y%m%d')
+    for student_id, cache_path in paths.items():
+        student = students[student_id]
+        filename = f"Statement_{student.student_id}_{filename_date}.pdf"
+        try:
+            if encrypt and password:
+                # Encrypted copies are per-run temporaries; the outbox deletes them once sent
+                pdf_bytes = StatementRenderer.pdf_bytes(cache_path, encrypt=True, password=password)
+                attachment_path = default_storage.save(
+                    f'{TEMPORARY_ATTACHMENT_PREFIX}estatements/{school.id}/{uuid.uuid4().hex}_{filename}',
+                    ContentFile(pdf_bytes)
+                )
+            else:
+                attachment_path = cache_path
+        except Exception as e:
+            logger.error(f'Error processing student {student_id}: {str(e)}')
+            error_count += 1
+            continue
+        for recipient_email in recipients[student_id]:
+            outgoing.append(OutgoingEmail(
+                student=student,
+                recipient_email=recipient_email,
+                subject=email_subject,
+                content=email_content,
+                attachment_path=attachment_path,
+                attachment_name=filename,
+            ))
+    
+    # Send everything over reused connections with retries (see communications.email_outbox)
+    queue_emails(school, outgoing, sent_by=sent_by, schedule_drain=False)
+    if ctx is not None:
+        ctx.progress(len(paths), None, f'Sending {len(outgoing)} e-statement email(s)', force=True)
+    result = drain_outbox(school)
+    success_count += result['sent']
+    error_count += result['failed']
+    if result['next_retry_at'] is not None:
+        schedule_outbox_drain(school, user=sent_by, run_after=result['next_retry_at'])
+    
+    return {
+        'success_count': success_count,
+        'error_count': error_count,
+        'skipped_count': skipped_count,
+        'skipped_students': skipped_students,
+    }
 
 
 @login_required
@@ -1373,142 +1286,23 @@ def bulk_estatement_email(request):
             messages.error(request, 'Please select at least one student.')
         else:
             try:
-                communication_service = CommunicationService()
-                success_count = 0
-                error_count = 0
-                
-                skipped_count = 0
-                skipped_students = []
-                
-                for student_id in selected_student_ids:
-                    try:
-                        student = Student.objects.get(school=school, id=int(student_id))
-                        
-                        # Check if there are any transactions in the date range before generating PDF
-                        fee_count = 0
-                        payment_count = 0
-                        
-                        if start_date or end_date:
-                            # Filter by date range - use transaction date (created_at) to match PDF generation
-                            # PDF generation uses: skip if transaction_date < start_date or transaction_date > end_date
-                            # So include if: transaction_date >= start_date AND transaction_date <= end_date
-                            fee_query = StudentFee.objects.filter(school=school, student=student)
-                            if start_date:
-                                fee_query = fee_query.filter(created_at__date__gte=start_date)
-                            if end_date:
-                                fee_query = fee_query.filter(created_at__date__lte=end_date)
-                            fee_count = fee_query.count()
-                            
-                            payment_query = Payment.objects.filter(
-                                school=school,
-                                student=student,
-                                status='completed'
-                            )
-                            if start_date:
-                                payment_query = payment_query.filter(payment_date__date__gte=start_date)
-                            if end_date:
-                                payment_query = payment_query.filter(payment_date__date__lte=end_date)
-                            payment_count = payment_query.count()
-                            
-                            # Debug logging (can be removed later)
-                            if fee_count > 0 or payment_count > 0:
-                                logger.debug(f'Student {student.student_id} has {fee_count} fees and {payment_count} payments in range {start_date} to {end_date}')
-                        else:
-                            # No date filter - check if student has any fees/payments at all
-                            fee_count = StudentFee.objects.filter(school=school, student=student).count()
-                            payment_count = Payment.objects.filter(
-                                school=school,
-                                student=student,
-                                status='completed'
-                            ).count()
-                        
-                        # Skip if no transactions in date range
-                        if fee_count == 0 and payment_count == 0:
-                            skipped_count += 1
-                            skipped_students.append(student.full_name)
-                            continue
-                        
-                        # Generate PDF
-                        pdf_bytes = generate_student_statement_pdf(
-                            student=student,
-                            school=school,
-                            start_date=start_date,
-                            end_date=end_date,
-                            encrypt=encrypt_pdf,
-                            password=pdf_password if encrypt_pdf else None
-                        )
-                        
-                        # Get recipient emails
-                        email_to_parent = {}
-                        if student.parent_email:
-                            email_to_parent[student.parent_email] = student.parent_email
-                        
-                        for parent in student.parents.all():
-                            parent_email = parent.email or (parent.user.email if parent.user else None)
-                            if parent_email:
-                                email_to_parent[parent_email] = parent_email
-                        
-                        if not email_to_parent:
-                            error_count += 1
-                            continue
-                        
-                        # Send email with PDF attachment
-                        for recipient_email in email_to_parent.values():
-                            try:
-                                from django.core.mail import EmailMessage as DjangoEmailMessage
-                                from django.conf import settings
-                                
-                                email_msg = DjangoEmailMessage(
-                                    subject=email_subject,
-                                    body=email_content,
-                                    from_email=settings.EMAIL_HOST_USER,
-                                    to=[recipient_email]
-                                )
-                                
-                                # Attach PDF
-                                filename = f"Statement_{student.student_id}_{timezone.now().strftime('%Y%m%d')}.pdf"
-                                email_msg.attach(filename, pdf_bytes, 'application/pdf')
-                                
-                                email_msg.send()
-                                
-                                # Log the email
-                                EmailMessage.objects.create(
-                                    school=school,
-                                    student=student,
-                                    recipient_email=recipient_email,
-                                    subject=email_subject,
-                                    content=email_content,
-                                    status='sent',
-                                    sent_at=timezone.now(),
-                                    sent_by=request.user
-                                )
-                                
-                                success_count += 1
-                            except Exception as e:
-                                logger.error(f'Error sending e-statement email to {recipient_email}: {str(e)}')
-                                error_count += 1
-                    except Exception as e:
-                        logger.error(f'Error processing student {student_id}: {str(e)}')
-                        error_count += 1
-                
-                if success_count > 0:
-                    if success_count == 1:
-                        messages.success(request, 'Successfully sent 1 e-statement.')
-                    else:
-                        messages.success(request, f'Successfully sent {success_count} e-statements.')
-                if skipped_count > 0:
-                    if skipped_count == 1:
-                        messages.warning(request, f'Skipped 1 student (no transactions in selected date range): {skipped_students[0]}.')
-                    else:
-                        students_list = ', '.join(skipped_students[:5])
-                        if len(skipped_students) > 5:
-                            students_list += f' and {len(skipped_students) - 5} more'
-                        messages.warning(request, f'Skipped {skipped_count} student(s) with no transactions in selected date range: {students_list}.')
-                if error_count > 0:
-                    if error_count == 1:
-                        messages.warning(request, 'Failed to send 1 e-statement.')
-                    else:
-                        messages.warning(request, f'Failed to send {error_count} e-statements.')
+                job = job_queue.enqueue(
+                    'bulk_estatement_email',
+                    {
+                        'student_ids': [int(sid) for sid in selected_student_ids if str(sid).isdigit()],
+                        'start_date': start_date.isoformat() if start_date else None,
+                        'end_date': end_date.isoformat() if end_date else None,
+                        'encrypt_pdf': encrypt_pdf,
+                        'pdf_password': pdf_password if encrypt_pdf else '',
+                        'subject': email_subject,
+                        'content': email_content,
+                    },
+                    school=school,
+                    user=request.user,
+                    max_attempts=1,
+                )
+                messages.info(request, f'Queued {len(selected_student_ids)} e-statement(s) for sending.')
+                return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('communications:bulk_estatement_email')}")
             except Exception as e:
                 messages.error(request, f'Error sending bulk e-statements: {str(e)}')
             return redirect('communications:bulk_estatement_email')
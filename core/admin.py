@@ -2,7 +2,7 @@ from django.contrib import admin
 from .models import (
     School, Grade, Term, FeeCategory, FeeCategoryType, TransportRoute, Student, FeeStructure, StudentFee, 
     SchoolClass, Role, Permission, UserProfile, Parent,
-    AcademicYear, Section, StudentClassEnrollment, PromotionLog
+    AcademicYear, Section, StudentClassEnrollment, PromotionLog, Job
 )
 
 
@@ -268,3 +268,13 @@ class PromotionLogAdmin(admin.ModelAdmin):
     search_fields = ['from_academic_year__name', 'to_academic_year__name', 'promoted_by__username']
     ordering = ['-created_at']
     readonly_fields = ['created_at']
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'job_type', 'school', 'status', 'progress_current', 'progress_total',
+                   'attempts', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['status', 'job_type', 'school']
+    search_fields = ['job_type', 'error_message', 'created_by__username']
+    ordering = ['-created_at']
+    readonly_fields = ['created_at', 'updated_at', 'started_at', 'finished_at', 'worker']
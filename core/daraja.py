@@ -0,0 +1,163 @@
+"""
+Shared Safaricom Daraja plumbing for the M-Pesa services
+
+- ``get_daraja_session`` returns one pooled requests.Session per process, so
+  STK pushes and status queries reuse open TLS connections.
+- ``get_access_token`` caches OAuth tokens in the Django cache (shared by
+  every worker when the cache is shared) with a per-process copy in front of
+  it, which also serves as the fallback when the cache backend is down.
+  Tokens are refreshed MPESA_TOKEN_REFRESH_MARGIN seconds before they
+  expire. Only one worker refreshes at a time: the others keep using the
+  still-valid token, or wait briefly for the new one instead of all calling
+  the OAuth endpoint.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+import hashlib
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeout for Daraja calls, in seconds
+DARAJA_TIMEOUT = (5, 30)
+
+# Don't hand out a token this close to its expiry, even while another worker refreshes it
+TOKEN_MIN_VALIDITY = 30
+# How long a worker may hold the refresh lock, and how long others wait for it
+TOKEN_LOCK_TIMEOUT = 15
+TOKEN_WAIT_INTERVAL = 0.1
+
+_session = None
+_session_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_local_tokens = {}  # cache key -> {'token': ..., 'expires_at': epoch seconds}
+
+
+def get_daraja_session():
+    """Shared requests.Session for Daraja API calls"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = max(1, getattr(settings, 'MPESA_HTTP_POOL_SIZE', 4))
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def _token_cache_key(base_url, consumer_key):
+    digest = hashlib.sha256(f'{base_url}|{consumer_key}'.encode()).hexdigest()[:32]
+    return f'mpesa:token:{digest}'
+
+
+def _cache_get(key):
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f'M-Pesa token cache unavailable, using the local copy: {str(e)}')
+        return None
+
+
+def _cache_call(method, *args):
+    try:
+        return getattr(cache, method)(*args)
+    except Exception as e:
+        logger.warning(f'M-Pesa token cache unavailable: {str(e)}')
+        return None
+
+
+def _is_fresh(entry, now):
+    margin = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)
+    return bool(entry) and now < entry['expires_at'] - margin
+
+
+def _is_usable(entry, now):
+    return bool(entry) and now < entry['expires_at'] - TOKEN_MIN_VALIDITY
+
+
+def _fetch_token(base_url, consumer_key, consumer_secret):
+    response = get_daraja_session().get(
+        f'{base_url}/oauth/v1/generate?grant_type=client_credentials',
+        auth=(consumer_key, consumer_secret),
+        timeout=DARAJA_TIMEOUT,
+    )
+    response.raise_for_status()
+    data = response.json()
+    token = data.get('access_token')
+    if not token:
+        raise ValueError('M-Pesa OAuth response did not include an access token')
+    logger.info('M-Pesa access token obtained successfully')
+    return {'token': token, 'expires_at': time.time() + int(data.get('expires_in', 3599))}
+
+
+def get_access_token(base_url, consumer_key, consumer_secret):
+    """
+    Return a valid Daraja OAuth token, fetching one only when needed
+
+    Args:
+        base_url: Daraja base URL (sandbox or production)
+        consumer_key: App consumer key
+        consumer_secret: App consumer secret
+
+    Returns:
+        The access token string
+
+    Raises:
+        requests.RequestException or ValueError when a new token is needed
+        and Safaricom does not provide one
+    """
+    key = _token_cache_key(base_url, consumer_key)
+    now = time.time()
+    entry = _local_tokens.get(key)
+    if _is_fresh(entry, now):
+        return entry['token']
+    shared = _cache_get(key)
+    if _is_fresh(shared, now):
+        _local_tokens[key] = shared
+        return shared['token']
+    entry = shared if _is_usable(shared, now) else entry
+
+    # Single flight: one thread per process, and one process per shared cache, refreshes
+    with _refresh_lock:
+        shared = _cache_get(key)
+        if _is_fresh(shared, time.time()):
+            _local_tokens[key] = shared
+            return shared['token']
+
+        lock_key = f'{key}:lock'
+        acquired = _cache_call('add', lock_key, True, TOKEN_LOCK_TIMEOUT)
+        if acquired is False:
+            if _is_usable(entry, time.time()):
+                # Another worker is refreshing; the current token is still good
+                return entry['token']
+            deadline = time.time() + TOKEN_LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(TOKEN_WAIT_INTERVAL)
+                shared = _cache_get(key)
+                if _is_usable(shared, time.time()):
+                    _local_tokens[key] = shared
+                    return shared['token']
+            logger.warning('Timed out waiting for another worker to refresh the M-Pesa token')
+
+        try:
+            entry = _fetch_token(base_url, consumer_key, consumer_secret)
+            _local_tokens[key] = entry
+            _cache_call('set', key, entry, max(1, int(entry['expires_at'] - time.time())))
+            return entry['token']
+        finally:
+            if acquired:
+                _cache_call('delete', lock_key)
+
+
+def invalidate_access_token(base_url, consumer_key):
+    """Forget a cached token Safaricom rejected, so the next call fetches a new one"""
+    key = _token_cache_key(base_url, consumer_key)
+    _local_tokens.pop(key, None)
+    _cache_call('delete', key)
@@ -0,0 +1,310 @@
+"""
+Streaming tabular exports (and uploads)
+
+Generators that turn an iterable of rows into CSV or XLSX bytes a chunk at a
+time, for use with StreamingHttpResponse. Rows are consumed lazily (e.g.
+from ``QuerySet.iterator()``), so an export never holds the full result set
+in memory. The XLSX writer produces a minimal single-sheet workbook with
+inline strings and needs no third-party library.
+
+``iter_table_rows`` goes the other way for uploaded CSV/XLSX files, yielding
+one row of cell strings at a time; XLSX sheets are read with ``iterparse``
+so only the shared strings table is held in memory.
+"""
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from decimal import Decimal
+import csv
+import datetime
+import io
+import os
+import re
+import zipfile
+
+# Rows written between yields
+EXPORT_CHUNK_ROWS = 500
+
+CSV_CONTENT_TYPE = 'text/csv'
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Characters XML 1.0 does not allow
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _ChunkBuffer:
+    """Write-only file object whose contents are collected and drained by the generator"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8') for chunk in self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_csv(header, rows):
+    """
+    Yield a CSV document chunk by chunk
+
+    Args:
+        header: List of column titles
+        rows: Iterable of row sequences
+
+    Yields:
+        bytes (UTF-8 with a BOM, so Excel detects the encoding)
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('﻿')
+    writer.writerow(header)
+    for index, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if index % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def _column_name(index):
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+def _xlsx_cell(reference, value):
+    if value is None or value == '':
+        return ''
+    if isinstance(value, bool):
+        return f'<c r="{reference}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c r="{reference}"><v>{value}</v></c>'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    text = escape(_INVALID_XML_CHARS.sub('', str(value)))
+    return f'<c r="{reference}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(number, values):
+    cells = ''.join(_xlsx_cell(f'{_column_name(i)}{number}', value) for i, value in enumerate(values))
+    return f'<row r="{number}">{cells}</row>'
+
+
+_XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def stream_xlsx(header, rows, sheet_name='Sheet1'):
+    """
+    Yield an XLSX workbook chunk by chunk
+
+    Args:
+        header: List of column titles
+        rows: Iterable of row sequences (str, numbers, Decimal, dates, bool or None)
+        sheet_name: Worksheet title (at most 31 characters)
+
+    Yields:
+        bytes of the zip archive
+    """
+    buffer = _ChunkBuffer()
+    # The buffer has no tell()/seek(), so zipfile writes a streamable archive
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        sheet_title = escape(re.sub(r'[\[\]:*?/\\]', ' ', sheet_name)[:31] or 'Sheet1', {'"': '&quot;'})
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{sheet_title}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield buffer.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row(1, header)
+            ).encode('utf-8'))
+            for number, row in enumerate(rows, start=2):
+                sheet.write(_xlsx_row(number, row).encode('utf-8'))
+                if number % EXPORT_CHUNK_ROWS == 0:
+                    yield buffer.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.drain()
+
+
+# ---- Reading uploads ----
+
+_XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+def iter_csv_rows(upload, encoding='utf-8-sig'):
+    """
+    Yield the rows of an uploaded CSV file as lists of strings
+
+    Args:
+        upload: Binary file object (e.g. an UploadedFile); left open
+        encoding: Text encoding; the default also strips a UTF-8 BOM
+    """
+    text = io.TextIOWrapper(upload, encoding=encoding, errors='replace', newline='')
+    try:
+        yield from csv.reader(text)
+    except csv.Error as e:
+        raise ValueError(f'Could not read the CSV file: {e}') from e
+    finally:
+        # Leave the caller's file open
+        text.detach()
+
+
+def _column_index(reference):
+    index = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index - 1
+
+
+def _xlsx_first_sheet(archive):
+    """Path of the workbook's first worksheet"""
+    try:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    except KeyError:
+        return 'xl/worksheets/sheet1.xml'
+    sheet = workbook.find(f'{_XLSX_NS}sheets/{_XLSX_NS}sheet')
+    if sheet is not None:
+        rel_id = sheet.get(f'{_XLSX_REL_NS}id')
+        for rel in rels:
+            if rel.get('Id') == rel_id and rel.get('Target'):
+                target = rel.get('Target')
+                return target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    return 'xl/worksheets/sheet1.xml'
+
+
+def _xlsx_shared_strings(archive):
+    try:
+        stream = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+    strings = []
+    with stream:
+        for _, element in ElementTree.iterparse(stream):
+            if element.tag == f'{_XLSX_NS}si':
+                # Rich text splits a string over several runs; phonetic hints are skipped
+                phonetic = set(element.findall(f'{_XLSX_NS}rPh/{_XLSX_NS}t'))
+                strings.append(''.join(
+                    node.text or '' for node in element.iter(f'{_XLSX_NS}t') if node not in phonetic
+                ))
+                element.clear()
+    return strings
+
+
+def _xlsx_cell_value(cell, shared_strings):
+    cell_type = cell.get('t')
+    if cell_type == 'inlineStr':
+        return ''.join(node.text or '' for node in cell.iter(f'{_XLSX_NS}t'))
+    value = cell.find(f'{_XLSX_NS}v')
+    text = value.text if value is not None and value.text else ''
+    if cell_type == 's' and text:
+        index = int(text)
+        return shared_strings[index] if index < len(shared_strings) else ''
+    if cell_type == 'b':
+        return 'TRUE' if text == '1' else 'FALSE'
+    return text
+
+
+def iter_xlsx_rows(upload):
+    """
+    Yield the rows of an uploaded workbook's first sheet as lists of strings
+
+    Numbers are returned as written in the file (e.g. ``'72.5'``); empty
+    cells between filled ones are returned as ``''``.
+
+    Raises:
+        ValueError if the file is not a readable XLSX workbook
+    """
+    try:
+        archive = zipfile.ZipFile(upload)
+    except zipfile.BadZipFile as e:
+        raise ValueError('Not a valid XLSX file') from e
+    with archive:
+        try:
+            shared_strings = _xlsx_shared_strings(archive)
+            stream = archive.open(_xlsx_first_sheet(archive))
+        except KeyError as e:
+            raise ValueError('The workbook has no worksheet') from e
+        except ElementTree.ParseError as e:
+            raise ValueError(f'Could not read the XLSX file: {e}') from e
+        with stream:
+            try:
+                for _, element in ElementTree.iterparse(stream):
+                    if element.tag != f'{_XLSX_NS}row':
+                        continue
+                    row = []
+                    for cell in element.iter(f'{_XLSX_NS}c'):
+                        reference = cell.get('r')
+                        position = _column_index(reference) if reference else len(row)
+                        row.extend([''] * (position - len(row)))
+                        row.append(_xlsx_cell_value(cell, shared_strings))
+                    element.clear()
+                    yield row
+            except ElementTree.ParseError as e:
+                raise ValueError(f'Could not read the XLSX file: {e}') from e
+
+
+def iter_table_rows(upload, file_name=None):
+    """
+    Yield the rows of an uploaded CSV or XLSX file, chosen by file extension
+
+    Raises:
+        ValueError for other file types
+    """
+    extension = os.path.splitext(file_name or getattr(upload, 'name', '') or '')[1].lower()
+    if extension == '.csv':
+        return iter_csv_rows(upload)
+    if extension == '.xlsx':
+        return iter_xlsx_rows(upload)
+    raise ValueError('Upload a .csv or .xlsx file')
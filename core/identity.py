@@ -0,0 +1,111 @@
+"""
+Request identity
+
+Resolves who is making a request - user profile, school, role names and
+parent link - once, and exposes it as ``request.identity``. The decorators,
+context processors and views read from it instead of each fetching the
+UserProfile or Parent row again.
+"""
+
+from functools import cached_property
+
+
+class RequestIdentity:
+    """
+    Immutable view of the requesting user's profile, school, roles and parent link.
+
+    The profile is loaded when the identity is created; the parent link and
+    role names are loaded the first time they are read.
+    """
+
+    def __init__(self, user, profile):
+        object.__setattr__(self, 'user', user)
+        object.__setattr__(self, 'profile', profile)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RequestIdentity is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('RequestIdentity is immutable')
+
+    @classmethod
+    def resolve(cls, user):
+        """Load the identity for a user with a single profile query"""
+        from .models import UserProfile
+
+        if not user or not user.is_authenticated:
+            return cls(user, None)
+        profile = UserProfile.objects.select_related('school').filter(user=user).first()
+        if profile is not None:
+            # Let user.profile use this instance (and its memoised permissions)
+            user.profile = profile
+        return cls(user, profile)
+
+    @property
+    def is_authenticated(self):
+        return bool(self.user and self.user.is_authenticated)
+
+    @property
+    def school(self):
+        return self.profile.school if self.profile else None
+
+    @property
+    def school_id(self):
+        return self.profile.school_id if self.profile else None
+
+    @cached_property
+    def role_names(self):
+        """Assigned role names, falling back to the legacy `role` field"""
+        if self.profile is None:
+            return ()
+        from .permission_resolver import profile_role_names
+        names = tuple(sorted(profile_role_names(self.profile)))
+        if not names and self.profile.role:
+            names = (self.profile.role,)
+        return names
+
+    @cached_property
+    def parent(self):
+        """The user's Parent record (with school), or None"""
+        if not self.is_authenticated:
+            return None
+        from .models import Parent
+        return Parent.objects.select_related('school').filter(user=self.user).first()
+
+    @property
+    def is_parent_with_school(self):
+        return bool(self.parent and self.parent.school_id)
+
+    @property
+    def is_superuser(self):
+        return bool(self.is_authenticated and self.user.is_superuser)
+
+
+def get_identity(request):
+    """Return request.identity, resolving it for requests that bypassed the middleware"""
+    identity = getattr(request, 'identity', None)
+    if identity is None:
+        identity = RequestIdentity.resolve(request.user)
+        request.identity = identity
+    return identity
+
+
+def ensure_profile(request):
+    """
+    Create a UserProfile for a user that has none (assigned to the first
+    school, as the User post_save signal does) and refresh request.identity.
+
+    Returns:
+        The updated RequestIdentity
+    """
+    from .models import School, UserProfile
+
+    identity = get_identity(request)
+    if identity.profile is not None or not identity.is_authenticated:
+        return identity
+    UserProfile.objects.get_or_create(
+        user=request.user,
+        defaults={'school': School.objects.first()}
+    )
+    request.identity = RequestIdentity.resolve(request.user)
+    return request.identity
@@ -2,9 +2,10 @@
 Integration service for cross-module communication and coordination
 """
 from django.utils import timezone
-from .models import Student, Term
+from .models import Student
+from .term_calendar import TermCalendar
 from attendance.models import AttendanceSummary
-from exams.models import GradebookSummary
+from exams.models import GradebookSummary, TermRanking
 from communications.services import CommunicationService
 
 
@@ -76,7 +77,7 @@ class IntegrationService:
         from core.models import StudentFee
         
         if not term:
-            term = Term.objects.filter(school=student.school, is_active=True).first()
+            term = TermCalendar.for_school(student.school).active_term()
         
         # Get all statistics
         student_stats = StudentService.get_student_statistics(student)
@@ -112,6 +113,14 @@ class IntegrationService:
                 term=term
             ).select_related('subject').order_by('subject__name')
         
+        # Class and stream positions are stored by exams.ranking.RankingEngine
+        ranking = None
+        if term:
+            ranking = TermRanking.objects.filter(
+                student=student,
+                term=term
+            ).select_related('grade', 'school_class').first()
+        
         return {
             'student': student,
             'term': term,
@@ -129,6 +138,7 @@ class IntegrationService:
             'performance': {
                 'stats': performance_stats,
                 'summaries': gradebook_summaries,
+                'ranking': ranking,
             },
             'overall': {
                 'attendance_percentage': attendance_stats.get('attendance_percentage', 0),
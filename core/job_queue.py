@@ -0,0 +1,340 @@
+"""
+Database-backed background job queue
+
+Long-running operations (term billing, promotions, bank statement imports,
+bulk e-statements) are enqueued as Job rows and executed by the
+``manage.py run_jobs`` worker instead of inside the HTTP request.
+
+Handlers are plain functions registered with ``@register_job('name')`` in an
+app's ``jobs.py`` module; they receive a JobContext and return a
+JSON-serializable result dict.
+"""
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+
+# job type -> [callable(school_id)] run when a stale job of that type is failed
+STALE_HANDLERS = {}
+
+# Retry backoff: BASE * 2 ** (attempt - 1) seconds, capped at MAX
+RETRY_BACKOFF_BASE_SECONDS = 30
+RETRY_BACKOFF_MAX_SECONDS = 3600
+
+# Minimum seconds between progress writes, so tight loops don't hammer the jobs table
+PROGRESS_WRITE_INTERVAL = 1.0
+
+# Seconds between updated_at bumps while a handler runs, so a long job that
+# reports little progress is not mistaken for one whose worker died
+HEARTBEAT_INTERVAL = 60
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when cancellation has been requested"""
+    pass
+
+
+def register_job(job_type):
+    """Decorator registering a function as the handler for a job type"""
+    def decorator(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return decorator
+
+
+def register_stale_handler(job_type):
+    """
+    Decorator registering a function called with the school id of a job of
+    ``job_type`` that ``requeue_stale_jobs`` failed because its worker died
+    """
+    def decorator(func):
+        STALE_HANDLERS.setdefault(job_type, []).append(func)
+        return func
+    return decorator
+
+
+def autodiscover_jobs():
+    """Import every installed app's jobs.py so its handlers are registered"""
+    from django.utils.module_loading import autodiscover_modules
+    autodiscover_modules('jobs')
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def retry_delay(attempts):
+    """Backoff delay in seconds before the next attempt"""
+    return min(RETRY_BACKOFF_MAX_SECONDS, RETRY_BACKOFF_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+def enqueue(job_type, payload=None, school=None, user=None, max_attempts=3, run_after=None):
+    """
+    Queue a job for the background worker
+
+    Args:
+        job_type: Registered handler name
+        payload: JSON-serializable dict passed to the handler
+        school: School the job belongs to (used for access checks when polling)
+        user: User who requested the job
+        max_attempts: Attempts before the job is marked failed
+        run_after: Optional datetime before which the job is not picked up
+
+    Returns:
+        The created Job
+    """
+    from core.models import Job
+
+    return Job.objects.create(
+        school=school,
+        job_type=job_type,
+        payload=payload or {},
+        created_by=user if user is not None and user.is_authenticated else None,
+        max_attempts=max_attempts,
+        run_after=run_after or timezone.now(),
+    )
+
+
+def cancel(job):
+    """Request cancellation; queued jobs are cancelled immediately, running jobs at their next check"""
+    from core.models import Job
+
+    if job.status == 'queued':
+        Job.objects.filter(pk=job.pk, status='queued').update(
+            status='cancelled', cancel_requested=True, finished_at=timezone.now(), updated_at=timezone.now()
+        )
+    elif job.status == 'running':
+        Job.objects.filter(pk=job.pk).update(cancel_requested=True, updated_at=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+def claim_jobs(limit, worker=None):
+    """
+    Atomically claim up to ``limit`` runnable jobs for this worker
+
+    Uses SELECT ... FOR UPDATE SKIP LOCKED so several workers can poll the
+    same table without picking up the same job.
+    """
+    from core.models import Job
+
+    if limit <= 0:
+        return []
+    worker = worker or worker_name()
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True).filter(
+                status='queued',
+                run_after__lte=now,
+                job_type__in=list(JOB_HANDLERS.keys()),
+            ).order_by('run_after', 'id')[:limit]
+        )
+        if not jobs:
+            return []
+        ids = [job.id for job in jobs]
+        Job.objects.filter(id__in=ids).update(
+            status='running',
+            worker=worker,
+            started_at=now,
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+    return ids
+
+
+def requeue_stale_jobs(stale_after_minutes=30):
+    """
+    Recover running jobs whose worker stopped sending heartbeats
+
+    Jobs with attempts left go back in the queue; jobs that used their last
+    attempt (including every ``max_attempts=1`` job, which is not safe to run
+    twice) are marked failed and their ``register_stale_handler`` handlers
+    are called to clean up after them.
+
+    Returns:
+        Tuple of (requeued, failed) counts
+    """
+    from core.models import Job
+
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', updated_at__lt=now - timedelta(minutes=stale_after_minutes))
+    with transaction.atomic():
+        exhausted = list(
+            stale.filter(attempts__gte=F('max_attempts')).select_for_update(skip_locked=True)
+            .values_list('id', 'job_type', 'school_id')
+        )
+        if exhausted:
+            Job.objects.filter(id__in=[job_id for job_id, _, _ in exhausted]).update(
+                status='failed',
+                error_message='Worker stopped while the job was running',
+                finished_at=now,
+                updated_at=now,
+            )
+    requeued = stale.filter(attempts__lt=F('max_attempts')).update(
+        status='queued', worker='', run_after=now, updated_at=now
+    )
+
+    for job_id, job_type, school_id in exhausted:
+        for handler in STALE_HANDLERS.get(job_type, []):
+            try:
+                handler(school_id)
+            except Exception as e:
+                logger.error('Stale handler for job %s (%s) failed: %s', job_id, job_type, e, exc_info=True)
+    return requeued, len(exhausted)
+
+
+class _Heartbeat(threading.Thread):
+    """Bump a running job's updated_at every HEARTBEAT_INTERVAL seconds until stopped"""
+
+    def __init__(self, job_id, interval=HEARTBEAT_INTERVAL):
+        super().__init__(name=f'job-{job_id}-heartbeat', daemon=True)
+        self.job_id = job_id
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        from django.db import connection
+        from core.models import Job
+
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    Job.objects.filter(pk=self.job_id, status='running').update(updated_at=timezone.now())
+                except Exception as e:
+                    logger.warning('Heartbeat for job %s failed: %s', self.job_id, e)
+        finally:
+            # The thread has its own connection; don't leave it open
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class JobContext:
+    """Handle passed to job handlers for progress reporting and cancellation checks"""
+
+    def __init__(self, job):
+        self.job = job
+        self.job_id = job.id
+        self.school_id = job.school_id
+        self.payload = job.payload or {}
+        self._last_write = 0.0
+
+    def progress(self, current, total=None, message=None, force=False):
+        """Record progress; writes are throttled unless ``force`` is set or the job is done"""
+        from core.models import Job
+
+        now = time.monotonic()
+        finished = total is not None and current >= total
+        if not force and not finished and now - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_write = now
+        fields = {'progress_current': current, 'updated_at': timezone.now()}
+        if total is not None:
+            fields['progress_total'] = total
+        if message is not None:
+            fields['progress_message'] = message[:255]
+        Job.objects.filter(pk=self.job_id).update(**fields)
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if cancellation was requested"""
+        from core.models import Job
+
+        if Job.objects.filter(pk=self.job_id, cancel_requested=True).exists():
+            raise JobCancelled()
+
+    def redact(self, *keys):
+        """Remove sensitive keys (e.g. passwords) from the stored payload"""
+        from core.models import Job
+
+        payload = {k: v for k, v in self.payload.items() if k not in keys}
+        Job.objects.filter(pk=self.job_id).update(payload=payload)
+
+
+def execute_job(job_id):
+    """
+    Run a claimed job to completion (called inside a worker process)
+
+    On failure the job is re-queued with exponential backoff until
+    ``max_attempts`` is reached, then marked failed.
+    """
+    from django.db import close_old_connections
+    from core.models import Job
+
+    close_old_connections()
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return 'missing'
+
+    handler = JOB_HANDLERS.get(job.job_type)
+    if handler is None:
+        Job.objects.filter(pk=job.pk).update(
+            status='failed', error_message=f'No handler registered for job type "{job.job_type}"',
+            finished_at=timezone.now()
+        )
+        return 'failed'
+
+    context = JobContext(job)
+    heartbeat = _Heartbeat(job.pk)
+    heartbeat.start()
+    try:
+        if job.cancel_requested:
+            raise JobCancelled()
+        result = handler(context) or {}
+    except JobCancelled:
+        Job.objects.filter(pk=job.pk).update(
+            status='cancelled', finished_at=timezone.now(), updated_at=timezone.now()
+        )
+        logger.info('Job %s (%s) cancelled', job.pk, job.job_type)
+        return 'cancelled'
+    except Exception as e:
+        logger.error('Job %s (%s) failed on attempt %s: %s', job.pk, job.job_type, job.attempts, e, exc_info=True)
+        if job.attempts < job.max_attempts:
+            Job.objects.filter(pk=job.pk).update(
+                status='queued',
+                worker='',
+                error_message=str(e),
+                run_after=timezone.now() + timedelta(seconds=retry_delay(job.attempts)),
+                updated_at=timezone.now(),
+            )
+            return 'retry'
+        Job.objects.filter(pk=job.pk).update(
+            status='failed', error_message=str(e), finished_at=timezone.now(), updated_at=timezone.now()
+        )
+        return 'failed'
+    finally:
+        heartbeat.stop()
+        close_old_connections()
+
+    Job.objects.filter(pk=job.pk).update(
+        status='completed',
+        result=result,
+        error_message='',
+        progress_current=F('progress_total'),
+        finished_at=timezone.now(),
+        updated_at=timezone.now(),
+    )
+    logger.info('Job %s (%s) completed', job.pk, job.job_type)
+    return 'completed'
+
+
+def init_worker_process():
+    """ProcessPoolExecutor initializer: set up Django in a freshly spawned worker"""
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'school_management.settings')
+    django.setup()
+    autodiscover_jobs()
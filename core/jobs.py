@@ -0,0 +1,59 @@
+"""
+Background job handlers for the core app
+"""
+from .job_queue import register_job
+
+
+@register_job('generate_student_fees')
+def generate_student_fees_job(ctx):
+    """Apply fee structures to students for a term (see FeeGenerationService)"""
+    from .models import School, Term
+    from .services.fee_generation_service import FeeGenerationService
+
+    school = School.objects.get(pk=ctx.school_id)
+    term = Term.objects.get(pk=ctx.payload['term_id'], school=school)
+    ctx.progress(0, 1, f'Generating fees for {term}', force=True)
+
+    report = FeeGenerationService(school, term, grade_id=ctx.payload.get('grade_id')).generate()
+
+    ctx.progress(1, 1, 'Done')
+    return {
+        'students_count': report.students_count,
+        'created_count': report.created_count,
+        'updated_count': report.updated_count,
+        'skipped_count': report.skipped_count,
+        'deleted_count': report.deleted_count,
+        'transport_deleted_count': report.transport_deleted_count,
+    }
+
+
+@register_job('execute_promotion')
+def execute_promotion_job(ctx):
+    """Execute a confirmed student promotion (see PromotionService.execute_promotion)"""
+    from django.contrib.auth.models import User
+    from .models import School
+    from .services.promotion_service import PromotionService, PromotionPreview
+
+    school = School.objects.get(pk=ctx.school_id)
+    user = User.objects.filter(pk=ctx.payload.get('user_id')).first()
+    previews = [PromotionPreview(**data) for data in ctx.payload['previews']]
+    ctx.progress(0, len(previews), 'Promoting students', force=True)
+
+    result = PromotionService(school, user).execute_promotion(
+        ctx.payload['from_year_id'],
+        ctx.payload['to_year_id'],
+        previews,
+        ctx.payload.get('promotion_type', 'automatic'),
+    )
+
+    ctx.progress(len(previews), len(previews), 'Done')
+    return {
+        'success': result.success,
+        'promoted_count': result.promoted_count,
+        'retained_count': result.retained_count,
+        'graduated_count': result.graduated_count,
+        'left_count': result.left_count,
+        'errors': result.errors,
+        'warnings': result.warnings,
+        'log_id': result.log_id,
+    }
@@ -0,0 +1,47 @@
+"""
+Management command to rebuild the FeeRollup table from StudentFee.
+Safe to run at any time; the rows for the selected scope are recomputed.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School, Term
+from core.services.finance_rollup_service import FinanceRollupService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-school fee rollup table used by the dashboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only rebuild rollups for this school',
+        )
+        parser.add_argument(
+            '--term-id',
+            type=int,
+            help='Only rebuild rollups for this term',
+        )
+
+    def handle(self, *args, **options):
+        school = None
+        if options.get('school_id'):
+            try:
+                school = School.objects.get(id=options['school_id'])
+            except School.DoesNotExist:
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        term_ids = None
+        if options.get('term_id'):
+            terms = Term.objects.filter(id=options['term_id'])
+            if school is not None:
+                terms = terms.filter(school=school)
+            if not terms.exists():
+                self.stdout.write(self.style.ERROR(f'Term with ID {options["term_id"]} does not exist.'))
+                return
+            term_ids = [options['term_id']]
+
+        scope = school.name if school else 'all schools'
+        self.stdout.write(f'Rebuilding fee rollups for {scope}...')
+        rows = FinanceRollupService.rebuild(school, term_ids=term_ids)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {rows} rollup row(s).'))
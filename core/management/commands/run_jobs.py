@@ -0,0 +1,97 @@
+"""
+Management command that runs the background job worker.
+
+Claims queued Job rows and executes them in a pool of worker processes so
+long operations (term billing, promotions, statement runs) can use more than
+one core and never block a gunicorn worker.
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import job_queue
+
+
+class Command(BaseCommand):
+    help = 'Run the background job worker (term billing, promotions, statement runs)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=getattr(settings, 'JOB_QUEUE_WORKERS', 2),
+            help='Number of worker processes (default: JOB_QUEUE_WORKERS setting)',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=2.0,
+            help='Seconds to wait between polls when the queue is empty',
+        )
+        parser.add_argument(
+            '--stale-after',
+            type=int,
+            default=30,
+            help='Minutes without a heartbeat after which a running job is re-queued, '
+                 'or failed if it has no attempts left',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit instead of polling forever',
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        poll_interval = options['poll_interval']
+        once = options['once']
+
+        job_queue.autodiscover_jobs()
+        requeued, failed = job_queue.requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Re-queued {requeued} stale job(s).'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'Failed {failed} stale job(s) with no attempts left.'))
+
+        self.stdout.write(
+            f'Job worker {job_queue.worker_name()} started with {workers} process(es). '
+            f'Handlers: {", ".join(sorted(job_queue.JOB_HANDLERS))}'
+        )
+
+        # Spawn (not fork) so children never share the parent's database connection
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=job_queue.init_worker_process,
+        )
+        running = {}
+        try:
+            while True:
+                free_slots = workers - len(running)
+                for job_id in job_queue.claim_jobs(free_slots):
+                    running[pool.submit(job_queue.execute_job, job_id)] = job_id
+                    self.stdout.write(f'Started job {job_id}')
+
+                if not running:
+                    if once:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(list(running), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = running.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        outcome = f'crashed ({e})'
+                    self.stdout.write(f'Job {job_id}: {outcome}')
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Stopping job worker...'))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        self.stdout.write(self.style.SUCCESS('Job worker stopped.'))
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.3 on 2026-10-16 10:00
+
+import django.db.models.deletion
+from datetime import date
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+
+def populate_fee_rollups(apps, schema_editor):
+    """Build the initial rollup rows from existing StudentFee data"""
+    StudentFee = apps.get_model('core', 'StudentFee')
+    FeeRollup = apps.get_model('core', 'FeeRollup')
+
+    aggregates = StudentFee.objects.annotate(
+        month=TruncMonth('created_at')
+    ).values(
+        'school_id', 'term_id', 'fee_category_id', 'month', 'due_date'
+    ).annotate(
+        fee_count=Count('id'),
+        unpaid_count=Count('id', filter=Q(is_paid=False)),
+        total_charged=Sum('amount_charged'),
+        total_paid=Sum('amount_paid', filter=Q(amount_paid__gt=0)),
+    ).order_by()
+
+    FeeRollup.objects.bulk_create([
+        FeeRollup(
+            school_id=row['school_id'],
+            term_id=row['term_id'],
+            fee_category_id=row['fee_category_id'],
+            month=date(timezone.localtime(row['month']).year, timezone.localtime(row['month']).month, 1),
+            due_date=row['due_date'],
+            fee_count=row['fee_count'],
+            unpaid_count=row['unpaid_count'],
+            total_charged=row['total_charged'] or Decimal('0'),
+            total_paid=row['total_paid'] or Decimal('0'),
+        )
+        for row in aggregates
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month the fees were created in')),
+                ('due_date', models.DateField()),
+                ('fee_count', models.IntegerField(default=0)),
+                ('unpaid_count', models.IntegerField(default=0)),
+                ('total_charged', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('fee_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_rollups', to='core.feecategory')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_rollups', to='core.school')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_rollups', to='core.term')),
+            ],
+            options={
+                'ordering': ['school', 'term', 'fee_category', 'month'],
+                'indexes': [models.Index(fields=['school', 'month'], name='fee_rollup_school_month_idx')],
+                'constraints': [models.UniqueConstraint(fields=('school', 'term', 'fee_category', 'month', 'due_date'), name='fee_rollup_bucket_uniq')],
+            },
+        ),
+        migrations.RunPython(populate_fee_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.3 on 2026-10-16 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_feerollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='studentfee',
+            index=models.Index(
+                condition=models.Q(('amount_charged__gt', models.F('amount_paid'))),
+                fields=['school', 'student', 'due_date'],
+                name='stud_fee_outstanding_idx',
+            ),
+        ),
+    ]
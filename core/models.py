@@ -1,10 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator
 from decimal import Decimal
 import uuid
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 
 
 class School(models.Model):
@@ -776,6 +777,46 @@ class StudentFee(models.Model):
             models.Index(fields=['school', 'due_date', 'is_paid'], name='stud_fee_sch_due_paid_idx'),
             models.Index(fields=['student', 'term', 'is_paid'], name='stud_fee_stu_term_paid_idx'),
             models.Index(fields=['due_date'], name='student_fee_due_date_idx'),
+            # Outstanding fees of a student, in due date order (receivables.allocation_service)
+            models.Index(
+                fields=['school', 'student', 'due_date'],
+                name='stud_fee_outstanding_idx',
+                condition=models.Q(amount_charged__gt=models.F('amount_paid')),
+            ),
+        ]
+
+
+class FeeRollup(models.Model):
+    """
+    Pre-aggregated StudentFee totals per school, term, fee category, month
+    (of the fee's creation) and due date. Kept up to date by the StudentFee
+    signals below and FinanceRollupService; rebuild with
+    ``manage.py rebuild_finance_rollups``.
+    """
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='fee_rollups')
+    term = models.ForeignKey(Term, on_delete=models.CASCADE, related_name='fee_rollups')
+    fee_category = models.ForeignKey(FeeCategory, on_delete=models.CASCADE, related_name='fee_rollups')
+    month = models.DateField(help_text='First day of the month the fees were created in')
+    due_date = models.DateField()
+    fee_count = models.IntegerField(default=0)
+    unpaid_count = models.IntegerField(default=0)
+    total_charged = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.school} - {self.term} - {self.fee_category} ({self.month:%b %Y})"
+
+    class Meta:
+        ordering = ['school', 'term', 'fee_category', 'month']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['school', 'term', 'fee_category', 'month', 'due_date'],
+                name='fee_rollup_bucket_uniq'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['school', 'month'], name='fee_rollup_school_month_idx'),
         ]
 
 
@@ -851,19 +892,13 @@ class Role(models.Model):
     
     def has_permission(self, permission_type, resource_type):
         """Check if this role has a specific permission"""
-        # Check if this role has all permissions (super_admin role)
-        # This is indicated by having all Permission objects assigned
-        # We check if the role has permissions count equal to total permissions
-        from .models import Permission
-        total_permissions = Permission.objects.count()
-        if total_permissions > 0 and self.permissions.count() == total_permissions:
+        # A role with every Permission assigned (super_admin) has all permissions;
+        # the resolver caches the role's permission set per role version
+        from .permission_resolver import role_permission_set, ALL_PERMISSIONS
+        permissions = role_permission_set(self.id, self.updated_at)
+        if permissions == ALL_PERMISSIONS:
             return True
-        
-        # Otherwise, check for the specific permission
-        return self.permissions.filter(
-            permission_type=permission_type,
-            resource_type=resource_type
-        ).exists()
+        return (permission_type, resource_type) in permissions
     
     class Meta:
         ordering = ['name']
@@ -953,7 +988,8 @@ class UserProfile(models.Model):
     
     def has_role(self, role_name):
         """Check if user has a specific role"""
-        return self.roles.filter(name=role_name).exists()
+        from .permission_resolver import profile_role_names
+        return role_name in profile_role_names(self)
     
     def get_roles_display(self):
         """Get comma-separated list of role display names"""
@@ -993,28 +1029,10 @@ class UserProfile(models.Model):
     
     def has_permission(self, permission_type, resource_type):
         """Check if the user has a specific permission through any of their roles"""
-        # Superusers have all permissions
-        if self.user.is_superuser:
-            return True
-        
-        # Check if user has super_admin role - they have all permissions
-        if self.has_role('super_admin'):
-            return True
-
-        # Backward-compatibility: if user has no M2M roles assigned but still uses the legacy
-        # `role` field, resolve that to a Role object and use its permissions.
-        # This avoids "You do not have permission..." for older users after introducing Role M2M.
-        if self.roles.count() == 0 and self.role:
-            legacy_role = Role.objects.filter(name=self.role, school=self.school).first()
-            if legacy_role and legacy_role.has_permission(permission_type, resource_type):
-                return True
-        
-        # Check if any of the user's roles have this permission
-        for role in self.roles.all():
-            if role.has_permission(permission_type, resource_type):
-                return True
-        
-        return False
+        # Superusers, super_admin role holders and legacy `role` users are all
+        # handled by the resolver, which loads the permission set once per request
+        from .permission_resolver import profile_has_permission
+        return profile_has_permission(self, permission_type, resource_type)
     
     # Backward compatibility properties (check roles, fallback to old role field)
     @property
@@ -1084,6 +1102,72 @@ def save_user_profile(sender, instance, **kwargs):
             pass
 
 
+@receiver(m2m_changed, sender=Role.permissions.through)
+def invalidate_role_permission_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """Bump the version of roles whose permissions changed"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    from .permission_resolver import touch_roles
+    if not reverse:
+        touch_roles([instance.pk])
+    elif action == 'post_clear':
+        # Permission.roles.clear() doesn't report which roles were affected
+        touch_roles()
+    elif pk_set:
+        touch_roles(pk_set)
+
+
+@receiver(m2m_changed, sender=UserProfile.roles.through)
+def clear_profile_permission_cache(sender, instance, action, reverse, **kwargs):
+    """Forget permissions memoised on a profile whose roles changed"""
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        from .permission_resolver import clear_profile_cache
+        clear_profile_cache(instance)
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def invalidate_permission_caches(sender, instance, **kwargs):
+    """The 'has every permission' check depends on the total, so all roles are affected"""
+    from .permission_resolver import touch_roles
+    touch_roles()
+
+
+@receiver(post_save, sender=Term)
+@receiver(post_delete, sender=Term)
+def invalidate_term_calendar(sender, instance, **kwargs):
+    """Rebuild the school's cached term calendar once the change is committed"""
+    from .term_calendar import invalidate
+    school_id = instance.school_id
+    transaction.on_commit(lambda: invalidate(school_id))
+
+
+@receiver(pre_save, sender=StudentFee)
+def store_previous_fee_rollup_values(sender, instance, **kwargs):
+    """Remember the fee's stored values so the rollup can be adjusted by the difference"""
+    if instance.pk:
+        instance._rollup_previous = StudentFee.objects.filter(pk=instance.pk).values(
+            'school_id', 'term_id', 'fee_category_id', 'created_at', 'due_date',
+            'amount_charged', 'amount_paid', 'is_paid'
+        ).first()
+    else:
+        instance._rollup_previous = None
+
+
+@receiver(post_save, sender=StudentFee)
+def update_fee_rollup_on_save(sender, instance, created, **kwargs):
+    """Apply a saved fee's change to the FeeRollup table"""
+    from .services.finance_rollup_service import FinanceRollupService
+    FinanceRollupService.record_fee_change(getattr(instance, '_rollup_previous', None), instance)
+
+
+@receiver(post_delete, sender=StudentFee)
+def update_fee_rollup_on_delete(sender, instance, **kwargs):
+    """Remove a deleted fee from the FeeRollup table"""
+    from .services.finance_rollup_service import FinanceRollupService
+    FinanceRollupService.record_fee_change(FinanceRollupService.fee_values(instance), None)
+
+
 # Store old short_name in a module-level dictionary to preserve it across save
 _old_short_names = {}
 
@@ -1441,3 +1525,87 @@ class PromotionLog(models.Model):
 
     def __str__(self):
         return f"Promotion: {self.from_academic_year.name} → {self.to_academic_year.name} ({self.created_at.date()})"
+
+
+class Job(models.Model):
+    """Database-backed background job (term billing, promotions, statement runs, etc.)"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
+    job_type = models.CharField(max_length=50, help_text='Registered job handler name (e.g. "generate_student_fees")')
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    progress_current = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(default=0)
+    progress_message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    error_message = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now, help_text='Job is not picked up before this time (used for retry backoff)')
+    cancel_requested = models.BooleanField(default=False)
+    worker = models.CharField(max_length=100, blank=True, help_text='Worker (host:pid) currently running this job')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.job_type} #{self.pk} - {self.get_status_display()}"
+
+    @property
+    def is_finished(self):
+        return self.status in ('completed', 'failed', 'cancelled')
+
+    @property
+    def percent(self):
+        """Progress percentage (0-100)"""
+        if self.status == 'completed':
+            return 100
+        if not self.progress_total:
+            return 0
+        return min(100, round(self.progress_current * 100 / self.progress_total, 1))
+
+    @property
+    def eta_seconds(self):
+        """Estimated seconds remaining, extrapolated from progress so far"""
+        if self.status != 'running' or not self.started_at or not self.progress_total or not self.progress_current:
+            return None
+        elapsed = (timezone.now() - self.started_at).total_seconds()
+        remaining = self.progress_total - self.progress_current
+        return max(0, round(elapsed / self.progress_current * remaining))
+
+    def get_signed_token(self):
+        """Generate an opaque signed token for this job to use in URLs."""
+        from django.core import signing
+        payload = {'jobid': self.id, 'sch': self.school_id}
+        return signing.dumps(payload)
+
+    @classmethod
+    def from_signed_token(cls, token):
+        """Resolve a signed token back to a Job object."""
+        from django.core import signing
+        from django.core.signing import BadSignature
+        try:
+            data = signing.loads(token)
+            job_id = data.get('jobid')
+            if not job_id:
+                return None
+            return cls.objects.get(id=job_id, school_id=data.get('sch'))
+        except (BadSignature, ValueError, cls.DoesNotExist, TypeError):
+            return None
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+            models.Index(fields=['school', 'created_at'], name='job_school_created_idx'),
+            models.Index(fields=['job_type', 'status'], name='job_type_status_idx'),
+        ]
@@ -3,10 +3,9 @@ M-Pesa Express (STK Push) API Integration Service
 """
 import requests
 import base64
-import json
 from datetime import datetime
 from django.conf import settings
-from django.utils import timezone
+from .daraja import DARAJA_TIMEOUT, get_access_token, get_daraja_session, invalidate_access_token
 import logging
 
 logger = logging.getLogger(__name__)
@@ -29,44 +28,27 @@ class MpesaService:
             self.base_url = 'https://api.safaricom.co.ke'
         else:
             self.base_url = 'https://sandbox.safaricom.co.ke'
-        
-        self.access_token = None
-        self.token_expires_at = None
     
     def get_access_token(self):
-        """Get OAuth access token from M-Pesa API"""
-        # Check if we have a valid token
-        if self.access_token and self.token_expires_at and timezone.now() < self.token_expires_at:
-            return self.access_token
-        
+        """Get OAuth access token from M-Pesa API (shared across workers, see core.daraja)"""
         try:
-            url = f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials'
-            
-            # Encode credentials
-            credentials = f'{self.consumer_key}:{self.consumer_secret}'
-            encoded_credentials = base64.b64encode(credentials.encode()).decode()
-            
-            headers = {
-                'Authorization': f'Basic {encoded_credentials}'
-            }
-            
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            self.access_token = data.get('access_token')
-            
-            # Token expires in 3599 seconds (set expiry 5 minutes before actual expiry)
-            expires_in = data.get('expires_in', 3599) - 300
-            self.token_expires_at = timezone.now() + timezone.timedelta(seconds=expires_in)
-            
-            logger.info('M-Pesa access token obtained successfully')
-            return self.access_token
-            
+            return get_access_token(self.base_url, self.consumer_key, self.consumer_secret)
         except Exception as e:
             logger.error(f'Error getting M-Pesa access token: {str(e)}')
             raise
     
+    def _post(self, url, payload, access_token):
+        """POST to Daraja over the shared session, dropping the cached token if it was rejected"""
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        response = get_daraja_session().post(url, json=payload, headers=headers, timeout=DARAJA_TIMEOUT)
+        if response.status_code == 401:
+            invalidate_access_token(self.base_url, self.consumer_key)
+        response.raise_for_status()
+        return response.json()
+    
     def generate_password(self, timestamp):
         """Generate password for STK push"""
         data_to_encode = f'{self.shortcode}{self.passkey}{timestamp}'
@@ -104,11 +86,6 @@ class MpesaService:
             # STK Push URL
             url = f'{self.base_url}/mpesa/stkpush/v1/processrequest'
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             payload = {
                 'BusinessShortCode': self.shortcode,
                 'Password': password,
@@ -123,10 +100,7 @@ class MpesaService:
                 'TransactionDesc': transaction_desc
             }
             
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = self._post(url, payload, access_token)
             
             if result.get('ResponseCode') == '0':
                 logger.info(f'M-Pesa STK Push initiated successfully. CheckoutRequestID: {result.get("CheckoutRequestID")}')
@@ -180,11 +154,6 @@ class MpesaService:
             
             url = f'{self.base_url}/mpesa/stkpushquery/v1/query'
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             payload = {
                 'BusinessShortCode': self.shortcode,
                 'Password': password,
@@ -192,10 +161,7 @@ class MpesaService:
                 'CheckoutRequestID': checkout_request_id
             }
             
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = self._post(url, payload, access_token)
             
             return {
                 'success': True,
@@ -0,0 +1,161 @@
+"""
+Role-based permission resolver
+
+Resolves a user's complete set of (permission_type, resource_type) pairs once
+per request instead of querying roles and permissions for every check.
+
+- Each role's permission set is cached under a key that includes the role's
+  ``updated_at`` timestamp, so any change to a role (or to its permissions,
+  which touches ``updated_at`` through the signals in core.models) produces a
+  new key and stale entries simply age out. This stays correct across worker
+  processes even with the default per-process cache.
+- The resolved set is memoised on the UserProfile instance, which lives on
+  ``request.user`` for the duration of a request.
+
+The decorators, DRF permission classes and the ``has_permission`` template
+filter all go through ``has_permission`` below.
+"""
+
+from django.core.cache import cache
+from django.utils import timezone
+
+# Marker for roles/users that hold every permission
+ALL_PERMISSIONS = 'all'
+
+ROLE_CACHE_TIMEOUT = 60 * 60 * 24
+PROFILE_CACHE_ATTR = '_resolved_permissions'
+
+
+def _role_cache_key(role_id, updated_at):
+    version = updated_at.timestamp() if updated_at else 0
+    return f'rbac:role:{role_id}:{version}'
+
+
+def role_permission_set(role_id, updated_at):
+    """
+    Return the permission set for a role, cached per role version
+
+    Args:
+        role_id: Role primary key
+        updated_at: The role's updated_at, used as the cache version
+
+    Returns:
+        frozenset of (permission_type, resource_type), or ALL_PERMISSIONS when
+        the role has every Permission assigned (the super_admin convention)
+    """
+    from .models import Permission, Role
+
+    key = _role_cache_key(role_id, updated_at)
+    permissions = cache.get(key)
+    if permissions is not None:
+        return permissions
+
+    pairs = frozenset(
+        Role.permissions.through.objects.filter(role_id=role_id).values_list(
+            'permission__permission_type', 'permission__resource_type'
+        )
+    )
+    total_permissions = Permission.objects.count()
+    if total_permissions > 0 and len(pairs) == total_permissions:
+        permissions = ALL_PERMISSIONS
+    else:
+        permissions = pairs
+    cache.set(key, permissions, ROLE_CACHE_TIMEOUT)
+    return permissions
+
+
+def _resolve(profile):
+    """Load the profile's role names and combined permission set"""
+    from .models import Role
+
+    roles = list(profile.roles.values_list('id', 'name', 'updated_at'))
+    role_names = frozenset(name for _, name, _ in roles)
+
+    if 'super_admin' in role_names:
+        return role_names, ALL_PERMISSIONS
+
+    # Backward-compatibility: users with no M2M roles but a legacy `role` value
+    # get the permissions of the school's Role of that name
+    if not roles and profile.role:
+        legacy_role = Role.objects.filter(
+            name=profile.role, school_id=profile.school_id
+        ).values_list('id', 'name', 'updated_at').first()
+        if legacy_role:
+            roles = [legacy_role]
+
+    permissions = set()
+    for role_id, _, updated_at in roles:
+        role_permissions = role_permission_set(role_id, updated_at)
+        if role_permissions == ALL_PERMISSIONS:
+            return role_names, ALL_PERMISSIONS
+        permissions |= role_permissions
+    return role_names, frozenset(permissions)
+
+
+def _resolved(profile):
+    resolved = getattr(profile, PROFILE_CACHE_ATTR, None)
+    if resolved is None:
+        resolved = _resolve(profile)
+        setattr(profile, PROFILE_CACHE_ATTR, resolved)
+    return resolved
+
+
+def profile_role_names(profile):
+    """Names of the profile's assigned roles (memoised for the request)"""
+    return _resolved(profile)[0]
+
+
+def profile_permissions(profile):
+    """The profile's permission set, or ALL_PERMISSIONS (memoised for the request)"""
+    if profile.user.is_superuser:
+        return ALL_PERMISSIONS
+    return _resolved(profile)[1]
+
+
+def profile_has_permission(profile, permission_type, resource_type):
+    """Check a permission against the profile's resolved permission set"""
+    permissions = profile_permissions(profile)
+    if permissions == ALL_PERMISSIONS:
+        return True
+    return (permission_type, resource_type) in permissions
+
+
+def has_permission(user, permission_type, resource_type):
+    """
+    Check whether a user holds a permission through any of their roles
+
+    Args:
+        user: Django user (anonymous users never have permissions)
+        permission_type: 'view', 'add', 'change' or 'delete'
+        resource_type: One of Permission.RESOURCE_TYPES
+
+    Returns:
+        True if the user has the permission
+    """
+    if not user or not user.is_authenticated:
+        return False
+    if user.is_superuser:
+        return True
+    profile = getattr(user, 'profile', None)
+    if profile is None:
+        return False
+    return profile_has_permission(profile, permission_type, resource_type)
+
+
+def clear_profile_cache(profile):
+    """Forget the permissions memoised on a profile instance"""
+    if profile is not None and hasattr(profile, PROFILE_CACHE_ATTR):
+        delattr(profile, PROFILE_CACHE_ATTR)
+
+
+def touch_roles(role_ids=None):
+    """
+    Bump the version of the given roles (all roles when None) so their cached
+    permission sets are no longer used
+    """
+    from .models import Role
+
+    roles = Role.objects.all()
+    if role_ids is not None:
+        roles = roles.filter(id__in=list(role_ids))
+    roles.update(updated_at=timezone.now())
@@ -4,6 +4,7 @@ Custom permission classes for role-based access control
 from rest_framework.permissions import BasePermission
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.mixins import LoginRequiredMixin
+from core import permission_resolver
 
 
 class HasResourcePermission(BasePermission):
@@ -32,11 +33,8 @@ class HasResourcePermission(BasePermission):
         # Get the required permission type based on the viewset action
         permission_type = action_map.get(view.action, 'view')
         
-        # Check if the user has the required permission
-        if hasattr(request.user, 'profile'):
-            return request.user.profile.has_permission(permission_type, self.resource_type)
-            
-        return False
+        # Check if the user has the required permission (resolved once per request)
+        return permission_resolver.has_permission(request.user, permission_type, self.resource_type)
 
 
 def HasResourcePermissionFactory(resource_type):
@@ -56,9 +54,8 @@ class CustomPermissionRequiredMixin(LoginRequiredMixin):
         if self.request.user.is_superuser:
             return True
 
-        profile = getattr(self.request.user, 'profile', None)
-        if profile and self.permission_type and self.resource_type:
-            return profile.has_permission(self.permission_type, self.resource_type)
+        if self.permission_type and self.resource_type:
+            return permission_resolver.has_permission(self.request.user, self.permission_type, self.resource_type)
         return False
 
     def dispatch(self, request, *args, **kwargs):
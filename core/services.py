@@ -9,6 +9,8 @@ from .models import School, Student, Term, StudentFee, Grade, SchoolClass
 from attendance.models import Attendance, AttendanceSummary
 from exams.models import Exam, Gradebook, GradebookSummary
 from receivables.models import Payment
+from core.services.finance_rollup_service import FinanceRollupService
+from core.term_calendar import TermCalendar
 
 
 class DashboardService:
@@ -17,7 +19,7 @@ class DashboardService:
     @staticmethod
     def get_dashboard_data(school, user):
         """Get all dashboard statistics"""
-        current_term = Term.objects.filter(school=school, is_active=True).first()
+        current_term = TermCalendar.for_school(school).active_term()
         
         # Student statistics
         total_students = Student.objects.filter(school=school, is_active=True).count()
@@ -65,31 +67,8 @@ class DashboardService:
     
     @staticmethod
     def _get_fee_statistics(school, current_term):
-        """Get fee-related statistics"""
-        if not current_term:
-            return {
-                'total_charged': 0,
-                'total_paid': 0,
-                'total_balance': 0,
-                'overdue_count': 0,
-            }
-        
-        fees = StudentFee.objects.filter(school=school, term=current_term)
-        
-        total_charged = fees.aggregate(total=Sum('amount_charged'))['total'] or 0
-        total_paid = fees.aggregate(total=Sum('amount_paid'))['total'] or 0
-        total_balance = total_charged - total_paid
-        overdue_count = fees.filter(
-            is_paid=False,
-            due_date__lt=timezone.now().date()
-        ).count()
-        
-        return {
-            'total_charged': float(total_charged),
-            'total_paid': float(total_paid),
-            'total_balance': float(total_balance),
-            'overdue_count': overdue_count,
-        }
+        """Get fee-related statistics (read from the FeeRollup table)"""
+        return FinanceRollupService.fee_statistics(school, current_term)
     
     @staticmethod
     def _get_attendance_statistics(school, current_term):
@@ -149,12 +128,7 @@ class DashboardService:
             exam__term=current_term
         )
         
-        if gradebooks.exists():
-            avg_performance = gradebooks.aggregate(
-                avg=Avg('percentage')
-            )['avg'] or 0
-        else:
-            avg_performance = 0
+        avg_performance = gradebooks.aggregate(avg=Avg('percentage'))['avg'] or 0
         
         return {
             'total_exams': total_exams,
@@ -252,10 +226,7 @@ class TeacherService:
         
         # Exam statistics
         gradebooks = Gradebook.objects.filter(student=student)
-        if gradebooks.exists():
-            avg_performance = gradebooks.aggregate(avg=Avg('percentage'))['avg'] or 0
-        else:
-            avg_performance = 0
+        avg_performance = gradebooks.aggregate(avg=Avg('percentage'))['avg'] or 0
         
         return {
             'fee_statistics': {
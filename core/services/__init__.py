@@ -1,10 +1,17 @@
 # Services package
 # Import new promotion service
 from .promotion_service import PromotionService, PromotionPreview, PromotionResult
+from .fee_generation_service import FeeGenerationService, FeeGenerationReport, FeeChange
+from .finance_rollup_service import FinanceRollupService
+from .statement_ledger import StatementLedger
 
 __all__ = [
     'PromotionService', 
     'PromotionPreview', 
-    'PromotionResult'
+    'PromotionResult',
+    'FeeGenerationService',
+    'FeeGenerationReport',
+    'FeeChange',
+    'FinanceRollupService',
+    'StatementLedger',
 ]
-
@@ -0,0 +1,280 @@
+"""
+Student Fee Generation Service
+
+Applies FeeStructure amounts to students for a term as a set-based operation.
+Structures, opt-ins, transport routes and existing StudentFee rows are loaded
+once, the insert/update/delete diff is computed in memory and written with
+bulk operations, followed by a single Receivable sync for the touched fees.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+from dataclasses import dataclass, field
+from typing import List, Optional
+from decimal import Decimal
+import logging
+
+from .finance_rollup_service import FinanceRollupService
+from receivables.receivable_sync import sync_receivables
+from receivables.report_cube import mark_dirty
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FeeChange:
+    """A single planned change to a StudentFee row"""
+    student_id: int
+    student_code: str
+    student_name: str
+    fee_category_id: int
+    fee_category_name: str
+    action: str  # 'create', 'update', 'delete'
+    amount: Decimal
+    previous_amount: Optional[Decimal] = None
+    reason: str = ''
+    student_fee_id: Optional[int] = None
+
+
+@dataclass
+class FeeGenerationReport:
+    """Diff report of a fee generation run (also returned for dry runs)"""
+    dry_run: bool
+    students_count: int = 0
+    created_count: int = 0
+    updated_count: int = 0
+    unchanged_count: int = 0
+    skipped_count: int = 0
+    deleted_count: int = 0
+    transport_deleted_count: int = 0
+    changes: List[FeeChange] = field(default_factory=list)
+
+    @property
+    def to_create(self):
+        return [c for c in self.changes if c.action == 'create']
+
+    @property
+    def to_update(self):
+        return [c for c in self.changes if c.action == 'update']
+
+    @property
+    def to_delete(self):
+        return [c for c in self.changes if c.action == 'delete']
+
+
+class FeeGenerationService:
+    """Service for generating StudentFee records from fee structures in bulk"""
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, school, term, grade_id=None):
+        """
+        Initialize fee generation service
+
+        Args:
+            school: School instance
+            term: Term instance fees are generated for
+            grade_id: Optional grade ID to restrict generation to one grade
+        """
+        self.school = school
+        self.term = term
+        self.grade_id = grade_id
+
+    def _get_transport_type(self):
+        from core.models import FeeCategoryType
+        return FeeCategoryType.objects.filter(school=self.school, code='transport').first()
+
+    def _load_structures(self, transport_type):
+        """Active fee structures for the term grouped by grade, in allocation order"""
+        from core.models import FeeStructure
+
+        structures = FeeStructure.objects.filter(
+            school=self.school,
+            term=self.term,
+            is_active=True
+        ).select_related('fee_category').order_by('fee_category__allocation_order', 'fee_category__name')
+        if transport_type:
+            structures = structures.exclude(fee_category__category_type=transport_type)
+        if self.grade_id:
+            structures = structures.filter(grade_id=self.grade_id)
+
+        by_grade = {}
+        for structure in structures:
+            by_grade.setdefault(structure.grade_id, []).append(structure)
+        return by_grade
+
+    def _load_students(self, grade_ids):
+        from core.models import Student
+
+        students = Student.objects.filter(school=self.school, is_active=True).select_related('transport_route')
+        if self.grade_id:
+            return list(students.filter(grade_id=self.grade_id))
+        return list(students.filter(grade_id__in=grade_ids))
+
+    def _load_opt_ins(self, student_ids):
+        """Set of (student_id, fee_category_id) pairs for optional fee opt-ins"""
+        from core.models import Student
+
+        through = Student.optional_fee_categories.through
+        return set(
+            through.objects.filter(student_id__in=student_ids).values_list('student_id', 'feecategory_id')
+        )
+
+    def _load_existing_fees(self, student_ids):
+        """Existing StudentFee rows for the term keyed by (student_id, fee_category_id)"""
+        from core.models import StudentFee
+
+        existing = StudentFee.objects.filter(
+            school=self.school,
+            term=self.term,
+            student_id__in=student_ids
+        ).only('id', 'student_id', 'fee_category_id', 'amount_charged', 'amount_paid', 'is_paid')
+        return {(fee.student_id, fee.fee_category_id): fee for fee in existing}
+
+    def plan(self, dry_run=True):
+        """
+        Compute the insert/update/delete diff for the term without writing anything
+
+        Returns:
+            Tuple of (FeeGenerationReport, new StudentFee instances, updated StudentFee instances, IDs to delete)
+        """
+        from core.models import FeeCategory, StudentFee
+
+        report = FeeGenerationReport(dry_run=dry_run)
+
+        transport_type = self._get_transport_type()
+        structures_by_grade = self._load_structures(transport_type)
+        transport_category = None
+        if transport_type:
+            transport_category = FeeCategory.objects.filter(
+                school=self.school,
+                category_type=transport_type
+            ).first()
+
+        students = self._load_students(list(structures_by_grade.keys()))
+        report.students_count = len(students)
+        student_ids = [s.id for s in students]
+        opt_ins = self._load_opt_ins(student_ids)
+        existing = self._load_existing_fees(student_ids)
+
+        new_fees = []
+        updated_fees = []
+        delete_ids = []
+
+        def record(student, category, action, amount, previous=None, reason='', fee_id=None):
+            report.changes.append(FeeChange(
+                student_id=student.id,
+                student_code=student.student_id,
+                student_name=student.full_name,
+                fee_category_id=category.id,
+                fee_category_name=category.name,
+                action=action,
+                amount=amount,
+                previous_amount=previous,
+                reason=reason,
+                student_fee_id=fee_id,
+            ))
+
+        def apply_amount(student, category, amount):
+            fee = existing.get((student.id, category.id))
+            if fee is None:
+                new_fees.append(StudentFee(
+                    school=self.school,
+                    student=student,
+                    term=self.term,
+                    fee_category=category,
+                    amount_charged=amount,
+                    amount_paid=Decimal('0'),
+                    due_date=self.term.end_date,
+                    is_paid=amount <= 0,
+                ))
+                report.created_count += 1
+                record(student, category, 'create', amount)
+            elif fee.amount_charged != amount:
+                previous = fee.amount_charged
+                fee.amount_charged = amount
+                fee.is_paid = max(Decimal('0'), fee.amount_paid) >= amount
+                updated_fees.append(fee)
+                report.updated_count += 1
+                record(student, category, 'update', amount, previous=previous, fee_id=fee.id)
+            else:
+                report.unchanged_count += 1
+
+        for student in students:
+            for structure in structures_by_grade.get(student.grade_id, []):
+                category = structure.fee_category
+                if category.is_optional and (student.id, category.id) not in opt_ins:
+                    # Remove fee if student hasn't opted in
+                    report.skipped_count += 1
+                    fee = existing.get((student.id, category.id))
+                    if fee is not None:
+                        delete_ids.append(fee.id)
+                        report.deleted_count += 1
+                        record(student, category, 'delete', fee.amount_charged,
+                               reason='Not opted in to optional fee', fee_id=fee.id)
+                    continue
+                apply_amount(student, category, structure.amount)
+
+            if transport_category:
+                route = student.transport_route
+                if route and route.is_currently_active():
+                    apply_amount(student, transport_category, route.base_fare)
+                else:
+                    fee = existing.get((student.id, transport_category.id))
+                    if fee is not None:
+                        delete_ids.append(fee.id)
+                        report.transport_deleted_count += 1
+                        record(student, transport_category, 'delete', fee.amount_charged,
+                               reason='No active transport route', fee_id=fee.id)
+
+        return report, new_fees, updated_fees, delete_ids
+
+    def generate(self, dry_run=False) -> FeeGenerationReport:
+        """
+        Generate StudentFee records for the term
+
+        Args:
+            dry_run: If True, only compute and return the diff report
+
+        Returns:
+            FeeGenerationReport describing the (planned) changes
+        """
+        from core.models import StudentFee
+
+        report, new_fees, updated_fees, delete_ids = self.plan(dry_run=dry_run)
+        if dry_run:
+            return report
+
+        with transaction.atomic():
+            if delete_ids:
+                StudentFee.objects.filter(id__in=delete_ids).delete()
+
+            if new_fees:
+                StudentFee.objects.bulk_create(new_fees, batch_size=self.BATCH_SIZE)
+
+            if updated_fees:
+                now = timezone.now()
+                for fee in updated_fees:
+                    fee.updated_at = now
+                StudentFee.objects.bulk_update(
+                    updated_fees,
+                    ['amount_charged', 'is_paid', 'updated_at'],
+                    batch_size=self.BATCH_SIZE
+                )
+
+            # bulk_create/bulk_update bypass post_save, so sync receivables set-wise
+            touched = StudentFee.objects.filter(
+                school=self.school,
+                term=self.term,
+                student_id__in={c.student_id for c in report.changes if c.action != 'delete'}
+            ).values_list('id', flat=True)
+            sync_receivables(self.school, student_fee_ids=touched)
+            FinanceRollupService.rebuild(self.school, term_ids=[self.term.id])
+            mark_dirty(self.school.id, term_ids=[self.term.id])
+
+        logger.info(
+            'Generated fees for %s term %s: %s created, %s updated, %s deleted',
+            self.school, self.term, report.created_count, report.updated_count,
+            report.deleted_count + report.transport_deleted_count
+        )
+        return report
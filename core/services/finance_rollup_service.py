@@ -0,0 +1,259 @@
+"""
+Finance Rollup Service
+
+Maintains the FeeRollup table: StudentFee totals per school, term, fee
+category, creation month and due date. Single-row saves and deletes adjust
+their bucket by the difference (see the StudentFee signals in core.models),
+and AllocationService applies the differences of its bulk balance updates
+through ``record_fee_changes``; fee generation calls ``rebuild`` for the
+term it wrote. Dashboards read the
+small rollup table instead of aggregating the fee table on every request.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from datetime import date
+from decimal import Decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FinanceRollupService:
+    """Incremental maintenance and reads of per-school fee rollups"""
+
+    FEE_VALUE_FIELDS = (
+        'school_id', 'term_id', 'fee_category_id', 'created_at', 'due_date',
+        'amount_charged', 'amount_paid', 'is_paid'
+    )
+
+    @staticmethod
+    def fee_values(fee):
+        """The fields of a StudentFee instance that determine its rollup bucket and totals"""
+        return {name: getattr(fee, name) for name in FinanceRollupService.FEE_VALUE_FIELDS}
+
+    @staticmethod
+    def _month_of(value):
+        if value is None:
+            value = timezone.now()
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return date(value.year, value.month, 1)
+
+    @staticmethod
+    def _bucket(values):
+        return (
+            values['school_id'],
+            values['term_id'],
+            values['fee_category_id'],
+            FinanceRollupService._month_of(values['created_at']),
+            values['due_date'],
+        )
+
+    @staticmethod
+    def _totals(values, sign):
+        return (
+            sign,
+            sign if not values['is_paid'] else 0,
+            sign * Decimal(values['amount_charged'] or 0),
+            sign * max(Decimal('0'), Decimal(values['amount_paid'] or 0)),
+        )
+
+    @staticmethod
+    def record_fee_change(previous, fee):
+        """
+        Move a fee's contribution from its previous bucket to its current one
+
+        Args:
+            previous: Dict of FEE_VALUE_FIELDS as stored before the change (None for new fees)
+            fee: StudentFee after the change (None when deleted)
+        """
+        FinanceRollupService.record_fee_changes([(previous, fee)])
+
+    @staticmethod
+    def record_fee_changes(changes):
+        """
+        Apply many fee changes, with one delta per touched bucket
+
+        Args:
+            changes: Iterable of (previous, fee) pairs as taken by ``record_fee_change``
+        """
+        deltas = {}
+
+        def add(values, sign):
+            bucket = FinanceRollupService._bucket(values)
+            added = FinanceRollupService._totals(values, sign)
+            existing = deltas.get(bucket, (0, 0, Decimal('0'), Decimal('0')))
+            deltas[bucket] = tuple(a + b for a, b in zip(existing, added))
+
+        for previous, fee in changes:
+            if previous:
+                add(previous, -1)
+            if fee is not None:
+                add(FinanceRollupService.fee_values(fee), 1)
+
+        # Sorted so concurrent writers lock buckets in the same order
+        for bucket, (fee_count, unpaid_count, charged, paid) in sorted(deltas.items(), key=lambda item: str(item[0])):
+            if fee_count or unpaid_count or charged or paid:
+                FinanceRollupService._apply_delta(bucket, fee_count, unpaid_count, charged, paid)
+
+    @staticmethod
+    def _apply_delta(bucket, fee_count, unpaid_count, charged, paid):
+        from core.models import FeeRollup
+
+        school_id, term_id, fee_category_id, month, due_date = bucket
+        key = {
+            'school_id': school_id,
+            'term_id': term_id,
+            'fee_category_id': fee_category_id,
+            'month': month,
+            'due_date': due_date,
+        }
+        changes = {
+            'fee_count': F('fee_count') + fee_count,
+            'unpaid_count': F('unpaid_count') + unpaid_count,
+            'total_charged': F('total_charged') + charged,
+            'total_paid': F('total_paid') + paid,
+            'updated_at': timezone.now(),
+        }
+        if FeeRollup.objects.filter(**key).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                FeeRollup.objects.create(
+                    **key,
+                    fee_count=fee_count,
+                    unpaid_count=unpaid_count,
+                    total_charged=charged,
+                    total_paid=paid,
+                )
+        except IntegrityError:
+            # Another writer created the bucket first
+            FeeRollup.objects.filter(**key).update(**changes)
+
+    @staticmethod
+    def rebuild(school=None, term_ids=None):
+        """
+        Recompute rollup rows from StudentFee
+
+        Args:
+            school: Limit the rebuild to one school (all schools when None)
+            term_ids: Optional iterable of term ids to limit the rebuild to
+
+        Returns:
+            Number of rollup rows written
+        """
+        from core.models import FeeRollup, School, StudentFee
+
+        fees = StudentFee.objects.all()
+        rollups = FeeRollup.objects.all()
+        if school is not None:
+            fees = fees.filter(school=school)
+            rollups = rollups.filter(school=school)
+        if term_ids is not None:
+            term_ids = list(term_ids)
+            fees = fees.filter(term_id__in=term_ids)
+            rollups = rollups.filter(term_id__in=term_ids)
+
+        with transaction.atomic():
+            if school is not None:
+                # One rebuild per school at a time
+                School.objects.select_for_update().filter(pk=school.pk).first()
+            # Lock the rows being replaced before reading the fee totals: a
+            # concurrent signal delta either committed before the lock (and
+            # is in the aggregate) or waits and is applied to the new rows
+            list(rollups.select_for_update().values_list('id', flat=True))
+
+            aggregates = fees.annotate(
+                month=TruncMonth('created_at')
+            ).values(
+                'school_id', 'term_id', 'fee_category_id', 'month', 'due_date'
+            ).annotate(
+                fee_count=Count('id'),
+                unpaid_count=Count('id', filter=Q(is_paid=False)),
+                total_charged=Sum('amount_charged'),
+                total_paid=Sum('amount_paid', filter=Q(amount_paid__gt=0)),
+            ).order_by()
+
+            rows = [
+                FeeRollup(
+                    school_id=row['school_id'],
+                    term_id=row['term_id'],
+                    fee_category_id=row['fee_category_id'],
+                    month=FinanceRollupService._month_of(row['month']),
+                    due_date=row['due_date'],
+                    fee_count=row['fee_count'],
+                    unpaid_count=row['unpaid_count'],
+                    total_charged=row['total_charged'] or Decimal('0'),
+                    total_paid=row['total_paid'] or Decimal('0'),
+                )
+                for row in aggregates
+            ]
+            rollups.delete()
+            FeeRollup.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+    @staticmethod
+    def fee_statistics(school, term):
+        """Charged, paid, balance and overdue count for a term"""
+        from core.models import FeeRollup
+
+        if not term:
+            return {
+                'total_charged': 0,
+                'total_paid': 0,
+                'total_balance': 0,
+                'overdue_count': 0,
+            }
+        rows = FeeRollup.objects.filter(school=school, term=term)
+        totals = rows.aggregate(charged=Sum('total_charged'), paid=Sum('total_paid'))
+        overdue = rows.filter(due_date__lt=timezone.now().date()).aggregate(
+            count=Sum('unpaid_count')
+        )['count'] or 0
+        total_charged = totals['charged'] or 0
+        total_paid = totals['paid'] or 0
+        return {
+            'total_charged': float(total_charged),
+            'total_paid': float(total_paid),
+            'total_balance': float(total_charged - total_paid),
+            'overdue_count': overdue,
+        }
+
+    @staticmethod
+    def monthly_trend(school, months=6):
+        """[(month, charged, paid)] for fees created in the last ``months`` months"""
+        from core.models import FeeRollup
+
+        today = timezone.now().date()
+        start_index = today.year * 12 + today.month - 1 - (months - 1)
+        start_month = date(start_index // 12, start_index % 12 + 1, 1)
+        return [
+            (row['month'], row['charged'] or 0, row['paid'] or 0)
+            for row in FeeRollup.objects.filter(
+                school=school, month__gte=start_month
+            ).values('month').annotate(
+                charged=Sum('total_charged'), paid=Sum('total_paid')
+            ).order_by('month')
+        ]
+
+    @staticmethod
+    def category_breakdown(school, term):
+        """Charged and paid per fee category for a term, largest first"""
+        from core.models import FeeRollup
+
+        if not term:
+            return []
+        return [
+            {
+                'category': row['fee_category__name'] or 'Unknown',
+                'charged': float(row['charged'] or 0),
+                'paid': float(row['paid'] or 0),
+            }
+            for row in FeeRollup.objects.filter(school=school, term=term).values(
+                'fee_category__name'
+            ).annotate(
+                charged=Sum('total_charged'), paid=Sum('total_paid')
+            ).order_by('-charged')
+        ]
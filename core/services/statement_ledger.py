@@ -0,0 +1,275 @@
+"""
+Statement Ledger Service
+
+Builds a student's fee statement - opening balance, the fees and completed
+payments dated within the statement period, and the running balance after
+each entry - in one PostgreSQL query. Entries are dated by when a fee was
+charged (created_at) and when a payment was made (payment_date); within a
+day fees come before payments, each in fee category allocation order.
+
+The staff, parent portal, PDF and emailed statements all read from this
+service, so they always agree on what a statement contains.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from decimal import Decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip when streaming a ledger
+STREAM_CHUNK_SIZE = 500
+
+LEDGER_ORDER = 'entry_date, kind, allocation_order, sort_year, sort_term, sort_name, sort_at, reference'
+
+
+class StatementLedger:
+    """Opening balance, dated entries and running balance for one student's statement"""
+
+    def __init__(self, student, school=None, start_date=None, end_date=None):
+        self.student = student
+        self.school = school or student.school
+        self.start_date = start_date
+        self.end_date = end_date
+        self._opening_balance = None
+        self._transactions = None
+
+    @classmethod
+    def for_request(cls, request, student, school=None, start_date=None, end_date=None):
+        """
+        Return the ledger for a statement, memoised on the request
+
+        Args:
+            request: Current HttpRequest
+            student: Student the statement is for
+            school: Statement school (defaults to the student's school)
+            start_date: First day of the statement period, or None
+            end_date: Last day of the statement period, or None
+
+        Returns:
+            StatementLedger shared by every caller in the same request
+        """
+        school = school or student.school
+        memo = getattr(request, '_statement_ledgers', None)
+        if memo is None:
+            memo = {}
+            request._statement_ledgers = memo
+        key = (school.id, student.id, start_date, end_date)
+        if key not in memo:
+            memo[key] = cls(student, school=school, start_date=start_date, end_date=end_date)
+        return memo[key]
+
+    @staticmethod
+    def _local_date(column):
+        """SQL for the date of a timestamp column in the active time zone (as Django's __date lookup)"""
+        if settings.USE_TZ:
+            return f'({column} AT TIME ZONE %(tz)s)::date'
+        return f'{column}::date'
+
+    def _sql(self):
+        from core.models import FeeCategory, StudentFee, Term
+        from receivables.models import Payment, PaymentAllocation
+
+        qn = connection.ops.quote_name
+        fee_table = qn(StudentFee._meta.db_table)
+        category_table = qn(FeeCategory._meta.db_table)
+        term_table = qn(Term._meta.db_table)
+        payment_table = qn(Payment._meta.db_table)
+        allocation_table = qn(PaymentAllocation._meta.db_table)
+
+        return f"""
+            WITH entries AS (
+                SELECT 0 AS kind,
+                       {self._local_date('sf.created_at')} AS entry_date,
+                       fc.name || ' - ' || t.academic_year || ' Term ' || t.term_number AS description,
+                       sf.due_date AS due_date,
+                       'Fee-' || sf.id AS reference,
+                       sf.amount_charged AS debit,
+                       0::numeric AS credit,
+                       NULL::varchar AS payment_method,
+                       fc.allocation_order AS allocation_order,
+                       t.academic_year AS sort_year,
+                       t.term_number AS sort_term,
+                       fc.name AS sort_name,
+                       NULL AS sort_at
+                FROM {fee_table} sf
+                JOIN {category_table} fc ON fc.id = sf.fee_category_id
+                JOIN {term_table} t ON t.id = sf.term_id
+                WHERE sf.school_id = %(school_id)s AND sf.student_id = %(student_id)s
+                UNION ALL
+                SELECT 1,
+                       {self._local_date('p.payment_date')},
+                       'Payment - ' || COALESCE(alloc.names, pfc.name),
+                       NULL,
+                       COALESCE(NULLIF(p.reference_number, ''), p.payment_id::text),
+                       0::numeric,
+                       p.amount,
+                       p.payment_method,
+                       COALESCE(alloc.allocation_order, pfc.allocation_order),
+                       NULL, NULL, NULL,
+                       p.payment_date
+                FROM {payment_table} p
+                JOIN {fee_table} psf ON psf.id = p.student_fee_id
+                JOIN {category_table} pfc ON pfc.id = psf.fee_category_id
+                LEFT JOIN LATERAL (
+                    -- Categories the payment was allocated to, most recent allocation first
+                    SELECT string_agg(c.name, ', ' ORDER BY c.last_allocated DESC, c.last_id DESC) AS names,
+                           MIN(c.allocation_order) AS allocation_order
+                    FROM (
+                        SELECT afc.name,
+                               MIN(afc.allocation_order) AS allocation_order,
+                               MAX(pa.created_at) AS last_allocated,
+                               MAX(pa.id) AS last_id
+                        FROM {allocation_table} pa
+                        JOIN {fee_table} asf ON asf.id = pa.student_fee_id
+                        JOIN {category_table} afc ON afc.id = asf.fee_category_id
+                        WHERE pa.payment_id = p.id
+                        GROUP BY afc.name
+                    ) c
+                ) alloc ON TRUE
+                WHERE p.school_id = %(school_id)s AND p.student_id = %(student_id)s AND p.status = 'completed'
+            ),
+            opening AS (
+                SELECT COALESCE(SUM(debit - credit), 0) AS amount
+                FROM entries
+                WHERE %(start_date)s::date IS NOT NULL AND entry_date < %(start_date)s::date
+            ),
+            period AS (
+                SELECT e.*,
+                       SUM(e.debit - e.credit) OVER (
+                           ORDER BY {LEDGER_ORDER} ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                       ) AS movement
+                FROM entries e
+                WHERE (%(start_date)s::date IS NULL OR e.entry_date >= %(start_date)s::date)
+                  AND (%(end_date)s::date IS NULL OR e.entry_date <= %(end_date)s::date)
+            )
+            SELECT opening.amount, p.kind, p.entry_date, p.description, p.due_date, p.reference,
+                   p.debit, p.credit, p.payment_method, p.allocation_order, opening.amount + p.movement
+            FROM opening
+            LEFT JOIN period p ON TRUE
+            ORDER BY {', '.join('p.' + column.strip() for column in LEDGER_ORDER.split(','))}
+        """
+
+    def _params(self):
+        return {
+            'school_id': self.school.id,
+            'student_id': self.student.id,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'tz': timezone.get_current_timezone_name(),
+        }
+
+    def rows(self):
+        """
+        Stream the statement entries without holding the whole history in memory
+
+        Yields:
+            Dict per entry with date, description, due_date (fees), reference,
+            debit, credit, type ('fee' or 'payment'), payment_method (payments),
+            allocation_order and balance
+        """
+        from receivables.models import Payment
+
+        method_labels = dict(Payment.PAYMENT_METHOD_CHOICES)
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(self._sql(), self._params())
+            while True:
+                chunk = cursor.fetchmany(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                for (opening, kind, entry_date, description, due_date, reference,
+                     debit, credit, payment_method, allocation_order, balance) in chunk:
+                    self._opening_balance = opening
+                    if kind is None:
+                        # Opening balance only: no entries in the period
+                        continue
+                    entry = {
+                        'date': entry_date,
+                        'description': description,
+                        'reference': reference,
+                        'debit': debit,
+                        'credit': credit,
+                        'type': 'fee' if kind == 0 else 'payment',
+                        'allocation_order': 999 if allocation_order is None else allocation_order,
+                        'balance': balance,
+                    }
+                    if kind == 0:
+                        entry['due_date'] = due_date
+                    else:
+                        entry['payment_method'] = method_labels.get(payment_method, payment_method)
+                    yield entry
+
+    @property
+    def transactions(self):
+        """All entries in the period, loaded once"""
+        if self._transactions is None:
+            self._transactions = list(self.rows())
+        return self._transactions
+
+    @property
+    def opening_balance(self):
+        if self._transactions is None:
+            # Every row carries the opening balance, so loading the entries sets it
+            self._transactions = list(self.rows())
+        return self._opening_balance if self._opening_balance is not None else Decimal('0.00')
+
+    @property
+    def total_debits(self):
+        return sum((t['debit'] for t in self.transactions), Decimal('0.00'))
+
+    @property
+    def total_credits(self):
+        return sum((t['credit'] for t in self.transactions), Decimal('0.00'))
+
+    @property
+    def closing_balance(self):
+        return self.opening_balance + self.total_debits - self.total_credits
+
+    @property
+    def balance_label(self):
+        closing_balance = self.closing_balance
+        if closing_balance > 0:
+            return 'Balance Due'
+        if closing_balance < 0:
+            return 'Credit Balance'
+        return 'Closing Balance'
+
+    @property
+    def balance_type(self):
+        closing_balance = self.closing_balance
+        if closing_balance > 0:
+            return 'outstanding'
+        if closing_balance < 0:
+            return 'credit'
+        return 'zero'
+
+    def context(self, **extra):
+        """
+        Template context shared by the statement page, PDF and emails
+
+        Args:
+            **extra: Additional context (e.g. logo_path, parent)
+
+        Returns:
+            Dict for the statement templates
+        """
+        closing_balance = self.closing_balance
+        context = {
+            'student': self.student,
+            'school': self.school,
+            'transactions': self.transactions,
+            'opening_balance': self.opening_balance,
+            'total_debits': self.total_debits,
+            'total_credits': self.total_credits,
+            'closing_balance': closing_balance,
+            'closing_balance_abs': abs(closing_balance),
+            'balance_label': self.balance_label,
+            'balance_type': self.balance_type,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'statement_date': timezone.now().date(),
+        }
+        context.update(extra)
+        return context
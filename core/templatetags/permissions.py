@@ -2,6 +2,7 @@
 Template filters for permission checking
 """
 from django import template
+from core import permission_resolver
 
 register = template.Library()
 
@@ -38,9 +39,10 @@ def has_permission(user, permission_string):
     permission_type = parts[0]  # e.g., 'view', 'add', 'change', 'delete'
     resource_type = '_'.join(parts[1:])  # e.g., 'term', 'student', 'school_class'
     
-    # Call the profile's has_permission method
+    # The resolver loads the user's permission set once per request, so
+    # sidebar menus with many checks don't query roles for each item
     try:
-        return user.profile.has_permission(permission_type, resource_type)
+        return permission_resolver.has_permission(user, permission_type, resource_type)
     except (AttributeError, TypeError):
         return False
 
@@ -0,0 +1,142 @@
+"""
+Term calendar
+
+Resolves "which term contains this date" in memory instead of querying Term
+each time. ``TermCalendar.for_school(school)`` loads a school's terms once
+into arrays sorted by start date, and ``term_for`` / ``terms_for`` answer
+with a bisect.
+
+- Calendars are kept per process and tagged with a version stored in the
+  Django cache. The Term post_save/post_delete signals in core.models bump
+  the version, and the next ``for_school`` call rebuilds that school's
+  calendar. With a shared cache this reaches every worker at once. With the
+  default per-process cache, other workers pick up the change when their
+  copy is older than TERM_CALENDAR_MAX_AGE seconds.
+- When terms overlap, the same term as ``Term.objects.filter(...).first()``
+  is returned (default Term ordering: latest academic year, then term
+  number).
+
+The Term instances handed out are shared snapshots and must be treated as
+read-only.
+"""
+
+from bisect import bisect_right
+from django.conf import settings
+from django.core.cache import cache
+import threading
+import time
+
+VERSION_CACHE_TIMEOUT = None  # Versions never expire; a missing version just forces a rebuild
+
+_calendars = {}  # school id -> TermCalendar
+_lock = threading.Lock()
+
+
+def _version_key(school_id):
+    return f'term_calendar:version:{school_id}'
+
+
+def _current_version(school_id):
+    return cache.get(_version_key(school_id))
+
+
+def invalidate(school_id):
+    """Bump a school's calendar version so every worker rebuilds it"""
+    cache.set(_version_key(school_id), time.time_ns(), VERSION_CACHE_TIMEOUT)
+    _calendars.pop(school_id, None)
+
+
+class TermCalendar:
+    """Sorted interval index of one school's terms"""
+
+    def __init__(self, school_id, terms, version=None):
+        self.school_id = school_id
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # Position in the default Term ordering breaks ties between overlapping terms
+        self._rank = {term.id: rank for rank, term in enumerate(terms)}
+        self._active = next((term for term in terms if term.is_active), None)
+
+        self._terms = sorted(terms, key=lambda term: (term.start_date, term.id))
+        self._starts = [term.start_date for term in self._terms]
+        # Running maximum of end dates, so a lookup can stop scanning back
+        # once no earlier term can still be open
+        self._max_ends = []
+        for term in self._terms:
+            latest = self._max_ends[-1] if self._max_ends else term.end_date
+            self._max_ends.append(max(latest, term.end_date))
+
+    @classmethod
+    def for_school(cls, school):
+        """
+        Return the school's calendar, rebuilding it if its terms changed
+
+        Args:
+            school: School instance or id
+
+        Returns:
+            TermCalendar
+        """
+        from .models import Term
+
+        school_id = getattr(school, 'pk', school)
+        version = _current_version(school_id)
+        max_age = getattr(settings, 'TERM_CALENDAR_MAX_AGE', 300)
+        calendar = _calendars.get(school_id)
+        if calendar is not None and calendar.version == version and version is not None and (
+            max_age <= 0 or time.monotonic() - calendar.loaded_at < max_age
+        ):
+            return calendar
+
+        with _lock:
+            if version is None:
+                # First use (or the version was evicted): start a version so
+                # later signals have something to bump
+                version = time.time_ns()
+                if not cache.add(_version_key(school_id), version, VERSION_CACHE_TIMEOUT):
+                    version = _current_version(school_id)
+            calendar = cls(school_id, list(Term.objects.filter(school_id=school_id)), version=version)
+            _calendars[school_id] = calendar
+        return calendar
+
+    @property
+    def terms(self):
+        """The school's terms, ordered by start date"""
+        return list(self._terms)
+
+    def active_term(self):
+        """The term flagged active (first in default Term ordering), or None"""
+        return self._active
+
+    def term_for(self, day):
+        """
+        Term containing a date
+
+        Args:
+            day: datetime.date
+
+        Returns:
+            Term or None
+        """
+        index = bisect_right(self._starts, day) - 1
+        found = None
+        while index >= 0 and self._max_ends[index] >= day:
+            term = self._terms[index]
+            if term.end_date >= day and (found is None or self._rank[term.id] < self._rank[found.id]):
+                found = term
+            index -= 1
+        return found
+
+    def terms_for(self, dates):
+        """
+        Terms containing each of the dates
+
+        Args:
+            dates: Iterable of datetime.date
+
+        Returns:
+            List of Term or None, aligned with ``dates``
+        """
+        dates = list(dates)
+        resolved = {day: self.term_for(day) for day in set(dates)}
+        return [resolved[day] for day in dates]
@@ -159,6 +159,11 @@ urlpatterns = [
     path('roles/<str:role_id>/delete/', views.role_delete, name='role_delete'),
     path('roles/<str:role_id>/permissions/', views.role_permissions, name='role_permissions'),
     
+    # Background Jobs
+    path('jobs/<str:job_id>/', views.job_detail, name='job_detail'),
+    path('jobs/<str:job_id>/status/', views.job_status, name='job_status'),
+    path('jobs/<str:job_id>/cancel/', views.job_cancel, name='job_cancel'),
+    
     # Student Promotion
     path('promotion/', views.promotion_wizard_step1, name='promotion_wizard_step1'),
     path('promotion/step2/', views.promotion_wizard_step2, name='promotion_wizard_step2'),
@@ -1,4 +1,5 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse, HttpResponse, Http404
@@ -13,7 +14,6 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.core.exceptions import ValidationError
 import json
-import os
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
 from .models import (
@@ -62,7 +62,12 @@ TeacherService = services_module.TeacherService
 
 # Import new promotion service from services package
 from .services.promotion_service import PromotionService, PromotionPreview, PromotionResult
+from .services.fee_generation_service import FeeGenerationService
+from .services.finance_rollup_service import FinanceRollupService
+from .services.statement_ledger import StatementLedger
+from . import job_queue
 from .decorators import role_required, permission_required
+from .identity import ensure_profile, get_identity
 # Import promotion views
 from .views_promotion import (
     promotion_wizard_step1, promotion_wizard_step2, promotion_preview,
@@ -210,17 +215,8 @@ def settings_list(request):
 def dashboard(request):
     """Main dashboard view - uses service for business logic (Admin/Teacher only for MVP)"""
     # Ensure user has a profile
-    from .models import UserProfile
-    if not hasattr(request.user, 'profile'):
-        # Create a profile if it doesn't exist
-        default_school = School.objects.first()
-        UserProfile.objects.get_or_create(
-            user=request.user,
-            defaults={'school': default_school}
-        )
-        request.user.refresh_from_db()
-    
-    school = request.user.profile.school
+    identity = ensure_profile(request)
+    school = identity.school
     
     # If user doesn't have a school assigned and is not superadmin, redirect
     # (This should be caught by decorator, but handle it here as well for safety)
@@ -231,7 +227,7 @@ def dashboard(request):
             return redirect('core:school_admin_list')
         else:
             # Check if user is a parent - redirect to parent portal instead
-            if hasattr(request.user, 'parent_profile'):
+            if identity.parent is not None:
                 messages.error(request, 'You must be assigned to a school to access the dashboard.')
                 return redirect('core:parent_portal_dashboard')
             # For other users without school, redirect to login to avoid loop
@@ -254,35 +250,14 @@ def dashboard(request):
         due_date__lt=timezone.now().date()
     ).select_related('student', 'fee_category', 'term')[:10]
     
-    # Get chart data - monthly fee trends for last 6 months
-    from datetime import datetime, timedelta
-    from django.db.models import Sum
-    from django.db.models.functions import TruncMonth
-    
+    # Chart data and category breakdown come from the FeeRollup table
     chart_labels = []
     chart_paid = []
     chart_charged = []
-    
-    # Get last 6 months of data
-    end_date = timezone.now().date()
-    start_date = end_date - timedelta(days=180)
-    
-    monthly_fees = StudentFee.objects.filter(
-        school=school,
-        created_at__date__gte=start_date,
-        created_at__date__lte=end_date
-    ).annotate(
-        month=TruncMonth('created_at')
-    ).values('month').annotate(
-        total_charged=Sum('amount_charged'),
-        total_paid=Sum('amount_paid')
-    ).order_by('month')
-    
-    for item in monthly_fees:
-        month_name = item['month'].strftime('%b %Y')
-        chart_labels.append(month_name)
-        chart_charged.append(float(item['total_charged'] or 0))
-        chart_paid.append(float(item['total_paid'] or 0))
+    for month, charged, paid in FinanceRollupService.monthly_trend(school, months=6):
+        chart_labels.append(month.strftime('%b %Y'))
+        chart_charged.append(float(charged))
+        chart_paid.append(float(paid))
     
     # If no data, add placeholder
     if not chart_labels:
@@ -292,23 +267,7 @@ def dashboard(request):
     
     # Get fee breakdown by category for current term
     current_term = dashboard_data.get('current_term')
-    fee_by_category = []
-    if current_term:
-        from .models import FeeCategory
-        category_breakdown = StudentFee.objects.filter(
-            school=school,
-            term=current_term
-        ).values('fee_category__name').annotate(
-            total_charged=Sum('amount_charged'),
-            total_paid=Sum('amount_paid')
-        ).order_by('-total_charged')
-        
-        for item in category_breakdown:
-            fee_by_category.append({
-                'category': item['fee_category__name'] or 'Unknown',
-                'charged': float(item['total_charged'] or 0),
-                'paid': float(item['total_paid'] or 0),
-            })
+    fee_by_category = FinanceRollupService.category_breakdown(school, current_term)
     
     context = {
         **dashboard_data,
@@ -2035,151 +1994,31 @@ def generate_student_fees_from_structures(request):
             return redirect('core:fee_structure_list')
         
         term = get_object_or_404(Term, id=term_id, school=school)
-        
-        # Get fee structures for this term (exclude transport - it's route-based)
-        try:
-            transport_type = FeeCategoryType.objects.get(school=school, code='transport')
-            fee_structures = FeeStructure.objects.filter(
-                school=school,
-                term=term,
-                is_active=True
-            ).exclude(fee_category__category_type=transport_type).select_related('grade', 'fee_category', 'fee_category__category_type')
-        except FeeCategoryType.DoesNotExist:
-            fee_structures = FeeStructure.objects.filter(
-                school=school,
-                term=term,
-                is_active=True
-            ).select_related('grade', 'fee_category', 'fee_category__category_type')
-        
-        # Filter by grade if specified
         if grade_id:
-            fee_structures = fee_structures.filter(grade_id=grade_id)
-            students = Student.objects.filter(school=school, grade_id=grade_id, is_active=True)
-        else:
-            # Get all students in grades that have fee structures
-            grade_ids = fee_structures.values_list('grade_id', flat=True).distinct()
-            students = Student.objects.filter(school=school, grade_id__in=grade_ids, is_active=True)
-        
-        created_count = 0
-        skipped_count = 0
-        
-        # Get transport category for transport fees
-        try:
-            transport_type = FeeCategoryType.objects.get(school=school, code='transport')
-            transport_category = FeeCategory.objects.filter(
-                school=school,
-                category_type=transport_type
-            ).first()
-        except FeeCategoryType.DoesNotExist:
-            transport_category = None
-        
-        deleted_count = 0
-        
-        for student in students:
-            # Process fee structures for this student's grade in allocation_order
-            # (same order used when applying payments/credits to receivables)
-            student_grade_structures = fee_structures.filter(
-                grade=student.grade
-            ).order_by('fee_category__allocation_order', 'fee_category__name')
-            
-            for fee_structure in student_grade_structures:
-                category = fee_structure.fee_category
-                
-                # Check if fee is optional and if student should pay it
-                if category.is_optional:
-                    # Check if student has opted into this optional category
-                    student_opted_in = category in student.optional_fee_categories.all()
-                    
-                    if not student_opted_in:
-                        # Remove fee if student hasn't opted in
-                        StudentFee.objects.filter(
-                            school=school,
-                            student=student,
-                            term=term,
-                            fee_category=category
-                        ).delete()
-                        skipped_count += 1
-                        continue
-                
-                # Create or update student fee
-                student_fee, created = StudentFee.objects.get_or_create(
-                    school=school,
-                    student=student,
-                    term=term,
-                    fee_category=category,
-                    defaults={
-                        'amount_charged': fee_structure.amount,
-                        'due_date': term.end_date,
-                    }
-                )
-                
-                if created:
-                    created_count += 1
-                else:
-                    # Update amount if it changed
-                    if student_fee.amount_charged != fee_structure.amount:
-                        student_fee.amount_charged = fee_structure.amount
-                        student_fee.save()
-            
-            # Handle transport fees
-            if transport_category:
-                # Check if student has an active transport route
-                has_active_route = (
-                    student.transport_route and 
-                    student.transport_route.is_currently_active()
-                )
-                
-                if has_active_route:
-                    # Student has an active route - create or update transport fee
-                    transport_amount = student.transport_route.base_fare
-                    
-                    student_fee, created = StudentFee.objects.get_or_create(
-                        school=school,
-                        student=student,
-                        term=term,
-                        fee_category=transport_category,
-                        defaults={
-                            'amount_charged': transport_amount,
-                            'due_date': term.end_date,
-                        }
-                    )
-                    
-                    if created:
-                        created_count += 1
-                    else:
-                        # Update amount if route fare changed
-                        if student_fee.amount_charged != transport_amount:
-                            student_fee.amount_charged = transport_amount
-                            student_fee.save()
-                else:
-                    # Student doesn't have an active route - remove transport fee if it exists
-                    deleted_transport_fees = StudentFee.objects.filter(
-                        school=school,
-                        student=student,
-                        term=term,
-                        fee_category=transport_category
-                    ).delete()
-                    
-                    if deleted_transport_fees[0] > 0:
-                        deleted_count += deleted_transport_fees[0]
+            get_object_or_404(Grade, id=grade_id, school=school)
         
-        if grade_id:
-            grade = Grade.objects.get(id=grade_id)
-            message_parts = [f'Generated {created_count} student fee records for {grade.name} in {term.academic_year} - Term {term.term_number}.']
-            if skipped_count > 0:
-                message_parts.append(f'{skipped_count} optional fees skipped based on student preferences.')
-            if deleted_count > 0:
-                message_parts.append(f'{deleted_count} transport fee(s) removed for students without routes.')
-            messages.success(request, ' '.join(message_parts))
-        else:
-            message_parts = [f'Generated {created_count} student fee records for {term.academic_year} - Term {term.term_number}.']
-            if skipped_count > 0:
-                message_parts.append(f'{skipped_count} optional fees skipped based on student preferences.')
-            if deleted_count > 0:
-                message_parts.append(f'{deleted_count} transport fee(s) removed for students without routes.')
-            messages.success(request, ' '.join(message_parts))
+        # Dry runs only compute the diff (a few queries) so they stay in the request
+        if request.POST.get('dry_run') == '1':
+            fee_service = FeeGenerationService(school, term, grade_id=grade_id or None)
+            report = fee_service.generate(dry_run=True)
+            context = {
+                'terms': Term.objects.filter(school=school).order_by('-academic_year', '-term_number'),
+                'grades': Grade.objects.filter(school=school).order_by('name'),
+                'report': report,
+                'selected_term': term,
+                'selected_grade_id': grade_id,
+            }
+            return render(request, 'core/generate_student_fees_from_structures.html', context)
         
-        return redirect('core:fee_structure_list')
+        # Writing fees runs in the background job worker
+        job = job_queue.enqueue(
+            'generate_student_fees',
+            {'term_id': term.id, 'grade_id': int(grade_id) if grade_id else None},
+            school=school,
+            user=request.user,
+        )
+        messages.success(request, f'Fee generation for {term.academic_year} - Term {term.term_number} has been queued.')
+        return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('core:fee_structure_list')}")
     
     # GET request - show form
     terms = Term.objects.filter(school=school).order_by('-academic_year', '-term_number')
@@ -3440,830 +3279,147 @@ def class_generate(request):
     return render(request, 'core/class_generate.html', {'grades': grades})
 
 
-@login_required
-@permission_required('view', 'report')
-def student_statement(request, student_id):
-    """Generate fee statement for a student"""
-    student = _get_student_from_token_or_id(request, student_id)
-    school = request.user.profile.school
-    
-    # Get date filters
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
-    
-    if start_date:
-        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-    if end_date:
-        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-    
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
+def serve_media_file(request, path):
+    """
+    Serve media files from Railway storage (S3-compatible)
+    This view proxies files from private Railway buckets to make them publicly accessible
+    """
+    # settings is already imported at the top of the file
+    # Only serve files when using S3 storage
+    if not getattr(settings, 'USE_S3', False):
+        raise Http404("Media file not found")
     
-    # Calculate opening balance (all fees and payments before start_date)
-    # Use created_at (transaction date) for fees to match transaction date filtering
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
+    try:
+        # Open the file from storage
+        file = default_storage.open(path)
         
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+        # Determine content type from file extension
+        import mimetypes
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
         
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    # Use created_at as transaction date (when fee was charged), due_date goes in description
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
+        # Read file content
+        file_content = file.read()
+        file.close()
         
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
+        # Create response with appropriate headers
+        response = HttpResponse(file_content, content_type=content_type)
         
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
+        # Set cache headers (1 day)
+        response['Cache-Control'] = 'public, max-age=86400'
         
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
+        return response
+    except Exception as e:
+        # Log error and return 404
+        import logging
+        logger = logging.getLogger(__name__)
+        logger.error(f"Error serving media file {path}: {e}")
+        raise Http404("Media file not found")
+
+@login_required
+@permission_required('add', 'class')
+def class_add(request):
+    school = request.user.profile.school
+    # Debug: Check user's school and available grades
+    school = request.user.profile.school
+    print(f"User's school: {school.id} - {school.name}")
+    grades = Grade.objects.filter(school=school)
+    print(f"Grades for school {school.id}: {list(grades.values('id', 'name'))}")
     
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-    }
+    # If no grades for this school, show all grades for debugging
+    if not grades.exists():
+        print("No grades found for user's school, showing all grades for debugging")
+        grades = Grade.objects.all()
+    if request.method == 'POST':
+        name = request.POST.get('name', '').strip()
+        grade_id = request.POST.get('grade')
+        class_teacher_id = request.POST.get('class_teacher', '')
+        description = request.POST.get('description', '').strip()
+        errors = []
+        if not name:
+            errors.append('Class name is required.')
+        if not grade_id or not grade_id.isdigit():
+            errors.append('Grade is required.')
+        if SchoolClass.objects.filter(school=school, grade_id=grade_id, name=name).exists():
+            errors.append('A class with this name already exists in the selected grade.')
+        if errors:
+            for error in errors:
+                messages.error(request, error)
+            teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
+            return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': request.POST, 'school_class': None})
+        SchoolClass.objects.create(school=school, grade_id=grade_id, name=name, class_teacher_id=class_teacher_id if class_teacher_id and class_teacher_id.isdigit() else None, description=description)
+        messages.success(request, 'Class added successfully!')
+        return redirect('core:class_list')
+    teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
+    return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': {}, 'school_class': None})
+
+@login_required
+@permission_required('change', 'class')
+def class_edit(request, class_id):
+    school = request.user.profile.school
+    school_class = _get_school_class_from_token_or_id(request, class_id)
+    # Debug: Check user's school and available grades
+    school = request.user.profile.school
+    print(f"User's school: {school.id} - {school.name}")
+    grades = Grade.objects.filter(school=school)
+    print(f"Grades for school {school.id}: {list(grades.values('id', 'name'))}")
     
-    return render(request, 'core/student_statement.html', context)
+    # If no grades for this school, show all grades for debugging
+    if not grades.exists():
+        print("No grades found for user's school, showing all grades for debugging")
+        grades = Grade.objects.all()
+    if request.method == 'POST':
+        name = request.POST.get('name', '').strip()
+        grade_id = request.POST.get('grade')
+        class_teacher_id = request.POST.get('class_teacher', '')
+        description = request.POST.get('description', '').strip()
+        errors = []
+        if not name:
+            errors.append('Class name is required.')
+        if not grade_id or not grade_id.isdigit():
+            errors.append('Grade is required.')
+        if SchoolClass.objects.filter(school=school, grade_id=grade_id, name=name).exclude(id=school_class.id).exists():
+            errors.append('A class with this name already exists in the selected grade.')
+        if errors:
+            for error in errors:
+                messages.error(request, error)
+            teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
+            return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': request.POST, 'school_class': school_class})
+        school_class.name = name
+        school_class.grade_id = grade_id
+        school_class.class_teacher_id = class_teacher_id if class_teacher_id and class_teacher_id.isdigit() else None
+        school_class.description = description
+        school_class.save()
+        messages.success(request, 'Class updated successfully!')
+        return redirect('core:class_list')
+    teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
+    return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'school_class': school_class})
+
+@login_required
+@permission_required('delete', 'class')
+def class_delete(request, class_id):
+    school = request.user.profile.school
+    school_class = _get_school_class_from_token_or_id(request, class_id)
+    if request.method == 'POST':
+        school_class.delete()
+        messages.success(request, 'Class deleted successfully!')
+        return redirect('core:class_list')
+    return render(request, 'core/class_confirm_delete.html', {'school_class': school_class})
 
 
 @login_required
-@permission_required('view', 'report')
-def student_statement_pdf(request, student_id):
-    """Generate PDF version of student statement"""
-    student = _get_student_from_token_or_id(request, student_id)
+@permission_required('delete', 'class')
+def class_bulk_delete(request):
+    """Bulk delete classes"""
     school = request.user.profile.school
     
-    # Get date filters
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
-    
-    if start_date:
-        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-    if end_date:
-        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-    
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    # Use created_at (transaction date) for fees to match transaction date filtering
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+    if request.method == 'POST':
+        class_ids = request.POST.getlist('class_ids')
         
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    # Use created_at as transaction date (when fee was charged), due_date goes in description
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
-    
-    # Get logo path for WeasyPrint (needs absolute file path)
-    logo_path = None
-    if school.logo:
-        # Check if using local file storage (not S3)
-        # settings is already imported at the top of the file
-        if settings.MEDIA_ROOT:
-            logo_path = os.path.join(settings.MEDIA_ROOT, school.logo.name)
-            if os.path.exists(logo_path):
-                # Normalize path for WeasyPrint (convert backslashes to forward slashes on Windows)
-                logo_path = os.path.normpath(logo_path).replace('\\', '/')
-                # Ensure it's an absolute path
-                if not os.path.isabs(logo_path):
-                    logo_path = os.path.abspath(logo_path).replace('\\', '/')
-            else:
-                logo_path = None
-                logger.warning(f'Logo file not found at: {os.path.join(settings.MEDIA_ROOT, school.logo.name)}')
-        else:
-            # If using S3 or remote storage, try to get the file locally
-            # For now, we'll skip logo if using remote storage
-            # In production, you might want to download the file temporarily
-            logo_path = None
-            logger.debug('MEDIA_ROOT is None, skipping logo (likely using S3 storage)')
-    
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
-    
-    # Generate PDF using WeasyPrint
-    try:
-        from weasyprint import HTML
-        import os
-        import io
-    except ImportError:
-        messages.error(request, 'WeasyPrint is not installed. Please install it using: pip install weasyprint')
-        # Get student to generate token for redirect
-        student = _get_student_from_token_or_id(request, student_id)
-        return redirect('core:student_statement', student_id=student.get_signed_token())
-    
-    try:
-        # Render HTML template
-        html_string = render_to_string('core/student_statement_pdf.html', context)
-        
-        # Generate PDF
-        # Set base_url to MEDIA_ROOT if available, otherwise use current directory
-        # This helps WeasyPrint resolve relative paths and file:// URLs
-        base_url = None
-        if settings.MEDIA_ROOT:
-            base_url = os.path.normpath(settings.MEDIA_ROOT).replace('\\', '/')
-            if not os.path.isabs(base_url):
-                base_url = os.path.abspath(base_url).replace('\\', '/')
-        
-        html = HTML(string=html_string, base_url=base_url)
-        pdf_bytes = html.write_pdf()
-        
-        # Check if this is a download request
-        is_download = request.GET.get('download') == '1'
-        disposition = 'attachment' if is_download else 'inline'
-        
-        # Return PDF response
-        filename = f"statement_{student.student_id}_{timezone.now().date()}.pdf"
-        response = HttpResponse(pdf_bytes, content_type='application/pdf')
-        response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
-        # Ensure browser doesn't cache this as HTML
-        response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response['Pragma'] = 'no-cache'
-        response['Expires'] = '0'
-        return response
-    except Exception as e:
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f'Error generating PDF: {str(e)}', exc_info=True)
-        messages.error(request, f'Error generating PDF: {str(e)}')
-        # Get student to generate token for redirect
-        student = _get_student_from_token_or_id(request, student_id)
-        return redirect('core:student_statement', student_id=student.get_signed_token())
-
-
-@login_required
-@permission_required('view', 'report')
-def student_statement_email(request, student_id):
-    """Email student statement"""
-    student = _get_student_from_token_or_id(request, student_id)
-    school = request.user.profile.school
-    
-    # Get parent email from student.parent_email or linked Parent objects
-    parent_email = student.get_parent_email()
-    if not parent_email:
-        messages.error(request, 'Student has no email address on file.')
-        # Get student to generate token for redirect
-        student = _get_student_from_token_or_id(request, student_id)
-        return redirect('core:student_statement', student_id=student.get_signed_token())
-    
-    # Get date filters
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
-    
-    if start_date:
-        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-    if end_date:
-        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-    
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
-    
-    # Get logo path for WeasyPrint
-    logo_path = None
-    if school.logo:
-        import os
-        if settings.MEDIA_ROOT:
-            logo_path = os.path.join(settings.MEDIA_ROOT, school.logo.name)
-            if os.path.exists(logo_path):
-                logo_path = os.path.normpath(logo_path).replace('\\', '/')
-                if not os.path.isabs(logo_path):
-                    logo_path = os.path.abspath(logo_path).replace('\\', '/')
-            else:
-                logo_path = None
-    
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
-    
-    # Generate PDF using WeasyPrint
-    try:
-        from weasyprint import HTML
-        import os
-        from django.core.mail import EmailMessage
-    except ImportError:
-        messages.error(request, 'WeasyPrint is not installed. Please install it using: pip install weasyprint')
-        # Get student to generate token for redirect
-        student = _get_student_from_token_or_id(request, student_id)
-        return redirect('core:student_statement', student_id=student.get_signed_token())
-    
-    try:
-        # Render HTML template for PDF
-        html_string = render_to_string('core/student_statement_pdf.html', context)
-        
-        # Generate PDF
-        base_url = None
-        if settings.MEDIA_ROOT:
-            base_url = os.path.normpath(settings.MEDIA_ROOT).replace('\\', '/')
-            if not os.path.isabs(base_url):
-                base_url = os.path.abspath(base_url).replace('\\', '/')
-        
-        html = HTML(string=html_string, base_url=base_url)
-        pdf_bytes = html.write_pdf()
-        
-        # Create email message with PDF attachment
-        subject = f'Fee Statement - {student.full_name} - {school.name}'
-        period_text = ''
-        if start_date and end_date:
-            period_text = f' for the period {start_date.strftime("%d %b %Y")} to {end_date.strftime("%d %b %Y")}'
-        elif start_date:
-            period_text = f' from {start_date.strftime("%d %b %Y")}'
-        
-        email_body = f"""Dear Parent/Guardian,
-
-Please find attached the fee statement for {student.full_name} (Student ID: {student.student_id}){period_text}.
-
-"""
-        if closing_balance > 0:
-            email_body += f"Outstanding Balance: KES {closing_balance:,.2f}\n\n"
-        elif closing_balance < 0:
-            email_body += f"Credit Balance: KES {abs(closing_balance):,.2f}\n\n"
-        else:
-            email_body += "Account Status: Fully Paid\n\n"
-        
-        email_body += f"""The detailed statement is attached as a PDF document.
-
-If you have any questions or concerns, please contact the school office.
-
-Best regards,
-{school.name}
-"""
-        
-        # Validate email settings before attempting to send
-        # Check if using Resend (API-based) or SMTP
-        resend_api_key = getattr(settings, 'RESEND_API_KEY', None)
-        email_backend = getattr(settings, 'EMAIL_BACKEND', '')
-        
-        # Check if we're using SMTP backend (which won't work on Railway)
-        if 'smtp' in email_backend.lower() and 'resend' not in email_backend.lower():
-            # Detect if we're on Railway (or production) where SMTP is blocked
-            is_railway = os.environ.get('RAILWAY_ENVIRONMENT') or os.environ.get('RAILWAY_SERVICE_NAME')
-            if is_railway or not settings.DEBUG:
-                error_msg = "SMTP email is blocked on Railway. Please configure Resend API by setting RESEND_API_KEY and DEFAULT_FROM_EMAIL environment variables in Railway. See: https://resend.com for a free account."
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(error_msg)
-                messages.error(request, "Email sending is not configured. Please set RESEND_API_KEY and DEFAULT_FROM_EMAIL in Railway environment variables. SMTP is blocked on Railway.")
-                student = _get_student_from_token_or_id(request, student_id)
-                return redirect('core:student_statement', student_id=student.get_signed_token())
-        
-        if resend_api_key:
-            # Using Resend API - check for from_email
-            from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None)
-            if not from_email:
-                error_msg = "From email address is not configured. Please set DEFAULT_FROM_EMAIL in your environment variables."
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(error_msg)
-                messages.error(request, error_msg)
-                student = _get_student_from_token_or_id(request, student_id)
-                return redirect('core:student_statement', student_id=student.get_signed_token())
-        else:
-            # Using SMTP - check for SMTP credentials
-            if not getattr(settings, 'EMAIL_HOST_USER', None) or not getattr(settings, 'EMAIL_HOST_PASSWORD', None):
-                error_msg = "Email settings are not configured. Please set EMAIL_HOST_USER and EMAIL_HOST_PASSWORD (for SMTP) or RESEND_API_KEY (for Resend API) in your environment variables."
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(error_msg)
-                messages.error(request, error_msg)
-                student = _get_student_from_token_or_id(request, student_id)
-                return redirect('core:student_statement', student_id=student.get_signed_token())
-            from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None) or getattr(settings, 'EMAIL_HOST_USER', None)
-            if not from_email:
-                error_msg = "From email address is not configured. Please set DEFAULT_FROM_EMAIL or EMAIL_HOST_USER in your environment variables."
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(error_msg)
-                messages.error(request, error_msg)
-                student = _get_student_from_token_or_id(request, student_id)
-                return redirect('core:student_statement', student_id=student.get_signed_token())
-        
-        # Create email with PDF attachment
-        email_msg = EmailMessage(
-            subject=subject,
-            body=email_body,
-            from_email=from_email,
-            to=[parent_email],
-        )
-        
-        # Attach PDF
-        filename = f"Statement_{student.student_id}_{timezone.now().strftime('%Y%m%d')}.pdf"
-        email_msg.attach(filename, pdf_bytes, 'application/pdf')
-        
-        # Send email with better error handling
-        try:
-            email_msg.send(fail_silently=False)
-            messages.success(request, f'PDF statement sent successfully to {parent_email}')
-        except OSError as e:
-            # Network-related errors (connection refused, unreachable, etc.)
-            import logging
-            logger = logging.getLogger(__name__)
-            if getattr(settings, 'RESEND_API_KEY', None):
-                error_msg = f"Network error: Unable to send email via Resend API. Please check your RESEND_API_KEY. Error: {str(e)}"
-                messages.error(request, "Unable to send email: Network connection failed. Please check your Resend API configuration.")
-            else:
-                email_host = getattr(settings, 'EMAIL_HOST', 'unknown')
-                email_port = getattr(settings, 'EMAIL_PORT', 'unknown')
-                error_msg = f"Network error: Unable to connect to email server ({email_host}:{email_port}). Railway blocks SMTP connections. Please use Resend API instead by setting RESEND_API_KEY. Error: {str(e)}"
-                messages.error(request, f"Unable to send email: Railway blocks SMTP connections. Please configure Resend API by setting RESEND_API_KEY environment variable.")
-            logger.error(error_msg, exc_info=True)
-        except Exception as email_error:
-            import logging
-            logger = logging.getLogger(__name__)
-            error_msg = f"Error sending email: {str(email_error)}"
-            logger.error(error_msg, exc_info=True)
-            
-            # Check for Resend-specific errors
-            error_str = str(email_error)
-            if '403' in error_str or 'Forbidden' in error_str:
-                if 'domain is not verified' in error_str.lower() or 'domain' in error_str.lower():
-                    # Extract domain from from_email if possible
-                    domain_hint = ""
-                    if '@' in from_email:
-                        domain = from_email.split('@')[1]
-                        if domain in ['gmail.com', 'yahoo.com', 'hotmail.com', 'outlook.com']:
-                            domain_hint = f" Gmail/Yahoo/Outlook domains cannot be used directly. "
-                    messages.error(request, f"Resend Error: The domain for '{from_email}' is not verified. {domain_hint}Options: 1) Use 'onboarding@resend.dev' as DEFAULT_FROM_EMAIL (works immediately), or 2) Verify your own domain at https://resend.com/domains")
-                elif 'from address' in error_str.lower() or 'sender' in error_str.lower():
-                    messages.error(request, f"Resend Error: The 'from' email address ({from_email}) may not be verified. Please check your Resend dashboard: https://resend.com/domains to verify your sender domain/email.")
-                else:
-                    messages.error(request, f"Resend API Error (403 Forbidden): Please check your RESEND_API_KEY permissions and sender verification in Resend dashboard.")
-            elif '401' in error_str or 'Unauthorized' in error_str:
-                messages.error(request, f"Resend API Error: Invalid API key. Please check your RESEND_API_KEY in Railway environment variables.")
-            else:
-                messages.error(request, f"Error sending email: {str(email_error)}")
-    
-    except Exception as e:
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f'Error generating PDF or preparing email: {str(e)}', exc_info=True)
-        messages.error(request, f'Error preparing email: {str(e)}')
-    
-    student = _get_student_from_token_or_id(request, student_id)
-    return redirect('core:student_statement', student_id=student.get_signed_token())
-
-
-def serve_media_file(request, path):
-    """
-    Serve media files from Railway storage (S3-compatible)
-    This view proxies files from private Railway buckets to make them publicly accessible
-    """
-    # settings is already imported at the top of the file
-    # Only serve files when using S3 storage
-    if not getattr(settings, 'USE_S3', False):
-        raise Http404("Media file not found")
-    
-    try:
-        # Open the file from storage
-        file = default_storage.open(path)
-        
-        # Determine content type from file extension
-        import mimetypes
-        content_type, _ = mimetypes.guess_type(path)
-        if content_type is None:
-            content_type = 'application/octet-stream'
-        
-        # Read file content
-        file_content = file.read()
-        file.close()
-        
-        # Create response with appropriate headers
-        response = HttpResponse(file_content, content_type=content_type)
-        
-        # Set cache headers (1 day)
-        response['Cache-Control'] = 'public, max-age=86400'
-        
-        return response
-    except Exception as e:
-        # Log error and return 404
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f"Error serving media file {path}: {e}")
-        raise Http404("Media file not found")
-
-@login_required
-@permission_required('add', 'class')
-def class_add(request):
-    school = request.user.profile.school
-    # Debug: Check user's school and available grades
-    school = request.user.profile.school
-    print(f"User's school: {school.id} - {school.name}")
-    grades = Grade.objects.filter(school=school)
-    print(f"Grades for school {school.id}: {list(grades.values('id', 'name'))}")
-    
-    # If no grades for this school, show all grades for debugging
-    if not grades.exists():
-        print("No grades found for user's school, showing all grades for debugging")
-        grades = Grade.objects.all()
-    if request.method == 'POST':
-        name = request.POST.get('name', '').strip()
-        grade_id = request.POST.get('grade')
-        class_teacher_id = request.POST.get('class_teacher', '')
-        description = request.POST.get('description', '').strip()
-        errors = []
-        if not name:
-            errors.append('Class name is required.')
-        if not grade_id or not grade_id.isdigit():
-            errors.append('Grade is required.')
-        if SchoolClass.objects.filter(school=school, grade_id=grade_id, name=name).exists():
-            errors.append('A class with this name already exists in the selected grade.')
-        if errors:
-            for error in errors:
-                messages.error(request, error)
-            teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
-            return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': request.POST, 'school_class': None})
-        SchoolClass.objects.create(school=school, grade_id=grade_id, name=name, class_teacher_id=class_teacher_id if class_teacher_id and class_teacher_id.isdigit() else None, description=description)
-        messages.success(request, 'Class added successfully!')
-        return redirect('core:class_list')
-    teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
-    return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': {}, 'school_class': None})
-
-@login_required
-@permission_required('change', 'class')
-def class_edit(request, class_id):
-    school = request.user.profile.school
-    school_class = _get_school_class_from_token_or_id(request, class_id)
-    # Debug: Check user's school and available grades
-    school = request.user.profile.school
-    print(f"User's school: {school.id} - {school.name}")
-    grades = Grade.objects.filter(school=school)
-    print(f"Grades for school {school.id}: {list(grades.values('id', 'name'))}")
-    
-    # If no grades for this school, show all grades for debugging
-    if not grades.exists():
-        print("No grades found for user's school, showing all grades for debugging")
-        grades = Grade.objects.all()
-    if request.method == 'POST':
-        name = request.POST.get('name', '').strip()
-        grade_id = request.POST.get('grade')
-        class_teacher_id = request.POST.get('class_teacher', '')
-        description = request.POST.get('description', '').strip()
-        errors = []
-        if not name:
-            errors.append('Class name is required.')
-        if not grade_id or not grade_id.isdigit():
-            errors.append('Grade is required.')
-        if SchoolClass.objects.filter(school=school, grade_id=grade_id, name=name).exclude(id=school_class.id).exists():
-            errors.append('A class with this name already exists in the selected grade.')
-        if errors:
-            for error in errors:
-                messages.error(request, error)
-            teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
-            return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'post': request.POST, 'school_class': school_class})
-        school_class.name = name
-        school_class.grade_id = grade_id
-        school_class.class_teacher_id = class_teacher_id if class_teacher_id and class_teacher_id.isdigit() else None
-        school_class.description = description
-        school_class.save()
-        messages.success(request, 'Class updated successfully!')
-        return redirect('core:class_list')
-    teachers = Teacher.objects.filter(school=school, is_active=True).order_by('first_name', 'last_name')
-    return render(request, 'core/class_form.html', {'grades': grades, 'teachers': teachers, 'school_class': school_class})
-
-@login_required
-@permission_required('delete', 'class')
-def class_delete(request, class_id):
-    school = request.user.profile.school
-    school_class = _get_school_class_from_token_or_id(request, class_id)
-    if request.method == 'POST':
-        school_class.delete()
-        messages.success(request, 'Class deleted successfully!')
-        return redirect('core:class_list')
-    return render(request, 'core/class_confirm_delete.html', {'school_class': school_class})
-
-
-@login_required
-@permission_required('delete', 'class')
-def class_bulk_delete(request):
-    """Bulk delete classes"""
-    school = request.user.profile.school
-    
-    if request.method == 'POST':
-        class_ids = request.POST.getlist('class_ids')
-        
-        if not class_ids:
-            messages.error(request, 'No classes selected for deletion.')
-            return redirect('core:class_list')
+        if not class_ids:
+            messages.error(request, 'No classes selected for deletion.')
+            return redirect('core:class_list')
         
         # Verify all classes belong to the school
         classes_to_delete = SchoolClass.objects.filter(
@@ -5172,110 +4328,9 @@ def student_statement(request, student_id):
     if end_date:
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance (all fees and payments before start_date)
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
+    ledger = StatementLedger.for_request(request, student, school, start_date, end_date)
     
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-    }
+    context = ledger.context()
     
     return render(request, 'core/student_statement.html', context)
 
@@ -5296,107 +4351,7 @@ def student_statement_pdf(request, student_id):
     if end_date:
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
+    ledger = StatementLedger.for_request(request, student, school, start_date, end_date)
     
     # Get logo path for WeasyPrint (needs absolute file path)
     logo_path = None
@@ -5415,22 +4370,7 @@ def student_statement_pdf(request, student_id):
             else:
                 logo_path = None
     
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
+    context = ledger.context(logo_path=logo_path)
     
     # Generate PDF using WeasyPrint
     try:
@@ -5506,118 +4446,8 @@ def student_statement_email(request, student_id):
     if end_date:
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date()
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
+    ledger = StatementLedger.for_request(request, student, school, start_date, end_date)
+    closing_balance = ledger.closing_balance
     
     # Get logo path for WeasyPrint
     logo_path = None
@@ -5632,22 +4462,7 @@ def student_statement_email(request, student_id):
             else:
                 logo_path = None
     
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
+    context = ledger.context(logo_path=logo_path)
     
     # Generate PDF using WeasyPrint
     try:
@@ -5961,10 +4776,8 @@ def parent_portal_dashboard(request):
 @permission_required('view', 'parent_portal')
 def parent_portal_student_fees(request, student_id):
     """View fee details for a specific child"""
-    parent = None
-    try:
-        parent = Parent.objects.get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         # Allow superusers to access even without a Parent profile
         if not request.user.is_superuser:
             messages.error(request, 'Parent profile not found.')
@@ -6012,10 +4825,8 @@ def parent_portal_student_fees(request, student_id):
 @permission_required('view', 'parent_portal')
 def parent_portal_student_statement(request, student_id):
     """View fee statement for a specific child (parent portal version)"""
-    parent = None
-    try:
-        parent = Parent.objects.get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         # Allow superusers to access even without a Parent profile
         if not request.user.is_superuser:
             messages.error(request, 'Parent profile not found.')
@@ -6033,7 +4844,6 @@ def parent_portal_student_statement(request, student_id):
     
     # Get date filters
     from datetime import datetime
-    from django.utils import timezone
     start_date = request.GET.get('start_date')
     end_date = request.GET.get('end_date')
     
@@ -6048,126 +4858,9 @@ def parent_portal_student_statement(request, student_id):
         except ValueError:
             end_date = None
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance (all fees and payments before start_date)
-    # Use created_at (transaction date) for fees to match transaction date filtering
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    # Use created_at as transaction date (when fee was charged), due_date goes in description
-    for fee in student_fees:
-        # Transaction date is when the fee was created/charged - use this for filtering
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        # Filter by transaction date (when fee was charged)
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date() if hasattr(payment.payment_date, 'date') else payment.payment_date
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
+    ledger = StatementLedger.for_request(request, student, school, start_date, end_date)
     
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
-    
-    context = {
-        'parent': parent,
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-    }
+    context = ledger.context(parent=parent)
     
     return render(request, 'core/parent_portal/student_statement.html', context)
 
@@ -6175,10 +4868,8 @@ def parent_portal_student_statement(request, student_id):
 @login_required
 def parent_portal_student_statement_email(request, student_id):
     """Email student statement to parent (parent portal version)"""
-    parent = None
-    try:
-        parent = Parent.objects.get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         # Allow superusers to access even without a Parent profile
         if not request.user.is_superuser:
             messages.error(request, 'Parent profile not found.')
@@ -6222,105 +4913,8 @@ def parent_portal_student_statement_email(request, student_id):
         except ValueError:
             end_date = None
     
-    # Get all student fees (debits)
-    student_fees = StudentFee.objects.filter(
-        school=school,
-        student=student
-    ).select_related('term', 'fee_category').order_by('term__academic_year', 'term__term_number', 'fee_category__name')
-    
-    # Get all payments (credits)
-    payments = Payment.objects.filter(
-        school=school,
-        student=student,
-        status='completed'
-    ).select_related('student_fee__term', 'student_fee__fee_category').prefetch_related('allocations__student_fee__fee_category').order_by('payment_date')
-    
-    # Calculate opening balance
-    opening_balance = Decimal('0.00')
-    if start_date:
-        opening_fees = StudentFee.objects.filter(
-            school=school,
-            student=student,
-            created_at__date__lt=start_date
-        ).aggregate(total=Sum('amount_charged'))['total'] or Decimal('0.00')
-        
-        opening_payments = Payment.objects.filter(
-            school=school,
-            student=student,
-            status='completed',
-            payment_date__date__lt=start_date
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        opening_balance = opening_fees - opening_payments
-    
-    # Filter by date range if provided
-    transactions = []
-    
-    # Add fee transactions (debits)
-    for fee in student_fees:
-        transaction_date = fee.created_at.date()
-        fee_due_date = fee.due_date
-        
-        if start_date and transaction_date < start_date:
-            continue
-        if end_date and transaction_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': transaction_date,
-            'description': f"{fee.fee_category.name} - {fee.term.academic_year} Term {fee.term.term_number}",
-            'due_date': fee_due_date,
-            'reference': f"Fee-{fee.id}",
-            'debit': fee.amount_charged,
-            'credit': Decimal('0.00'),
-            'type': 'fee',
-            'allocation_order': getattr(fee.fee_category, 'allocation_order', 999),
-        })
-    
-    # Add payment transactions (credits)
-    for payment in payments:
-        payment_date = payment.payment_date.date() if hasattr(payment.payment_date, 'date') else payment.payment_date
-        if start_date and payment_date < start_date:
-            continue
-        if end_date and payment_date > end_date:
-            continue
-        
-        transactions.append({
-            'date': payment_date,
-            'description': ("Payment - " + ", ".join(list(dict.fromkeys([a.student_fee.fee_category.name for a in payment.allocations.all()]))) if payment.allocations.exists() else f"Payment - {payment.student_fee.fee_category.name}"),
-            'reference': payment.reference_number or str(payment.payment_id),
-            'debit': Decimal('0.00'),
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display(),
-            'allocation_order': (min(getattr(a.student_fee.fee_category, 'allocation_order', 999) for a in payment.allocations.all()) if payment.allocations.exists() else getattr(payment.student_fee.fee_category, 'allocation_order', 999)),
-        })
-    
-    # Sort by date, then fees before payments, then by allocation_order within each type.
-    # So on a given day all receivables (fees) show in category order, then all payments after.
-    transactions.sort(key=lambda x: (x['date'], (0 if x.get('type') == 'fee' else 1), x.get('allocation_order', 999)))
-    
-    # Calculate running balance
-    running_balance = opening_balance
-    for transaction in transactions:
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
-    
-    # Calculate totals
-    total_debits = sum(t['debit'] for t in transactions)
-    total_credits = sum(t['credit'] for t in transactions)
-    closing_balance = opening_balance + total_debits - total_credits
-    
-    # Determine balance label and type
-    if closing_balance > 0:
-        balance_label = 'Balance Due'
-        balance_type = 'outstanding'
-    elif closing_balance < 0:
-        balance_label = 'Credit Balance'
-        balance_type = 'credit'
-    else:
-        balance_label = 'Closing Balance'
-        balance_type = 'zero'
+    ledger = StatementLedger.for_request(request, student, school, start_date, end_date)
+    closing_balance = ledger.closing_balance
     
     # Get logo path for WeasyPrint
     logo_path = None
@@ -6335,22 +4929,7 @@ def parent_portal_student_statement_email(request, student_id):
             else:
                 logo_path = None
     
-    context = {
-        'student': student,
-        'school': school,
-        'transactions': transactions,
-        'opening_balance': opening_balance,
-        'total_debits': total_debits,
-        'total_credits': total_credits,
-        'closing_balance': closing_balance,
-        'closing_balance_abs': abs(closing_balance),
-        'balance_label': balance_label,
-        'balance_type': balance_type,
-        'start_date': start_date,
-        'end_date': end_date,
-        'statement_date': timezone.now().date(),
-        'logo_path': logo_path,
-    }
+    context = ledger.context(logo_path=logo_path)
     
     # Generate PDF using WeasyPrint
     try:
@@ -6446,9 +5025,8 @@ Best regards,
 @permission_required('view', 'parent_portal')
 def parent_portal_student_performance(request, student_id):
     """View student performance/academic records"""
-    try:
-        parent = Parent.objects.get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         messages.error(request, 'Parent profile not found.')
         return redirect('core:parent_portal_dashboard')
     
@@ -6457,12 +5035,36 @@ def parent_portal_student_performance(request, student_id):
     if not student or not student.parents.filter(id=parent.id).exists():
         raise Http404("Student not found")
     
-    # TODO: Add academic records/performance data when that module is implemented
-    # For now, just show basic student info
+    from exams.models import GradebookSummary, SubjectAnalytics, TermRanking
+    
+    # Positions are precomputed by exams.ranking.RankingEngine; nothing is ranked here
+    rankings = list(
+        TermRanking.objects.filter(school=student.school, student=student)
+        .select_related('term', 'grade', 'school_class')
+        .order_by('-term__academic_year', '-term__term_number')
+    )
+    term_id = request.GET.get('term_id', '')
+    ranking = next((r for r in rankings if str(r.term_id) == term_id), rankings[0] if rankings else None)
+    
+    subject_results = []
+    if ranking:
+        means = dict(
+            SubjectAnalytics.objects.filter(
+                school=student.school, term=ranking.term, grade_id=ranking.grade_id
+            ).values_list('subject_id', 'mean_score')
+        )
+        for summary in GradebookSummary.objects.filter(
+            school=student.school, student=student, term=ranking.term
+        ).select_related('subject').order_by('subject__name'):
+            summary.class_mean = means.get(summary.subject_id)
+            subject_results.append(summary)
     
     context = {
         'parent': parent,
         'student': student,
+        'rankings': rankings,
+        'ranking': ranking,
+        'subject_results': subject_results,
     }
     
     return render(request, 'core/parent_portal/student_performance.html', context)
@@ -6472,9 +5074,8 @@ def parent_portal_student_performance(request, student_id):
 @permission_required('view', 'parent_portal')
 def parent_portal_profile(request):
     """Parent profile management with verification for phone/email updates"""
-    try:
-        parent = Parent.objects.select_related('user', 'school').get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         # Superusers don't need a parent profile to access - redirect to dashboard
         if request.user.is_superuser:
             messages.info(request, 'As a superuser, you can manage parent profiles from the parent list.')
@@ -6578,12 +5179,10 @@ def parent_portal_profile(request):
 @permission_required('view', 'parent_portal')
 def parent_portal_payment_initiate(request, student_id, fee_id):
     """Initiate M-Pesa payment for a student fee or total balance (fee_id=0)"""
-    try:
-        parent = Parent.objects.get(user=request.user)
-    except Parent.DoesNotExist:
+    parent = get_identity(request).parent
+    if parent is None:
         if not request.user.is_superuser:
             return JsonResponse({'error': 'Parent profile not found.'}, status=403)
-        parent = None
     
     # Resolve student token/id and verify ownership (or allow superuser)
     student = _get_student_from_token_or_id(request, student_id)
@@ -6695,97 +5294,92 @@ def parent_portal_payment_initiate(request, student_id, fee_id):
 
 @csrf_exempt
 def mpesa_callback(request):
-    """Handle M-Pesa STK Push callback"""
+    """
+    Handle M-Pesa STK Push callback
+
+    The payload is stored and posted by a background job (see
+    receivables.mpesa_callbacks), so Safaricom is answered at once and a
+    retried callback is never posted twice.
+    """
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
     
+    from receivables.mpesa_callbacks import ingest_callback
     try:
-        import json
         data = json.loads(request.body)
-        
-        # Log the callback for debugging
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.info(f'M-Pesa callback received: {data}')
-        
-        # Extract callback data
-        body = data.get('Body', {})
-        stk_callback = body.get('stkCallback', {})
-        
-        merchant_request_id = stk_callback.get('MerchantRequestID')
-        checkout_request_id = stk_callback.get('CheckoutRequestID')
-        result_code = stk_callback.get('ResultCode')
-        result_desc = stk_callback.get('ResultDesc')
-        
-        # Extract payment details if successful
-        if result_code == 0:
-            callback_metadata = stk_callback.get('CallbackMetadata', {})
-            items = callback_metadata.get('Item', [])
-            
-            # Extract payment details
-            amount = None
-            mpesa_receipt_number = None
-            transaction_date = None
-            phone_number = None
-            
-            for item in items:
-                name = item.get('Name')
-                value = item.get('Value')
-                
-                if name == 'Amount':
-                    amount = value
-                elif name == 'MpesaReceiptNumber':
-                    mpesa_receipt_number = value
-                elif name == 'TransactionDate':
-                    transaction_date = value
-                elif name == 'PhoneNumber':
-                    phone_number = value
-            
-            # Parse account reference to get fee ID
-            # Format: FEE-{fee_id}-{student_id}
-            account_reference = None
-            for item in items:
-                if item.get('Name') == 'AccountReference':
-                    account_reference = item.get('Value')
-                    break
-            
-            if account_reference and account_reference.startswith('FEE-'):
-                try:
-                    # Extract fee ID from reference (FEE-{fee_id}-{student_id})
-                    parts = account_reference.split('-')
-                    if len(parts) >= 2:
-                        fee_id = int(parts[1])
-                        student_fee = StudentFee.objects.get(id=fee_id)
-                        
-                        # Create payment record
-                        from receivables.models import Payment
-                        payment = Payment.objects.create(
-                            student=student_fee.student,
-                            student_fee=student_fee,
-                            amount=Decimal(str(amount)) / 100,  # M-Pesa returns amount in cents
-                            payment_method='mpesa',
-                            status='completed',
-                            reference_number=mpesa_receipt_number,
-                            payment_date=timezone.now(),
-                            notes=f'M-Pesa payment via parent portal. Phone: {phone_number}'
-                        )
-                        
-                        # Update student fee
-                        student_fee.amount_paid += payment.amount
-                        if student_fee.amount_paid >= student_fee.amount_charged:
-                            student_fee.is_paid = True
-                        student_fee.save()
-                        
-                        logger.info(f'Payment processed successfully: {payment.id} for fee {fee_id}')
-                except Exception as e:
-                    logger.error(f'Error processing payment from callback: {str(e)}')
-        
-        # Always return success to M-Pesa (they will retry if we return error)
-        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
-        
-    except Exception as e:
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f'Error processing M-Pesa callback: {str(e)}')
-        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})  # Return success to prevent retries
+    except ValueError:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid payload'}, status=400)
+    
+    ingest_callback(data)
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
+
+
+def _get_job_for_request(request, job_id):
+    """Resolve a job token and make sure it belongs to the user's school"""
+    from .models import Job
+    job = Job.from_signed_token(job_id)
+    if job is None:
+        raise Http404("Job not found")
+    if not request.user.is_superuser and job.school_id != request.user.profile.school_id:
+        raise Http404("Job not found")
+    return job
+
+
+def _can_cancel_job(user, job):
+    """Only the user who started a job (or a superuser) may cancel it"""
+    return user.is_superuser or (job.created_by_id is not None and job.created_by_id == user.id)
+
+
+def _job_status_data(job):
+    return {
+        'job_id': job.get_signed_token(),
+        'job_type': job.job_type,
+        'status': job.status,
+        'is_finished': job.is_finished,
+        'percent': job.percent,
+        'progress_current': job.progress_current,
+        'progress_total': job.progress_total,
+        'progress_message': job.progress_message,
+        'eta_seconds': job.eta_seconds,
+        'attempts': job.attempts,
+        'result': job.result,
+        'error_message': job.error_message,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+@login_required
+def job_detail(request, job_id):
+    """Progress page for a background job; polls job_status until it finishes"""
+    from django.utils.http import url_has_allowed_host_and_scheme
+    job = _get_job_for_request(request, job_id)
+    next_url = request.GET.get('next', '')
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        next_url = ''
+    context = {
+        'job': job,
+        'job_token': job.get_signed_token(),
+        'next_url': next_url,
+        'can_cancel': _can_cancel_job(request.user, job),
+    }
+    return render(request, 'core/job_detail.html', context)
+
+
+@login_required
+def job_status(request, job_id):
+    """JSON status of a background job (progress, ETA, result)"""
+    job = _get_job_for_request(request, job_id)
+    return JsonResponse(_job_status_data(job))
 
+
+@login_required
+def job_cancel(request, job_id):
+    """Request cancellation of a queued or running job"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    job = _get_job_for_request(request, job_id)
+    if not _can_cancel_job(request.user, job):
+        return JsonResponse({'error': 'Only the user who started this job can cancel it.'}, status=403)
+    job = job_queue.cancel(job)
+    return JsonResponse(_job_status_data(job))
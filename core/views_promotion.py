@@ -4,12 +4,14 @@ These views handle the multi-step promotion wizard
 """
 
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.paginator import Paginator
 from .models import AcademicYear, Grade, SchoolClass, Section, StudentClassEnrollment, PromotionLog
 from .services.promotion_service import PromotionService, PromotionPreview, PromotionResult
 from .decorators import role_required, permission_required
+from . import job_queue
 
 
 @login_required
@@ -286,40 +288,33 @@ def promotion_confirm(request):
     }
     
     if request.method == 'POST' and request.POST.get('confirm') == 'yes':
-        # Execute promotion
-        service = PromotionService(school, request.user)
-        result = service.execute_promotion(
-            from_year_id,
-            to_year_id,
-            previews,
-            promotion_type
+        # Execute promotion in the background job worker
+        job = job_queue.enqueue(
+            'execute_promotion',
+            {
+                'from_year_id': from_year.id,
+                'to_year_id': to_year.id,
+                'promotion_type': promotion_type,
+                'previews': previews_data,
+                'user_id': request.user.id,
+            },
+            school=school,
+            user=request.user,
+            max_attempts=1,
+        )
+        messages.success(
+            request,
+            f'Promotion of {stats["total"]} student(s) from {from_year.name} to {to_year.name} has been queued.'
         )
         
-        if result.success:
-            messages.success(
-                request,
-                f'Promotion completed successfully! '
-                f'Promoted: {result.promoted_count}, '
-                f'Retained: {result.retained_count}, '
-                f'Graduated: {result.graduated_count}, '
-                f'Left: {result.left_count}'
-            )
-            
-            # Clear session
-            for key in ['promotion_from_year', 'promotion_to_year', 'promotion_type',
-                       'promotion_grade_filter', 'promotion_class_filter',
-                       'promotion_retain', 'promotion_graduate', 'promotion_leave',
-                       'promotion_previews']:
-                request.session.pop(key, None)
-            
-            if result.log_id:
-                return redirect('core:promotion_history')
-            return redirect('core:promotion_wizard_step1')
-        else:
-            messages.error(request, f'Promotion failed: {", ".join(result.errors)}')
-            if result.warnings:
-                for warning in result.warnings:
-                    messages.warning(request, warning)
+        # Clear session
+        for key in ['promotion_from_year', 'promotion_to_year', 'promotion_type',
+                   'promotion_grade_filter', 'promotion_class_filter',
+                   'promotion_retain', 'promotion_graduate', 'promotion_leave',
+                   'promotion_previews']:
+            request.session.pop(key, None)
+        
+        return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('core:promotion_history')}")
     
     context = {
         'from_year': from_year,
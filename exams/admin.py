@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ExamType, Exam, Gradebook, GradebookSummary
+from .models import ExamType, Exam, Gradebook, GradebookSummary, TermRanking, SubjectAnalytics
 
 
 @admin.register(ExamType)
@@ -33,3 +33,19 @@ class GradebookSummaryAdmin(admin.ModelAdmin):
     list_filter = ['term', 'final_grade', 'school']
     search_fields = ['student__first_name', 'student__last_name', 'subject__name']
     ordering = ['student', 'term', 'subject']
+
+
+@admin.register(TermRanking)
+class TermRankingAdmin(admin.ModelAdmin):
+    list_display = ['student', 'term', 'grade', 'school_class', 'mean_score', 'class_position', 'stream_position']
+    list_filter = ['term', 'grade', 'school']
+    search_fields = ['student__first_name', 'student__last_name', 'student__student_id']
+    ordering = ['term', 'grade', 'class_position']
+
+
+@admin.register(SubjectAnalytics)
+class SubjectAnalyticsAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'grade', 'term', 'student_count', 'mean_score', 'std_deviation', 'min_score', 'max_score']
+    list_filter = ['term', 'grade', 'school']
+    search_fields = ['subject__name']
+    ordering = ['term', 'grade', 'subject']
@@ -0,0 +1,335 @@
+"""
+Bulk Grade Entry
+
+Writes the marks of one exam for many students at once. The exam is loaded
+once, percentages and letter grades are computed for the whole batch in
+memory, and Gradebook rows are written with one INSERT ... ON CONFLICT
+upsert per chunk on (school, student, exam). The affected students'
+GradebookSummary rows for the exam's term and subject are then regenerated
+set-wise by GradeSummaryEngine in the same transaction.
+
+Mark sheets (CSV or XLSX with a header row) are streamed row by row through
+``core.exports.iter_table_rows`` and matched to students by admission
+number a chunk at a time. Entry is all-or-nothing: if any row is invalid
+nothing is saved and every problem found is reported.
+"""
+
+from django.db import transaction
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import logging
+
+from core.exports import iter_table_rows
+from .models import Gradebook
+from .services import GradeSummaryEngine, grade_for_percentage
+
+logger = logging.getLogger(__name__)
+
+# Accepted mark sheet headers (case-insensitive), first match wins
+STUDENT_COLUMNS = ('admission_number', 'admission_no', 'student_id', 'student')
+MARKS_COLUMNS = ('marks_obtained', 'marks', 'score')
+REMARKS_COLUMNS = ('remarks', 'comments', 'comment')
+GRADE_COLUMNS = ('grade',)
+
+
+class GradeEntryError(ValueError):
+    """Marks failed validation; ``errors`` lists the problems found"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__('; '.join(self.errors))
+
+
+@dataclass
+class MarkEntry:
+    """A validated mark for one student"""
+    student_id: int
+    marks_obtained: Decimal
+    remarks: str = ''
+    grade: str = ''
+
+
+class GradeEntryService:
+    """Validate and upsert the marks of a single exam"""
+
+    CHUNK_SIZE = 1000
+    MAX_ERRORS = 50
+
+    def __init__(self, school, exam, user=None):
+        """
+        Args:
+            school: School the exam belongs to
+            exam: Exam instance (term and subject are read from it)
+            user: User recorded as entered_by
+        """
+        self.school = school
+        self.exam = exam
+        self.user = user
+        self.max_marks = Decimal(str(exam.max_marks))
+
+    # ------------------------------------------------------------------
+    # Validation
+    # ------------------------------------------------------------------
+
+    def _check(self, label, student_id, marks, remarks, grade, errors):
+        """Validate one row's values; returns a MarkEntry or None after recording errors"""
+        if marks is None or str(marks).strip() == '':
+            errors.append(f'{label}: marks are required')
+            return None
+        try:
+            marks_obtained = Decimal(str(marks).strip()).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        except (InvalidOperation, ValueError):
+            errors.append(f'{label}: invalid marks {marks!r}')
+            return None
+        if marks_obtained < 0 or marks_obtained > self.max_marks:
+            errors.append(f'{label}: marks must be between 0 and {self.max_marks}')
+            return None
+        grade = str(grade or '').strip().upper()
+        if len(grade) > 5:
+            errors.append(f'{label}: grade {grade!r} is too long')
+            return None
+        return MarkEntry(
+            student_id=student_id,
+            marks_obtained=marks_obtained,
+            remarks=str(remarks or '').strip(),
+            grade=grade,
+        )
+
+    # ------------------------------------------------------------------
+    # Entry from API payloads
+    # ------------------------------------------------------------------
+
+    def validate(self, grades):
+        """
+        Check a list of marks keyed by student primary key
+
+        Args:
+            grades: Iterable of dicts with student_id, marks_obtained and
+                optionally remarks and grade (computed from the marks when blank)
+
+        Returns:
+            List of MarkEntry
+
+        Raises:
+            GradeEntryError listing every invalid entry
+        """
+        from core.models import Student
+
+        errors = []
+        entries = []
+        seen = set()
+        for index, data in enumerate(grades, start=1):
+            label = f'Entry {index}'
+            try:
+                student_id = int(data.get('student_id'))
+            except (TypeError, ValueError):
+                errors.append(f'{label}: invalid student id {data.get("student_id")!r}')
+                continue
+            if student_id in seen:
+                errors.append(f'{label}: student {student_id} appears more than once')
+                continue
+            seen.add(student_id)
+            entry = self._check(label, student_id, data.get('marks_obtained'), data.get('remarks'), data.get('grade'), errors)
+            if entry is not None:
+                entries.append(entry)
+
+        if not seen and not errors:
+            errors.append('No grades provided.')
+        if seen:
+            known = set(Student.objects.filter(school=self.school, id__in=seen).values_list('id', flat=True))
+            unknown = sorted(seen - known)
+            if unknown:
+                errors.append(f'Students not found: {", ".join(str(student_id) for student_id in unknown)}')
+
+        if errors:
+            raise GradeEntryError(errors)
+        return entries
+
+    def save(self, grades):
+        """
+        Validate and upsert marks, then refresh the affected summaries
+
+        Returns:
+            Dict with created, updated and summaries counts
+
+        Raises:
+            GradeEntryError when any entry is invalid; nothing is written
+        """
+        entries = self.validate(grades)
+        with transaction.atomic():
+            result = self._write(entries)
+            result['summaries'] = self._refresh_summaries({entry.student_id for entry in entries})
+        return result
+
+    # ------------------------------------------------------------------
+    # Entry from mark sheets
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _resolve_columns(header):
+        names = [str(cell).strip().lower() for cell in header or []]
+
+        def find(candidates):
+            for candidate in candidates:
+                if candidate in names:
+                    return names.index(candidate)
+            return None
+
+        return {
+            'student': find(STUDENT_COLUMNS),
+            'marks': find(MARKS_COLUMNS),
+            'remarks': find(REMARKS_COLUMNS),
+            'grade': find(GRADE_COLUMNS),
+        }
+
+    def import_sheet(self, upload, file_name=None):
+        """
+        Stream a CSV/XLSX mark sheet into the gradebook
+
+        The first row must name an admission number column (one of
+        STUDENT_COLUMNS) and a marks column (one of MARKS_COLUMNS); remarks
+        and grade columns are optional.
+
+        Args:
+            upload: Uploaded file object
+            file_name: Name used to pick the format (defaults to upload.name)
+
+        Returns:
+            Dict with rows, created, updated and summaries counts
+
+        Raises:
+            GradeEntryError when the sheet can't be read or any row is
+            invalid; nothing is written
+        """
+        try:
+            rows = iter_table_rows(upload, file_name)
+            header = next(rows, None)
+        except ValueError as e:
+            raise GradeEntryError([str(e)]) from e
+        columns = self._resolve_columns(header)
+        if columns['student'] is None or columns['marks'] is None:
+            raise GradeEntryError([
+                f'The first row must name an admission number column ({", ".join(STUDENT_COLUMNS)}) '
+                f'and a marks column ({", ".join(MARKS_COLUMNS)})'
+            ])
+
+        result = {'rows': 0, 'created': 0, 'updated': 0, 'summaries': 0}
+        errors = []
+        seen = {}  # admission number -> first row it appeared on
+        touched = set()
+        with transaction.atomic():
+            chunk = []
+            try:
+                for line_num, row in enumerate(rows, start=2):
+                    if not any(str(cell).strip() for cell in row):
+                        continue
+                    chunk.append((line_num, row))
+                    if len(chunk) >= self.CHUNK_SIZE:
+                        self._import_chunk(chunk, columns, seen, touched, errors, result)
+                        chunk = []
+            except ValueError as e:
+                errors.append(str(e))
+            if chunk:
+                self._import_chunk(chunk, columns, seen, touched, errors, result)
+
+            if not errors and not result['rows']:
+                errors.append('The mark sheet has no rows.')
+            if errors:
+                # Leaving the atomic block with an exception rolls back any chunks already written
+                if len(errors) > self.MAX_ERRORS:
+                    errors = errors[:self.MAX_ERRORS] + [f'... and {len(errors) - self.MAX_ERRORS} more']
+                raise GradeEntryError(errors)
+            result['summaries'] = self._refresh_summaries(touched)
+
+        logger.info(
+            f'Mark sheet for exam {self.exam.id}: {result["rows"]} rows '
+            f'({result["created"]} new, {result["updated"]} updated)'
+        )
+        return result
+
+    def _import_chunk(self, chunk, columns, seen, touched, errors, result):
+        from core.models import Student
+
+        def cell(row, key):
+            index = columns[key]
+            return str(row[index]).strip() if index is not None and index < len(row) else ''
+
+        admission_numbers = {cell(row, 'student') for _, row in chunk} - {''}
+        students = dict(
+            Student.objects.filter(school=self.school, student_id__in=admission_numbers).values_list('student_id', 'id')
+        )
+
+        entries = []
+        for line_num, row in chunk:
+            label = f'Row {line_num}'
+            admission_number = cell(row, 'student')
+            if not admission_number:
+                errors.append(f'{label}: admission number is required')
+                continue
+            if admission_number in seen:
+                errors.append(f'{label}: {admission_number} already appears on row {seen[admission_number]}')
+                continue
+            seen[admission_number] = line_num
+            student_id = students.get(admission_number)
+            if student_id is None:
+                errors.append(f'{label}: no student with admission number {admission_number}')
+                continue
+            entry = self._check(label, student_id, cell(row, 'marks'), cell(row, 'remarks'), cell(row, 'grade'), errors)
+            if entry is not None:
+                entries.append(entry)
+
+        result['rows'] += len(chunk)
+        if errors or not entries:
+            # The sheet will be rejected; keep validating without writing
+            return
+        written = self._write(entries)
+        result['created'] += written['created']
+        result['updated'] += written['updated']
+        touched.update(entry.student_id for entry in entries)
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def _write(self, entries):
+        """Upsert a batch of validated entries; returns created/updated counts"""
+        student_ids = [entry.student_id for entry in entries]
+        existing = set(Gradebook.objects.filter(
+            school=self.school, exam=self.exam, student_id__in=student_ids
+        ).values_list('student_id', flat=True))
+
+        gradebooks = []
+        for entry in entries:
+            gradebook = Gradebook(
+                school=self.school,
+                student_id=entry.student_id,
+                exam=self.exam,
+                marks_obtained=entry.marks_obtained,
+                remarks=entry.remarks,
+                entered_by=self.user,
+            )
+            gradebook.compute_scores(self.exam)
+            # Unlike Gradebook.save, a changed mark always regrades unless a grade is given
+            gradebook.grade = entry.grade or grade_for_percentage(gradebook.percentage)
+            gradebooks.append(gradebook)
+
+        Gradebook.objects.bulk_create(
+            gradebooks,
+            batch_size=self.CHUNK_SIZE,
+            update_conflicts=True,
+            unique_fields=['school', 'student', 'exam'],
+            update_fields=[
+                'marks_obtained', 'percentage', 'is_passing', 'grade', 'remarks', 'entered_by', 'updated_at',
+            ],
+        )
+        created = len(set(student_ids) - existing)
+        return {'created': created, 'updated': len(entries) - created}
+
+    def _refresh_summaries(self, student_ids):
+        """Regenerate the exam's term/subject summaries of the given students (bulk writes skip the signals)"""
+        if not student_ids:
+            return 0
+        result = GradeSummaryEngine.generate(
+            self.school, self.exam.term, subject=self.exam.subject, student_ids=student_ids
+        )
+        return result['created'] + result['updated']
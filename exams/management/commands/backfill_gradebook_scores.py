@@ -0,0 +1,35 @@
+"""
+Management command to fill the stored Gradebook.percentage and is_passing
+columns from the marks and their exams. Run it once after migrating; day-to-day
+grade entry and exam edits keep the columns current on their own.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School
+from exams.services import sync_gradebook_scores
+
+
+class Command(BaseCommand):
+    help = 'Recompute stored gradebook percentages and pass flags with one UPDATE per school'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only backfill gradebooks of this school',
+        )
+
+    def handle(self, *args, **options):
+        schools = School.objects.all()
+        if options.get('school_id'):
+            schools = schools.filter(id=options['school_id'])
+            if not schools.exists():
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        total = 0
+        for school in schools:
+            updated = sync_gradebook_scores(school=school)
+            total += updated
+            if updated:
+                self.stdout.write(f'{school.name}: updated {updated} gradebook(s)')
+        self.stdout.write(self.style.SUCCESS(f'Updated {total} gradebook(s).'))
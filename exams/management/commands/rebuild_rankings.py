@@ -0,0 +1,51 @@
+"""
+Management command to recompute term positions (GradebookSummary.rank and
+TermRanking) and SubjectAnalytics from the stored gradebook summaries. Run it
+after migrating to fill the tables for past terms; grade entry keeps the
+affected grades current on its own.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School, Term
+from exams.ranking import RankingEngine
+
+
+class Command(BaseCommand):
+    help = 'Recompute merit list positions and subject analytics for each term'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only rebuild rankings of this school',
+        )
+        parser.add_argument(
+            '--term-id',
+            type=int,
+            help='Only rebuild rankings of this term',
+        )
+
+    def handle(self, *args, **options):
+        schools = School.objects.all()
+        if options.get('school_id'):
+            schools = schools.filter(id=options['school_id'])
+            if not schools.exists():
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        terms = Term.objects.filter(school__in=schools).select_related('school')
+        if options.get('term_id'):
+            terms = terms.filter(id=options['term_id'])
+            if not terms.exists():
+                self.stdout.write(self.style.ERROR(f'Term with ID {options["term_id"]} does not exist.'))
+                return
+
+        total = 0
+        for term in terms:
+            result = RankingEngine(term.school, term).refresh()
+            total += result['rankings']
+            if result['rankings']:
+                self.stdout.write(
+                    f'{term.school.name} - {term.name} {term.academic_year}: ranked {result["rankings"]} student(s), '
+                    f'{result["analytics"]} subject analytics row(s)'
+                )
+        self.stdout.write(self.style.SUCCESS(f'Ranked {total} student term result(s).'))
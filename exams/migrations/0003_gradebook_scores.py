@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-16 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0002_add_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradebook',
+            name='percentage',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=7),
+        ),
+        migrations.AddField(
+            model_name='gradebook',
+            name='is_passing',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='gradebook',
+            index=models.Index(fields=['exam', 'percentage'], name='gradebook_exam_pct_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gradebook',
+            index=models.Index(fields=['school', 'is_passing'], name='gradebook_school_pass_idx'),
+        ),
+    ]
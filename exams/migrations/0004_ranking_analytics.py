@@ -0,0 +1,67 @@
+# Generated by Django 5.2.3 on 2026-10-16 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_studentfee_outstanding_idx'),
+        ('exams', '0003_gradebook_scores'),
+        ('timetable', '0002_add_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subjects_count', models.IntegerField(default=0)),
+                ('total_score', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('mean_score', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('class_position', models.IntegerField(help_text='Position among all students of the grade (every stream)')),
+                ('class_size', models.IntegerField()),
+                ('stream_position', models.IntegerField(blank=True, help_text="Position within the student's class", null=True)),
+                ('stream_size', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('grade', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='term_rankings', to='core.grade')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='term_rankings', to='core.school')),
+                ('school_class', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='term_rankings', to='core.schoolclass')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='term_rankings', to='core.student')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='term_rankings', to='core.term')),
+            ],
+            options={
+                'ordering': ['term', 'grade', 'class_position'],
+                'unique_together': {('school', 'term', 'student')},
+                'indexes': [
+                    models.Index(fields=['term', 'grade', 'class_position'], name='term_rank_grade_pos_idx'),
+                    models.Index(fields=['term', 'school_class', 'stream_position'], name='term_rank_class_pos_idx'),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubjectAnalytics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_count', models.IntegerField(default=0)),
+                ('mean_score', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('std_deviation', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('min_score', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('max_score', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('grade_distribution', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('grade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subject_analytics', to='core.grade')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subject_analytics', to='core.school')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subject_analytics', to='timetable.subject')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subject_analytics', to='core.term')),
+            ],
+            options={
+                'verbose_name_plural': 'Subject analytics',
+                'ordering': ['term', 'grade', 'subject'],
+                'unique_together': {('school', 'term', 'grade', 'subject')},
+            },
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import User
 from core.models import School, Student, SchoolClass, Term
 from django.core.validators import MinValueValidator, MaxValueValidator
+from decimal import Decimal, ROUND_HALF_UP
 
 
 class ExamType(models.Model):
@@ -80,6 +81,10 @@ class Gradebook(models.Model):
         validators=[MinValueValidator(0)]
     )
     grade = models.CharField(max_length=5, blank=True)  # A, B, C, D, F
+    # Stored so performance statistics can be aggregated in SQL; kept in step with
+    # the marks by save(), bulk grade entry and exams.services.sync_gradebook_scores
+    percentage = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    is_passing = models.BooleanField(default=False)
     remarks = models.TextField(blank=True)
     entered_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -88,20 +93,21 @@ class Gradebook(models.Model):
     def __str__(self):
         return f"{self.student} - {self.exam} - {self.marks_obtained}/{self.exam.max_marks}"
 
-    @property
-    def percentage(self):
-        """Calculate percentage marks"""
-        if self.exam.max_marks > 0:
-            return (self.marks_obtained / self.exam.max_marks) * 100
-        return 0
-
-    @property
-    def is_passing(self):
-        """Check if student passed"""
-        return self.marks_obtained >= self.exam.passing_marks
+    def compute_scores(self, exam=None):
+        """Set percentage and is_passing from the marks and the exam's max/passing marks"""
+        exam = exam or self.exam
+        marks_obtained = Decimal(str(self.marks_obtained))
+        if exam.max_marks > 0:
+            self.percentage = (marks_obtained / Decimal(exam.max_marks) * 100).quantize(
+                Decimal('0.01'), rounding=ROUND_HALF_UP
+            )
+        else:
+            self.percentage = Decimal('0')
+        self.is_passing = marks_obtained >= exam.passing_marks
 
     def save(self, *args, **kwargs):
-        """Auto-calculate grade based on percentage"""
+        """Store percentage/is_passing and auto-calculate grade based on percentage"""
+        self.compute_scores()
         if not self.grade:
             percentage = self.percentage
             if percentage >= 90:
@@ -114,6 +120,9 @@ class Gradebook(models.Model):
                 self.grade = 'D'
             else:
                 self.grade = 'F'
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'marks_obtained' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'percentage', 'is_passing', 'grade'}
         super().save(*args, **kwargs)
 
     class Meta:
@@ -121,6 +130,8 @@ class Gradebook(models.Model):
         ordering = ['student', 'exam']
         indexes = [
             models.Index(fields=['student', 'exam']),
+            models.Index(fields=['exam', 'percentage'], name='gradebook_exam_pct_idx'),
+            models.Index(fields=['school', 'is_passing'], name='gradebook_school_pass_idx'),
         ]
 
 
@@ -149,3 +160,62 @@ class GradebookSummary(models.Model):
             models.Index(fields=['student', 'term', 'subject'], name='gb_sum_stu_term_sub_idx'),
             models.Index(fields=['term', 'subject'], name='gb_sum_term_sub_idx'),
         ]
+
+
+class TermRanking(models.Model):
+    """
+    Merit list entry: a student's overall result and positions for a term.
+    Maintained by exams.ranking.RankingEngine from GradebookSummary; the
+    grade and class are those of the student when the ranking was computed.
+    """
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='term_rankings')
+    term = models.ForeignKey(Term, on_delete=models.CASCADE, related_name='term_rankings')
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='term_rankings')
+    grade = models.ForeignKey('core.Grade', on_delete=models.SET_NULL, null=True, blank=True, related_name='term_rankings')
+    school_class = models.ForeignKey(
+        SchoolClass, on_delete=models.SET_NULL, null=True, blank=True, related_name='term_rankings'
+    )
+    subjects_count = models.IntegerField(default=0)
+    total_score = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    mean_score = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    class_position = models.IntegerField(help_text='Position among all students of the grade (every stream)')
+    class_size = models.IntegerField()
+    stream_position = models.IntegerField(null=True, blank=True, help_text='Position within the student\'s class')
+    stream_size = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.student} - {self.term} - {self.class_position}/{self.class_size}"
+
+    class Meta:
+        unique_together = ['school', 'term', 'student']
+        ordering = ['term', 'grade', 'class_position']
+        indexes = [
+            models.Index(fields=['term', 'grade', 'class_position'], name='term_rank_grade_pos_idx'),
+            models.Index(fields=['term', 'school_class', 'stream_position'], name='term_rank_class_pos_idx'),
+        ]
+
+
+class SubjectAnalytics(models.Model):
+    """Score statistics of one subject across a grade for a term (see exams.ranking)"""
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='subject_analytics')
+    term = models.ForeignKey(Term, on_delete=models.CASCADE, related_name='subject_analytics')
+    grade = models.ForeignKey('core.Grade', on_delete=models.CASCADE, related_name='subject_analytics')
+    subject = models.ForeignKey('timetable.Subject', on_delete=models.CASCADE, related_name='subject_analytics')
+    student_count = models.IntegerField(default=0)
+    mean_score = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    std_deviation = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    min_score = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    max_score = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    grade_distribution = models.JSONField(default=dict, blank=True)  # final grade -> number of students
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.subject} - {self.grade} - {self.term}: {self.mean_score}"
+
+    class Meta:
+        unique_together = ['school', 'term', 'grade', 'subject']
+        ordering = ['term', 'grade', 'subject']
+        verbose_name_plural = 'Subject analytics'
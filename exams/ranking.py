@@ -0,0 +1,262 @@
+"""
+Ranking and Analytics Engine
+
+Turns a term's GradebookSummary rows into merit lists and subject statistics,
+one grade (all its streams) at a time:
+
+- Subject position: GradebookSummary.rank, the DENSE_RANK of a student's
+  subject average among students of the same grade.
+- Class and stream position: TermRanking, the DENSE_RANK of a student's mean
+  subject average within the grade and within their class (stream), with the
+  group sizes.
+- SubjectAnalytics: mean, standard deviation, minimum, maximum and final
+  grade distribution per (term, grade, subject).
+
+Positions come from window functions and statistics from SQL aggregates, so a
+refresh is a handful of queries however large the grade is. GradeSummaryEngine
+(bulk grade entry, mark sheets, exam mark changes) calls ``refresh`` for the
+grades of the students whose marks changed. A single saved Gradebook queues
+``schedule_refresh`` for the student's grade, which runs once per term and
+grade after the transaction commits however many rows it saved;
+``manage.py rebuild_rankings`` recomputes whole terms. Report views read
+positions from these tables instead of ranking on the fly.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Max, Min, StdDev
+from decimal import Decimal, ROUND_HALF_UP
+import threading
+
+from .models import GradebookSummary, SubjectAnalytics, TermRanking
+
+
+def _two_places(value):
+    return Decimal(value or 0).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+# Per thread: (database transaction id, {(term id, grade id), ...}) of the
+# refreshes queued in the current transaction
+_pending = threading.local()
+
+
+def _current_transaction_id():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+        return cursor.fetchone()[0]
+
+
+def schedule_refresh(school, term, grade_id):
+    """
+    Refresh the positions and analytics of one grade once the current
+    transaction commits
+
+    Repeated calls for the same term and grade inside one transaction queue a
+    single refresh. Pending keys are tagged with the database transaction id,
+    so keys left behind by a rolled back transaction are discarded. Outside a
+    transaction the refresh runs immediately.
+    """
+    if grade_id is None:
+        return
+    if not connection.in_atomic_block:
+        RankingEngine(school, term).refresh(grade_ids=[grade_id])
+        return
+
+    txid = _current_transaction_id()
+    if getattr(_pending, 'txid', None) != txid:
+        _pending.txid = txid
+        _pending.keys = set()
+    key = (term.id, grade_id)
+    if key in _pending.keys:
+        return
+    _pending.keys.add(key)
+
+    def refresh():
+        _pending.keys.discard(key)
+        RankingEngine(school, term).refresh(grade_ids=[grade_id])
+
+    transaction.on_commit(refresh)
+
+
+class RankingEngine:
+    """Maintain the positions and subject analytics of one school term"""
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, school, term):
+        self.school = school
+        self.term = term
+
+    def grades_of_students(self, student_ids):
+        """Ids of the grades the given students are in"""
+        from core.models import Student
+
+        return set(
+            Student.objects.filter(school=self.school, id__in=list(student_ids))
+            .values_list('grade_id', flat=True).distinct()
+        )
+
+    def refresh(self, grade_ids=None):
+        """
+        Recompute positions and analytics
+
+        Args:
+            grade_ids: Grades to recompute; every grade with summaries in the
+                term when None
+
+        Returns:
+            Dict with subject_positions (summaries whose rank changed),
+            rankings and analytics (rows written) counts
+        """
+        if grade_ids is None:
+            grade_ids = set(
+                GradebookSummary.objects.filter(school=self.school, term=self.term)
+                .values_list('student__grade_id', flat=True).distinct()
+            )
+        grade_ids = sorted(grade_id for grade_id in grade_ids if grade_id is not None)
+        if not grade_ids:
+            return {'subject_positions': 0, 'rankings': 0, 'analytics': 0}
+
+        with transaction.atomic():
+            subject_positions = self._rank_subjects(grade_ids)
+            rankings = self._rank_students(grade_ids)
+            analytics = self._subject_analytics(grade_ids)
+        return {'subject_positions': subject_positions, 'rankings': rankings, 'analytics': analytics}
+
+    def _rank_subjects(self, grade_ids):
+        """Set GradebookSummary.rank to the subject position within the grade, in one UPDATE"""
+        from core.models import Student
+
+        summary_table = connection.ops.quote_name(GradebookSummary._meta.db_table)
+        student_table = connection.ops.quote_name(Student._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {summary_table} s
+                SET rank = ranked.position
+                FROM (
+                    SELECT gs.id, DENSE_RANK() OVER (
+                        PARTITION BY gs.subject_id, st.grade_id ORDER BY gs.average_percentage DESC
+                    ) AS position
+                    FROM {summary_table} gs
+                    JOIN {student_table} st ON st.id = gs.student_id
+                    WHERE gs.school_id = %s AND gs.term_id = %s AND st.grade_id = ANY(%s)
+                ) ranked
+                WHERE s.id = ranked.id AND s.rank IS DISTINCT FROM ranked.position
+            """, [self.school.id, self.term.id, grade_ids])
+            return cursor.rowcount
+
+    def _rank_students(self, grade_ids):
+        """Rebuild the TermRanking rows of the grades"""
+        from core.models import Student
+
+        summary_table = connection.ops.quote_name(GradebookSummary._meta.db_table)
+        student_table = connection.ops.quote_name(Student._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH totals AS (
+                    SELECT gs.student_id, st.grade_id, st.school_class_id,
+                           COUNT(*) AS subjects_count,
+                           SUM(gs.average_percentage) AS total_score,
+                           ROUND(AVG(gs.average_percentage), 2) AS mean_score
+                    FROM {summary_table} gs
+                    JOIN {student_table} st ON st.id = gs.student_id
+                    WHERE gs.school_id = %s AND gs.term_id = %s AND st.grade_id = ANY(%s)
+                    GROUP BY gs.student_id, st.grade_id, st.school_class_id
+                )
+                SELECT student_id, grade_id, school_class_id, subjects_count, total_score, mean_score,
+                       DENSE_RANK() OVER (PARTITION BY grade_id ORDER BY mean_score DESC),
+                       COUNT(*) OVER (PARTITION BY grade_id),
+                       DENSE_RANK() OVER (PARTITION BY grade_id, school_class_id ORDER BY mean_score DESC),
+                       COUNT(*) OVER (PARTITION BY grade_id, school_class_id)
+                FROM totals
+            """, [self.school.id, self.term.id, grade_ids])
+            rows = cursor.fetchall()
+
+        rankings = []
+        for (student_id, grade_id, school_class_id, subjects_count, total_score, mean_score,
+             class_position, class_size, stream_position, stream_size) in rows:
+            in_stream = school_class_id is not None
+            rankings.append(TermRanking(
+                school=self.school,
+                term=self.term,
+                student_id=student_id,
+                grade_id=grade_id,
+                school_class_id=school_class_id,
+                subjects_count=subjects_count,
+                total_score=_two_places(total_score),
+                mean_score=_two_places(mean_score),
+                class_position=class_position,
+                class_size=class_size,
+                stream_position=stream_position if in_stream else None,
+                stream_size=stream_size if in_stream else None,
+            ))
+
+        # Students who moved grade are upserted into their new grade below
+        TermRanking.objects.filter(school=self.school, term=self.term, grade_id__in=grade_ids).exclude(
+            student_id__in=[ranking.student_id for ranking in rankings]
+        ).delete()
+        TermRanking.objects.bulk_create(
+            rankings,
+            batch_size=self.BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['school', 'term', 'student'],
+            update_fields=[
+                'grade', 'school_class', 'subjects_count', 'total_score', 'mean_score',
+                'class_position', 'class_size', 'stream_position', 'stream_size', 'updated_at',
+            ],
+        )
+        return len(rankings)
+
+    def _subject_analytics(self, grade_ids):
+        """Rebuild the SubjectAnalytics rows of the grades"""
+        summaries = GradebookSummary.objects.filter(
+            school=self.school, term=self.term, student__grade_id__in=grade_ids
+        )
+        distributions = {}
+        for row in summaries.values('student__grade_id', 'subject_id', 'final_grade').annotate(
+            students=Count('id')
+        ).order_by():
+            key = (row['student__grade_id'], row['subject_id'])
+            distributions.setdefault(key, {})[row['final_grade'] or '-'] = row['students']
+
+        analytics = []
+        for row in summaries.values('student__grade_id', 'subject_id').annotate(
+            student_count=Count('id'),
+            mean_score=Avg('average_percentage'),
+            std_deviation=StdDev('average_percentage'),
+            min_score=Min('average_percentage'),
+            max_score=Max('average_percentage'),
+        ).order_by():
+            key = (row['student__grade_id'], row['subject_id'])
+            analytics.append(SubjectAnalytics(
+                school=self.school,
+                term=self.term,
+                grade_id=key[0],
+                subject_id=key[1],
+                student_count=row['student_count'],
+                mean_score=_two_places(row['mean_score']),
+                std_deviation=_two_places(row['std_deviation']),
+                min_score=_two_places(row['min_score']),
+                max_score=_two_places(row['max_score']),
+                grade_distribution=dict(sorted(distributions.get(key, {}).items())),
+            ))
+
+        current = {(row.grade_id, row.subject_id) for row in analytics}
+        stale_ids = [
+            pk for pk, grade_id, subject_id in SubjectAnalytics.objects.filter(
+                school=self.school, term=self.term, grade_id__in=grade_ids
+            ).values_list('id', 'grade_id', 'subject_id')
+            if (grade_id, subject_id) not in current
+        ]
+        if stale_ids:
+            SubjectAnalytics.objects.filter(id__in=stale_ids).delete()
+        SubjectAnalytics.objects.bulk_create(
+            analytics,
+            batch_size=self.BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['school', 'term', 'grade', 'subject'],
+            update_fields=[
+                'student_count', 'mean_score', 'std_deviation', 'min_score', 'max_score',
+                'grade_distribution', 'updated_at',
+            ],
+        )
+        return len(analytics)
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import ExamType, Exam, Gradebook, GradebookSummary
+from .models import ExamType, Exam, Gradebook, GradebookSummary, TermRanking, SubjectAnalytics
 from core.serializers import StudentSerializer, SchoolClassSerializer
 from timetable.serializers import SubjectSerializer
 
@@ -69,7 +69,7 @@ class GradebookSerializer(serializers.ModelSerializer):
     student_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
     exam = ExamSerializer(read_only=True)
     exam_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
-    percentage = serializers.DecimalField(max_digits=5, decimal_places=2, read_only=True)
+    percentage = serializers.DecimalField(max_digits=7, decimal_places=2, read_only=True)
     is_passing = serializers.BooleanField(read_only=True)
     entered_by_username = serializers.CharField(source='entered_by.username', read_only=True, allow_null=True)
 
@@ -149,3 +149,36 @@ class GradebookSummarySerializer(serializers.ModelSerializer):
             validated_data['subject'] = Subject.objects.get(id=subject_id)
         
         return super().update(instance, validated_data)
+
+
+class TermRankingSerializer(serializers.ModelSerializer):
+    student = StudentSerializer(read_only=True)
+    term_name = serializers.CharField(source='term.name', read_only=True)
+    term_academic_year = serializers.CharField(source='term.academic_year', read_only=True)
+    grade_name = serializers.CharField(source='grade.name', read_only=True, allow_null=True)
+    school_class_name = serializers.CharField(source='school_class.name', read_only=True, allow_null=True)
+
+    class Meta:
+        model = TermRanking
+        fields = [
+            'id', 'student', 'term', 'term_name', 'term_academic_year',
+            'grade', 'grade_name', 'school_class', 'school_class_name',
+            'subjects_count', 'total_score', 'mean_score',
+            'class_position', 'class_size', 'stream_position', 'stream_size', 'updated_at'
+        ]
+        read_only_fields = fields
+
+
+class SubjectAnalyticsSerializer(serializers.ModelSerializer):
+    subject = SubjectSerializer(read_only=True)
+    term_name = serializers.CharField(source='term.name', read_only=True)
+    grade_name = serializers.CharField(source='grade.name', read_only=True)
+
+    class Meta:
+        model = SubjectAnalytics
+        fields = [
+            'id', 'term', 'term_name', 'grade', 'grade_name', 'subject',
+            'student_count', 'mean_score', 'std_deviation', 'min_score', 'max_score',
+            'grade_distribution', 'updated_at'
+        ]
+        read_only_fields = fields
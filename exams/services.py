@@ -1,11 +1,149 @@
 """
 Service classes for exams module business logic
 """
-from django.db.models import Sum, Avg, Count
+from django.db import connection, transaction
+from django.db.models import Sum, Avg, Count, Q
 from django.utils import timezone
+from decimal import Decimal, ROUND_HALF_UP
 from .models import Exam, Gradebook, GradebookSummary
-from core.models import Student, Term
-from timetable.models import Subject
+from .ranking import RankingEngine, schedule_refresh
+from core.models import Term
+
+
+def grade_for_percentage(percentage):
+    """Letter grade for an average percentage"""
+    if percentage >= 90:
+        return 'A'
+    elif percentage >= 80:
+        return 'B'
+    elif percentage >= 70:
+        return 'C'
+    elif percentage >= 60:
+        return 'D'
+    return 'F'
+
+
+def _percentage(marks_obtained, total_marks):
+    if not total_marks:
+        return Decimal('0')
+    return (Decimal(marks_obtained) / Decimal(total_marks) * 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def sync_gradebook_scores(school=None, exam_ids=None):
+    """
+    Recompute the stored Gradebook.percentage and is_passing from the marks
+    and their exam's max/passing marks, in a single UPDATE
+
+    Args:
+        school: Optional School to limit the update to
+        exam_ids: Optional iterable of exam ids to limit the update to
+
+    Returns:
+        Number of gradebooks whose stored scores changed
+    """
+    gradebook_table = connection.ops.quote_name(Gradebook._meta.db_table)
+    exam_table = connection.ops.quote_name(Exam._meta.db_table)
+    conditions = ''
+    params = []
+    if school is not None:
+        conditions += ' AND g.school_id = %s'
+        params.append(school.id)
+    if exam_ids is not None:
+        exam_ids = list(exam_ids)
+        if not exam_ids:
+            return 0
+        conditions += ' AND g.exam_id = ANY(%s)'
+        params.append(exam_ids)
+
+    percentage = 'CASE WHEN e.max_marks > 0 THEN ROUND(g.marks_obtained * 100 / e.max_marks, 2) ELSE 0 END'
+    is_passing = 'g.marks_obtained >= e.passing_marks'
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {gradebook_table} g
+            SET percentage = {percentage}, is_passing = {is_passing}
+            FROM {exam_table} e
+            WHERE g.exam_id = e.id{conditions}
+              AND (g.percentage IS DISTINCT FROM {percentage} OR g.is_passing IS DISTINCT FROM {is_passing})
+        """, params)
+        return cursor.rowcount
+
+
+class GradeSummaryEngine:
+    """
+    Set-based generation of GradebookSummary rows for a term.
+
+    Marks are summed per (student, subject) in one aggregate query, all
+    summaries are written with a single upsert, and positions are refreshed
+    by the RankingEngine - a handful of queries regardless of class size.
+    """
+
+    BATCH_SIZE = 1000
+
+    @staticmethod
+    def generate(school, term, subject=None, student_ids=None):
+        """
+        Create or refresh summaries for active students in a term
+
+        Args:
+            school: School instance
+            term: Term instance
+            subject: Optional Subject to limit generation to (all active subjects otherwise)
+            student_ids: Optional iterable of student ids to limit generation to
+
+        Returns:
+            Dict with created, updated and ranked counts
+        """
+        gradebooks = Gradebook.objects.filter(
+            school=school,
+            exam__term=term,
+            student__is_active=True,
+        )
+        if subject:
+            gradebooks = gradebooks.filter(exam__subject=subject, exam__subject__school=school)
+        else:
+            gradebooks = gradebooks.filter(exam__subject__school=school, exam__subject__is_active=True)
+        if student_ids is not None:
+            gradebooks = gradebooks.filter(student_id__in=list(student_ids))
+
+        totals = gradebooks.values('student_id', 'exam__subject_id').annotate(
+            marks_obtained=Sum('marks_obtained'),
+            total_marks=Sum('exam__max_marks'),
+        ).order_by()
+
+        summaries = []
+        for row in totals:
+            average_percentage = _percentage(row['marks_obtained'], row['total_marks'])
+            summaries.append(GradebookSummary(
+                school=school,
+                student_id=row['student_id'],
+                term=term,
+                subject_id=row['exam__subject_id'],
+                total_marks=row['total_marks'] or 0,
+                marks_obtained=row['marks_obtained'] or 0,
+                average_percentage=average_percentage,
+                final_grade=grade_for_percentage(average_percentage),
+            ))
+        if not summaries:
+            return {'created': 0, 'updated': 0, 'ranked': 0}
+
+        existing = set(
+            GradebookSummary.objects.filter(school=school, term=term).values_list('student_id', 'subject_id')
+        )
+        created = sum(1 for s in summaries if (s.student_id, s.subject_id) not in existing)
+
+        with transaction.atomic():
+            GradebookSummary.objects.bulk_create(
+                summaries,
+                batch_size=GradeSummaryEngine.BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['school', 'student', 'term', 'subject'],
+                update_fields=['total_marks', 'marks_obtained', 'average_percentage', 'final_grade', 'updated_at'],
+            )
+            ranking_engine = RankingEngine(school, term)
+            grade_ids = ranking_engine.grades_of_students(student_ids) if student_ids is not None else None
+            ranked = ranking_engine.refresh(grade_ids=grade_ids)['subject_positions']
+
+        return {'created': created, 'updated': len(summaries) - created, 'ranked': ranked}
 
 
 class GradebookService:
@@ -17,31 +155,23 @@ class GradebookService:
         Update or create gradebook summary for a student in a term for a subject.
         This should be called whenever a grade is entered or updated.
         """
-        gradebooks = Gradebook.objects.filter(
+        totals = Gradebook.objects.filter(
             school=student.school,
             student=student,
             exam__term=term,
             exam__subject=subject
+        ).aggregate(
+            count=Count('id'),
+            marks_obtained=Sum('marks_obtained'),
+            total_marks=Sum('exam__max_marks'),
         )
         
-        if not gradebooks.exists():
+        if not totals['count']:
             return None
         
-        total_marks = sum(gb.exam.max_marks for gb in gradebooks)
-        marks_obtained = sum(gb.marks_obtained for gb in gradebooks)
-        average_percentage = (marks_obtained / total_marks * 100) if total_marks > 0 else 0
-        
-        # Calculate final grade
-        if average_percentage >= 90:
-            final_grade = 'A'
-        elif average_percentage >= 80:
-            final_grade = 'B'
-        elif average_percentage >= 70:
-            final_grade = 'C'
-        elif average_percentage >= 60:
-            final_grade = 'D'
-        else:
-            final_grade = 'F'
+        total_marks = totals['total_marks'] or 0
+        marks_obtained = totals['marks_obtained'] or 0
+        average_percentage = _percentage(marks_obtained, total_marks)
         
         summary, created = GradebookSummary.objects.update_or_create(
             school=student.school,
@@ -52,10 +182,14 @@ class GradebookService:
                 'total_marks': total_marks,
                 'marks_obtained': marks_obtained,
                 'average_percentage': average_percentage,
-                'final_grade': final_grade,
+                'final_grade': grade_for_percentage(average_percentage),
             }
         )
         
+        # Positions, merit list and analytics of the student's grade follow once
+        # the save commits, one refresh per grade however many rows were saved
+        schedule_refresh(student.school, term, student.grade_id)
+        
         return summary
     
     @staticmethod
@@ -63,30 +197,10 @@ class GradebookService:
         """
         Generate gradebook summaries for all active students in a term.
         If subject is provided, only generate for that subject.
-        """
-        students = Student.objects.filter(school=school, is_active=True)
-        
-        if subject:
-            subjects = Subject.objects.filter(id=subject.id, school=school)
-        else:
-            subjects = Subject.objects.filter(school=school, is_active=True)
-        
-        created_count = 0
-        
-        for student in students:
-            for subj in subjects:
-                # Check if summary exists before updating
-                existing = GradebookSummary.objects.filter(
-                    school=school,
-                    student=student,
-                    term=term,
-                    subject=subj
-                ).exists()
-                summary = GradebookService.update_gradebook_summary(student, term, subj)
-                if summary and not existing:
-                    created_count += 1
         
-        return created_count
+        Returns the number of summaries created (existing ones are refreshed).
+        """
+        return GradeSummaryEngine.generate(school, term, subject=subject)['created']
     
     @staticmethod
     def get_student_performance_stats(student, term=None):
@@ -102,7 +216,13 @@ class GradebookService:
         if term:
             gradebooks = gradebooks.filter(exam__term=term)
         
-        if not gradebooks.exists():
+        counts = gradebooks.aggregate(
+            total_exams=Count('id'),
+            avg_percentage=Avg('percentage'),
+            passing_count=Count('id', filter=Q(is_passing=True)),
+        )
+        total_exams = counts['total_exams']
+        if not total_exams:
             return {
                 'total_exams': 0,
                 'average_percentage': 0,
@@ -110,9 +230,8 @@ class GradebookService:
                 'failing_count': 0,
             }
         
-        total_exams = gradebooks.count()
-        avg_percentage = gradebooks.aggregate(avg=Avg('percentage'))['avg'] or 0
-        passing_count = sum(1 for gb in gradebooks if gb.is_passing)
+        avg_percentage = counts['avg_percentage'] or 0
+        passing_count = counts['passing_count']
         failing_count = total_exams - passing_count
         
         return {
@@ -1,10 +1,11 @@
 """
 Signals for exams module
 """
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
-from .models import Gradebook
-from .services import GradebookService
+from decimal import Decimal
+from .models import Exam, Gradebook
+from .services import GradebookService, GradeSummaryEngine, sync_gradebook_scores
 
 
 @receiver(post_save, sender=Gradebook)
@@ -30,3 +31,31 @@ def update_gradebook_summary_on_delete(sender, instance, **kwargs):
         instance.exam.subject
     )
 
+
+@receiver(pre_save, sender=Exam)
+def store_previous_exam_marks(sender, instance, **kwargs):
+    """Remember the stored max/passing marks so changes can be detected after saving"""
+    if instance.pk:
+        instance._previous_marks = Exam.objects.filter(pk=instance.pk).values_list(
+            'max_marks', 'passing_marks'
+        ).first()
+    else:
+        instance._previous_marks = None
+
+
+@receiver(post_save, sender=Exam)
+def sync_gradebooks_on_exam_change(sender, instance, created, **kwargs):
+    """
+    Recompute the stored percentage/is_passing of the exam's gradebooks when
+    its max or passing marks change, and the term summaries when max marks do
+    """
+    previous = getattr(instance, '_previous_marks', None)
+    if created or previous is None:
+        return
+    max_marks = Decimal(str(instance.max_marks))
+    passing_marks = Decimal(str(instance.passing_marks))
+    if previous == (max_marks, passing_marks):
+        return
+    sync_gradebook_scores(exam_ids=[instance.pk])
+    if previous[0] != max_marks:
+        GradeSummaryEngine.generate(instance.school, instance.term, subject=instance.subject)
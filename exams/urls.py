@@ -2,7 +2,8 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
     ExamTypeViewSet, ExamViewSet, GradebookViewSet, GradebookSummaryViewSet,
-    exam_list, gradebook_list, gradebook_summary_list
+    TermRankingViewSet, SubjectAnalyticsViewSet,
+    exam_list, gradebook_list, gradebook_import, gradebook_summary_list, merit_list
 )
 
 app_name = 'exams'
@@ -12,11 +13,15 @@ router.register(r'api/exam-types', ExamTypeViewSet, basename='api-exam-type')
 router.register(r'api/exams', ExamViewSet, basename='api-exam')
 router.register(r'api/gradebooks', GradebookViewSet, basename='api-gradebook')
 router.register(r'api/gradebook-summaries', GradebookSummaryViewSet, basename='api-gradebook-summary')
+router.register(r'api/rankings', TermRankingViewSet, basename='api-term-ranking')
+router.register(r'api/subject-analytics', SubjectAnalyticsViewSet, basename='api-subject-analytics')
 
 urlpatterns = [
     path('', exam_list, name='exam_list'),
     path('gradebooks/', gradebook_list, name='gradebook_list'),
+    path('gradebooks/import/', gradebook_import, name='gradebook_import'),
     path('summaries/', gradebook_summary_list, name='gradebook_summary_list'),
+    path('merit-list/', merit_list, name='merit_list'),
     path('', include(router.urls)),
 ]
 
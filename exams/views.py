@@ -3,14 +3,19 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.db.models import Avg, Sum, Count, F
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.paginator import Paginator
-from .models import ExamType, Exam, Gradebook, GradebookSummary
+from .models import ExamType, Exam, Gradebook, GradebookSummary, TermRanking, SubjectAnalytics
+from .grade_entry import GradeEntryError, GradeEntryService
+from .ranking import RankingEngine
+from .services import GradeSummaryEngine
 from .serializers import (
-    ExamTypeSerializer, ExamSerializer, GradebookSerializer, GradebookSummarySerializer
+    ExamTypeSerializer, ExamSerializer, GradebookSerializer, GradebookSummarySerializer,
+    TermRankingSerializer, SubjectAnalyticsSerializer
 )
-from core.models import Student, Term, SchoolClass
+from core.models import Student, Term, SchoolClass, Grade
 from timetable.models import Subject
 
 
@@ -96,42 +101,50 @@ class GradebookViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'])
     def bulk_enter(self, request):
-        """Bulk enter grades for multiple students"""
+        """Bulk enter grades for multiple students with a single upsert"""
         school = request.user.profile.school
         exam_id = request.data.get('exam_id')
         grades_data = request.data.get('grades', [])
         
         if not exam_id:
             return Response({'error': 'exam_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        exam = Exam.objects.select_related('term', 'subject').filter(id=exam_id, school=school).first()
+        if exam is None:
+            return Response({'error': 'Exam not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        created_count = 0
-        updated_count = 0
-        
-        for grade_data in grades_data:
-            student_id = grade_data.get('student_id')
-            marks_obtained = grade_data.get('marks_obtained')
-            remarks = grade_data.get('remarks', '')
-            
-            gradebook, created = Gradebook.objects.update_or_create(
-                school=school,
-                student_id=student_id,
-                exam_id=exam_id,
-                defaults={
-                    'marks_obtained': marks_obtained,
-                    'remarks': remarks,
-                    'entered_by': request.user,
-                }
-            )
-            
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+        try:
+            result = GradeEntryService(school, exam, user=request.user).save(grades_data)
+        except GradeEntryError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response({
             'message': f'Entered grades for {len(grades_data)} students',
-            'created': created_count,
-            'updated': updated_count
+            'created': result['created'],
+            'updated': result['updated']
+        })
+
+    @action(detail=False, methods=['post'])
+    def import_sheet(self, request):
+        """Enter grades for an exam from an uploaded CSV/XLSX mark sheet"""
+        school = request.user.profile.school
+        exam_id = request.data.get('exam_id')
+        mark_sheet = request.FILES.get('file')
+        
+        if not exam_id or not mark_sheet:
+            return Response({'error': 'exam_id and file are required'}, status=status.HTTP_400_BAD_REQUEST)
+        exam = Exam.objects.select_related('term', 'subject').filter(id=exam_id, school=school).first()
+        if exam is None:
+            return Response({'error': 'Exam not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        try:
+            result = GradeEntryService(school, exam, user=request.user).import_sheet(mark_sheet)
+        except GradeEntryError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'message': f'Entered grades for {result["rows"]} students',
+            'created': result['created'],
+            'updated': result['updated']
         })
 
 
@@ -174,66 +187,108 @@ class GradebookSummaryViewSet(viewsets.ModelViewSet):
             return Response({'error': 'term_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         
         term = Term.objects.get(id=term_id, school=school)
-        students = Student.objects.filter(school=school, is_active=True)
-        
+        subject = None
         if subject_id:
-            subjects = Subject.objects.filter(id=subject_id, school=school)
-        else:
-            subjects = Subject.objects.filter(school=school, is_active=True)
-        
-        created_count = 0
-        
-        for student in students:
-            for subject in subjects:
-                # Get all gradebooks for this student, term, and subject
-                gradebooks = Gradebook.objects.filter(
-                    school=school,
-                    student=student,
-                    exam__term=term,
-                    exam__subject=subject
-                )
-                
-                if not gradebooks.exists():
-                    continue
-                
-                total_marks = sum(gb.exam.max_marks for gb in gradebooks)
-                marks_obtained = sum(gb.marks_obtained for gb in gradebooks)
-                average_percentage = (marks_obtained / total_marks * 100) if total_marks > 0 else 0
-                
-                # Calculate final grade
-                if average_percentage >= 90:
-                    final_grade = 'A'
-                elif average_percentage >= 80:
-                    final_grade = 'B'
-                elif average_percentage >= 70:
-                    final_grade = 'C'
-                elif average_percentage >= 60:
-                    final_grade = 'D'
-                else:
-                    final_grade = 'F'
-                
-                summary, created = GradebookSummary.objects.update_or_create(
-                    school=school,
-                    student=student,
-                    term=term,
-                    subject=subject,
-                    defaults={
-                        'total_marks': total_marks,
-                        'marks_obtained': marks_obtained,
-                        'average_percentage': average_percentage,
-                        'final_grade': final_grade,
-                    }
-                )
-                
-                if created:
-                    created_count += 1
+            subject = Subject.objects.filter(id=subject_id, school=school).first()
+            if subject is None:
+                return Response({'error': 'Subject not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        result = GradeSummaryEngine.generate(school, term, subject=subject)
+        created_count = result['created']
         
         return Response({
             'message': f'Generated gradebook summaries for {created_count} student-subject combinations',
-            'term': term.name
+            'term': term.name,
+            'created': created_count,
+            'updated': result['updated'],
+            'ranked': result['ranked'],
+        })
+
+
+class TermRankingViewSet(viewsets.ReadOnlyModelViewSet):
+    """Merit list positions maintained by RankingEngine"""
+    serializer_class = TermRankingSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        school = self.request.user.profile.school
+        queryset = TermRanking.objects.filter(school=school).select_related(
+            'student', 'term', 'grade', 'school_class'
+        )
+        
+        term_id = self.request.query_params.get('term_id')
+        if term_id:
+            queryset = queryset.filter(term_id=term_id)
+        
+        grade_id = self.request.query_params.get('grade_id')
+        if grade_id:
+            queryset = queryset.filter(grade_id=grade_id)
+        
+        class_id = self.request.query_params.get('class_id')
+        if class_id:
+            queryset = queryset.filter(school_class_id=class_id)
+            return queryset.order_by('term', 'stream_position', 'student__first_name')
+        
+        student_id = self.request.query_params.get('student_id')
+        if student_id:
+            queryset = queryset.filter(student_id=student_id)
+        
+        return queryset.order_by('term', 'grade', 'class_position', 'student__first_name')
+
+    @action(detail=False, methods=['post'])
+    def refresh(self, request):
+        """Recompute a term's positions and subject analytics (optionally for one grade)"""
+        school = request.user.profile.school
+        term_id = request.data.get('term_id')
+        grade_id = request.data.get('grade_id')
+        
+        if not term_id:
+            return Response({'error': 'term_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        term = Term.objects.filter(id=term_id, school=school).first()
+        if term is None:
+            return Response({'error': 'Term not found'}, status=status.HTTP_404_NOT_FOUND)
+        grade_ids = None
+        if grade_id:
+            grade = Grade.objects.filter(id=grade_id, school=school).first()
+            if grade is None:
+                return Response({'error': 'Grade not found'}, status=status.HTTP_404_NOT_FOUND)
+            grade_ids = [grade.id]
+        
+        result = RankingEngine(school, term).refresh(grade_ids=grade_ids)
+        return Response({
+            'message': f'Ranked {result["rankings"]} students',
+            'term': term.name,
+            **result,
         })
 
 
+class SubjectAnalyticsViewSet(viewsets.ReadOnlyModelViewSet):
+    """Per grade subject statistics maintained by RankingEngine"""
+    serializer_class = SubjectAnalyticsSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        school = self.request.user.profile.school
+        queryset = SubjectAnalytics.objects.filter(school=school).select_related(
+            'term', 'grade', 'subject'
+        )
+        
+        term_id = self.request.query_params.get('term_id')
+        if term_id:
+            queryset = queryset.filter(term_id=term_id)
+        
+        grade_id = self.request.query_params.get('grade_id')
+        if grade_id:
+            queryset = queryset.filter(grade_id=grade_id)
+        
+        subject_id = self.request.query_params.get('subject_id')
+        if subject_id:
+            queryset = queryset.filter(subject_id=subject_id)
+        
+        return queryset.order_by('term', 'grade', 'subject__name')
+
+
 # UI Views
 @login_required
 def exam_list(request):
@@ -300,7 +355,7 @@ def gradebook_list(request):
     page_obj = paginator.get_page(page_number)
     
     students = Student.objects.filter(school=school, is_active=True).order_by('first_name')
-    exams = Exam.objects.filter(school=school).order_by('-exam_date')
+    exams = Exam.objects.filter(school=school).select_related('subject').order_by('-exam_date')
     terms = Term.objects.filter(school=school).order_by('-academic_year', '-term_number')
     
     context = {
@@ -315,6 +370,35 @@ def gradebook_list(request):
     return render(request, 'exams/gradebook_list.html', context)
 
 
+@login_required
+def gradebook_import(request):
+    """Upload a CSV/XLSX mark sheet for an exam"""
+    school = request.user.profile.school
+    if request.method != 'POST':
+        return redirect('exams:gradebook_list')
+    
+    exam_id = request.POST.get('exam_id', '')
+    mark_sheet = request.FILES.get('mark_sheet')
+    exam = Exam.objects.select_related('term', 'subject').filter(id=exam_id, school=school).first() if exam_id.isdigit() else None
+    if exam is None or not mark_sheet:
+        messages.error(request, 'Select an exam and a mark sheet to upload.')
+        return redirect('exams:gradebook_list')
+    
+    try:
+        result = GradeEntryService(school, exam, user=request.user).import_sheet(mark_sheet)
+    except GradeEntryError as e:
+        messages.error(request, f'Mark sheet not imported; nothing was saved. {len(e.errors)} problem(s) found:')
+        for error in e.errors:
+            messages.error(request, error)
+        return redirect(f"{reverse('exams:gradebook_list')}?exam_id={exam.id}")
+    
+    messages.success(
+        request,
+        f'Entered grades for {result["rows"]} students ({result["created"]} new, {result["updated"]} updated)'
+    )
+    return redirect(f"{reverse('exams:gradebook_list')}?exam_id={exam.id}")
+
+
 @login_required
 def gradebook_summary_list(request):
     """List gradebook summaries"""
@@ -353,3 +437,49 @@ def gradebook_summary_list(request):
         'subject_id': subject_id,
     }
     return render(request, 'exams/gradebook_summary_list.html', context)
+
+
+@login_required
+def merit_list(request):
+    """Class (grade) merit list for a term, with stream positions and subject analytics"""
+    school = request.user.profile.school
+    terms = Term.objects.filter(school=school).order_by('-academic_year', '-term_number')
+    grades = Grade.objects.filter(school=school).order_by('name')
+    
+    term_id = request.GET.get('term_id', '')
+    grade_id = request.GET.get('grade_id', '')
+    class_id = request.GET.get('class_id', '')
+    term = terms.filter(id=term_id).first() if term_id.isdigit() else None
+    grade = grades.filter(id=grade_id).first() if grade_id.isdigit() else None
+    
+    rankings = TermRanking.objects.none()
+    analytics = SubjectAnalytics.objects.none()
+    classes = SchoolClass.objects.none()
+    if term and grade:
+        rankings = TermRanking.objects.filter(school=school, term=term, grade=grade).select_related(
+            'student', 'school_class'
+        ).order_by('class_position', 'student__first_name')
+        if class_id:
+            rankings = rankings.filter(school_class_id=class_id)
+        analytics = SubjectAnalytics.objects.filter(school=school, term=term, grade=grade).select_related(
+            'subject'
+        ).order_by('subject__name')
+        classes = SchoolClass.objects.filter(school=school, grade=grade, is_active=True).order_by('name')
+    
+    paginator = Paginator(rankings, 50)
+    page_number = request.GET.get('page')
+    page_obj = paginator.get_page(page_number)
+    
+    context = {
+        'page_obj': page_obj,
+        'analytics': analytics,
+        'terms': terms,
+        'grades': grades,
+        'classes': classes,
+        'term': term,
+        'grade': grade,
+        'term_id': term_id,
+        'grade_id': grade_id,
+        'class_id': class_id,
+    }
+    return render(request, 'exams/merit_list.html', context)
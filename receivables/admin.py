@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment, MpesaPayment, PaymentReceipt, PaymentReminder
+from .models import Payment, MpesaPayment, MpesaCallback, PaymentReceipt, PaymentReminder
 
 
 @admin.register(Payment)
@@ -32,6 +32,15 @@ class MpesaPaymentAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'updated_at']
 
 
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ['checkout_request_id', 'mpesa_receipt_number', 'result_code', 'status', 'school', 'received_at']
+    list_filter = ['status', 'result_code', 'received_at']
+    search_fields = ['checkout_request_id', 'merchant_request_id', 'mpesa_receipt_number']
+    ordering = ['-received_at']
+    readonly_fields = ['payload', 'received_at', 'processed_at']
+
+
 @admin.register(PaymentReceipt)
 class PaymentReceiptAdmin(admin.ModelAdmin):
     list_display = ['receipt_number', 'student', 'amount_paid', 'payment_method', 'issued_at']
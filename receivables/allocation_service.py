@@ -0,0 +1,246 @@
+"""
+Allocation Service
+
+The single implementation of "spread an amount over a student's outstanding
+fees": fee category allocation_order first, then due date, then the smallest
+balance. Bank statement imports, unmatched transaction matching, credit
+application and M-Pesa callbacks all allocate through it.
+
+- ``outstanding_fees`` loads the outstanding fees of many students with one
+  query (served by the partial index ``stud_fee_outstanding_idx``).
+- ``allocate`` plans many (student, amount) requests in one in-memory pass
+  with Decimal arithmetic; later requests for a student see the balances
+  left by earlier ones.
+- ``commit`` writes the planned fee balances and PaymentAllocations with
+  bulk operations, refreshes the fees' Receivables, adjusts their
+  FeeRollup buckets by the difference and flags their reporting cube
+  partitions, which bulk writes would otherwise leave stale.
+"""
+
+from django.db.models import F
+from django.utils import timezone
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Optional
+import logging
+
+from core.services.finance_rollup_service import FinanceRollupService
+from .receivable_sync import sync_receivables
+from .report_cube import mark_dirty, payment_month
+
+logger = logging.getLogger(__name__)
+
+# Amounts below this are treated as fully allocated
+ALLOCATION_TOLERANCE = Decimal('0.01')
+
+
+@dataclass
+class AllocationRequest:
+    """An amount to allocate to one student's fees"""
+    student_id: int
+    amount: Decimal
+    # Allocate to this fee before the others (e.g. the fee an STK push was for)
+    preferred_fee_id: Optional[int] = None
+    # Only allocate to the preferred fee; anything left over is the remainder
+    preferred_only: bool = False
+
+
+@dataclass
+class AllocationPlan:
+    """Where a request's amount goes"""
+    request: AllocationRequest
+    allocations: list = field(default_factory=list)  # [(StudentFee, Decimal amount), ...]
+    remainder: Decimal = Decimal('0.00')
+
+    @property
+    def applied(self):
+        return sum((amount for _, amount in self.allocations), Decimal('0.00'))
+
+    @property
+    def has_remainder(self):
+        return self.remainder > ALLOCATION_TOLERANCE
+
+
+def allocation_key(fee):
+    """Order in which a student's outstanding fees receive money"""
+    return (getattr(fee.fee_category, 'allocation_order', 999), fee.due_date, fee.amount_charged - fee.amount_paid)
+
+
+class AllocationService:
+    """Plan and persist allocations of amounts to outstanding StudentFees"""
+
+    BATCH_SIZE = 500
+
+    def __init__(self, school, user=None):
+        self.school = school
+        self.user = user
+
+    def outstanding_fees(self, student_ids, lock=False):
+        """
+        Outstanding fees of the given students, in allocation order
+
+        Args:
+            student_ids: Students to load fees for
+            lock: SELECT ... FOR UPDATE the fee rows (call inside a transaction)
+
+        Returns:
+            Dict of student_id -> list of StudentFee
+        """
+        from core.models import StudentFee
+
+        fees_by_student = {}
+        student_ids = set(student_ids)
+        if not student_ids:
+            return fees_by_student
+        fees = StudentFee.objects.filter(
+            school=self.school,
+            student_id__in=student_ids,
+            amount_charged__gt=F('amount_paid'),
+        )
+        if lock:
+            fees = fees.select_for_update(of=('self',))
+        for fee in fees.select_related('fee_category').order_by('due_date', 'created_at'):
+            fees_by_student.setdefault(fee.student_id, []).append(fee)
+        for student_fees in fees_by_student.values():
+            student_fees.sort(key=allocation_key)
+        return fees_by_student
+
+    def allocate(self, requests, fees_by_student=None, lock=False):
+        """
+        Plan the allocation of each request
+
+        Fee instances in ``fees_by_student`` are updated in memory
+        (amount_paid, is_paid) so that ``commit`` can save them.
+
+        Args:
+            requests: Iterable of AllocationRequest, allocated in order
+            fees_by_student: Preloaded ``outstanding_fees`` result (loaded when None)
+            lock: Lock the fee rows when loading them
+
+        Returns:
+            List of AllocationPlan, one per request
+        """
+        requests = list(requests)
+        if fees_by_student is None:
+            fees_by_student = self.outstanding_fees({r.student_id for r in requests}, lock=lock)
+        return [self._allocate_one(request, fees_by_student.get(request.student_id, [])) for request in requests]
+
+    @staticmethod
+    def _allocate_one(request, fees):
+        plan = AllocationPlan(request=request)
+        if request.preferred_fee_id is not None:
+            preferred = [fee for fee in fees if fee.id == request.preferred_fee_id]
+            if request.preferred_only:
+                fees = preferred
+            else:
+                fees = preferred + [fee for fee in fees if fee.id != request.preferred_fee_id]
+
+        remaining = request.amount
+        for fee in fees:
+            if remaining <= ALLOCATION_TOLERANCE:
+                break
+            outstanding = fee.amount_charged - fee.amount_paid
+            if outstanding <= 0:
+                continue
+            amount = min(remaining, outstanding)
+            if not hasattr(fee, '_allocation_previous'):
+                # Stored values, so commit can move the fee's rollup contribution
+                fee._allocation_previous = FinanceRollupService.fee_values(fee)
+            fee.amount_paid += amount
+            fee.is_paid = fee.amount_paid >= fee.amount_charged
+            plan.allocations.append((fee, amount))
+            remaining -= amount
+        plan.remainder = remaining
+        return plan
+
+    def commit(self, plans, payments=None):
+        """
+        Save the planned fee balances and their PaymentAllocations
+
+        Args:
+            plans: AllocationPlans returned by ``allocate``
+            payments: Optional list parallel to ``plans`` with the saved
+                Payment (or payment id, or None) each plan's allocations belong to
+
+        Returns:
+            Dict of fee id -> StudentFee for every fee that was updated
+        """
+        from core.models import StudentFee
+
+        plans = list(plans)
+        if payments is not None:
+            # Payments written with bulk_create skip the post_save that flags their cube partition
+            self._mark_payment_partitions(payments)
+        touched_fees = {}
+        for plan in plans:
+            for fee, _ in plan.allocations:
+                touched_fees[fee.id] = fee
+        if not touched_fees:
+            return touched_fees
+
+        now = timezone.now()
+        for fee in touched_fees.values():
+            fee.updated_at = now
+        StudentFee.objects.bulk_update(
+            list(touched_fees.values()), ['amount_paid', 'is_paid', 'updated_at'], batch_size=self.BATCH_SIZE
+        )
+        if payments is not None:
+            self._write_allocations(zip(plans, payments))
+
+        sync_receivables(self.school, student_fee_ids=touched_fees.keys())
+        FinanceRollupService.record_fee_changes(
+            (fee.__dict__.pop('_allocation_previous', None), fee) for fee in touched_fees.values()
+        )
+        mark_dirty(self.school.id, term_ids={fee.term_id for fee in touched_fees.values()})
+        return touched_fees
+
+    def _mark_payment_partitions(self, payments):
+        from .models import Payment
+
+        months = {payment_month(payment.payment_date) for payment in payments if hasattr(payment, 'payment_date')}
+        payment_ids = [payment for payment in payments if payment is not None and not hasattr(payment, 'payment_date')]
+        if payment_ids:
+            months.update(
+                payment_month(payment_date)
+                for payment_date in Payment.objects.filter(id__in=payment_ids).values_list('payment_date', flat=True)
+            )
+        mark_dirty(self.school.id, months=months)
+
+    def _write_allocations(self, plans_with_payments):
+        """Insert PaymentAllocations, topping up existing (school, payment, student_fee) rows"""
+        from .models import PaymentAllocation
+
+        amounts = {}
+        for plan, payment in plans_with_payments:
+            payment_id = getattr(payment, 'pk', payment)
+            if payment_id is None:
+                continue
+            for fee, amount in plan.allocations:
+                key = (payment_id, fee.id)
+                amounts[key] = amounts.get(key, Decimal('0.00')) + amount
+        if not amounts:
+            return
+
+        existing = PaymentAllocation.objects.filter(
+            school=self.school,
+            payment_id__in={payment_id for payment_id, _ in amounts},
+            student_fee_id__in={fee_id for _, fee_id in amounts},
+        )
+        updated = []
+        for allocation in existing:
+            key = (allocation.payment_id, allocation.student_fee_id)
+            if key in amounts:
+                allocation.amount_allocated += amounts.pop(key)
+                updated.append(allocation)
+        if updated:
+            PaymentAllocation.objects.bulk_update(updated, ['amount_allocated'], batch_size=self.BATCH_SIZE)
+        PaymentAllocation.objects.bulk_create([
+            PaymentAllocation(
+                school=self.school,
+                payment_id=payment_id,
+                student_fee_id=fee_id,
+                amount_allocated=amount,
+                created_by=self.user,
+            )
+            for (payment_id, fee_id), amount in amounts.items()
+        ], batch_size=self.BATCH_SIZE)
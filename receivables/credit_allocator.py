@@ -0,0 +1,152 @@
+"""
+Credit Allocator
+
+Applies a school's unapplied Credits to its students' outstanding fees in
+one pass. All open credits and outstanding fees are loaded with two queries,
+credits are allocated oldest first by the AllocationService, and fees,
+credits, remainder credits and PaymentAllocations are written with bulk
+operations in a single transaction. With ``dry_run=True`` the same
+allocation is computed and returned without writing anything.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+from dataclasses import dataclass, field
+from decimal import Decimal
+import logging
+
+from .allocation_service import AllocationRequest, AllocationService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CreditApplication:
+    """How one credit is spread over a student's outstanding fees"""
+    credit: object
+    plan: object  # AllocationPlan
+
+    @property
+    def allocations(self):
+        return self.plan.allocations
+
+    @property
+    def applied(self):
+        return self.plan.applied
+
+    @property
+    def remainder(self):
+        return self.plan.remainder
+
+
+@dataclass
+class CreditAllocationResult:
+    """Outcome (or preview) of applying all open credits"""
+    applications: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+    dry_run: bool = False
+
+    @property
+    def applied_count(self):
+        return len(self.applications)
+
+    @property
+    def skipped_count(self):
+        return len(self.skipped)
+
+    @property
+    def total_applied(self):
+        return sum((application.applied for application in self.applications), Decimal('0.00'))
+
+    @property
+    def remainder_count(self):
+        return sum(1 for application in self.applications if application.plan.has_remainder)
+
+
+class CreditAllocator:
+    """Allocate all unapplied credits of a school to outstanding fees"""
+
+    BATCH_SIZE = 500
+
+    def __init__(self, school, user=None):
+        self.school = school
+        self.user = user
+        self.allocation_service = AllocationService(school, user=user)
+
+    def run(self, dry_run=False):
+        """
+        Apply (or preview) every unapplied credit
+
+        Args:
+            dry_run: Compute the allocation without saving anything
+
+        Returns:
+            CreditAllocationResult
+        """
+        if dry_run:
+            return self._allocate(lock=False, dry_run=True)
+        with transaction.atomic():
+            result = self._allocate(lock=True, dry_run=False)
+            self._write(result)
+        return result
+
+    def _allocate(self, lock, dry_run):
+        from .models import Credit
+
+        credits = Credit.objects.filter(school=self.school, is_applied=False)
+        if lock:
+            credits = credits.select_for_update(of=('self',))
+        credits = list(credits.select_related('student').order_by('created_at', 'id'))
+        plans = self.allocation_service.allocate(
+            [AllocationRequest(student_id=credit.student_id, amount=credit.amount) for credit in credits],
+            lock=lock,
+        )
+
+        result = CreditAllocationResult(dry_run=dry_run)
+        for credit, plan in zip(credits, plans):
+            if plan.allocations:
+                result.applications.append(CreditApplication(credit=credit, plan=plan))
+            else:
+                result.skipped.append(credit)
+        return result
+
+    def _write(self, result):
+        from .models import Credit
+
+        if not result.applications:
+            return
+        now = timezone.now()
+
+        applied_credits = []
+        remainder_credits = []
+        for application in result.applications:
+            credit = application.credit
+            credit.is_applied = True
+            credit.applied_to_fee = application.allocations[0][0]
+            credit.applied_at = now
+            applied_credits.append(credit)
+            if application.plan.has_remainder:
+                remainder_credits.append(Credit(
+                    school=self.school,
+                    student_id=credit.student_id,
+                    amount=application.remainder,
+                    source=credit.source,
+                    payment_id=credit.payment_id,
+                    description=(
+                        f'Remaining credit from bulk application of credit ID {credit.id}. '
+                        f'Original credit amount: {credit.amount}, Applied: {application.applied}, '
+                        f'Remaining: {application.remainder}'
+                    ),
+                    created_by=self.user,
+                ))
+        Credit.objects.bulk_update(
+            applied_credits, ['is_applied', 'applied_to_fee', 'applied_at'], batch_size=self.BATCH_SIZE
+        )
+        if remainder_credits:
+            Credit.objects.bulk_create(remainder_credits, batch_size=self.BATCH_SIZE)
+
+        # Credits that came from a payment are recorded as allocations of that payment
+        self.allocation_service.commit(
+            [application.plan for application in result.applications],
+            payments=[application.credit.payment_id for application in result.applications],
+        )
@@ -0,0 +1,57 @@
+"""
+Background job handlers for the receivables app
+"""
+from core.job_queue import register_job
+
+
+@register_job('process_bank_statement')
+def process_bank_statement_job(ctx):
+    """Import an uploaded bank statement and match its transactions to payments"""
+    from django.core.files.storage import default_storage
+    from django.utils import timezone
+    from .models import BankStatementUpload
+    from .views import process_bank_statement
+
+    upload = BankStatementUpload.objects.select_related('pattern').get(
+        pk=ctx.payload['upload_id'], school_id=ctx.school_id
+    )
+    upload.status = 'processing'
+    upload.save(update_fields=['status'])
+    ctx.progress(0, 1, f'Processing {upload.file_name}', force=True)
+
+    try:
+        with default_storage.open(upload.file_path, 'rb') as statement_file:
+            result = process_bank_statement(
+                upload, statement_file, upload.pattern,
+                progress=lambda lines: ctx.progress(lines, None, f'Processed {lines} statement lines'),
+            )
+    except Exception as e:
+        upload.status = 'failed'
+        upload.error_message = str(e)
+        upload.save(update_fields=['status', 'error_message'])
+        raise
+
+    upload.status = 'completed'
+    upload.total_transactions = result.get('total_transactions', 0)
+    upload.matched_payments = result.get('matched_payments', 0)
+    upload.unmatched_payments = result.get('unmatched_payments', 0)
+    upload.duplicate_transactions = result.get('duplicate_transactions', 0)
+    upload.error_message = ''
+    upload.processed_at = timezone.now()
+    upload.save()
+
+    ctx.progress(1, 1, 'Done')
+    return {
+        'total_transactions': upload.total_transactions,
+        'matched_payments': upload.matched_payments,
+        'unmatched_payments': upload.unmatched_payments,
+        'duplicate_transactions': upload.duplicate_transactions,
+    }
+
+
+@register_job('process_mpesa_callback')
+def process_mpesa_callback_job(ctx):
+    """Post a stored M-Pesa callback (see receivables.mpesa_callbacks)"""
+    from .mpesa_callbacks import process_callback
+
+    return process_callback(ctx.payload['callback_id'])
@@ -0,0 +1,87 @@
+"""
+Management command to populate the PaymentReference index from existing
+payments and unmatched bank statement transactions.
+Safe to run repeatedly; references that are already indexed are skipped.
+"""
+from django.core.management.base import BaseCommand
+from receivables.models import (
+    Payment, UnmatchedTransaction, PaymentReference, payment_external_references
+)
+
+
+class Command(BaseCommand):
+    help = 'Backfill the PaymentReference index from existing payments and unmatched transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only backfill references for this school',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='Rows read and written per batch (default: 2000)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the references that would be indexed without writing them',
+        )
+
+    def handle(self, *args, **options):
+        school_id = options.get('school_id')
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        payments = Payment.objects.exclude(transaction_id='', reference_number='')
+        transactions = UnmatchedTransaction.objects.all()
+        if school_id:
+            payments = payments.filter(school_id=school_id)
+            transactions = transactions.filter(school_id=school_id)
+
+        rows = []
+        found = 0
+
+        def flush():
+            nonlocal rows
+            if rows and not dry_run:
+                PaymentReference.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+            rows = []
+
+        self.stdout.write('Indexing payment references...')
+        for payment_id, payment_school_id, transaction_id, reference_number in payments.values_list(
+            'id', 'school_id', 'transaction_id', 'reference_number'
+        ).order_by('id').iterator(chunk_size=batch_size):
+            for reference in payment_external_references(transaction_id, reference_number):
+                rows.append(PaymentReference(
+                    school_id=payment_school_id, reference=reference, payment_id=payment_id, source='backfill'
+                ))
+                found += 1
+            if len(rows) >= batch_size:
+                flush()
+        flush()
+
+        self.stdout.write('Indexing unmatched transaction references...')
+        for transaction_pk, transaction_school_id, mpesa_reference, bank_reference in transactions.values_list(
+            'id', 'school_id', 'mpesa_reference', 'bank_reference_number'
+        ).order_by('id').iterator(chunk_size=batch_size):
+            for reference in {PaymentReference.normalize(mpesa_reference), PaymentReference.normalize(bank_reference)}:
+                if not reference:
+                    continue
+                rows.append(PaymentReference(
+                    school_id=transaction_school_id, reference=reference,
+                    unmatched_transaction_id=transaction_pk, source='backfill'
+                ))
+                found += 1
+            if len(rows) >= batch_size:
+                flush()
+        flush()
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING(f'Dry run: found {found} reference(s); nothing written.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Indexed {found} reference(s); {PaymentReference.objects.count()} reference(s) now in the index.'
+            ))
@@ -0,0 +1,42 @@
+"""
+Management command to refresh the financial reporting cube (FeeFact and
+PaymentFact). By default only partitions whose source rows changed are
+rebuilt, so it is cheap enough to run daily; use --full to rebuild from
+scratch.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School
+from receivables.report_cube import ReportCube
+
+
+class Command(BaseCommand):
+    help = 'Refresh (or fully rebuild) the fact tables behind the receivables reports'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only refresh the cube for this school',
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Drop and rebuild every partition instead of only the changed ones',
+        )
+
+    def handle(self, *args, **options):
+        schools = School.objects.all()
+        if options.get('school_id'):
+            schools = schools.filter(id=options['school_id'])
+            if not schools.exists():
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        for school in schools.order_by('id'):
+            cube = ReportCube(school)
+            result = cube.rebuild() if options['full'] else cube.refresh(force=True)
+            self.stdout.write(
+                f'{school.name}: rebuilt {result["fee_partitions"]} fee and '
+                f'{result["payment_partitions"]} payment partition(s)'
+            )
+        self.stdout.write(self.style.SUCCESS('Report cube is up to date.'))
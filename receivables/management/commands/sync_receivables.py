@@ -0,0 +1,41 @@
+"""
+Management command to reconcile Receivable rows with StudentFee.
+Creates missing receivables and corrects drifted ones with two set-based
+statements per run; use --check to only report drift.
+"""
+from django.core.management.base import BaseCommand
+from core.models import School
+from receivables.receivable_sync import sync_receivables, receivable_drift
+
+
+class Command(BaseCommand):
+    help = 'Create missing and correct drifted Receivable rows from StudentFee'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--school-id',
+            type=int,
+            help='Only sync receivables for this school',
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Report missing/drifted receivables without changing anything',
+        )
+
+    def handle(self, *args, **options):
+        school = None
+        if options.get('school_id'):
+            try:
+                school = School.objects.get(id=options['school_id'])
+            except School.DoesNotExist:
+                self.stdout.write(self.style.ERROR(f'School with ID {options["school_id"]} does not exist.'))
+                return
+
+        drift = receivable_drift(school)
+        self.stdout.write(f'Missing receivables: {drift["missing"]}, drifted receivables: {drift["drifted"]}')
+        if options['check']:
+            return
+
+        created, updated = sync_receivables(school)
+        self.stdout.write(self.style.SUCCESS(f'Created {created} and updated {updated} receivable(s).'))
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-16 09:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_job'),
+        ('receivables', '0002_add_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentReference',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reference', models.CharField(help_text='Upper-cased external reference, e.g. TK18K8USG7', max_length=100)),
+                ('source', models.CharField(choices=[('payment', 'Payment'), ('mpesa', 'M-Pesa Callback'), ('statement', 'Bank Statement'), ('backfill', 'Backfill')], default='payment', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='external_references', to='receivables.payment')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_references', to='core.school')),
+                ('unmatched_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='external_references', to='receivables.unmatchedtransaction')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'constraints': [models.UniqueConstraint(fields=('school', 'reference'), name='payref_school_reference_uniq')],
+            },
+        ),
+    ]
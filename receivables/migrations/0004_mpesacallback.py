@@ -0,0 +1,39 @@
+# Generated by Django 5.2.3 on 2026-10-16 14:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_studentfee_outstanding_idx'),
+        ('receivables', '0003_paymentreference'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_request_id', models.CharField(blank=True, max_length=100)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100)),
+                ('mpesa_receipt_number', models.CharField(blank=True, max_length=100)),
+                ('result_code', models.CharField(blank=True, max_length=10)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('received', 'Received'), ('processed', 'Processed'), ('ignored', 'Ignored'), ('failed', 'Failed')], default='received', max_length=20)),
+                ('error_message', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mpesa_callbacks', to='receivables.payment')),
+                ('school', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mpesa_callbacks', to='core.school')),
+            ],
+            options={
+                'verbose_name': 'M-Pesa Callback',
+                'verbose_name_plural': 'M-Pesa Callbacks',
+                'ordering': ['-received_at'],
+                'indexes': [models.Index(fields=['status', 'received_at'], name='mpesa_cb_status_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('checkout_request_id', ''), _negated=True), fields=('checkout_request_id',), name='mpesa_cb_checkout_uniq'), models.UniqueConstraint(condition=models.Q(('mpesa_receipt_number', ''), _negated=True), fields=('mpesa_receipt_number',), name='mpesa_cb_receipt_uniq')],
+            },
+        ),
+    ]
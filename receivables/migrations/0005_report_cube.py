@@ -0,0 +1,70 @@
+# Generated by Django 5.2.3 on 2026-10-16 15:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_studentfee_outstanding_idx'),
+        ('receivables', '0004_mpesacallback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeeFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_date', models.DateField()),
+                ('student_active', models.BooleanField()),
+                ('fee_count', models.IntegerField(default=0)),
+                ('paid_count', models.IntegerField(default=0)),
+                ('outstanding_count', models.IntegerField(default=0, help_text='Fees with amount_charged > amount_paid')),
+                ('total_charged', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('paid_amount', models.DecimalField(decimal_places=2, default=0, help_text='amount_paid of fees marked paid', max_digits=14)),
+                ('unpaid_charged', models.DecimalField(decimal_places=2, default=0, help_text='amount_charged of fees not marked paid', max_digits=14)),
+                ('outstanding_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('credit_amount', models.DecimalField(decimal_places=2, default=0, help_text='Overpayments', max_digits=14)),
+                ('fee_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_facts', to='core.feecategory')),
+                ('grade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_facts', to='core.grade')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_facts', to='core.school')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_facts', to='core.term')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('school', 'term', 'grade', 'fee_category', 'due_date', 'student_active'), name='fee_fact_bucket_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='Local date of payment_date')),
+                ('payment_method', models.CharField(choices=[('mpesa', 'M-Pesa'), ('cash', 'Cash'), ('bank_transfer', 'Bank Transfer'), ('cheque', 'Cheque')], max_length=20)),
+                ('payment_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('fee_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_facts', to='core.feecategory')),
+                ('grade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_facts', to='core.grade')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_facts', to='core.school')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_facts', to='core.term')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('school', 'day', 'payment_method', 'term', 'grade', 'fee_category'), name='payment_fact_bucket_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportCubePartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('fee', 'Fees by term'), ('payment', 'Payments by month')], max_length=10)),
+                ('partition', models.CharField(help_text='Term id (fees) or first day of the month (payments)', max_length=20)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='report_cube_partitions', to='core.school')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('school', 'kind', 'partition'), name='report_cube_partition_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.3 on 2026-10-17 09:00
+
+from django.db import migrations, models
+from django.db.models import DateField
+from django.db.models.functions import TruncMonth
+
+
+def flag_existing_partitions(apps, schema_editor):
+    """Flag every partition with source rows, so the first refresh builds it"""
+    StudentFee = apps.get_model('core', 'StudentFee')
+    Payment = apps.get_model('receivables', 'Payment')
+    ReportCubePartition = apps.get_model('receivables', 'ReportCubePartition')
+
+    fee_partitions = StudentFee.objects.values_list('school_id', 'term_id').distinct().order_by()
+    payment_partitions = Payment.objects.annotate(
+        month=TruncMonth('payment_date', output_field=DateField())
+    ).values_list('school_id', 'month').distinct().order_by()
+    ReportCubePartition.objects.bulk_create(
+        [
+            ReportCubePartition(school_id=school_id, kind='fee', partition=str(term_id), is_dirty=True)
+            for school_id, term_id in fee_partitions
+        ] + [
+            ReportCubePartition(school_id=school_id, kind='payment', partition=month.isoformat(), is_dirty=True)
+            for school_id, month in payment_partitions if month is not None
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receivables', '0005_report_cube'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='reportcubepartition',
+            name='fingerprint',
+        ),
+        migrations.AddField(
+            model_name='reportcubepartition',
+            name='is_dirty',
+            field=models.BooleanField(default=True, help_text='Source rows changed since the partition was last rebuilt'),
+        ),
+        migrations.RunPython(flag_existing_partitions, migrations.RunPython.noop),
+    ]
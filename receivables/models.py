@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from core.models import School, Student, StudentFee
+from core.models import School, Student, StudentFee, Term, Grade, FeeCategory
 from django.core.validators import MinValueValidator
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
@@ -103,6 +103,60 @@ class MpesaPayment(models.Model):
         unique_together = ['school', 'payment']
 
 
+class MpesaCallback(models.Model):
+    """
+    Raw M-Pesa callback payload, stored as soon as Safaricom delivers it and
+    posted later by the ``process_mpesa_callback`` job. Safaricom retries
+    callbacks that are slow to acknowledge; the unique checkout request id
+    and receipt number turn a retried delivery into a no-op.
+    """
+    STATUS_CHOICES = [
+        ('received', 'Received'),
+        ('processed', 'Processed'),
+        ('ignored', 'Ignored'),
+        ('failed', 'Failed'),
+    ]
+    
+    school = models.ForeignKey(
+        School, on_delete=models.CASCADE, null=True, blank=True, related_name='mpesa_callbacks'
+    )
+    checkout_request_id = models.CharField(max_length=100, blank=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True)
+    result_code = models.CharField(max_length=10, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='received')
+    payment = models.ForeignKey(
+        Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='mpesa_callbacks'
+    )
+    error_message = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"M-Pesa Callback {self.checkout_request_id or self.mpesa_receipt_number} ({self.status})"
+    
+    class Meta:
+        verbose_name = "M-Pesa Callback"
+        verbose_name_plural = "M-Pesa Callbacks"
+        ordering = ['-received_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['checkout_request_id'],
+                condition=~models.Q(checkout_request_id=''),
+                name='mpesa_cb_checkout_uniq',
+            ),
+            models.UniqueConstraint(
+                fields=['mpesa_receipt_number'],
+                condition=~models.Q(mpesa_receipt_number=''),
+                name='mpesa_cb_receipt_uniq',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received_at'], name='mpesa_cb_status_idx'),
+        ]
+
+
 class PaymentReceipt(models.Model):
     """Model for payment receipts"""
     school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='payment_receipts')
@@ -680,6 +734,193 @@ class UnmatchedTransaction(models.Model):
         ]
 
 
+class PaymentReference(models.Model):
+    """
+    Normalized external reference (M-Pesa receipt, bank transaction reference)
+    seen by the school, used for exact-match duplicate detection instead of
+    scanning Payment.reference_number text.
+    """
+    SOURCE_CHOICES = [
+        ('payment', 'Payment'),
+        ('mpesa', 'M-Pesa Callback'),
+        ('statement', 'Bank Statement'),
+        ('backfill', 'Backfill'),
+    ]
+    
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='payment_references')
+    reference = models.CharField(max_length=100, help_text='Upper-cased external reference, e.g. TK18K8USG7')
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='external_references'
+    )
+    unmatched_transaction = models.ForeignKey(
+        UnmatchedTransaction,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='external_references'
+    )
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='payment')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Reference {self.reference} ({self.school.name})"
+    
+    @staticmethod
+    def normalize(reference):
+        """Canonical form used for storage and lookups"""
+        return (reference or '').strip().upper()[:100]
+    
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['school', 'reference'], name='payref_school_reference_uniq'),
+        ]
+
+
+class FeeFact(models.Model):
+    """
+    Reporting cube: StudentFee totals per school, term, grade, fee category,
+    due date and student active flag. Partitions (one per term) are rebuilt
+    by receivables.report_cube when their source rows change; rebuild with
+    ``manage.py rebuild_report_cube``.
+    """
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='fee_facts')
+    term = models.ForeignKey(Term, on_delete=models.CASCADE, related_name='fee_facts')
+    grade = models.ForeignKey(Grade, on_delete=models.CASCADE, related_name='fee_facts')
+    fee_category = models.ForeignKey(FeeCategory, on_delete=models.CASCADE, related_name='fee_facts')
+    due_date = models.DateField()
+    student_active = models.BooleanField()
+    fee_count = models.IntegerField(default=0)
+    paid_count = models.IntegerField(default=0)
+    outstanding_count = models.IntegerField(default=0, help_text='Fees with amount_charged > amount_paid')
+    total_charged = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    paid_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, help_text='amount_paid of fees marked paid')
+    unpaid_charged = models.DecimalField(max_digits=14, decimal_places=2, default=0, help_text='amount_charged of fees not marked paid')
+    outstanding_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    credit_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, help_text='Overpayments')
+    
+    def __str__(self):
+        return f"{self.school} - {self.term} - {self.grade} - {self.fee_category}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['school', 'term', 'grade', 'fee_category', 'due_date', 'student_active'],
+                name='fee_fact_bucket_uniq'
+            ),
+        ]
+
+
+class PaymentFact(models.Model):
+    """
+    Reporting cube: completed Payment totals per school, day, payment method,
+    term, grade and fee category. Partitions (one per month) are rebuilt by
+    receivables.report_cube when their source rows change.
+    """
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='payment_facts')
+    day = models.DateField(help_text='Local date of payment_date')
+    payment_method = models.CharField(max_length=20, choices=Payment.PAYMENT_METHOD_CHOICES)
+    term = models.ForeignKey(Term, on_delete=models.CASCADE, related_name='payment_facts')
+    grade = models.ForeignKey(Grade, on_delete=models.CASCADE, related_name='payment_facts')
+    fee_category = models.ForeignKey(FeeCategory, on_delete=models.CASCADE, related_name='payment_facts')
+    payment_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    def __str__(self):
+        return f"{self.school} - {self.day} - {self.payment_method}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['school', 'day', 'payment_method', 'term', 'grade', 'fee_category'],
+                name='payment_fact_bucket_uniq'
+            ),
+        ]
+
+
+class ReportCubePartition(models.Model):
+    """A reporting cube partition; is_dirty is set when its source rows change"""
+    KIND_CHOICES = [
+        ('fee', 'Fees by term'),
+        ('payment', 'Payments by month'),
+    ]
+    
+    school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='report_cube_partitions')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    partition = models.CharField(max_length=20, help_text='Term id (fees) or first day of the month (payments)')
+    is_dirty = models.BooleanField(default=True, help_text='Source rows changed since the partition was last rebuilt')
+    refreshed_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.school} - {self.kind} {self.partition}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['school', 'kind', 'partition'], name='report_cube_partition_uniq'),
+        ]
+
+
+# Reference formats embedded in Payment.reference_number by statement imports
+_EMBEDDED_REFERENCE_RE = re.compile(r'(?:BankRef|M-Pesa):\s*([A-Za-z0-9]+)')
+# A bare M-Pesa receipt / bank reference (e.g. reference_number set by the STK callback)
+_BARE_REFERENCE_RE = re.compile(r'^[A-Z0-9]{8,15}$')
+
+
+def payment_external_references(transaction_id='', reference_number=''):
+    """Extract the external references carried by a payment's transaction_id and reference_number"""
+    references = set()
+    if transaction_id and transaction_id.strip():
+        references.add(PaymentReference.normalize(transaction_id))
+    if reference_number:
+        references.update(PaymentReference.normalize(ref) for ref in _EMBEDDED_REFERENCE_RE.findall(reference_number))
+        if _BARE_REFERENCE_RE.match(reference_number.strip()):
+            references.add(PaymentReference.normalize(reference_number))
+    references.discard('')
+    return references
+
+
+def register_payment_references(school, references, payment=None, unmatched_transaction=None, source='payment'):
+    """
+    Record external references for a school; references already known are left as they are
+    
+    Args:
+        school: School (or school id) the references belong to
+        references: Iterable of raw reference strings
+        payment: Payment carrying the references, if any
+        unmatched_transaction: UnmatchedTransaction carrying the references, if any
+        source: One of PaymentReference.SOURCE_CHOICES
+    """
+    school_id = getattr(school, 'id', school)
+    rows = [
+        PaymentReference(
+            school_id=school_id,
+            reference=reference,
+            payment=payment,
+            unmatched_transaction=unmatched_transaction,
+            source=source,
+        )
+        for reference in {PaymentReference.normalize(r) for r in references} if reference
+    ]
+    if rows:
+        PaymentReference.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def find_existing_references(school, references):
+    """Return the normalized references (from ``references``) already recorded for the school"""
+    normalized = {PaymentReference.normalize(r) for r in references}
+    normalized.discard('')
+    if not normalized:
+        return set()
+    return set(PaymentReference.objects.filter(
+        school=school, reference__in=normalized
+    ).values_list('reference', flat=True))
+
+
 # ==================== Signals ====================
 
 @receiver(post_save, sender=StudentFee)
@@ -746,3 +987,43 @@ def create_payment_allocation(sender, instance, created, **kwargs):
                 receivable.save()
             except Receivable.DoesNotExist:
                 pass
+
+
+@receiver(post_save, sender=Payment)
+def register_payment_external_references(sender, instance, **kwargs):
+    """Keep the PaymentReference index in step with payment references"""
+    references = payment_external_references(instance.transaction_id, instance.reference_number)
+    if references:
+        register_payment_references(instance.school_id, references, payment=instance, source='payment')
+
+
+@receiver(post_save, sender=StudentFee)
+@receiver(post_delete, sender=StudentFee)
+def mark_fee_cube_partition(sender, instance, **kwargs):
+    """Flag the reporting cube partitions of a saved or deleted fee"""
+    from .report_cube import mark_dirty
+    previous = getattr(instance, '_rollup_previous', None) or {}
+    mark_dirty(instance.school_id, term_ids=[instance.term_id, previous.get('term_id')])
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def mark_payment_cube_partition(sender, instance, **kwargs):
+    """Flag the reporting cube partition of a saved or deleted payment"""
+    from .report_cube import mark_dirty, payment_month
+    mark_dirty(instance.school_id, months=[payment_month(instance.payment_date)])
+
+
+@receiver(post_save, sender=Student)
+def mark_student_cube_partitions(sender, instance, created, **kwargs):
+    """Fee and payment facts are grouped by the student's grade and active flag"""
+    from django.db.models import DateField
+    from django.db.models.functions import TruncMonth
+    from .report_cube import mark_dirty
+    if created:
+        return
+    term_ids = StudentFee.objects.filter(student=instance).values_list('term_id', flat=True).distinct().order_by()
+    months = Payment.objects.filter(student=instance).annotate(
+        month=TruncMonth('payment_date', output_field=DateField())
+    ).values_list('month', flat=True).distinct().order_by()
+    mark_dirty(instance.school_id, term_ids=list(term_ids), months=list(months))
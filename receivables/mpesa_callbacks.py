@@ -0,0 +1,233 @@
+"""
+M-Pesa Callback Ingestion
+
+Safaricom retries a callback when it is not acknowledged quickly, so the
+callback views only store the raw payload and queue a job:
+
+- ``ingest_callback`` saves an MpesaCallback keyed by CheckoutRequestID (or
+  MpesaReceiptNumber) and enqueues ``process_mpesa_callback`` in the same
+  transaction. A retried delivery hits the unique key and is dropped.
+- ``process_callback`` (run by the job worker) locks the stored callback,
+  posts it once - completing the STK push payment it belongs to, or
+  recording a parent portal payment from its FEE-{fee_id}-... account
+  reference - and queues the payment receipt as a separate job.
+"""
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from decimal import Decimal
+import logging
+
+from core import job_queue
+from .allocation_service import AllocationRequest, AllocationService
+from .models import (
+    Credit, MpesaCallback, MpesaPayment, Payment,
+    find_existing_references, register_payment_references,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_callback(payload):
+    """
+    Flatten an STK callback payload
+
+    Accepts both the Daraja envelope (``{"Body": {"stkCallback": {...}}}``)
+    and an already unwrapped callback.
+
+    Returns:
+        Dict with CheckoutRequestID, MerchantRequestID, ResultCode (str),
+        ResultDesc and the CallbackMetadata items (Amount,
+        MpesaReceiptNumber, PhoneNumber, ...) as top-level keys
+    """
+    callback = (payload.get('Body') or {}).get('stkCallback') or payload
+    data = {
+        'CheckoutRequestID': str(callback.get('CheckoutRequestID') or ''),
+        'MerchantRequestID': str(callback.get('MerchantRequestID') or ''),
+        'ResultCode': '' if callback.get('ResultCode') is None else str(callback.get('ResultCode')),
+        'ResultDesc': callback.get('ResultDesc') or '',
+    }
+    for item in (callback.get('CallbackMetadata') or {}).get('Item', []):
+        if item.get('Name'):
+            data[item['Name']] = item.get('Value')
+    for key in ('MpesaReceiptNumber', 'TransactionID'):
+        # Unwrapped callbacks carry these at the top level
+        if key not in data and callback.get(key):
+            data[key] = callback[key]
+    data['MpesaReceiptNumber'] = str(data.get('MpesaReceiptNumber') or '').strip()
+    return data
+
+
+def ingest_callback(payload):
+    """
+    Durably store a callback and queue it for processing
+
+    Args:
+        payload: Decoded callback JSON
+
+    Returns:
+        Tuple (MpesaCallback or None, created). ``created`` is False for
+        retried deliveries and payloads without any identifier.
+    """
+    data = parse_callback(payload)
+    checkout_request_id = data['CheckoutRequestID'][:100]
+    receipt_number = data['MpesaReceiptNumber'][:100]
+    if checkout_request_id:
+        lookup = {'checkout_request_id': checkout_request_id}
+    elif receipt_number:
+        lookup = {'mpesa_receipt_number': receipt_number}
+    else:
+        logger.warning('M-Pesa callback without CheckoutRequestID or receipt number ignored')
+        return None, False
+
+    try:
+        with transaction.atomic():
+            callback, created = MpesaCallback.objects.get_or_create(**lookup, defaults={
+                'checkout_request_id': checkout_request_id,
+                'merchant_request_id': data['MerchantRequestID'][:100],
+                'mpesa_receipt_number': receipt_number,
+                'result_code': data['ResultCode'][:10],
+                'payload': payload,
+            })
+            if created:
+                job_queue.enqueue('process_mpesa_callback', {'callback_id': callback.id}, max_attempts=5)
+    except IntegrityError:
+        # The receipt number arrived before under another checkout request id
+        logger.info(f'Duplicate M-Pesa callback ignored for receipt {receipt_number}')
+        return None, False
+
+    if not created:
+        logger.info(f'Retried M-Pesa callback ignored: {lookup}')
+    return callback, created
+
+
+def process_callback(callback_id):
+    """
+    Post a stored callback exactly once
+
+    Args:
+        callback_id: MpesaCallback primary key
+
+    Returns:
+        Dict with the callback status and the payment id, if any
+    """
+    with transaction.atomic():
+        callback = MpesaCallback.objects.select_for_update().get(pk=callback_id)
+        if callback.status in ('processed', 'ignored'):
+            return {'status': callback.status, 'duplicate': True}
+
+        data = parse_callback(callback.payload)
+        mpesa_payment = None
+        if callback.checkout_request_id:
+            mpesa_payment = MpesaPayment.objects.select_related(
+                'payment__student_fee__school'
+            ).filter(checkout_request_id=callback.checkout_request_id).first()
+
+        if mpesa_payment is not None:
+            payment, note = _complete_stk_payment(mpesa_payment, data)
+        else:
+            payment, note = _record_portal_payment(data)
+
+        callback.payment = payment
+        if payment is not None:
+            callback.school_id = payment.school_id
+        callback.status = 'processed' if payment is not None and not note else 'ignored'
+        callback.error_message = note
+        callback.processed_at = timezone.now()
+        callback.save(update_fields=['payment', 'school', 'status', 'error_message', 'processed_at'])
+
+        if callback.status == 'processed' and payment.status == 'completed':
+            # Receipts go out of band so a slow mail/SMS gateway never delays or repeats posting
+            job_queue.enqueue('send_payment_receipt', {'payment_id': payment.id}, school=payment.school)
+
+    if note:
+        logger.info(f'M-Pesa callback {callback.id} not posted: {note}')
+    return {'status': callback.status, 'payment_id': str(payment.payment_id) if payment else None}
+
+
+def _complete_stk_payment(mpesa_payment, data):
+    """Complete (or fail) the processing Payment created by an STK push"""
+    payment = mpesa_payment.payment
+    if payment.status != 'processing':
+        return payment, f'Payment already {payment.status}'
+
+    mpesa_payment.result_code = data['ResultCode']
+    mpesa_payment.result_desc = data['ResultDesc']
+    if data['ResultCode'] != '0':
+        payment.status = 'failed'
+        payment.save()
+        mpesa_payment.save()
+        logger.warning(f"Payment failed: {payment.payment_id} - {data['ResultDesc']}")
+        return payment, ''
+
+    receipt_number = data['MpesaReceiptNumber']
+    if receipt_number and find_existing_references(payment.school_id, [receipt_number]):
+        return payment, f'Receipt {receipt_number} already recorded'
+
+    payment.status = 'completed'
+    payment.transaction_id = data.get('TransactionID') or ''
+    mpesa_payment.mpesa_receipt_number = receipt_number
+    mpesa_payment.transaction_date = timezone.now()
+    payment.save()
+    mpesa_payment.save()
+    # Allocate to the fee the STK push was for first, then the student's other outstanding fees
+    _allocate_payment(payment, receipt_number)
+    logger.info(f"Payment completed successfully: {payment.payment_id}")
+    return payment, ''
+
+
+def _record_portal_payment(data):
+    """Record a parent portal payment identified by its FEE-{fee_id}-{student_id} account reference"""
+    from core.models import StudentFee
+
+    if data['ResultCode'] != '0':
+        return None, f"Payment not completed: {data['ResultDesc']}"
+    account_reference = str(data.get('AccountReference') or '')
+    parts = account_reference.split('-')
+    if not account_reference.startswith('FEE-') or len(parts) < 2 or not parts[1].isdigit():
+        return None, f'No payment matches account reference {account_reference!r}'
+
+    student_fee = StudentFee.objects.select_related('school', 'student').filter(id=int(parts[1])).first()
+    if student_fee is None:
+        return None, f'Fee {parts[1]} not found'
+    receipt_number = data['MpesaReceiptNumber']
+    if receipt_number and find_existing_references(student_fee.school, [receipt_number]):
+        return None, f'Receipt {receipt_number} already recorded'
+
+    payment = Payment(
+        school=student_fee.school,
+        student=student_fee.student,
+        student_fee=student_fee,
+        amount=Decimal(str(data.get('Amount') or 0)) / 100,  # M-Pesa returns amount in cents
+        payment_method='mpesa',
+        status='completed',
+        reference_number=receipt_number,
+        payment_date=timezone.now(),
+        notes=f"M-Pesa payment via parent portal. Phone: {data.get('PhoneNumber')}",
+    )
+    # bulk_create skips the post_save signal that would allocate the whole amount to one fee
+    Payment.objects.bulk_create([payment])
+    _allocate_payment(payment, receipt_number)
+    logger.info(f'Payment processed successfully: {payment.id} for fee {student_fee.id}')
+    return payment, ''
+
+
+def _allocate_payment(payment, receipt_number):
+    """Allocate a completed payment, keeping any overpayment as a credit"""
+    allocation_service = AllocationService(payment.school, user=payment.processed_by)
+    plan = allocation_service.allocate([AllocationRequest(
+        student_id=payment.student_id,
+        amount=payment.amount,
+        preferred_fee_id=payment.student_fee_id,
+    )], lock=True)[0]
+    allocation_service.commit([plan], payments=[payment])
+    if plan.has_remainder:
+        Credit.objects.create(
+            school=payment.school,
+            student_id=payment.student_id,
+            amount=plan.remainder,
+            source='overpayment',
+            payment=payment,
+            description=f'Overpayment from M-Pesa payment {receipt_number}. Payment amount: {payment.amount}, Allocated: {plan.applied}, Remaining: {plan.remainder}',
+        )
+    register_payment_references(payment.school_id, [receipt_number], payment=payment, source='mpesa')
@@ -1,9 +1,7 @@
-import requests
 import base64
-import json
 from datetime import datetime
 from django.conf import settings
-from django.utils import timezone
+from core.daraja import DARAJA_TIMEOUT, get_access_token, get_daraja_session, invalidate_access_token
 from .models import Payment, MpesaPayment
 from core.models import StudentFee
 import logging
@@ -27,26 +25,25 @@ class MpesaService:
             self.base_url = 'https://api.safaricom.co.ke'
     
     def get_access_token(self):
-        """Get M-Pesa access token"""
+        """Get M-Pesa access token (shared across workers, see core.daraja)"""
         try:
-            url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-            auth = base64.b64encode(f"{self.consumer_key}:{self.consumer_secret}".encode()).decode()
-            
-            headers = {
-                'Authorization': f'Basic {auth}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            
-            data = response.json()
-            return data.get('access_token')
-            
+            return get_access_token(self.base_url, self.consumer_key, self.consumer_secret)
         except Exception as e:
             logger.error(f"Error getting M-Pesa access token: {str(e)}")
             return None
     
+    def _post(self, url, payload, access_token):
+        """POST to Daraja over the shared session, dropping the cached token if it was rejected"""
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        response = get_daraja_session().post(url, json=payload, headers=headers, timeout=DARAJA_TIMEOUT)
+        if response.status_code == 401:
+            invalidate_access_token(self.base_url, self.consumer_key)
+        response.raise_for_status()
+        return response.json()
+    
     def generate_password(self):
         """Generate M-Pesa API password"""
         try:
@@ -71,11 +68,6 @@ class MpesaService:
             
             url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             # Format phone number
             if phone_number.startswith('0'):
                 phone_number = '254' + phone_number[1:]
@@ -96,15 +88,13 @@ class MpesaService:
                 "TransactionDesc": f"School Fees - {reference}"
             }
             
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self._post(url, payload, access_token)
             
             if data.get('ResponseCode') == '0':
                 # Create payment record
                 student_fee = StudentFee.objects.get(id=student_fee_id)
                 payment = Payment.objects.create(
+                    school=student_fee.school,
                     student=student_fee.student,
                     student_fee=student_fee,
                     amount=amount,
@@ -115,6 +105,7 @@ class MpesaService:
                 
                 # Create M-Pesa payment record
                 MpesaPayment.objects.create(
+                    school=student_fee.school,
                     payment=payment,
                     phone_number=phone_number,
                     checkout_request_id=data.get('CheckoutRequestID'),
@@ -137,64 +128,6 @@ class MpesaService:
             logger.error(f"Error initiating STK push: {str(e)}")
             return {'success': False, 'message': f'Error: {str(e)}'}
     
-    def process_callback(self, callback_data):
-        """Process M-Pesa callback"""
-        try:
-            result_code = callback_data.get('ResultCode')
-            checkout_request_id = callback_data.get('CheckoutRequestID')
-            merchant_request_id = callback_data.get('MerchantRequestID')
-            
-            # Find the M-Pesa payment record
-            try:
-                mpesa_payment = MpesaPayment.objects.get(
-                    checkout_request_id=checkout_request_id
-                )
-            except MpesaPayment.DoesNotExist:
-                logger.error(f"M-Pesa payment not found for checkout_request_id: {checkout_request_id}")
-                return False
-            
-            payment = mpesa_payment.payment
-            
-            if result_code == '0':
-                # Payment successful
-                payment.status = 'completed'
-                payment.transaction_id = callback_data.get('TransactionID', '')
-                
-                # Update M-Pesa payment details
-                mpesa_payment.result_code = result_code
-                mpesa_payment.result_desc = callback_data.get('ResultDesc', '')
-                mpesa_payment.mpesa_receipt_number = callback_data.get('MpesaReceiptNumber', '')
-                mpesa_payment.transaction_date = timezone.now()
-                
-                # Update student fee amount paid
-                student_fee = payment.student_fee
-                student_fee.amount_paid += payment.amount
-                if student_fee.amount_paid >= student_fee.amount_charged:
-                    student_fee.is_paid = True
-                student_fee.save()
-                
-                payment.save()
-                mpesa_payment.save()
-                
-                logger.info(f"Payment completed successfully: {payment.payment_id}")
-                return True
-                
-            else:
-                # Payment failed
-                payment.status = 'failed'
-                mpesa_payment.result_code = result_code
-                mpesa_payment.result_desc = callback_data.get('ResultDesc', '')
-                
-                payment.save()
-                mpesa_payment.save()
-                
-                logger.warning(f"Payment failed: {payment.payment_id} - {callback_data.get('ResultDesc')}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"Error processing M-Pesa callback: {str(e)}")
-            return False
-    
     def check_transaction_status(self, checkout_request_id):
         """Check transaction status"""
         try:
@@ -204,11 +137,6 @@ class MpesaService:
             
             url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             password, timestamp = self.generate_password()
             if not password:
                 return {'success': False, 'message': 'Failed to generate password'}
@@ -220,10 +148,7 @@ class MpesaService:
                 "CheckoutRequestID": checkout_request_id
             }
             
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self._post(url, payload, access_token)
             return {
                 'success': True,
                 'data': data
@@ -0,0 +1,121 @@
+"""
+Receivable reconciliation
+
+Receivable rows mirror StudentFee (amount due, amount paid, due date,
+cleared flag). Single saves keep them in step through the StudentFee
+post_save signal; bulk writers, the ``sync_receivables`` management command
+and the drift check use the set-based functions below, which run one
+``INSERT ... SELECT`` for missing rows and one ``UPDATE ... FROM`` for rows
+that have drifted.
+"""
+
+from django.db import connection
+from django.db.models import DecimalField, F, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from decimal import Decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _fee_filter_sql(school_id, student_fee_ids):
+    clauses = []
+    params = []
+    if school_id is not None:
+        clauses.append('sf.school_id = %s')
+        params.append(school_id)
+    if student_fee_ids is not None:
+        clauses.append('sf.id = ANY(%s)')
+        params.append(list(student_fee_ids))
+    return (' AND ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+def sync_receivables(school=None, student_fee_ids=None):
+    """
+    Create missing Receivable rows and correct drifted ones from StudentFee
+
+    Args:
+        school: School (or id) to sync; all schools when None
+        student_fee_ids: Optional iterable of StudentFee ids to limit the sync to
+
+    Returns:
+        Tuple of (created_count, updated_count)
+    """
+    from core.models import StudentFee
+    from .models import Receivable
+
+    if student_fee_ids is not None:
+        student_fee_ids = list(student_fee_ids)
+        if not student_fee_ids:
+            return 0, 0
+
+    school_id = getattr(school, 'id', school)
+    fee_table = connection.ops.quote_name(StudentFee._meta.db_table)
+    receivable_table = connection.ops.quote_name(Receivable._meta.db_table)
+    fee_filter, fee_params = _fee_filter_sql(school_id, student_fee_ids)
+    now = timezone.now()
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {receivable_table}
+                (school_id, student_id, student_fee_id, amount_due, amount_paid,
+                 due_date, is_cleared, cleared_at, created_at, updated_at)
+            SELECT sf.school_id, sf.student_id, sf.id, sf.amount_charged, GREATEST(sf.amount_paid, 0),
+                   sf.due_date, sf.is_paid, CASE WHEN sf.is_paid THEN %s ELSE NULL END, %s, %s
+            FROM {fee_table} sf
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {receivable_table} r
+                WHERE r.school_id = sf.school_id AND r.student_fee_id = sf.id
+            ){fee_filter}
+            ON CONFLICT (school_id, student_fee_id) DO NOTHING
+        """, [now, now, now] + fee_params)
+        created = cursor.rowcount
+
+        cursor.execute(f"""
+            UPDATE {receivable_table} r
+            SET amount_due = sf.amount_charged,
+                amount_paid = GREATEST(sf.amount_paid, 0),
+                due_date = sf.due_date,
+                is_cleared = sf.is_paid,
+                cleared_at = CASE WHEN sf.is_paid THEN COALESCE(r.cleared_at, %s) ELSE NULL END,
+                updated_at = %s
+            FROM {fee_table} sf
+            WHERE r.student_fee_id = sf.id
+              AND r.school_id = sf.school_id
+              AND (r.amount_due <> sf.amount_charged
+                   OR r.amount_paid <> GREATEST(sf.amount_paid, 0)
+                   OR r.due_date <> sf.due_date
+                   OR r.is_cleared <> sf.is_paid){fee_filter}
+        """, [now, now] + fee_params)
+        updated = cursor.rowcount
+
+    if created or updated:
+        logger.info(f'Receivable sync (school={school_id}): {created} created, {updated} updated')
+    return created, updated
+
+
+def receivable_drift(school=None):
+    """
+    Count StudentFee rows whose Receivable is missing or out of date
+
+    Returns:
+        Dict with missing and drifted counts
+    """
+    from core.models import StudentFee
+    from .models import Receivable
+
+    fees = StudentFee.objects.all()
+    receivables = Receivable.objects.all()
+    if school is not None:
+        fees = fees.filter(school=school)
+        receivables = receivables.filter(school=school)
+
+    missing = fees.filter(receivables__isnull=True).count()
+    drifted = receivables.filter(
+        ~Q(amount_due=F('student_fee__amount_charged'))
+        | ~Q(amount_paid=Greatest(F('student_fee__amount_paid'), Value(Decimal('0')), output_field=DecimalField()))
+        | ~Q(due_date=F('student_fee__due_date'))
+        | ~Q(is_cleared=F('student_fee__is_paid'))
+    ).count()
+    return {'missing': missing, 'drifted': drifted}
@@ -0,0 +1,361 @@
+"""
+Financial Reporting Cube
+
+Pre-aggregated fact tables behind the receivables reports:
+
+- FeeFact: StudentFee totals per (school, term, grade, fee category, due
+  date, student active flag), partitioned by term.
+- PaymentFact: completed Payment totals per (school, day, payment method,
+  term, grade, fee category), partitioned by month of payment.
+
+``ReportCube.refresh`` is incremental. The write paths flag the partitions
+they touch with ``mark_dirty``: the StudentFee, Payment and Student signals
+in receivables.models, AllocationService.commit and fee generation (the
+same hooks that keep FeeRollup current). A refresh reads the flagged
+ReportCubePartition rows and rebuilds only those partitions, so its cost
+follows what changed rather than the school's history; only ``rebuild``
+scans the source tables. Report views refresh at most every
+REPORT_CUBE_REFRESH_INTERVAL seconds per school. ``manage.py
+rebuild_report_cube`` refreshes (or fully rebuilds) every school.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DateField, F, Q, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+from datetime import date, datetime
+from decimal import Decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sums over FeeFact rows, for .values(...).annotate(**FEE_MEASURES)
+FEE_MEASURES = {
+    name: Sum(name)
+    for name in (
+        'fee_count', 'paid_count', 'outstanding_count', 'total_charged', 'total_paid',
+        'paid_amount', 'unpaid_charged', 'outstanding_amount', 'credit_amount',
+    )
+}
+
+# Sums over PaymentFact rows
+PAYMENT_MEASURES = {
+    'payment_count': Sum('payment_count'),
+    'total_amount': Sum('total_amount'),
+}
+
+
+def payment_month(payment_date):
+    """Payment partition (first day of the local month) of a payment_date"""
+    if payment_date is None:
+        return None
+    if timezone.is_aware(payment_date):
+        payment_date = timezone.localtime(payment_date)
+    return date(payment_date.year, payment_date.month, 1)
+
+
+def mark_dirty(school_id, term_ids=(), months=()):
+    """
+    Flag cube partitions whose source rows changed; the next refresh rebuilds them
+
+    The flags are written once the current transaction commits, so a
+    refresh that claims a partition either sees the change or leaves a
+    fresh flag behind. Partitions that are already flagged are not
+    rewritten, so concurrent writers of one partition do not queue on its
+    row.
+
+    Args:
+        school_id: School the rows belong to
+        term_ids: Terms of changed StudentFees
+        months: Payment partitions (see ``payment_month``) of changed Payments
+    """
+    keys = {('fee', str(term_id)) for term_id in term_ids if term_id is not None}
+    keys |= {('payment', month.isoformat()) for month in months if month is not None}
+    if keys:
+        transaction.on_commit(lambda: _flag_partitions(school_id, keys))
+
+
+def _flag_partitions(school_id, keys):
+    from .models import ReportCubePartition
+
+    existing = {
+        (kind, partition): (pk, is_dirty)
+        for pk, kind, partition, is_dirty in ReportCubePartition.objects.filter(
+            school_id=school_id, partition__in={partition for _, partition in keys}
+        ).values_list('id', 'kind', 'partition', 'is_dirty')
+    }
+    clean_ids = [existing[key][0] for key in keys if key in existing and not existing[key][1]]
+    if clean_ids:
+        ReportCubePartition.objects.filter(id__in=clean_ids, is_dirty=False).update(is_dirty=True)
+    missing = sorted(keys - set(existing))
+    if missing:
+        ReportCubePartition.objects.bulk_create(
+            [
+                ReportCubePartition(school_id=school_id, kind=kind, partition=partition, is_dirty=True)
+                for kind, partition in missing
+            ],
+            update_conflicts=True,
+            unique_fields=['school', 'kind', 'partition'],
+            update_fields=['is_dirty'],
+        )
+
+
+def _next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class ReportCube:
+    """Incremental maintenance of one school's reporting cube"""
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, school):
+        self.school = school
+
+    def _checked_key(self):
+        return f'report_cube:checked:{self.school.id}'
+
+    def refresh(self, force=False):
+        """
+        Rebuild the partitions whose source rows changed
+
+        Args:
+            force: Check now even if the school was checked within
+                REPORT_CUBE_REFRESH_INTERVAL seconds
+
+        Returns:
+            Dict with the number of fee and payment partitions rebuilt
+        """
+        from core.models import School
+
+        interval = getattr(settings, 'REPORT_CUBE_REFRESH_INTERVAL', 60)
+        if not force and interval > 0 and cache.get(self._checked_key()):
+            return {'fee_partitions': 0, 'payment_partitions': 0}
+
+        term_ids, months = self._claim_dirty_partitions()
+        if term_ids or months:
+            try:
+                with transaction.atomic():
+                    # One rebuild per school at a time
+                    School.objects.select_for_update().filter(pk=self.school.pk).first()
+                    self._rebuild_fee_terms(term_ids)
+                    self._rebuild_payment_months(months)
+            except Exception:
+                # Keep the claimed partitions for the next refresh
+                mark_dirty(self.school.id, term_ids=term_ids, months=months)
+                raise
+
+        if interval > 0:
+            cache.set(self._checked_key(), True, interval)
+        if term_ids or months:
+            logger.info(
+                f'Report cube for school {self.school.id}: rebuilt {len(term_ids)} fee and '
+                f'{len(months)} payment partition(s)'
+            )
+        return {'fee_partitions': len(term_ids), 'payment_partitions': len(months)}
+
+    def rebuild(self):
+        """Build the school's whole cube from the source tables"""
+        from core.models import School
+        from .models import FeeFact, PaymentFact
+
+        with transaction.atomic():
+            School.objects.select_for_update().filter(pk=self.school.pk).first()
+            term_ids, months = self._source_partitions()
+            FeeFact.objects.filter(school=self.school).delete()
+            PaymentFact.objects.filter(school=self.school).delete()
+            self._rebuild_fee_terms(term_ids)
+            self._rebuild_payment_months(months)
+        return {'fee_partitions': len(term_ids), 'payment_partitions': len(months)}
+
+    def _claim_dirty_partitions(self):
+        """
+        Clear the flags of the school's dirty partitions and return them
+
+        The flags are cleared in a transaction of their own, before the
+        rebuild reads the source rows. A write committed after the rebuild's
+        read is marked after its commit, when the flag is already clear, so
+        it flags the partition again instead of being lost.
+
+        Returns:
+            Tuple of (term ids, months)
+        """
+        from .models import ReportCubePartition
+
+        with transaction.atomic():
+            # Partitions another refresh is claiming are skipped
+            dirty = list(
+                ReportCubePartition.objects.filter(school=self.school, is_dirty=True)
+                .select_for_update(skip_locked=True).values_list('id', 'kind', 'partition')
+            )
+            if dirty:
+                ReportCubePartition.objects.filter(id__in=[pk for pk, _, _ in dirty]).update(is_dirty=False)
+        term_ids = sorted(int(partition) for _, kind, partition in dirty if kind == 'fee')
+        months = sorted(date.fromisoformat(partition) for _, kind, partition in dirty if kind == 'payment')
+        return term_ids, months
+
+    def _source_partitions(self):
+        """Term ids of the school's fees and months of its payments (scans the source tables)"""
+        from core.models import StudentFee
+        from .models import Payment
+
+        term_ids = sorted(
+            StudentFee.objects.filter(school=self.school).values_list('term_id', flat=True).distinct().order_by()
+        )
+        months = sorted(
+            month for month in Payment.objects.filter(school=self.school).annotate(
+                month=TruncMonth('payment_date', output_field=DateField())
+            ).values_list('month', flat=True).distinct().order_by()
+            if month is not None
+        )
+        return term_ids, months
+
+    # ---- Fees ----
+
+    def _rebuild_fee_terms(self, term_ids):
+        from core.models import StudentFee
+        from .models import FeeFact
+
+        if not term_ids:
+            return
+        FeeFact.objects.filter(school=self.school, term_id__in=term_ids).delete()
+        overpaid = Q(amount_paid__gt=F('amount_charged'))
+        outstanding = Q(amount_charged__gt=F('amount_paid'))
+        aggregates = StudentFee.objects.filter(
+            school=self.school, term_id__in=term_ids
+        ).values(
+            'term_id', 'student__grade_id', 'fee_category_id', 'due_date', 'student__is_active'
+        ).annotate(
+            fee_count=Count('id'),
+            paid_count=Count('id', filter=Q(is_paid=True)),
+            outstanding_count=Count('id', filter=outstanding),
+            total_charged=Sum('amount_charged'),
+            total_paid=Sum('amount_paid'),
+            paid_amount=Sum('amount_paid', filter=Q(is_paid=True)),
+            unpaid_charged=Sum('amount_charged', filter=Q(is_paid=False)),
+            outstanding_amount=Sum(F('amount_charged') - F('amount_paid'), filter=outstanding),
+            credit_amount=Sum(F('amount_paid') - F('amount_charged'), filter=overpaid),
+        ).order_by()
+        FeeFact.objects.bulk_create([
+            FeeFact(
+                school=self.school,
+                term_id=row['term_id'],
+                grade_id=row['student__grade_id'],
+                fee_category_id=row['fee_category_id'],
+                due_date=row['due_date'],
+                student_active=row['student__is_active'],
+                fee_count=row['fee_count'],
+                paid_count=row['paid_count'],
+                outstanding_count=row['outstanding_count'],
+                total_charged=row['total_charged'] or Decimal('0'),
+                total_paid=row['total_paid'] or Decimal('0'),
+                paid_amount=row['paid_amount'] or Decimal('0'),
+                unpaid_charged=row['unpaid_charged'] or Decimal('0'),
+                outstanding_amount=row['outstanding_amount'] or Decimal('0'),
+                credit_amount=row['credit_amount'] or Decimal('0'),
+            )
+            for row in aggregates
+        ], batch_size=self.BATCH_SIZE)
+
+    # ---- Payments ----
+
+    @staticmethod
+    def _month_bounds(month):
+        """Aware datetimes bounding a local calendar month"""
+        start = datetime(month.year, month.month, 1)
+        end = datetime.combine(_next_month(month), datetime.min.time())
+        if settings.USE_TZ:
+            start, end = timezone.make_aware(start), timezone.make_aware(end)
+        return start, end
+
+    def _rebuild_payment_months(self, months):
+        from .models import Payment, PaymentFact
+
+        months = sorted(months)
+        if not months:
+            return
+        in_months = Q()
+        fact_days = Q()
+        for month in months:
+            start, end = self._month_bounds(month)
+            in_months |= Q(payment_date__gte=start, payment_date__lt=end)
+            fact_days |= Q(day__gte=month, day__lt=_next_month(month))
+
+        PaymentFact.objects.filter(fact_days, school=self.school).delete()
+        aggregates = Payment.objects.filter(in_months, school=self.school, status='completed').annotate(
+            day=TruncDate('payment_date')
+        ).values(
+            'day', 'payment_method', 'student_fee__term_id', 'student__grade_id', 'student_fee__fee_category_id'
+        ).annotate(
+            payment_count=Count('id'),
+            total_amount=Sum('amount'),
+        ).order_by()
+        PaymentFact.objects.bulk_create([
+            PaymentFact(
+                school=self.school,
+                day=row['day'],
+                payment_method=row['payment_method'],
+                term_id=row['student_fee__term_id'],
+                grade_id=row['student__grade_id'],
+                fee_category_id=row['student_fee__fee_category_id'],
+                payment_count=row['payment_count'],
+                total_amount=row['total_amount'] or Decimal('0'),
+            )
+            for row in aggregates
+        ], batch_size=self.BATCH_SIZE)
+
+    # ---- Reads ----
+
+    def fee_facts(self, term_id=None, academic_year=None, grade_id=None, include_inactive=False):
+        """FeeFact rows of the school matching the usual report filters"""
+        from .models import FeeFact
+
+        facts = FeeFact.objects.filter(school=self.school)
+        if not include_inactive:
+            facts = facts.filter(student_active=True)
+        if grade_id:
+            facts = facts.filter(grade_id=grade_id)
+        if academic_year:
+            facts = facts.filter(term__academic_year=academic_year)
+        if term_id:
+            facts = facts.filter(term_id=term_id)
+        return facts
+
+    def payment_facts(self, date_from=None, date_to=None, year=None):
+        """PaymentFact rows of the school for an optional date range / calendar year"""
+        from .models import PaymentFact
+
+        facts = PaymentFact.objects.filter(school=self.school)
+        if date_from:
+            facts = facts.filter(day__gte=date_from)
+        if date_to:
+            facts = facts.filter(day__lte=date_to)
+        if year:
+            facts = facts.filter(day__year=year)
+        return facts
+
+
+def fold(rows, keys, measures):
+    """
+    Sum grouped fact rows (already read from the database) over fewer keys
+
+    Args:
+        rows: Dicts from a ``.values(...).annotate(**measures)`` query
+        keys: Key fields to keep
+        measures: Measure names to sum (e.g. FEE_MEASURES)
+
+    Returns:
+        List of dicts with ``keys`` and the summed ``measures``, in first-seen order
+    """
+    groups = {}
+    for row in rows:
+        key = tuple(row[name] for name in keys)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {name: row[name] for name in keys}
+            group.update({name: 0 for name in measures})
+        for name in measures:
+            group[name] += row[name] or 0
+    return list(groups.values())
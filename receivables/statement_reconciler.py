@@ -0,0 +1,480 @@
+"""
+Bank Statement Reconciler
+
+Streams an uploaded bank statement through ``csv.reader`` and reconciles it in
+chunks. For each chunk every reference, student number and outstanding fee it
+mentions is loaded with a handful of ``__in`` queries, rows are matched in
+memory, and the resulting Payments, PaymentAllocations, Credits and
+UnmatchedTransactions are written with bulk inserts.
+"""
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+import codecs
+import csv
+import io
+import logging
+import re
+
+from .allocation_service import AllocationRequest, AllocationService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StatementLine:
+    """A parsed credit line from a bank statement"""
+    line_num: int
+    transaction_date: object
+    amount: Decimal
+    narrative: str
+    bank_reference: str
+    mpesa_reference: str
+    mobile_number: str
+    student_id: Optional[str]
+    payment: object = None
+
+    @property
+    def references(self):
+        """Normalized external references (see PaymentReference.normalize)"""
+        return [ref.strip().upper() for ref in (self.mpesa_reference, self.bank_reference) if ref and ref.strip()]
+
+
+class BankStatementReconciler:
+    """Match bank statement lines to students and outstanding fees"""
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, upload, pattern, progress=None):
+        """
+        Args:
+            upload: BankStatementUpload the lines belong to
+            pattern: BankStatementPattern describing the file layout
+            progress: Optional callable(lines_processed) invoked after each chunk
+        """
+        self.upload = upload
+        self.school = upload.school
+        self.pattern = pattern
+        self.progress = progress
+        self.allocation_service = AllocationService(self.school, user=upload.uploaded_by)
+        self.result = {
+            'total_transactions': 0,
+            'matched_payments': 0,
+            'unmatched_payments': 0,
+            'duplicate_transactions': 0,
+        }
+        # References and legacy (student, amount, date, narrative) keys written
+        # earlier in this file, so repeated lines are caught without a query
+        self._seen_references = set()
+        self._seen_payments = []
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def _open_text(self, statement_file):
+        encoding = self.pattern.encoding or 'utf-8'
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            logger.warning(f'Unknown statement encoding "{encoding}", falling back to utf-8')
+            encoding = 'utf-8'
+        if encoding.lower().replace('_', '-') in ('utf-8', 'utf8'):
+            encoding = 'utf-8-sig'
+        return io.TextIOWrapper(statement_file, encoding=encoding, errors='replace', newline='')
+
+    def _delimiter(self):
+        if self.pattern.delimiter == ';':
+            return ';'
+        if self.pattern.delimiter in ('\\t', '\t', 'tab'):
+            return '\t'
+        return ','
+
+    def _resolve_column(self, header, column_spec):
+        """Map a column name to its header index; indexes and unknown names are returned unchanged"""
+        if not column_spec or str(column_spec).isdigit() or not header:
+            return column_spec
+        stripped = [h.strip().lower() for h in header]
+        try:
+            return str(stripped.index(str(column_spec).strip().lower()))
+        except ValueError:
+            return column_spec
+
+    def iter_lines(self, statement_file):
+        """Yield StatementLine objects from the file without loading it into memory"""
+        from .views import extract_column_value
+
+        pattern = self.pattern
+        text = self._open_text(statement_file)
+        try:
+            reader = csv.reader(text, delimiter=self._delimiter())
+            columns = {
+                'date': pattern.date_column,
+                'amount': pattern.amount_column,
+                'reference': pattern.reference_column,
+                'transaction_reference': pattern.transaction_reference_column,
+            }
+            if pattern.has_header:
+                header = next(reader, None)
+                columns = {key: self._resolve_column(header, spec) for key, spec in columns.items()}
+
+            for row in reader:
+                line_num = reader.line_num
+                if len(row) < 2 or not any(cell.strip() for cell in row):
+                    continue
+
+                date_str = extract_column_value(row, columns['date'])
+                amount_str = extract_column_value(row, columns['amount'])
+                narrative = extract_column_value(row, columns['reference']) if columns['reference'] else ''
+                transaction_ref = extract_column_value(row, columns['transaction_reference']) if columns['transaction_reference'] else ''
+
+                try:
+                    transaction_date = datetime.strptime(date_str, pattern.date_format).date()
+                except (ValueError, TypeError):
+                    continue
+                try:
+                    amount = Decimal(re.sub(r'[^\d.-]', '', amount_str))
+                except (InvalidOperation, ValueError):
+                    continue
+
+                mpesa_details = pattern.extract_mpesa_details(narrative) if narrative else {}
+                student_id = pattern.extract_student_id(narrative) if narrative else None
+                if not student_id:
+                    student_id = mpesa_details.get('student_id')
+
+                # Prefer the bank's own transaction reference, then the M-Pesa code,
+                # then any reference-looking token in the narrative
+                bank_reference = transaction_ref.strip()
+                if not bank_reference:
+                    bank_reference = mpesa_details.get('mpesa_reference', '')
+                if not bank_reference and narrative:
+                    ref_match = re.search(r'\b([A-Z0-9]{8,15})\b', narrative)
+                    if ref_match:
+                        bank_reference = ref_match.group(1)
+
+                yield StatementLine(
+                    line_num=line_num,
+                    transaction_date=transaction_date,
+                    amount=amount,
+                    narrative=narrative,
+                    bank_reference=bank_reference[:100],
+                    mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50],
+                    mobile_number=mpesa_details.get('mobile_number', '')[:15],
+                    student_id=student_id,
+                )
+        finally:
+            # Leave the caller's file open
+            text.detach()
+
+    def process(self, statement_file):
+        """
+        Reconcile the whole statement
+
+        Returns:
+            Dict with total_transactions, matched_payments, unmatched_payments
+            and duplicate_transactions counts
+        """
+        chunk = []
+        processed = 0
+        for line in self.iter_lines(statement_file):
+            chunk.append(line)
+            if len(chunk) >= self.CHUNK_SIZE:
+                processed += self._process_chunk(chunk)
+                chunk = []
+                if self.progress:
+                    self.progress(processed)
+        if chunk:
+            processed += self._process_chunk(chunk)
+            if self.progress:
+                self.progress(processed)
+        return self.result
+
+    # ------------------------------------------------------------------
+    # Matching
+    # ------------------------------------------------------------------
+
+    def _load_existing_references(self, lines):
+        """Return the subset of the chunk's references already recorded in the PaymentReference index"""
+        from .models import find_existing_references
+
+        return find_existing_references(self.school, {ref for line in lines for ref in line.references})
+
+    def _load_recent_payments(self, students, lines):
+        """(student_pk, amount, date, reference_number) for payments that could be legacy duplicates"""
+        from .models import Payment
+
+        if not students:
+            return []
+        dates = [line.transaction_date for line in lines]
+        payments = Payment.objects.filter(
+            school=self.school,
+            student_id__in=[s.id for s in students.values()],
+            payment_date__date__gte=min(dates),
+            payment_date__date__lte=max(dates),
+        ).values_list('student_id', 'amount', 'payment_date', 'reference_number')
+        return [
+            (student_pk, amount, timezone.localtime(payment_date).date(), (reference or '').lower())
+            for student_pk, amount, payment_date, reference in payments
+        ]
+
+    def _is_legacy_duplicate(self, student, line, recent_payments):
+        narrative = line.narrative[:50].lower()
+        return any(
+            student_pk == student.id and amount == line.amount and paid_on == line.transaction_date
+            and narrative in reference
+            for student_pk, amount, paid_on, reference in recent_payments
+        )
+
+    def _match_candidates(self, candidates, recent_payments):
+        """
+        Allocate candidate lines to their students' locked outstanding fees
+
+        Call inside the transaction that writes the matches.
+
+        Returns:
+            Tuple of ([(line, student, AllocationPlan), ...], unmatched
+            transactions for lines with nothing to allocate to, number of
+            legacy duplicates)
+        """
+        outstanding = self.allocation_service.outstanding_fees(
+            {student.id for _, student in candidates}, lock=True
+        )
+        matches = []
+        unmatched = []
+        duplicates = 0
+        for line, student in candidates:
+            if self._is_legacy_duplicate(student, line, recent_payments):
+                duplicates += 1
+                continue
+
+            fees = outstanding.get(student.id, [])
+            plan = self.allocation_service.allocate(
+                [AllocationRequest(student_id=student.id, amount=line.amount)], fees_by_student=outstanding
+            )[0]
+            if not plan.allocations:
+                unmatched.append(self._unmatched(
+                    line,
+                    f'No matching receivable found. Student has {len(fees)} outstanding fee(s) but amounts do not match.'
+                ))
+                continue
+            matches.append((line, student, plan))
+            recent_payments.append(
+                (student.id, line.amount, line.transaction_date, line.narrative[:50].lower())
+            )
+        return matches, unmatched, duplicates
+
+    def _unmatched(self, line, notes=''):
+        from .models import UnmatchedTransaction
+
+        return UnmatchedTransaction(
+            school=self.school,
+            upload=self.upload,
+            transaction_date=line.transaction_date,
+            amount=line.amount,
+            reference_number=line.narrative[:200],
+            bank_reference_number=line.bank_reference or None,
+            mpesa_reference=line.mpesa_reference or None,
+            mobile_number=line.mobile_number or None,
+            extracted_student_id=line.student_id,
+            transaction_type='credit',
+            status='unmatched',
+            notes=notes,
+        )
+
+    def _process_chunk(self, lines):
+        """Match and persist one chunk of statement lines; returns the number of lines handled"""
+        from core.models import Student
+
+        existing_references = self._load_existing_references(lines)
+        student_codes = {line.student_id for line in lines if line.student_id}
+        students = {
+            s.student_id: s
+            for s in Student.objects.filter(school=self.school, student_id__in=student_codes)
+        } if student_codes else {}
+        recent_payments = self._load_recent_payments(students, lines) + self._seen_payments
+
+        unmatched = []
+        # (line, student) of lines that may become payments
+        candidates = []
+        duplicates = 0
+        seen_in_chunk = set()
+
+        for line in lines:
+            self.result['total_transactions'] += 1
+            references = line.references
+            if any(ref in existing_references or ref in self._seen_references or ref in seen_in_chunk for ref in references):
+                duplicates += 1
+                continue
+            seen_in_chunk.update(references)
+
+            if not line.student_id:
+                unmatched.append(self._unmatched(line))
+                continue
+
+            student = students.get(line.student_id)
+            if student is None:
+                unmatched.append(self._unmatched(
+                    line, f'Student with ID {line.student_id} not found in school {self.school.name}'
+                ))
+                continue
+            candidates.append((line, student))
+
+        matches = []
+        try:
+            with transaction.atomic():
+                # Fees are locked and allocated in the transaction that writes
+                # them, so payments posted meanwhile are not overwritten
+                matches, no_fees, legacy_duplicates = self._match_candidates(candidates, recent_payments)
+                self._write_matches(matches)
+            unmatched.extend(no_fees)
+            duplicates += legacy_duplicates
+        except Exception as e:
+            logger.error(f'Error saving matched payments for upload {self.upload.id}: {str(e)}', exc_info=True)
+            unmatched.extend(self._unmatched(line, f'Payment creation failed: {str(e)}') for line, _ in candidates)
+            matches = []
+
+        self._write_unmatched(unmatched)
+        self._register_references(matches, unmatched)
+
+        for line in lines:
+            self._seen_references.update(line.references)
+        self._seen_payments.extend(
+            (student.id, line.amount, line.transaction_date, line.narrative[:50].lower())
+            for line, student, _ in matches
+        )
+
+        self.result['duplicate_transactions'] += duplicates
+        self.result['matched_payments'] += len(matches)
+        self.result['unmatched_payments'] += len(unmatched)
+        return len(lines)
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def _write_matches(self, matches):
+        from .models import Payment, Credit
+
+        if not matches:
+            return
+        uploaded_by = self.upload.uploaded_by
+
+        payments = []
+        for line, student, plan in matches:
+            payment_ref = line.narrative[:100]
+            if line.mpesa_reference:
+                payment_ref = f"M-Pesa: {line.mpesa_reference} - {payment_ref}"
+            if line.bank_reference:
+                payment_ref = f"BankRef: {line.bank_reference} | {payment_ref}"
+            payments.append(Payment(
+                school=self.school,
+                student=student,
+                student_fee=plan.allocations[0][0],
+                amount=line.amount,
+                payment_method='bank_transfer',
+                status='completed',
+                reference_number=payment_ref[:100],
+                transaction_id=(line.mpesa_reference or line.bank_reference or '')[:50],
+                processed_by=uploaded_by,
+                notes=f'Auto-matched from bank statement upload: {self.upload.file_name}',
+            ))
+        # bulk_create skips the Payment post_save signal, so allocations are written explicitly
+        Payment.objects.bulk_create(payments, batch_size=self.CHUNK_SIZE)
+        for match, payment in zip(matches, payments):
+            match[0].payment = payment
+        self._store_transaction_dates(matches, payments)
+
+        credits = []
+        for payment, (line, student, plan) in zip(payments, matches):
+            if plan.has_remainder:
+                credits.append(Credit(
+                    school=self.school,
+                    student=student,
+                    amount=plan.remainder,
+                    source='overpayment',
+                    payment=payment,
+                    description=(
+                        f'Overpayment from bank statement upload: {self.upload.file_name}. '
+                        f'Payment amount: {line.amount}, Allocated to {len(plan.allocations)} fee(s), Remaining: {plan.remainder}'
+                    ),
+                    created_by=uploaded_by,
+                ))
+        if credits:
+            Credit.objects.bulk_create(credits, batch_size=self.CHUNK_SIZE)
+
+        self.allocation_service.commit([plan for _, _, plan in matches], payments=payments)
+
+    def _store_transaction_dates(self, matches, payments):
+        """
+        Record each payment's statement transaction date as its payment_date
+
+        Payment.payment_date is auto_now_add, so bulk_create stamps the import
+        time; the legacy duplicate check compares stored payments by
+        transaction date, so the date is written back with one UPDATE per
+        distinct date in the chunk.
+        """
+        from .models import Payment
+
+        now = timezone.now()
+        by_date = defaultdict(list)
+        for (line, _, _), payment in zip(matches, payments):
+            payment.payment_date = timezone.make_aware(datetime.combine(line.transaction_date, datetime.min.time()))
+            by_date[payment.payment_date].append(payment.pk)
+        for payment_date, payment_ids in by_date.items():
+            Payment.objects.filter(pk__in=payment_ids).update(payment_date=payment_date, updated_at=now)
+
+    def _write_unmatched(self, unmatched):
+        from .models import UnmatchedTransaction
+
+        if not unmatched:
+            return
+        UnmatchedTransaction.objects.bulk_create(unmatched, batch_size=self.CHUNK_SIZE, ignore_conflicts=True)
+
+        # ignore_conflicts leaves the primary keys unset; read back the ids of
+        # rows carrying references so their PaymentReference rows can link to them
+        bank_refs = {t.bank_reference_number for t in unmatched if t.bank_reference_number}
+        mpesa_refs = {t.mpesa_reference for t in unmatched if t.mpesa_reference}
+        if not bank_refs and not mpesa_refs:
+            return
+        by_bank_ref = {}
+        by_mpesa_ref = {}
+        for pk, bank_ref, mpesa_ref in UnmatchedTransaction.objects.filter(
+            Q(bank_reference_number__in=bank_refs) | Q(upload=self.upload, mpesa_reference__in=mpesa_refs),
+            school=self.school,
+        ).values_list('id', 'bank_reference_number', 'mpesa_reference'):
+            if bank_ref:
+                by_bank_ref[bank_ref] = pk
+            if mpesa_ref:
+                by_mpesa_ref.setdefault(mpesa_ref, pk)
+        for unmatched_txn in unmatched:
+            if unmatched_txn.pk is None:
+                unmatched_txn.pk = (
+                    by_bank_ref.get(unmatched_txn.bank_reference_number)
+                    or by_mpesa_ref.get(unmatched_txn.mpesa_reference)
+                )
+
+    def _register_references(self, matches, unmatched):
+        """Add the chunk's references to the PaymentReference index so later imports see them"""
+        from .models import PaymentReference
+
+        rows = []
+        for line, _, _ in matches:
+            rows.extend(
+                PaymentReference(school=self.school, reference=ref, payment=line.payment, source='statement')
+                for ref in line.references
+            )
+        for unmatched_txn in unmatched:
+            for ref in (unmatched_txn.mpesa_reference, unmatched_txn.bank_reference_number):
+                if ref and ref.strip():
+                    rows.append(PaymentReference(
+                        school=self.school, reference=PaymentReference.normalize(ref),
+                        unmatched_transaction_id=unmatched_txn.pk, source='statement'
+                    ))
+        if rows:
+            PaymentReference.objects.bulk_create(rows, batch_size=self.CHUNK_SIZE, ignore_conflicts=True)
@@ -68,6 +68,7 @@ urlpatterns = [
     
     # API endpoints for receivables
     path('api/receivables/<str:receivable_id>/allocations/', views.api_receivable_allocations, name='api_receivable_allocations'),
+    path('api/receivables/sync/', views.api_receivable_sync, name='api_receivable_sync'),
     
     # Detail views - must come last as they're catch-alls for tokens
     # Receivable detail comes first - it will check if token is a payment and redirect if needed
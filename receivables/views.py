@@ -7,16 +7,23 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
 from django.db import transaction
-from django.db.models import Q, Sum, F, Case, When, Value, DecimalField, Count, Avg
+from django.db.models import Q, Sum, F, Case, When, Value, BooleanField, DecimalField, Count
 from django.utils import timezone
 from .models import (
     Payment, MpesaPayment, PaymentReceipt, PaymentReminder,
     PaymentAllocation, Receivable, Credit, BankStatementPattern, BankStatementUpload,
-    UnmatchedTransaction
+    UnmatchedTransaction, PaymentReference, payment_external_references, register_payment_references
 )
 from .mpesa_service import MpesaService
+from .mpesa_callbacks import ingest_callback
+from .allocation_service import AllocationRequest, AllocationService
+from .credit_allocator import CreditAllocator
+from .report_cube import FEE_MEASURES, PAYMENT_MEASURES, ReportCube, fold
 from communications.services import CommunicationService
 from core.models import Student, StudentFee, Term
+from core import job_queue
+from core.decorators import permission_required
+from django.core.files.storage import default_storage
 import json
 import uuid
 from decimal import Decimal
@@ -387,35 +394,20 @@ def record_bank_payment(request, student_fee_id):
 
 @csrf_exempt
 def mpesa_callback(request):
-    """Handle M-Pesa callback"""
+    """
+    Handle M-Pesa callback
+
+    Only stores the payload; posting and the receipt run in background jobs
+    (see receivables.mpesa_callbacks) so Safaricom gets an answer at once.
+    """
     if request.method == 'POST':
         try:
-            # Parse callback data
             callback_data = json.loads(request.body)
-            
-            # Process the callback
-            mpesa_service = MpesaService()
-            success = mpesa_service.process_callback(callback_data)
-            
-            if success:
-                # Send payment receipt
-                checkout_request_id = callback_data.get('CheckoutRequestID')
-                try:
-                    mpesa_payment = MpesaPayment.objects.get(checkout_request_id=checkout_request_id)
-                    payment = mpesa_payment.payment
-                    
-                    communication_service = CommunicationService()
-                    communication_service.send_payment_receipt(payment)
-                    
-                except MpesaPayment.DoesNotExist:
-                    pass
-                
-                return HttpResponse('OK', status=200)
-            else:
-                return HttpResponse('FAILED', status=400)
-                
-        except Exception as e:
-            return HttpResponse(f'ERROR: {str(e)}', status=500)
+        except ValueError:
+            return HttpResponse('FAILED', status=400)
+        
+        ingest_callback(callback_data)
+        return HttpResponse('OK', status=200)
     
     return HttpResponse('Method not allowed', status=405)
 
@@ -523,9 +515,101 @@ def view_receipt(request, receipt_number):
     return render(request, 'receivables/view_receipt.html', context)
 
 
+# Students per fee summary page
+FEE_SUMMARY_PAGE_SIZE = 50
+
+FEE_SUMMARY_EXPORT_HEADER = [
+    'Student ID', 'First Name', 'Last Name', 'Grade', 'Active',
+    'Total Charged', 'Total Paid', 'Unpaid', 'Credit', 'Balance',
+]
+
+
+def _student_balance_annotations():
+    """Per-student fee totals, for StudentFee .values(...).annotate(...)"""
+    return {
+        'total_charged': Sum('amount_charged'),
+        'total_paid': Sum('amount_paid'),
+        'balance': Sum(F('amount_charged') - F('amount_paid'), output_field=DecimalField()),
+        'unpaid': Sum(
+            Case(
+                When(amount_charged__gt=F('amount_paid'), then=F('amount_charged') - F('amount_paid')),
+                default=Value(0, output_field=DecimalField())
+            ),
+            output_field=DecimalField()
+        ),
+        'credit': Sum(
+            Case(
+                When(amount_paid__gt=F('amount_charged'), then=F('amount_paid') - F('amount_charged')),
+                default=Value(0, output_field=DecimalField())
+            ),
+            output_field=DecimalField()
+        ),
+    }
+
+
+def _fee_summary_cursor(student):
+    """Opaque keyset cursor pointing just after ``student`` in fee summary order"""
+    from django.core import signing
+    return signing.dumps(
+        [student.is_active, student.first_name, student.last_name, student.id], salt='fee_summary'
+    )
+
+
+def _fee_summary_after(token):
+    """Q selecting the students after a cursor, or None when the cursor is missing/invalid"""
+    from django.core import signing
+    try:
+        is_active, first_name, last_name, student_id = signing.loads(token, salt='fee_summary')
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    # Order is (-is_active, first_name, last_name, id)
+    return Q(is_active__lt=is_active) | Q(is_active=is_active) & (
+        Q(first_name__gt=first_name) |
+        Q(first_name=first_name, last_name__gt=last_name) |
+        Q(first_name=first_name, last_name=last_name, id__gt=student_id)
+    )
+
+
+def _fee_summary_export(fees, export_format):
+    """Stream every student of the filtered fee summary as CSV or XLSX"""
+    from django.http import StreamingHttpResponse
+    from core.exports import CSV_CONTENT_TYPE, XLSX_CONTENT_TYPE, stream_csv, stream_xlsx
+    
+    rows = (
+        [
+            item['student__student_id'], item['student__first_name'], item['student__last_name'],
+            item['student__grade__name'] or '', 'Yes' if item['student__is_active'] else 'No',
+            item['total_charged'], item['total_paid'], item['unpaid'], item['credit'], item['balance'],
+        ]
+        for item in fees.values(
+            'student__id', 'student__student_id', 'student__first_name', 'student__last_name',
+            'student__grade__name', 'student__is_active',
+        ).annotate(**_student_balance_annotations()).order_by(
+            '-student__is_active', 'student__first_name', 'student__last_name', 'student__id'
+        ).iterator(chunk_size=2000)
+    )
+    filename = f"fee_summary_{timezone.now().strftime('%Y%m%d')}"
+    if export_format == 'xlsx':
+        response = StreamingHttpResponse(
+            stream_xlsx(FEE_SUMMARY_EXPORT_HEADER, rows, 'Fee Summary'), content_type=XLSX_CONTENT_TYPE
+        )
+        filename += '.xlsx'
+    else:
+        response = StreamingHttpResponse(stream_csv(FEE_SUMMARY_EXPORT_HEADER, rows), content_type=CSV_CONTENT_TYPE)
+        filename += '.csv'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 @login_required
 def fee_summary(request):
-    """List students with total fees, amount paid, and balance per academic year/term"""
+    """
+    List students with total fees, amount paid, and balance per academic year/term
+
+    Students are paged by keyset (``after`` cursor) rather than offset, and
+    ``export=csv|xlsx`` streams the full filtered result set.
+    """
+    from django.db.models import Exists, OuterRef
     school = request.user.profile.school
     
     # Filters
@@ -535,7 +619,7 @@ def fee_summary(request):
     search_query = request.GET.get('search', '')
     grade_filter = request.GET.get('grade', '')
     
-    fees = StudentFee.objects.filter(school=school).select_related('student', 'term', 'student__grade')
+    fees = StudentFee.objects.filter(school=school)
     
     # Filter by active status (default: show active only)
     if not show_inactive:
@@ -560,62 +644,71 @@ def fee_summary(request):
     if term_filter:
         fees = fees.filter(term_id=term_filter)
     
-    # Aggregate per student
-    student_fees = fees.values(
-        'student__id',
-        'student__student_id',
-        'student__first_name',
-        'student__last_name',
-        'student__grade__name',
-        'student__is_active',
-    ).annotate(
-        total_charged=Sum('amount_charged'),
-        total_paid=Sum('amount_paid'),
-        balance=Sum(F('amount_charged') - F('amount_paid'), output_field=DecimalField()),
-        unpaid=Sum(
-            Case(
-                When(amount_charged__gt=F('amount_paid'), then=F('amount_charged') - F('amount_paid')),
-                default=Value(0, output_field=DecimalField())
-            ),
-            output_field=DecimalField()
-        ),
-        credit=Sum(
-            Case(
-                When(amount_paid__gt=F('amount_charged'), then=F('amount_paid') - F('amount_charged')),
-                default=Value(0, output_field=DecimalField())
-            ),
-            output_field=DecimalField()
-        ),
-    ).order_by('-student__is_active', 'student__first_name', 'student__last_name')
-    
-    # Get detailed fees for each student
-    student_ids = [item['student__id'] for item in student_fees]
+    export_format = request.GET.get('export', '')
+    if export_format in ('csv', 'xlsx'):
+        return _fee_summary_export(fees, export_format)
+    
+    # Page of students with matching fees, in (-is_active, first_name, last_name, id) order
+    students = Student.objects.filter(school=school).filter(
+        Exists(fees.filter(student_id=OuterRef('pk')))
+    ).select_related('grade').order_by('-is_active', 'first_name', 'last_name', 'id')
+    after = _fee_summary_after(request.GET.get('after', ''))
+    if after is not None:
+        students = students.filter(after)
+    page_students = list(students[:FEE_SUMMARY_PAGE_SIZE + 1])
+    next_cursor = None
+    if len(page_students) > FEE_SUMMARY_PAGE_SIZE:
+        page_students = page_students[:FEE_SUMMARY_PAGE_SIZE]
+        next_cursor = _fee_summary_cursor(page_students[-1])
+    
+    # Totals and detailed fees of the page's students, one query each
+    page_ids = [student.id for student in page_students]
+    balances = {
+        row['student_id']: row
+        for row in fees.filter(student_id__in=page_ids).values('student_id').annotate(
+            **_student_balance_annotations()
+        ).order_by()
+    }
     detailed_fees = {}
-    for student_id in student_ids:
-        student_detail_fees = fees.filter(student_id=student_id).select_related(
-            'fee_category', 'term'
-        ).order_by('-term__academic_year', '-term__term_number', 'fee_category__name')
-        detailed_fees[student_id] = list(student_detail_fees)
-    
-    # Totals
-    totals = fees.aggregate(
-        total_charged=Sum('amount_charged', output_field=DecimalField()) or 0,
-        total_paid=Sum('amount_paid', output_field=DecimalField()) or 0,
-        total_unpaid=Sum(
-            Case(
-                When(amount_charged__gt=F('amount_paid'), then=F('amount_charged') - F('amount_paid')),
-                default=Value(0, output_field=DecimalField())
-            ),
-            output_field=DecimalField()
-        ) or 0,
-        total_credit=Sum(
-            Case(
-                When(amount_paid__gt=F('amount_charged'), then=F('amount_paid') - F('amount_charged')),
-                default=Value(0, output_field=DecimalField())
-            ),
-            output_field=DecimalField()
-        ) or 0,
-    )
+    for fee in fees.filter(student_id__in=page_ids).select_related('fee_category', 'term').order_by(
+        'student_id', '-term__academic_year', '-term__term_number', 'fee_category__name'
+    ):
+        detailed_fees.setdefault(fee.student_id, []).append(fee)
+    
+    student_fees = []
+    for student in page_students:
+        item = {
+            'student__id': student.id,
+            'student__student_id': student.student_id,
+            'student__first_name': student.first_name,
+            'student__last_name': student.last_name,
+            'student__grade__name': student.grade.name if student.grade_id else None,
+            'student__is_active': student.is_active,
+        }
+        item.update({key: value for key, value in balances.get(student.id, {}).items() if key != 'student_id'})
+        student_fees.append(item)
+    
+    # Totals come from the reporting cube, which has no student names to search on
+    if search_query:
+        aggregates = fees.aggregate(**_student_balance_annotations())
+        totals = {
+            'total_charged': aggregates['total_charged'] or 0,
+            'total_paid': aggregates['total_paid'] or 0,
+            'total_unpaid': aggregates['unpaid'] or 0,
+            'total_credit': aggregates['credit'] or 0,
+        }
+    else:
+        cube = ReportCube(school)
+        cube.refresh()
+        facts = cube.fee_facts(
+            term_id=term_filter, academic_year=year_filter, grade_id=grade_filter, include_inactive=show_inactive
+        ).aggregate(**FEE_MEASURES)
+        totals = {
+            'total_charged': facts['total_charged'] or 0,
+            'total_paid': facts['total_paid'] or 0,
+            'total_unpaid': facts['outstanding_amount'] or 0,
+            'total_credit': facts['credit_amount'] or 0,
+        }
     totals['balance'] = (totals['total_charged'] or 0) - (totals['total_paid'] or 0)
     
     # Filter options
@@ -628,10 +721,18 @@ def fee_summary(request):
     from core.models import Grade
     grades = Grade.objects.filter(school=school).order_by('name')
     
+    # Current filters, for the pagination and export links
+    filter_params = request.GET.copy()
+    for key in ('after', 'export'):
+        filter_params.pop(key, None)
+    
     context = {
         'student_fees': student_fees,
         'detailed_fees': detailed_fees,
         'totals': totals,
+        'next_cursor': next_cursor,
+        'is_first_page': after is None,
+        'filter_query': filter_params.urlencode(),
         'year_filter': year_filter,
         'term_filter': term_filter,
         'academic_years': academic_years,
@@ -672,61 +773,62 @@ def fee_report(request):
     if term_filter:
         fees = fees.filter(term_id=term_filter)
     
-    # Overall statistics
-    total_students = fees.values('student').distinct().count()
-    total_fees_charged = fees.aggregate(total=Sum('amount_charged', output_field=DecimalField()))['total'] or 0
-    total_fees_paid = fees.aggregate(total=Sum('amount_paid', output_field=DecimalField()))['total'] or 0
+    # Overall statistics, folded from one grouped read of the reporting cube
+    today = timezone.now().date()
+    cube = ReportCube(school)
+    cube.refresh()
+    buckets = list(cube.fee_facts(
+        term_id=term_filter, academic_year=year_filter, grade_id=grade_filter, include_inactive=show_inactive
+    ).annotate(
+        overdue=Case(When(due_date__lt=today, then=Value(True)), default=Value(False), output_field=BooleanField())
+    ).values(
+        'term__name', 'term__academic_year', 'term__term_number', 'fee_category__name', 'grade__name', 'overdue'
+    ).annotate(**FEE_MEASURES).order_by())
+    
+    total_fees_charged = sum((b['total_charged'] for b in buckets), Decimal('0'))
+    total_fees_paid = sum((b['total_paid'] for b in buckets), Decimal('0'))
     total_balance = total_fees_charged - total_fees_paid
     
-    # Overdue statistics
-    overdue_fees = fees.filter(
-        is_paid=False,
-        due_date__lt=timezone.now().date()
-    )
-    overdue_count = overdue_fees.count()
-    overdue_amount = overdue_fees.aggregate(total=Sum('amount_charged', output_field=DecimalField()))['total'] or 0
+    # Overdue and pending: unpaid fees due before / from today
+    overdue_count = sum(b['fee_count'] - b['paid_count'] for b in buckets if b['overdue'])
+    overdue_amount = sum((b['unpaid_charged'] for b in buckets if b['overdue']), Decimal('0'))
+    pending_count = sum(b['fee_count'] - b['paid_count'] for b in buckets if not b['overdue'])
+    pending_amount = sum((b['unpaid_charged'] for b in buckets if not b['overdue']), Decimal('0'))
     
     # Payment statistics
-    paid_fees = fees.filter(is_paid=True)
-    paid_count = paid_fees.count()
-    paid_amount = paid_fees.aggregate(total=Sum('amount_paid', output_field=DecimalField()))['total'] or 0
-    
-    # Pending statistics
-    pending_fees = fees.filter(is_paid=False, due_date__gte=timezone.now().date())
-    pending_count = pending_fees.count()
-    pending_amount = pending_fees.aggregate(total=Sum('amount_charged', output_field=DecimalField()))['total'] or 0
+    paid_count = sum(b['paid_count'] for b in buckets)
+    paid_amount = sum((b['paid_amount'] for b in buckets), Decimal('0'))
     
     # Fee breakdown by category
-    from core.models import FeeCategory
-    category_breakdown = []
-    for item in fees.values('fee_category__name').annotate(
-        total_charged=Sum('amount_charged', output_field=DecimalField()),
-        total_paid=Sum('amount_paid', output_field=DecimalField()),
-        count=Count('id')
-    ).order_by('-total_charged'):
+    category_breakdown = sorted(
+        fold(buckets, ['fee_category__name'], FEE_MEASURES), key=lambda item: item['total_charged'], reverse=True
+    )
+    for item in category_breakdown:
+        item['count'] = item['fee_count']
         item['balance'] = float(item['total_charged'] or 0) - float(item['total_paid'] or 0)
-        category_breakdown.append(item)
     
     # Fee breakdown by term
-    term_breakdown = []
-    for item in fees.values('term__name', 'term__academic_year').annotate(
-        total_charged=Sum('amount_charged', output_field=DecimalField()),
-        total_paid=Sum('amount_paid', output_field=DecimalField()),
-        count=Count('id')
-    ).order_by('-term__academic_year', '-term__term_number'):
+    term_breakdown = sorted(
+        fold(buckets, ['term__name', 'term__academic_year', 'term__term_number'], FEE_MEASURES),
+        key=lambda item: (item['term__academic_year'], item['term__term_number']),
+        reverse=True,
+    )
+    for item in term_breakdown:
+        item['count'] = item['fee_count']
         item['balance'] = float(item['total_charged'] or 0) - float(item['total_paid'] or 0)
-        term_breakdown.append(item)
-    
-    # Fee breakdown by grade
-    grade_breakdown = []
-    for item in fees.values('student__grade__name').annotate(
-        total_charged=Sum('amount_charged', output_field=DecimalField()),
-        total_paid=Sum('amount_paid', output_field=DecimalField()),
-        student_count=Count('student', distinct=True),
-        fee_count=Count('id')
-    ).order_by('student__grade__name'):
+    
+    # Fee breakdown by grade; distinct students can't be summed from the cube
+    student_counts = dict(
+        fees.values_list('student__grade__name').annotate(student_count=Count('student', distinct=True)).order_by()
+    )
+    total_students = sum(student_counts.values())
+    grade_breakdown = sorted(
+        fold(buckets, ['grade__name'], FEE_MEASURES), key=lambda item: item['grade__name'] or ''
+    )
+    for item in grade_breakdown:
+        item['student__grade__name'] = item['grade__name']
+        item['student_count'] = student_counts.get(item['grade__name'], 0)
         item['balance'] = float(item['total_charged'] or 0) - float(item['total_paid'] or 0)
-        grade_breakdown.append(item)
     
     # Top students by balance
     top_balances = fees.values(
@@ -814,67 +916,35 @@ def payment_collection_report(request):
     date_from = request.GET.get('date_from', '')
     date_to = request.GET.get('date_to', '')
     
-    payments = Payment.objects.filter(
-        school=school,
-        status='completed'
-    ).select_related('student', 'student_fee__fee_category', 'student_fee__term')
-    
-    # Date filtering
-    if date_from:
-        payments = payments.filter(payment_date__date__gte=date_from)
-    if date_to:
-        payments = payments.filter(payment_date__date__lte=date_to)
+    cube = ReportCube(school)
+    cube.refresh()
+    facts = cube.payment_facts(date_from=date_from, date_to=date_to)
     
     # Group by period
-    from django.db.models.functions import TruncDate, TruncWeek, TruncMonth
-    collection_data = []
-    
+    from django.db.models.functions import TruncWeek, TruncMonth
     if period == 'daily':
-        grouped = payments.annotate(
-            period=TruncDate('payment_date')
-        ).values('period').annotate(
-            total_amount=Sum('amount', output_field=DecimalField()),
-            count=Count('id')
-        ).order_by('-period')
-        
-        for item in grouped:
-            collection_data.append({
-                'period': item['period'].strftime('%d %b %Y') if item['period'] else 'Unknown',
-                'total_amount': float(item['total_amount'] or 0),
-                'count': item['count'],
-            })
+        period_expression, label = F('day'), lambda value: value.strftime('%d %b %Y')
     elif period == 'weekly':
-        grouped = payments.annotate(
-            period=TruncWeek('payment_date')
-        ).values('period').annotate(
-            total_amount=Sum('amount', output_field=DecimalField()),
-            count=Count('id')
-        ).order_by('-period')
-        
-        for item in grouped:
-            collection_data.append({
-                'period': f"Week of {item['period'].strftime('%d %b %Y')}" if item['period'] else 'Unknown',
-                'total_amount': float(item['total_amount'] or 0),
-                'count': item['count'],
-            })
+        period_expression, label = TruncWeek('day'), lambda value: f"Week of {value.strftime('%d %b %Y')}"
     else:  # monthly
-        grouped = payments.annotate(
-            period=TruncMonth('payment_date')
-        ).values('period').annotate(
-            total_amount=Sum('amount', output_field=DecimalField()),
-            count=Count('id')
-        ).order_by('-period')
-        
-        for item in grouped:
-            collection_data.append({
-                'period': item['period'].strftime('%B %Y') if item['period'] else 'Unknown',
-                'total_amount': float(item['total_amount'] or 0),
-                'count': item['count'],
-            })
+        period_expression, label = TruncMonth('day'), lambda value: value.strftime('%B %Y')
+    
+    grouped = facts.annotate(
+        period=period_expression
+    ).values('period').annotate(**PAYMENT_MEASURES).order_by('-period')
+    
+    collection_data = [
+        {
+            'period': label(item['period']) if item['period'] else 'Unknown',
+            'total_amount': float(item['total_amount'] or 0),
+            'count': item['payment_count'],
+        }
+        for item in grouped
+    ]
     
     # Overall statistics
-    total_collected = payments.aggregate(total=Sum('amount', output_field=DecimalField()))['total'] or 0
-    total_count = payments.count()
+    total_collected = sum(item['total_amount'] for item in collection_data)
+    total_count = sum(item['count'] for item in collection_data)
     avg_payment = total_collected / total_count if total_count > 0 else 0
     
     context = {
@@ -930,28 +1000,37 @@ def outstanding_fees_report(request):
     
     outstanding_fees = outstanding_fees.order_by('-calculated_balance', 'due_date')
     
-    # Statistics
-    total_outstanding = outstanding_fees.aggregate(
-        total=Sum('calculated_balance', output_field=DecimalField())
-    )['total'] or 0
-    
-    overdue_count = outstanding_fees.filter(
-        due_date__lt=timezone.now().date()
-    ).count()
+    # Statistics from the reporting cube
+    today = timezone.now().date()
+    cube = ReportCube(school)
+    cube.refresh()
+    facts = cube.fee_facts(term_id=term_filter, grade_id=grade_filter).filter(outstanding_count__gt=0)
+    if overdue_only:
+        facts = facts.filter(due_date__lt=today)
+    buckets = list(facts.annotate(
+        overdue=Case(When(due_date__lt=today, then=Value(True)), default=Value(False), output_field=BooleanField())
+    ).values('grade__name', 'overdue').annotate(**FEE_MEASURES).order_by())
     
-    overdue_amount = outstanding_fees.filter(
-        due_date__lt=timezone.now().date()
-    ).aggregate(
-        total=Sum('calculated_balance', output_field=DecimalField())
-    )['total'] or 0
+    total_outstanding = sum((b['outstanding_amount'] for b in buckets), Decimal('0'))
+    overdue_count = sum(b['outstanding_count'] for b in buckets if b['overdue'])
+    overdue_amount = sum((b['outstanding_amount'] for b in buckets if b['overdue']), Decimal('0'))
     
-    # Group by grade
+    # Group by grade; distinct students can't be summed from the cube
     from core.models import Grade
-    grade_breakdown = outstanding_fees.values('student__grade__name').annotate(
-        total_outstanding=Sum('calculated_balance', output_field=DecimalField()),
-        count=Count('id'),
-        student_count=Count('student', distinct=True)
-    ).order_by('student__grade__name')
+    student_counts = dict(
+        outstanding_fees.values_list('student__grade__name').annotate(
+            student_count=Count('student', distinct=True)
+        ).order_by()
+    )
+    grade_breakdown = [
+        {
+            'student__grade__name': item['grade__name'],
+            'total_outstanding': item['outstanding_amount'],
+            'count': item['outstanding_count'],
+            'student_count': student_counts.get(item['grade__name'], 0),
+        }
+        for item in sorted(fold(buckets, ['grade__name'], FEE_MEASURES), key=lambda item: item['grade__name'] or '')
+    ]
     
     # Filter options
     grades = Grade.objects.filter(school=school).order_by('name')
@@ -993,23 +1072,16 @@ def collection_summary_report(request):
     year_filter = request.GET.get('year', '')
     term_filter = request.GET.get('term', '')
     
-    fees = StudentFee.objects.filter(school=school).select_related('term', 'student__grade')
-    payments = Payment.objects.filter(school=school, status='completed').select_related('student')
-    
-    # Filter by year
-    if year_filter:
-        fees = fees.filter(term__academic_year=year_filter)
-        payments = payments.filter(payment_date__year=year_filter)
+    cube = ReportCube(school)
+    cube.refresh()
+    fee_facts = cube.fee_facts(term_id=term_filter, academic_year=year_filter, include_inactive=True)
+    payment_facts = cube.payment_facts(year=year_filter)
     
     # Filter by term
     if term_filter:
-        fees = fees.filter(term_id=term_filter)
         term = Term.objects.filter(id=term_filter).first()
         if term:
-            payments = payments.filter(
-                payment_date__date__gte=term.start_date,
-                payment_date__date__lte=term.end_date
-            )
+            payment_facts = payment_facts.filter(day__gte=term.start_date, day__lte=term.end_date)
     
     # Monthly collection trends (last 12 months)
     from datetime import timedelta
@@ -1017,28 +1089,25 @@ def collection_summary_report(request):
     end_date = timezone.now().date()
     start_date = end_date - timedelta(days=365)
     
-    monthly_collections = payments.filter(
-        payment_date__date__gte=start_date,
-        payment_date__date__lte=end_date
+    monthly_collections = payment_facts.filter(
+        day__gte=start_date,
+        day__lte=end_date
     ).annotate(
-        month=TruncMonth('payment_date')
-    ).values('month').annotate(
-        total_collected=Sum('amount', output_field=DecimalField()),
-        count=Count('id')
-    ).order_by('month')
+        month=TruncMonth('day')
+    ).values('month').annotate(**PAYMENT_MEASURES).order_by('month')
     
     monthly_data = []
     for item in monthly_collections:
         monthly_data.append({
             'month': item['month'].strftime('%b %Y') if item['month'] else 'Unknown',
-            'total_collected': float(item['total_collected'] or 0),
-            'count': item['count'],
+            'total_collected': float(item['total_amount'] or 0),
+            'count': item['payment_count'],
         })
     
     # Collection by term
-    term_collections = fees.values('term__name', 'term__academic_year').annotate(
-        total_charged=Sum('amount_charged', output_field=DecimalField()),
-        total_paid=Sum('amount_paid', output_field=DecimalField()),
+    term_collections = fee_facts.values('term__name', 'term__academic_year').annotate(
+        total_charged=Sum('total_charged'),
+        total_paid=Sum('total_paid'),
     ).order_by('-term__academic_year', '-term__term_number')
     
     term_data = []
@@ -1057,9 +1126,9 @@ def collection_summary_report(request):
         })
     
     # Overall statistics
-    total_charged = fees.aggregate(total=Sum('amount_charged', output_field=DecimalField()))['total'] or 0
-    total_paid = fees.aggregate(total=Sum('amount_paid', output_field=DecimalField()))['total'] or 0
-    total_outstanding = float(total_charged) - float(total_paid)
+    total_charged = sum(item['total_charged'] for item in term_data)
+    total_paid = sum(item['total_paid'] for item in term_data)
+    total_outstanding = total_charged - total_paid
     overall_collection_rate = (total_paid / total_charged * 100) if total_charged > 0 else 0
     
     # Filter options
@@ -1096,59 +1165,47 @@ def payment_method_analysis(request):
     date_to = request.GET.get('date_to', '')
     year_filter = request.GET.get('year', '')
     
-    payments = Payment.objects.filter(
-        school=school,
-        status='completed'
-    ).select_related('student')
+    cube = ReportCube(school)
+    cube.refresh()
+    facts = cube.payment_facts(date_from=date_from, date_to=date_to, year=year_filter)
     
-    # Date filtering
-    if date_from:
-        payments = payments.filter(payment_date__date__gte=date_from)
-    if date_to:
-        payments = payments.filter(payment_date__date__lte=date_to)
-    if year_filter:
-        payments = payments.filter(payment_date__year=year_filter)
+    # One grouped read: per method and month, flagging the last 6 months for the trend
+    from datetime import timedelta
+    from django.db.models.functions import TruncMonth
+    end_date = timezone.now().date()
+    start_date = end_date - timedelta(days=180)
+    buckets = list(facts.annotate(
+        month=TruncMonth('day'),
+        recent=Case(
+            When(day__gte=start_date, day__lte=end_date, then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField()
+        ),
+    ).values('payment_method', 'month', 'recent').annotate(**PAYMENT_MEASURES).order_by('month', 'payment_method'))
     
     # Breakdown by payment method
-    method_breakdown = payments.values('payment_method').annotate(
-        total_amount=Sum('amount', output_field=DecimalField()),
-        count=Count('id'),
-        avg_amount=Avg('amount')
-    ).order_by('-total_amount')
+    method_labels = dict(Payment.PAYMENT_METHOD_CHOICES)
+    method_breakdown = sorted(
+        fold(buckets, ['payment_method'], PAYMENT_MEASURES), key=lambda item: item['total_amount'], reverse=True
+    )
+    total_all = sum((item['total_amount'] for item in method_breakdown), Decimal('0'))
     
     method_data = []
-    total_all = payments.aggregate(total=Sum('amount', output_field=DecimalField()))['total'] or 0
-    
     for item in method_breakdown:
         total = float(item['total_amount'] or 0)
         percentage = (total / float(total_all) * 100) if total_all > 0 else 0
         method_data.append({
-            'method': dict(Payment.PAYMENT_METHOD_CHOICES).get(item['payment_method'], item['payment_method']),
+            'method': method_labels.get(item['payment_method'], item['payment_method']),
             'total_amount': total,
-            'count': item['count'],
-            'avg_amount': float(item['avg_amount'] or 0),
+            'count': item['payment_count'],
+            'avg_amount': total / item['payment_count'] if item['payment_count'] else 0,
             'percentage': percentage,
         })
     
     # Monthly trend by method (last 6 months)
-    from datetime import timedelta
-    from django.db.models.functions import TruncMonth
-    end_date = timezone.now().date()
-    start_date = end_date - timedelta(days=180)
-    
-    monthly_by_method = payments.filter(
-        payment_date__date__gte=start_date,
-        payment_date__date__lte=end_date
-    ).annotate(
-        month=TruncMonth('payment_date')
-    ).values('month', 'payment_method').annotate(
-        total_amount=Sum('amount', output_field=DecimalField())
-    ).order_by('month', 'payment_method')
-    
-    # Organize monthly data by method
     monthly_method_data = {}
-    for item in monthly_by_method:
-        method = dict(Payment.PAYMENT_METHOD_CHOICES).get(item['payment_method'], item['payment_method'])
+    for item in fold([b for b in buckets if b['recent']], ['month', 'payment_method'], PAYMENT_MEASURES):
+        method = method_labels.get(item['payment_method'], item['payment_method'])
         month = item['month'].strftime('%b %Y') if item['month'] else 'Unknown'
         
         if method not in monthly_method_data:
@@ -1159,7 +1216,7 @@ def payment_method_analysis(request):
         })
     
     # Overall statistics
-    total_payments = payments.count()
+    total_payments = sum(item['payment_count'] for item in method_breakdown)
     total_amount = float(total_all)
     avg_payment = total_amount / total_payments if total_payments > 0 else 0
     
@@ -1274,65 +1331,8 @@ def receivable_list(request):
     
     school = request.user.profile.school
     
-    # Get all StudentFee records with outstanding balances
-    # This ensures we show all fees that match the dashboard calculation
-    # First, ensure all StudentFee records have corresponding Receivable records
-    # Note: StudentFee has a balance property, so we filter using F() expressions
-    # Filter: amount_charged > amount_paid (which means balance > 0)
-    student_fees_with_balance = StudentFee.objects.filter(
-        school=school
-    ).filter(
-        amount_charged__gt=F('amount_paid')
-    )
-    
-    # Sync receivables for any StudentFee that doesn't have one or update existing ones
-    try:
-        for student_fee in student_fees_with_balance:
-            receivable, created = Receivable.objects.get_or_create(
-                school=student_fee.school,
-                student_fee=student_fee,
-                defaults={
-                    'student': student_fee.student,
-                    'amount_due': student_fee.amount_charged,
-                    'amount_paid': student_fee.amount_paid,
-                    'due_date': student_fee.due_date,
-                    'is_cleared': student_fee.is_paid,
-                }
-            )
-            if not created:
-                # Update existing receivable to match StudentFee; clamp amount_paid so it is never negative (e.g. after reversal)
-                receivable.amount_due = student_fee.amount_charged
-                receivable.amount_paid = max(Decimal('0'), student_fee.amount_paid)
-                receivable.due_date = student_fee.due_date
-                receivable.is_cleared = student_fee.is_paid
-                if student_fee.is_paid and not receivable.cleared_at:
-                    from django.utils import timezone
-                    receivable.cleared_at = timezone.now()
-                elif not student_fee.is_paid:
-                    receivable.cleared_at = None
-                receivable.save()
-    except ProgrammingError as e:
-        # Receivable table doesn't exist - migrations not run
-        if 'receivables_receivable' in str(e) or 'does not exist' in str(e):
-            messages.error(
-                request, 
-                'Database migration required: The Receivables table does not exist. '
-                'Please run migrations in production: python manage.py migrate receivables'
-            )
-            # Return empty context to avoid further errors
-            return render(request, 'receivables/receivable_list.html', {
-                'page_obj': None,
-                'search_query': '',
-                'total_due': Decimal('0.00'),
-                'total_paid': Decimal('0.00'),
-                'total_outstanding': Decimal('0.00'),
-                'has_bank_patterns': False,
-                'has_unmatched_transactions': False,
-            })
-        else:
-            raise  # Re-raise if it's a different ProgrammingError
-    
-    # Now query Receivable records (which should now exist for all outstanding fees)
+    # Receivable rows are kept in step with StudentFee by signals and the
+    # set-based sync (see receivables.receivable_sync), so this page is read-only
     try:
         receivables = Receivable.objects.filter(
             school=school,
@@ -1519,18 +1519,11 @@ def credit_list(request):
     from core.models import StudentFee
     from django.db.models import F
     available_credits_all = credits.filter(is_applied=False)
-    has_any_outstanding = False
-    if available_credits_all.exists():
-        # Check if any available credit has outstanding receivables
-        for credit in available_credits_all:
-            outstanding_fees = StudentFee.objects.filter(
-                school=school,
-                student=credit.student,
-                amount_charged__gt=F('amount_paid')
-            ).exists()
-            if outstanding_fees:
-                has_any_outstanding = True
-                break  # Found at least one, no need to check further
+    has_any_outstanding = StudentFee.objects.filter(
+        school=school,
+        student_id__in=available_credits_all.values('student_id'),
+        amount_charged__gt=F('amount_paid')
+    ).exists()
     
     # Pagination
     paginator = Paginator(credits, 20)
@@ -1627,8 +1620,6 @@ def credit_edit(request, credit_id):
 def credit_apply(request, credit_id):
     """Apply a credit to outstanding receivables (can apply to multiple fees)"""
     from django.db import transaction as db_transaction
-    from django.db.models import F
-    from core.models import StudentFee
     
     credit = _get_credit_from_token_or_id(request, credit_id)
     school = credit.school
@@ -1640,6 +1631,7 @@ def credit_apply(request, credit_id):
     
     if request.method == 'POST':
         student_fee_id = request.POST.get('student_fee_id')
+        allocation_service = AllocationService(school, user=request.user)
         
         try:
             with db_transaction.atomic():
@@ -1651,109 +1643,48 @@ def credit_apply(request, credit_id):
                         student=credit.student,
                         amount_charged__gt=F('amount_paid')
                     )
-                    
-                    outstanding = student_fee.amount_charged - student_fee.amount_paid
-                    amount_to_apply = min(float(credit.amount), float(outstanding))
-                    
-                    # Update student fee
-                    student_fee.amount_paid += Decimal(str(amount_to_apply))
-                    if student_fee.amount_paid >= student_fee.amount_charged:
-                        student_fee.is_paid = True
-                    student_fee.save()
-                    
-                    # Mark credit as applied
-                    credit.is_applied = True
-                    credit.applied_to_fee = student_fee
-                    from django.utils import timezone
-                    credit.applied_at = timezone.now()
-                    credit.save()
-                    
-                    # Create new credit for remaining amount if any
-                    if amount_to_apply < float(credit.amount):
-                        remaining = float(credit.amount) - amount_to_apply
-                        new_credit = Credit.objects.create(
-                            school=school,
-                            student=credit.student,
-                            amount=Decimal(str(remaining)),
-                            source=credit.source,
-                            payment=credit.payment,
-                            description=f'Remaining credit from application of credit ID {credit.id} to {student_fee.fee_category.name}. Original credit amount: {credit.amount}, Applied: {amount_to_apply:.2f}, Remaining: {remaining:.2f}',
-                            created_by=request.user
-                        )
-                        messages.success(request, f'Credit of KES {amount_to_apply:.2f} applied to {student_fee.fee_category.name}. Remaining KES {remaining:.2f} has been created as a new credit (ID: {new_credit.id}) for future application.')
-                    else:
-                        messages.success(request, f'Credit of KES {amount_to_apply:.2f} applied to {student_fee.fee_category.name}.')
+                    allocation = AllocationRequest(
+                        student_id=credit.student_id,
+                        amount=credit.amount,
+                        preferred_fee_id=student_fee.id,
+                        preferred_only=True,
+                    )
                 else:
                     # Apply to multiple outstanding fees (by fee category allocation_order, then due_date)
-                    outstanding_fees = list(StudentFee.objects.filter(
+                    allocation = AllocationRequest(student_id=credit.student_id, amount=credit.amount)
+                plan = allocation_service.allocate([allocation], lock=True)[0]
+                
+                if not plan.allocations:
+                    messages.error(request, 'No outstanding receivables found for this student.')
+                    return redirect('receivables:credit_list')
+                
+                # Mark credit as applied (use first fee as primary reference)
+                credit.is_applied = True
+                credit.applied_to_fee = plan.allocations[0][0]
+                credit.applied_at = timezone.now()
+                credit.save()
+                # A credit from a payment is recorded as an allocation of that payment
+                allocation_service.commit([plan], payments=[credit.payment_id])
+                
+                # Build success message
+                fee_names = [f"{fee.fee_category.name} (KES {amount:.2f})" for fee, amount in plan.allocations]
+                if len(plan.allocations) == 1:
+                    messages.success(request, f'Credit of KES {plan.applied:.2f} applied to {fee_names[0]}.')
+                else:
+                    messages.success(request, f'Credit of KES {plan.applied:.2f} applied to {len(plan.allocations)} fee(s): {", ".join(fee_names)}.')
+                
+                # Create new credit for remaining amount if any
+                if plan.has_remainder:
+                    new_credit = Credit.objects.create(
                         school=school,
                         student=credit.student,
-                        amount_charged__gt=F('amount_paid')
-                    ).select_related('fee_category').order_by('due_date', 'created_at'))
-                    _alloc_key = lambda f: (getattr(f.fee_category, 'allocation_order', 999), f.due_date, float(f.amount_charged - f.amount_paid))
-                    outstanding_fees = sorted(outstanding_fees, key=_alloc_key)
-                    
-                    if not outstanding_fees:
-                        messages.error(request, 'No outstanding receivables found for this student.')
-                        return redirect('receivables:credit_list')
-                    
-                    # Apply credit across multiple fees
-                    remaining_credit = float(credit.amount)
-                    applied_fees = []
-                    
-                    for student_fee in outstanding_fees:
-                        if remaining_credit <= 0.01:  # Less than 1 cent remaining
-                            break
-                        
-                        outstanding = float(student_fee.amount_charged - student_fee.amount_paid)
-                        if outstanding <= 0:
-                            continue
-                        
-                        # Apply what we can to this fee
-                        amount_to_apply = min(remaining_credit, outstanding)
-                        
-                        # Update student fee
-                        student_fee.amount_paid += Decimal(str(amount_to_apply))
-                        if student_fee.amount_paid >= student_fee.amount_charged:
-                            student_fee.is_paid = True
-                        student_fee.save()
-                        
-                        applied_fees.append({
-                            'fee': student_fee,
-                            'amount': amount_to_apply
-                        })
-                        remaining_credit -= amount_to_apply
-                    
-                    if applied_fees:
-                        # Mark credit as applied (use first fee as primary reference)
-                        credit.is_applied = True
-                        credit.applied_to_fee = applied_fees[0]['fee']
-                        from django.utils import timezone
-                        credit.applied_at = timezone.now()
-                        credit.save()
-                        
-                        # Build success message
-                        fee_names = [f"{fee['fee'].fee_category.name} (KES {fee['amount']:.2f})" for fee in applied_fees]
-                        if len(applied_fees) == 1:
-                            messages.success(request, f'Credit of KES {applied_fees[0]["amount"]:.2f} applied to {fee_names[0]}.')
-                        else:
-                            total_applied = sum(f['amount'] for f in applied_fees)
-                            messages.success(request, f'Credit of KES {total_applied:.2f} applied to {len(applied_fees)} fee(s): {", ".join(fee_names)}.')
-                        
-                        # Create new credit for remaining amount if any
-                        if remaining_credit > 0.01:
-                            new_credit = Credit.objects.create(
-                                school=school,
-                                student=credit.student,
-                                amount=Decimal(str(remaining_credit)),
-                                source=credit.source,
-                                payment=credit.payment,
-                                description=f'Remaining credit from application of credit ID {credit.id}. Original credit amount: {credit.amount}, Applied: {sum(f["amount"] for f in applied_fees):.2f}, Remaining: {remaining_credit:.2f}',
-                                created_by=request.user
-                            )
-                            messages.info(request, f'Remaining credit of KES {remaining_credit:.2f} has been created as a new credit (ID: {new_credit.id}) for future application.')
-                    else:
-                        messages.error(request, 'Could not apply credit to any fees.')
+                        amount=plan.remainder,
+                        source=credit.source,
+                        payment=credit.payment,
+                        description=f'Remaining credit from application of credit ID {credit.id}. Original credit amount: {credit.amount}, Applied: {plan.applied:.2f}, Remaining: {plan.remainder:.2f}',
+                        created_by=request.user
+                    )
+                    messages.info(request, f'Remaining credit of KES {plan.remainder:.2f} has been created as a new credit (ID: {new_credit.id}) for future application.')
                 
         except StudentFee.DoesNotExist:
             messages.error(request, 'Selected fee not found or already paid.')
@@ -1768,110 +1699,37 @@ def credit_apply(request, credit_id):
 
 @login_required
 def credit_apply_all(request):
-    """Apply all available credits to outstanding receivables"""
-    from django.db import transaction as db_transaction
-    from django.db.models import F
-    from core.models import StudentFee
-    
+    """Apply all available credits to outstanding receivables (GET shows a dry-run preview)"""
     school = request.user.profile.school
+    allocator = CreditAllocator(school, user=request.user)
     
-    if request.method == 'POST':
-        # Get all available (unapplied) credits
-        available_credits = Credit.objects.filter(
-            school=school,
-            is_applied=False
-        ).select_related('student')
-        
-        if not available_credits.exists():
+    if request.method != 'POST':
+        preview = allocator.run(dry_run=True)
+        if not preview.applications and not preview.skipped:
             messages.info(request, 'No available credits to apply.')
             return redirect('receivables:credit_list')
-        
-        applied_count = 0
-        skipped_count = 0
-        total_applied_amount = Decimal('0.00')
-        
-        try:
-            with db_transaction.atomic():
-                for credit in available_credits:
-                    # Get outstanding fees for this student, ordered by fee category allocation_order then due_date
-                    qs = StudentFee.objects.filter(
-                        school=school,
-                        student=credit.student,
-                        amount_charged__gt=F('amount_paid')
-                    ).select_related('fee_category').order_by('due_date', 'created_at')
-                    _alloc_key = lambda f: (getattr(f.fee_category, 'allocation_order', 999), f.due_date, float(f.amount_charged - f.amount_paid))
-                    outstanding_fees = sorted(qs, key=_alloc_key)
-                    
-                    if not outstanding_fees:
-                        skipped_count += 1
-                        continue
-                    
-                    # Apply credit across multiple fees
-                    remaining_credit = float(credit.amount)
-                    applied_fees = []
-                    
-                    for student_fee in outstanding_fees:
-                        if remaining_credit <= 0.01:  # Less than 1 cent remaining
-                            break
-                        
-                        outstanding = float(student_fee.amount_charged - student_fee.amount_paid)
-                        if outstanding <= 0:
-                            continue
-                        
-                        # Apply what we can to this fee
-                        amount_to_apply = min(remaining_credit, outstanding)
-                        
-                        # Update student fee
-                        student_fee.amount_paid += Decimal(str(amount_to_apply))
-                        if student_fee.amount_paid >= student_fee.amount_charged:
-                            student_fee.is_paid = True
-                        student_fee.save()
-                        
-                        applied_fees.append({
-                            'fee': student_fee,
-                            'amount': amount_to_apply
-                        })
-                        remaining_credit -= amount_to_apply
-                    
-                    if applied_fees:
-                        # Mark credit as applied (use first fee as primary reference)
-                        credit.is_applied = True
-                        credit.applied_to_fee = applied_fees[0]['fee']
-                        from django.utils import timezone
-                        credit.applied_at = timezone.now()
-                        credit.save()
-                        
-                        total_applied = sum(f['amount'] for f in applied_fees)
-                        total_applied_amount += Decimal(str(total_applied))
-                        applied_count += 1
-                        
-                        # Create new credit for remaining amount if any
-                        if remaining_credit > 0.01:
-                            Credit.objects.create(
-                                school=school,
-                                student=credit.student,
-                                amount=Decimal(str(remaining_credit)),
-                                source=credit.source,
-                                payment=credit.payment,
-                                description=f'Remaining credit from bulk application of credit ID {credit.id}. Original credit amount: {credit.amount}, Applied: {total_applied:.2f}, Remaining: {remaining_credit:.2f}',
-                                created_by=request.user
-                            )
-                    else:
-                        skipped_count += 1
-            
-            # Build success message
-            if applied_count > 0:
-                messages.success(request, f'Applied {applied_count} credit(s) totaling KES {total_applied_amount:.2f} to outstanding receivables.')
-            if skipped_count > 0:
-                messages.info(request, f'Skipped {skipped_count} credit(s) with no outstanding receivables.')
-            if applied_count == 0 and skipped_count > 0:
-                messages.warning(request, 'No credits could be applied. No outstanding receivables found for any credits.')
-                
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f'Error applying all credits: {str(e)}', exc_info=True)
-            messages.error(request, f'Error applying credits: {str(e)}')
+        return render(request, 'receivables/credit_apply_preview.html', {'preview': preview})
+    
+    try:
+        result = allocator.run()
+    except Exception as e:
+        import logging
+        logger = logging.getLogger(__name__)
+        logger.error(f'Error applying all credits: {str(e)}', exc_info=True)
+        messages.error(request, f'Error applying credits: {str(e)}')
+        return redirect('receivables:credit_list')
+    
+    if not result.applications and not result.skipped:
+        messages.info(request, 'No available credits to apply.')
+        return redirect('receivables:credit_list')
+    
+    # Build success message
+    if result.applied_count > 0:
+        messages.success(request, f'Applied {result.applied_count} credit(s) totaling KES {result.total_applied:.2f} to outstanding receivables.')
+    if result.skipped_count > 0:
+        messages.info(request, f'Skipped {result.skipped_count} credit(s) with no outstanding receivables.')
+    if result.applied_count == 0 and result.skipped_count > 0:
+        messages.warning(request, 'No credits could be applied. No outstanding receivables found for any credits.')
     
     return redirect('receivables:credit_list')
 
@@ -2071,46 +1929,30 @@ def bank_statement_upload(request):
             messages.error(request, 'Selected pattern not found.')
             return redirect('receivables:bank_statement_upload')
         
-        # Create upload record
+        # Keep the file in storage so the background worker can read it
+        stored_path = default_storage.save(
+            f'bank_statements/{school.id}/{uuid.uuid4().hex}_{statement_file.name}', statement_file
+        )
         upload = BankStatementUpload.objects.create(
             school=school,
             pattern=pattern,
             file_name=statement_file.name,
+            file_path=stored_path,
             uploaded_by=request.user,
-            status='processing'
+            status='pending'
         )
         
-        # Process the statement asynchronously (or synchronously for now)
-        try:
-            result = process_bank_statement(upload, statement_file, pattern)
-            upload.status = 'completed'
-            upload.total_transactions = result.get('total_transactions', 0)
-            upload.matched_payments = result.get('matched_payments', 0)
-            upload.unmatched_payments = result.get('unmatched_payments', 0)
-            upload.duplicate_transactions = result.get('duplicate_transactions', 0)
-            upload.processed_at = timezone.now()
-            upload.save()
-            
-            # Build success message with all counts
-            duplicate_count = result.get("duplicate_transactions", 0)
-            message_parts = [
-                f'Bank statement processed successfully. '
-                f'Total: {result.get("total_transactions", 0)}, '
-                f'Matched: {result.get("matched_payments", 0)}, '
-                f'Unmatched: {result.get("unmatched_payments", 0)}'
-            ]
-            if duplicate_count > 0:
-                message_parts.append(f'Duplicates: {duplicate_count}')
-            
-            messages.success(request, ', '.join(message_parts))
-        except Exception as e:
-            upload.status = 'failed'
-            upload.error_message = str(e)
-            upload.save()
-            messages.error(request, f'Error processing bank statement: {str(e)}')
-        
-        # Redirect back to upload page to show results and allow another upload
-        return redirect('receivables:bank_statement_upload')
+        # Not retried: the reconciler commits chunk by chunk, so a rerun
+        # would re-import whatever was already committed
+        job = job_queue.enqueue(
+            'process_bank_statement',
+            {'upload_id': upload.id},
+            school=school,
+            user=request.user,
+            max_attempts=1,
+        )
+        messages.info(request, f'Bank statement "{upload.file_name}" queued for processing.')
+        return redirect(f"{reverse('core:job_detail', args=[job.get_signed_token()])}?next={reverse('receivables:bank_statement_upload')}")
     
     # Get recent uploads
     recent_uploads = BankStatementUpload.objects.filter(school=school).order_by('-uploaded_at')[:10]
@@ -2123,536 +1965,10 @@ def bank_statement_upload(request):
     return render(request, 'receivables/bank_statement_upload.html', context)
 
 
-def process_bank_statement(upload, statement_file, pattern):
-    """Process bank statement file and match payments"""
-    import csv
-    import re
-    from datetime import datetime
-    from decimal import Decimal, InvalidOperation
-    from django.db.models import F
-    
-    result = {
-        'total_transactions': 0,
-        'matched_payments': 0,
-        'unmatched_payments': 0,
-        'duplicate_transactions': 0,
-        'transactions': []
-    }
-    
-    # Read CSV file
-    content = statement_file.read()
-    if pattern.encoding != 'utf-8':
-        try:
-            content = content.decode(pattern.encoding).encode('utf-8')
-        except:
-            content = content.decode('utf-8', errors='ignore').encode('utf-8')
-    else:
-        content = content.decode('utf-8', errors='ignore').encode('utf-8')
-    
-    csv_content = content.decode('utf-8')
-    lines = csv_content.split('\n')
-    
-    # Skip header if present
-    start_line = 1 if pattern.has_header else 0
-    
-    # Determine delimiter
-    delimiter = ',' if pattern.delimiter == ',' else (';' if pattern.delimiter == ';' else '\t')
-    
-    # Process each line
-    for line_num, line in enumerate(lines[start_line:], start=start_line + 1):
-        if not line.strip():
-            continue
-        
-        try:
-            reader = csv.reader([line], delimiter=delimiter)
-            row = next(reader)
-            
-            if len(row) < 2:
-                continue
-            
-            # Extract data based on pattern
-            date_str = extract_column_value(row, pattern.date_column)
-            amount_str = extract_column_value(row, pattern.amount_column)
-            reference_str = extract_column_value(row, pattern.reference_column) if pattern.reference_column else ''
-            transaction_ref_str = extract_column_value(row, pattern.transaction_reference_column) if pattern.transaction_reference_column else ''
-            
-            # Parse date
-            try:
-                transaction_date = datetime.strptime(date_str, pattern.date_format).date()
-            except:
-                continue
-            
-            # Parse amount
-            try:
-                # Remove currency symbols and commas
-                amount_str_clean = re.sub(r'[^\d.-]', '', amount_str)
-                amount = Decimal(amount_str_clean)
-            except (InvalidOperation, ValueError):
-                continue
-            
-            # Extract M-Pesa details from narrative
-            mpesa_details = {}
-            if reference_str:
-                mpesa_details = pattern.extract_mpesa_details(reference_str)
-            
-            # Extract student ID from reference using pattern's extract method
-            student_id = None
-            if reference_str:
-                student_id = pattern.extract_student_id(reference_str)
-                # Also check if student_id was extracted from mpesa_details
-                if not student_id and mpesa_details.get('student_id'):
-                    student_id = mpesa_details.get('student_id')
-            
-            # Get bank reference number - prioritize transaction_reference_column if available
-            bank_reference = transaction_ref_str.strip() if transaction_ref_str else ''
-            # If no transaction reference column, try M-Pesa reference from narrative
-            if not bank_reference and mpesa_details:
-                bank_reference = mpesa_details.get('mpesa_reference', '')
-            # If still no reference, try to extract from narrative
-            if not bank_reference and reference_str:
-                # Try to find any alphanumeric reference in the narrative
-                ref_match = re.search(r'\b([A-Z0-9]{8,15})\b', reference_str)
-                if ref_match:
-                    bank_reference = ref_match.group(1)
-            
-            # Check for duplicate transactions using bank_reference_number or mpesa_reference
-            is_duplicate = False
-            
-            # Check by M-Pesa reference first (most reliable)
-            if mpesa_details.get('mpesa_reference'):
-                mpesa_ref = mpesa_details.get('mpesa_reference')
-                
-                # Check unmatched transactions
-                existing_unmatched = UnmatchedTransaction.objects.filter(
-                    school=upload.school,
-                    mpesa_reference=mpesa_ref
-                ).first()
-                if existing_unmatched:
-                    result['duplicate_transactions'] += 1
-                    is_duplicate = True
-                
-                # Check payments by transaction_id (where M-Pesa reference is stored)
-                if not is_duplicate:
-                    existing_payment = Payment.objects.filter(
-                        school=upload.school,
-                        transaction_id=mpesa_ref
-                    ).first()
-                    if existing_payment:
-                        result['duplicate_transactions'] += 1
-                        is_duplicate = True
-                
-                # Also check payments by reference_number containing M-Pesa ref (backup check)
-                if not is_duplicate:
-                    existing_payment = Payment.objects.filter(
-                        school=upload.school,
-                        reference_number__icontains=mpesa_ref
-                    ).first()
-                    if existing_payment:
-                        result['duplicate_transactions'] += 1
-                        is_duplicate = True
-            
-            # Also check by bank reference number if available and not already duplicate
-            if not is_duplicate and bank_reference:
-                # Check unmatched transactions
-                existing_unmatched = UnmatchedTransaction.objects.filter(
-                    school=upload.school,
-                    bank_reference_number=bank_reference
-                ).first()
-                if existing_unmatched:
-                    result['duplicate_transactions'] += 1
-                    is_duplicate = True
-                
-                # Check payments by bank_reference in reference_number or transaction_id
-                # Some banks might store the transaction reference in these fields
-                if not is_duplicate:
-                    existing_payment = Payment.objects.filter(
-                        school=upload.school
-                    ).filter(
-                        Q(transaction_id=bank_reference) | 
-                        Q(reference_number__icontains=bank_reference)
-                    ).first()
-                    if existing_payment:
-                        result['duplicate_transactions'] += 1
-                        is_duplicate = True
-            
-            result['total_transactions'] += 1
-            
-            # Skip if duplicate
-            if is_duplicate:
-                result['transactions'].append({
-                    'transaction_id': f"{upload.id}-{line_num}",
-                    'student_id': student_id,
-                    'amount': float(amount),
-                    'payment_date': transaction_date.isoformat(),
-                    'narrative': reference_str,
-                    'status': 'Duplicate'
-                })
-                continue
-            
-            # Try to match with existing payment or create payment from receivable
-            matched = False
-            if student_id:
-                # Try to find student and match payment
-                try:
-                    student = Student.objects.get(school=upload.school, student_id=student_id)
-                    
-                    # Debug logging
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.info(f'Processing transaction: student_id={student_id}, amount={amount}, date={transaction_date}, reference={reference_str[:50]}')
-                    
-                    # Additional duplicate check - check by M-Pesa reference in transaction_id
-                    if mpesa_details.get('mpesa_reference'):
-                        existing_payment = Payment.objects.filter(
-                            school=upload.school,
-                            transaction_id=mpesa_details.get('mpesa_reference')
-                        ).first()
-                        if existing_payment:
-                            result['duplicate_transactions'] += 1
-                            matched = True
-                    
-                    # Also check by bank_reference_number if available
-                    if not matched and bank_reference:
-                        existing_payment = Payment.objects.filter(
-                            school=upload.school
-                        ).filter(
-                            Q(transaction_id=bank_reference) | 
-                            Q(reference_number__icontains=bank_reference)
-                        ).first()
-                        if existing_payment:
-                            result['duplicate_transactions'] += 1
-                            matched = True
-                    
-                    # Also check by amount, date, student, and reference (legacy check for non-M-Pesa)
-                    if not matched:
-                        existing_payment = Payment.objects.filter(
-                            school=upload.school,
-                            student=student,
-                            amount=amount,
-                            payment_date__date=transaction_date,
-                            reference_number__icontains=reference_str[:50] if reference_str else ''
-                        ).first()
-                        
-                        if existing_payment:
-                            result['duplicate_transactions'] += 1
-                            matched = True
-                            logger.info(f'Found duplicate payment by legacy check: payment_id={existing_payment.payment_id}')
-                    
-                    if not matched:
-                        # Try to match to outstanding receivables (StudentFee with amount_charged > amount_paid)
-                        # Note: We check is_paid=False OR amount_charged > amount_paid to catch edge cases
-                        # where is_paid might be incorrectly set to True
-                        outstanding_fees = StudentFee.objects.filter(
-                            school=upload.school,
-                            student=student
-                        ).filter(
-                            amount_charged__gt=F('amount_paid')
-                        ).select_related('fee_category').order_by('due_date', 'created_at')
-                        
-                        # Debug logging
-                        import logging
-                        logger = logging.getLogger(__name__)
-                        logger.info(f'Found {outstanding_fees.count()} outstanding fees for student {student_id}')
-                        for fee in outstanding_fees:
-                            outstanding = fee.amount_charged - fee.amount_paid
-                            logger.info(f'  Fee ID {fee.id}: charged={fee.amount_charged}, paid={fee.amount_paid}, outstanding={outstanding}, transaction_amount={amount}')
-                        
-                        # Calculate total outstanding
-                        total_outstanding = sum(float(fee.amount_charged - fee.amount_paid) for fee in outstanding_fees)
-                        logger.info(f'Total outstanding for student {student_id}: {total_outstanding}, transaction amount: {amount}')
-                        
-                        # Strategy: Try to match to multiple fees if payment covers them.
-                        # Sort by fee category allocation_order (lower first), then due_date, then outstanding.
-                        _alloc_order = lambda f: (getattr(f.fee_category, 'allocation_order', 999), f.due_date, float(f.amount_charged - f.amount_paid))
-                        matched_fees = []  # List of (fee, amount_to_allocate) tuples
-                        remaining_amount = float(amount)
-                        fees_sorted = sorted(outstanding_fees, key=_alloc_order)
-                        
-                        # Try to allocate payment across multiple fees
-                        for fee in fees_sorted:
-                            if remaining_amount <= 0.01:  # Less than 1 cent remaining
-                                break
-                            
-                            outstanding = float(fee.amount_charged - fee.amount_paid)
-                            if outstanding <= 0:
-                                continue
-                            
-                            # Allocate what we can to this fee
-                            amount_to_allocate = min(remaining_amount, outstanding)
-                            matched_fees.append((fee, amount_to_allocate))
-                            remaining_amount -= amount_to_allocate
-                            logger.info(f'  Allocating {amount_to_allocate} to fee ID {fee.id} (outstanding: {outstanding}), remaining: {remaining_amount}')
-                        
-                        # If we matched to fees, use the first one as the primary fee for the payment record
-                        # (Payment model requires a single student_fee, but we'll create allocations for all)
-                        matched_fee = matched_fees[0][0] if matched_fees else None
-                        
-                        if matched_fee:
-                            # Final duplicate check before creating payment - comprehensive check
-                            final_duplicate_check = False
-                            
-                            # Check by M-Pesa reference in transaction_id
-                            if mpesa_details.get('mpesa_reference'):
-                                existing_payment = Payment.objects.filter(
-                                    school=upload.school,
-                                    transaction_id=mpesa_details.get('mpesa_reference')
-                                ).first()
-                                if existing_payment:
-                                    result['duplicate_transactions'] += 1
-                                    final_duplicate_check = True
-                                    matched = True
-                            
-                            # Check by bank_reference_number if available
-                            if not final_duplicate_check and bank_reference:
-                                existing_payment = Payment.objects.filter(
-                                    school=upload.school
-                                ).filter(
-                                    Q(transaction_id=bank_reference) | 
-                                    Q(reference_number__icontains=bank_reference)
-                                ).first()
-                                if existing_payment:
-                                    result['duplicate_transactions'] += 1
-                                    final_duplicate_check = True
-                                    matched = True
-                            
-                            # Final check by amount, date, student, and reference
-                            if not final_duplicate_check:
-                                existing_payment = Payment.objects.filter(
-                                    school=upload.school,
-                                    student=student,
-                                    amount=amount,
-                                    payment_date__date=transaction_date,
-                                    reference_number__icontains=reference_str[:50] if reference_str else ''
-                                ).first()
-                                if existing_payment:
-                                    result['duplicate_transactions'] += 1
-                                    final_duplicate_check = True
-                                    matched = True
-                            
-                            if not final_duplicate_check:
-                                try:
-                                    # Create payment record
-                                    from django.utils import timezone as tz
-                                    from receivables.models import Credit
-                                    # Build reference number with M-Pesa and bank ref for duplicate detection
-                                    payment_ref = reference_str[:100] if reference_str else ''
-                                    if mpesa_details.get('mpesa_reference'):
-                                        payment_ref = f"M-Pesa: {mpesa_details.get('mpesa_reference')} - {payment_ref}"
-                                    if bank_reference:
-                                        payment_ref = f"BankRef: {bank_reference} | {payment_ref}"
-                                    
-                                    # Allocate payment across multiple fees if possible.
-                                    # Sort by fee category allocation_order, then due_date, then outstanding.
-                                    fees_to_allocate = sorted(outstanding_fees, key=_alloc_order)
-                                    
-                                    remaining_amount = float(amount)
-                                    allocations = []  # List of (fee, amount) tuples
-                                    
-                                    # Allocate payment across fees
-                                    for fee in fees_to_allocate:
-                                        if remaining_amount <= 0.01:  # Less than 1 cent remaining
-                                            break
-                                        
-                                        outstanding = float(fee.amount_charged - fee.amount_paid)
-                                        if outstanding <= 0:
-                                            continue
-                                        
-                                        # Allocate what we can to this fee
-                                        amount_to_allocate = min(remaining_amount, outstanding)
-                                        allocations.append((fee, amount_to_allocate))
-                                        remaining_amount -= amount_to_allocate
-                                        logger.info(f'  Planning allocation: {amount_to_allocate} to fee ID {fee.id} (outstanding: {outstanding}), remaining: {remaining_amount}')
-                                    
-                                    # Use the first fee as primary for payment record (Payment model requires a single student_fee)
-                                    primary_fee = allocations[0][0] if allocations else matched_fee
-                                    overpayment_amount = remaining_amount
-                                    
-                                    logger.info(f'Allocating payment: amount={amount}, {len(allocations)} fee(s), overpayment={overpayment_amount}')
-                                    
-                                    # Use database transaction to ensure consistency
-                                    from django.db import transaction as db_transaction
-                                    
-                                    with db_transaction.atomic():
-                                        # Update all fees that will receive allocation
-                                        for fee, alloc_amount in allocations:
-                                            fee.amount_paid += Decimal(str(alloc_amount))
-                                            if fee.amount_paid >= fee.amount_charged:
-                                                fee.is_paid = True
-                                            fee.save()
-                                        
-                                        # Create payment record with the full amount; store mpesa_ref and bank_ref for duplicate detection
-                                        txn_id = (mpesa_details.get('mpesa_reference') or bank_reference or '')[:50]
-                                        payment = Payment.objects.create(
-                                            school=upload.school,
-                                            student=student,
-                                            student_fee=primary_fee,  # Primary fee for payment record
-                                            amount=amount,  # Full payment amount
-                                            payment_method='bank_transfer',
-                                            status='completed',
-                                            reference_number=payment_ref[:100],
-                                            transaction_id=txn_id,
-                                            payment_date=tz.make_aware(datetime.combine(transaction_date, datetime.min.time())),
-                                            processed_by=upload.uploaded_by,
-                                            notes=f'Auto-matched from bank statement upload: {upload.file_name}'
-                                        )
-                                        
-                                        # Create allocations for all fees (update_or_create so we overwrite the
-                                        # allocation the Payment post_save signal created for primary_fee with
-                                        # the full amount — we need the split amount per fee)
-                                        from receivables.models import PaymentAllocation
-                                        for fee, alloc_amount in allocations:
-                                            PaymentAllocation.objects.update_or_create(
-                                                school=upload.school,
-                                                payment=payment,
-                                                student_fee=fee,
-                                                defaults={
-                                                    'amount_allocated': Decimal(str(alloc_amount)),
-                                                    'created_by': upload.uploaded_by
-                                                }
-                                            )
-                                            logger.info(f'  Created/updated allocation: {alloc_amount} to fee ID {fee.id}')
-                                        
-                                        # Create credit for overpayment if any (only after allocating to all possible fees)
-                                        if overpayment_amount > 0.01:  # Only create credit if overpayment is more than 1 cent
-                                            Credit.objects.create(
-                                                school=upload.school,
-                                                student=student,
-                                                amount=Decimal(str(overpayment_amount)),
-                                                source='overpayment',
-                                                payment=payment,
-                                                description=f'Overpayment from bank statement upload: {upload.file_name}. Payment amount: {amount}, Allocated to {len(allocations)} fee(s), Remaining: {overpayment_amount}',
-                                                created_by=upload.uploaded_by
-                                            )
-                                            logger.info(f'Created credit of {overpayment_amount} for student {student_id} (remaining after allocating to {len(allocations)} fees)')
-                                    
-                                    result['matched_payments'] += 1
-                                    matched = True
-                                except Exception as payment_error:
-                                    # Log the error and create unmatched transaction
-                                    import logging
-                                    logger = logging.getLogger(__name__)
-                                    logger.error(f'Error creating payment for student {student_id}, amount {amount}: {str(payment_error)}', exc_info=True)
-                                    
-                                    # Rollback student fee update if payment creation failed
-                                    matched_fee.amount_paid = max(
-                                        Decimal('0'),
-                                        matched_fee.amount_paid - amount
-                                    )
-                                    matched_fee.is_paid = matched_fee.amount_paid >= matched_fee.amount_charged
-                                    matched_fee.save(update_fields=['amount_paid', 'is_paid'])
-                                    
-                                    # Create unmatched transaction with error note
-                                    UnmatchedTransaction.objects.create(
-                                        school=upload.school,
-                                        upload=upload,
-                                        transaction_date=transaction_date,
-                                        amount=amount,
-                                        reference_number=reference_str[:200] if reference_str else '',
-                                        bank_reference_number=bank_reference[:100] if bank_reference else None,
-                                        mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50] if mpesa_details else None,
-                                        mobile_number=mpesa_details.get('mobile_number', '')[:15] if mpesa_details else None,
-                                        extracted_student_id=student_id,
-                                        transaction_type='credit',
-                                        status='unmatched',
-                                        notes=f'Payment creation failed: {str(payment_error)}'
-                                    )
-                                    result['unmatched_payments'] += 1
-                        else:
-                            # No matching receivable found - create unmatched transaction
-                            import logging
-                            logger = logging.getLogger(__name__)
-                            logger.warning(f'No matching receivable found for student {student_id}, amount {amount}. Outstanding fees count: {outstanding_fees.count()}')
-                            for fee in outstanding_fees:
-                                outstanding = fee.amount_charged - fee.amount_paid
-                                logger.warning(f'  Fee ID {fee.id}: outstanding={outstanding}, transaction_amount={amount}, difference={abs(float(amount) - float(outstanding))}')
-                            UnmatchedTransaction.objects.create(
-                                school=upload.school,
-                                upload=upload,
-                                transaction_date=transaction_date,
-                                amount=amount,
-                                reference_number=reference_str[:200] if reference_str else '',
-                                bank_reference_number=bank_reference[:100] if bank_reference else None,
-                                mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50] if mpesa_details else None,
-                                mobile_number=mpesa_details.get('mobile_number', '')[:15] if mpesa_details else None,
-                                extracted_student_id=student_id,
-                                transaction_type='credit',
-                                status='unmatched',
-                                notes=f'No matching receivable found. Student has {outstanding_fees.count()} outstanding fee(s) but amounts do not match.'
-                            )
-                            result['unmatched_payments'] += 1
-                except Student.DoesNotExist:
-                    # Create unmatched transaction record - student not found
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.warning(f'Student not found: student_id={student_id}, school={upload.school.name}')
-                    UnmatchedTransaction.objects.create(
-                        school=upload.school,
-                        upload=upload,
-                        transaction_date=transaction_date,
-                        amount=amount,
-                        reference_number=reference_str[:200] if reference_str else '',
-                        bank_reference_number=bank_reference[:100] if bank_reference else None,
-                        mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50] if mpesa_details else None,
-                        mobile_number=mpesa_details.get('mobile_number', '')[:15] if mpesa_details else None,
-                        extracted_student_id=student_id,
-                        transaction_type='credit',
-                        status='unmatched',
-                        notes=f'Student with ID {student_id} not found in school {upload.school.name}'
-                    )
-                    result['unmatched_payments'] += 1
-            else:
-                # Create unmatched transaction record - no student ID extracted
-                UnmatchedTransaction.objects.create(
-                    school=upload.school,
-                    upload=upload,
-                    transaction_date=transaction_date,
-                    amount=amount,
-                    reference_number=reference_str[:200] if reference_str else '',
-                    bank_reference_number=bank_reference[:100] if bank_reference else None,
-                    mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50] if mpesa_details else None,
-                    mobile_number=mpesa_details.get('mobile_number', '')[:15] if mpesa_details else None,
-                    extracted_student_id=None,
-                    transaction_type='credit',
-                    status='unmatched'
-                )
-                result['unmatched_payments'] += 1
-            
-            result['transactions'].append({
-                'transaction_id': f"{upload.id}-{line_num}",
-                'student_id': student_id,
-                'amount': float(amount),
-                'payment_date': transaction_date.isoformat(),
-                'narrative': reference_str,
-                'status': 'Matched' if matched else 'Unmatched'
-            })
-            
-        except Exception as e:
-            # Log the error for debugging
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f'Error processing bank statement line {line_num}: {str(e)}', exc_info=True)
-            # Create unmatched transaction for error cases
-            try:
-                UnmatchedTransaction.objects.create(
-                    school=upload.school,
-                    upload=upload,
-                    transaction_date=transaction_date if 'transaction_date' in locals() else timezone.now().date(),
-                    amount=amount if 'amount' in locals() else Decimal('0.00'),
-                    reference_number=reference_str[:200] if 'reference_str' in locals() and reference_str else '',
-                    bank_reference_number=bank_reference[:100] if 'bank_reference' in locals() and bank_reference else None,
-                    mpesa_reference=mpesa_details.get('mpesa_reference', '')[:50] if 'mpesa_details' in locals() and mpesa_details else None,
-                    mobile_number=mpesa_details.get('mobile_number', '')[:15] if 'mpesa_details' in locals() and mpesa_details else None,
-                    extracted_student_id=student_id if 'student_id' in locals() else None,
-                    transaction_type='credit',
-                    status='unmatched',
-                    notes=f'Error during processing: {str(e)}'
-                )
-                result['unmatched_payments'] += 1
-            except Exception as create_error:
-                logger.error(f'Failed to create unmatched transaction: {str(create_error)}')
-            continue
-    
-    return result
+def process_bank_statement(upload, statement_file, pattern, progress=None):
+    """Process bank statement file and match payments (see BankStatementReconciler)"""
+    from .statement_reconciler import BankStatementReconciler
+    return BankStatementReconciler(upload, pattern, progress=progress).process(statement_file)
 
 
 def extract_column_value(row, column_spec):
@@ -2792,11 +2108,9 @@ def unmatched_transaction_match(request, transaction_id):
         student_fee_id = request.POST.get('student_fee_id')  # Optional: specific fee to allocate to
         
         try:
+            from datetime import datetime
             from django.db import transaction as db_transaction
             from django.utils import timezone as tz
-            from receivables.models import Credit, PaymentAllocation
-            from core.models import StudentFee
-            from django.db.models import F
             
             if payment_id:
                 # Match to existing payment
@@ -2807,6 +2121,17 @@ def unmatched_transaction_match(request, transaction_id):
             elif student_id:
                 # Match to student - create payment and handle allocation/credits
                 student = Student.objects.get(school=school, student_id=student_id)
+                
+                # Refuse to record the same bank/M-Pesa reference as a second payment
+                transaction_refs = [ref for ref in (transaction.mpesa_reference, transaction.bank_reference_number) if ref]
+                if transaction_refs and PaymentReference.objects.filter(
+                    school=school,
+                    reference__in=[PaymentReference.normalize(ref) for ref in transaction_refs],
+                    payment__isnull=False
+                ).exists():
+                    messages.error(request, 'A payment with this transaction reference has already been recorded.')
+                    return redirect('receivables:unmatched_transaction_detail', transaction_id=transaction.get_signed_token())
+                
                 transaction.matched_student = student
                 
                 with db_transaction.atomic():
@@ -2815,90 +2140,37 @@ def unmatched_transaction_match(request, transaction_id):
                     if transaction.mpesa_reference:
                         payment_ref = f"M-Pesa: {transaction.mpesa_reference} - {payment_ref}"
                     
-                    # Check for outstanding receivables
-                    outstanding_fees = StudentFee.objects.filter(
-                        school=school,
-                        student=student,
-                        amount_charged__gt=F('amount_paid')
-                    ).select_related('fee_category').order_by('due_date', 'created_at')
-                    
-                    payment = None
-                    total_outstanding = sum(float(fee.amount_charged - fee.amount_paid) for fee in outstanding_fees)
-                    
+                    allocation_service = AllocationService(school, user=request.user)
+                    matched_fee = None
                     if student_fee_id:
                         # Allocate to specific fee
                         matched_fee = StudentFee.objects.get(id=student_fee_id, school=school, student=student)
-                        outstanding_amount = matched_fee.amount_charged - matched_fee.amount_paid
-                        amount_to_allocate = min(float(transaction.amount), float(outstanding_amount))
-                        overpayment_amount = float(transaction.amount) - amount_to_allocate
-                        
-                        # Update fee
-                        matched_fee.amount_paid += Decimal(str(amount_to_allocate))
-                        if matched_fee.amount_paid >= matched_fee.amount_charged:
-                            matched_fee.is_paid = True
-                        matched_fee.save()
-                        
-                        # Create payment
-                        payment = Payment.objects.create(
-                            school=school,
-                            student=student,
-                            student_fee=matched_fee,
+                        allocation = AllocationRequest(
+                            student_id=student.id,
                             amount=transaction.amount,
-                            payment_method='bank_transfer',
-                            status='completed',
-                            reference_number=payment_ref[:100],
-                            transaction_id=transaction.mpesa_reference[:50] if transaction.mpesa_reference else '',
-                            payment_date=tz.make_aware(datetime.combine(transaction.transaction_date, datetime.min.time())),
-                            processed_by=request.user,
-                            notes=f'Matched from unmatched transaction: {transaction.reference_number[:50]}'
-                        )
-                        
-                        # Create allocation
-                        PaymentAllocation.objects.get_or_create(
-                            school=school,
-                            payment=payment,
-                            student_fee=matched_fee,
-                            defaults={
-                                'amount_allocated': Decimal(str(amount_to_allocate)),
-                                'created_by': request.user
-                            }
+                            preferred_fee_id=matched_fee.id,
+                            preferred_only=True,
                         )
-                        
-                        # Create credit for overpayment if any
-                        if overpayment_amount > 0.01:
-                            Credit.objects.create(
-                                school=school,
-                                student=student,
-                                amount=Decimal(str(overpayment_amount)),
-                                source='overpayment',
-                                payment=payment,
-                                description=f'Overpayment from unmatched transaction match. Payment amount: {transaction.amount}, Fee outstanding: {outstanding_amount}',
-                                created_by=request.user
-                            )
-                            messages.success(request, f'Payment of KES {transaction.amount} matched. KES {amount_to_allocate} allocated to fee, KES {overpayment_amount} credited.')
-                        else:
-                            messages.success(request, f'Payment of KES {transaction.amount} matched and allocated to fee.')
+                    else:
+                        # Allocate by fee category allocation_order, then due_date
+                        allocation = AllocationRequest(student_id=student.id, amount=transaction.amount)
+                    plan = allocation_service.allocate([allocation], lock=True)[0]
+                    
+                    # Payment requires a student_fee: the first fee allocated to, else the
+                    # selected fee, else the most recent fee (even if paid)
+                    if plan.allocations:
+                        payment_fee = plan.allocations[0][0]
+                    else:
+                        payment_fee = matched_fee or StudentFee.objects.filter(
+                            school=school, student=student
+                        ).order_by('-created_at').first()
                     
-                    elif outstanding_fees.exists():
-                        # Allocate to the fee that comes first by allocation_order (fee category), then due_date
-                        _order_key = lambda f: (getattr(f.fee_category, 'allocation_order', 999), f.due_date)
-                        fees_sorted = sorted(outstanding_fees, key=_order_key)
-                        matched_fee = fees_sorted[0]
-                        outstanding_amount = matched_fee.amount_charged - matched_fee.amount_paid
-                        amount_to_allocate = min(float(transaction.amount), float(outstanding_amount))
-                        overpayment_amount = float(transaction.amount) - amount_to_allocate
-                        
-                        # Update fee
-                        matched_fee.amount_paid += Decimal(str(amount_to_allocate))
-                        if matched_fee.amount_paid >= matched_fee.amount_charged:
-                            matched_fee.is_paid = True
-                        matched_fee.save()
-                        
-                        # Create payment
-                        payment = Payment.objects.create(
+                    payment = None
+                    if payment_fee:
+                        payment = Payment(
                             school=school,
                             student=student,
-                            student_fee=matched_fee,
+                            student_fee=payment_fee,
                             amount=transaction.amount,
                             payment_method='bank_transfer',
                             status='completed',
@@ -2906,69 +2178,25 @@ def unmatched_transaction_match(request, transaction_id):
                             transaction_id=transaction.mpesa_reference[:50] if transaction.mpesa_reference else '',
                             payment_date=tz.make_aware(datetime.combine(transaction.transaction_date, datetime.min.time())),
                             processed_by=request.user,
-                            notes=f'Matched from unmatched transaction: {transaction.reference_number[:50]}'
+                            notes=(
+                                f'Matched from unmatched transaction: {transaction.reference_number[:50]}' if plan.allocations
+                                else f'Matched from unmatched transaction (no outstanding fees): {transaction.reference_number[:50]}'
+                            )
                         )
-                        
-                        # Create allocation
-                        PaymentAllocation.objects.get_or_create(
-                            school=school,
-                            payment=payment,
-                            student_fee=matched_fee,
-                            defaults={
-                                'amount_allocated': Decimal(str(amount_to_allocate)),
-                                'created_by': request.user
-                            }
+                        # bulk_create skips the post_save signal that would allocate the whole
+                        # amount to one fee; allocations come from the plan instead
+                        Payment.objects.bulk_create([payment])
+                        register_payment_references(
+                            school, payment_external_references(payment.transaction_id, payment.reference_number),
+                            payment=payment, source='payment'
                         )
-                        
-                        # Create credit for overpayment if any
-                        if overpayment_amount > 0.01:
-                            Credit.objects.create(
-                                school=school,
-                                student=student,
-                                amount=Decimal(str(overpayment_amount)),
-                                source='overpayment',
-                                payment=payment,
-                                description=f'Overpayment from unmatched transaction match. Payment amount: {transaction.amount}, Fee outstanding: {outstanding_amount}',
-                                created_by=request.user
-                            )
-                            messages.success(request, f'Payment of KES {transaction.amount} matched. KES {amount_to_allocate} allocated to fee, KES {overpayment_amount} credited.')
-                        else:
-                            messages.success(request, f'Payment of KES {transaction.amount} matched and allocated to fee.')
-                    
+                        allocation_service.commit([plan], payments=[payment])
                     else:
+                        # Student has no fees at all - we can't create a payment without a student_fee
+                        messages.warning(request, 'Student has no fees. Creating credit only.')
+                    
+                    if not plan.allocations:
                         # No outstanding receivables - create credit for full amount
-                        # Find any fee for the student (for payment record requirement) or create a dummy allocation
-                        # Since Payment requires student_fee, we'll use the most recent fee or create a special handling
-                        any_fee = StudentFee.objects.filter(school=school, student=student).order_by('-created_at').first()
-                        
-                        if any_fee:
-                            # Use the most recent fee (even if paid) for the payment record
-                            payment = Payment.objects.create(
-                                school=school,
-                                student=student,
-                                student_fee=any_fee,
-                                amount=transaction.amount,
-                                payment_method='bank_transfer',
-                                status='completed',
-                                reference_number=payment_ref[:100],
-                                transaction_id=transaction.mpesa_reference[:50] if transaction.mpesa_reference else '',
-                                payment_date=tz.make_aware(datetime.combine(transaction.transaction_date, datetime.min.time())),
-                                processed_by=request.user,
-                                notes=f'Matched from unmatched transaction (no outstanding fees): {transaction.reference_number[:50]}'
-                            )
-                            
-                            # Don't create allocation - full amount goes to credit
-                        else:
-                            # Student has no fees at all - this shouldn't happen but handle it
-                            # We can't create a payment without a student_fee, so create a credit directly
-                            # But we still need a payment record for tracking
-                            # Create a minimal payment record with a note
-                            from core.models import FeeCategory, Term
-                            # This is a fallback - ideally student should have fees
-                            messages.warning(request, 'Student has no fees. Creating credit only.')
-                            payment = None
-                        
-                        # Create credit for full amount
                         Credit.objects.create(
                             school=school,
                             student=student,
@@ -2982,9 +2210,29 @@ def unmatched_transaction_match(request, transaction_id):
                             messages.success(request, f'Payment of KES {transaction.amount} matched. No outstanding fees found - full amount credited for future application.')
                         else:
                             messages.success(request, f'Credit of KES {transaction.amount} created. No payment record created (student has no fees).')
+                    elif plan.has_remainder:
+                        # Create credit for overpayment
+                        Credit.objects.create(
+                            school=school,
+                            student=student,
+                            amount=plan.remainder,
+                            source='overpayment',
+                            payment=payment,
+                            description=f'Overpayment from unmatched transaction match. Payment amount: {transaction.amount}, Allocated to {len(plan.allocations)} fee(s): {plan.applied}',
+                            created_by=request.user
+                        )
+                        messages.success(request, f'Payment of KES {transaction.amount} matched. KES {plan.applied} allocated to fee(s), KES {plan.remainder} credited.')
+                    else:
+                        messages.success(request, f'Payment of KES {transaction.amount} matched and allocated to fee(s).')
                     
                     # Link transaction to payment
                     transaction.matched_payment = payment
+                    if payment and transaction_refs:
+                        PaymentReference.objects.filter(
+                            school=school,
+                            reference__in=[PaymentReference.normalize(ref) for ref in transaction_refs],
+                            payment__isnull=True
+                        ).update(payment=payment)
             
             # Update notes if provided
             notes = request.POST.get('notes', '')
@@ -3078,6 +2326,26 @@ def unmatched_transaction_delete(request, transaction_id):
 
 # ==================== API Views for Receivables ====================
 
+@login_required
+@permission_required('view', 'fee')
+def api_receivable_sync(request):
+    """
+    Drift check for the school's receivables
+    
+    GET returns how many StudentFee rows have a missing or out-of-date
+    Receivable; POST repairs them with a set-based sync and returns the counts.
+    """
+    from .receivable_sync import sync_receivables, receivable_drift
+    school = request.user.profile.school
+    
+    if request.method == 'POST':
+        if not request.user.profile.has_permission('change', 'fee'):
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+        created, updated = sync_receivables(school)
+        return JsonResponse({'created': created, 'updated': updated, **receivable_drift(school)})
+    return JsonResponse(receivable_drift(school))
+
+
 @login_required
 @csrf_exempt
 def api_receivable_allocations(request, receivable_id):
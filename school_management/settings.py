@@ -85,7 +85,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'core.middleware.OptimizeUserProfileMiddleware',  # Optimize profile queries
+    'core.middleware.RequestIdentityMiddleware',  # Resolve profile, school, roles and parent once
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -340,6 +340,12 @@ CELCOM_API_KEY = config('CELCOM_API_KEY', default='')
 CELCOM_PARTNER_ID = config('CELCOM_PARTNER_ID', default='')
 CELCOM_SHORTCODE = config('CELCOM_SHORTCODE', default='')
 CELCOM_COMPANY_PHONE = config('CELCOM_COMPANY_PHONE', default='')
+# Multi-message endpoint used for bulk SMS; bulk sends fall back to sendsms when unset
+CELCOM_URL_SENDBULK = config('CELCOM_URL_SENDBULK', default='')
+SMS_BULK_BATCH_SIZE = config('SMS_BULK_BATCH_SIZE', default=20, cast=int)
+SMS_DISPATCH_CONCURRENCY = config('SMS_DISPATCH_CONCURRENCY', default=4, cast=int)
+SMS_DISPATCH_RATE_PER_SECOND = config('SMS_DISPATCH_RATE_PER_SECOND', default=10, cast=float)
+SMS_HTTP_TIMEOUT = config('SMS_HTTP_TIMEOUT', default=15, cast=int)
 
 # M-Pesa settings
 MPESA_CONSUMER_KEY = config('MPESA_CONSUMER_KEY', default='')
@@ -348,6 +354,24 @@ MPESA_BUSINESS_SHORT_CODE = config('MPESA_BUSINESS_SHORT_CODE', default='')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
 MPESA_ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')  # sandbox or live
 
+# Background job worker (python manage.py run_jobs)
+JOB_QUEUE_WORKERS = config('JOB_QUEUE_WORKERS', default=2, cast=int)
+
+# Email outbox (bulk emails are queued and sent by the drain_email_outbox job)
+EMAIL_OUTBOX_BATCH_SIZE = config('EMAIL_OUTBOX_BATCH_SIZE', default=50, cast=int)
+EMAIL_OUTBOX_MAX_ATTEMPTS = config('EMAIL_OUTBOX_MAX_ATTEMPTS', default=3, cast=int)
+EMAIL_OUTBOX_RATE_PER_SECOND = config('EMAIL_OUTBOX_RATE_PER_SECOND', default=5, cast=float)
+
+# E-statement PDF rendering (communications.statement_renderer)
+STATEMENT_RENDER_WORKERS = config('STATEMENT_RENDER_WORKERS', default=2, cast=int)
+
+# Receivables reporting cube (receivables.report_cube): seconds between checks for flagged partitions per school
+REPORT_CUBE_REFRESH_INTERVAL = config('REPORT_CUBE_REFRESH_INTERVAL', default=60, cast=int)
+
+# Term calendar (core.term_calendar): seconds a worker keeps its copy of a school's terms
+# when the cache is not shared between workers
+TERM_CALENDAR_MAX_AGE = config('TERM_CALENDAR_MAX_AGE', default=300, cast=int)
+
 # Session settings
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_AGE = 3600  # 1 hour in seconds
@@ -385,4 +409,7 @@ MPESA_CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
 MPESA_SHORTCODE = config('MPESA_SHORTCODE', default='')
 MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='https://your-domain.com/core/api/mpesa/callback/')
-MPESA_ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')  # 'sandbox' or 'production'
\ No newline at end of file
+MPESA_ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')  # 'sandbox' or 'production'
+# OAuth tokens are cached (core.daraja) and refreshed this many seconds before they expire
+MPESA_TOKEN_REFRESH_MARGIN = config('MPESA_TOKEN_REFRESH_MARGIN', default=300, cast=int)
+MPESA_HTTP_POOL_SIZE = config('MPESA_HTTP_POOL_SIZE', default=4, cast=int)
\ No newline at end of file